@@ -14,7 +14,9 @@ from django.core.mail import mail_admins
 from grades.models import LetterActivity
 from grad.models import GradStudent, STATUS_ACTIVE, STATUS_APPLICANT, STATUS_GPA
 from ra.models import RAAppointment
-import itertools, random
+import itertools, random, logging
+
+logger = logging.getLogger(__name__)
 
 today = datetime.date.today()
 past_cutoff = today - datetime.timedelta(days=30)
@@ -276,6 +278,7 @@ def _person_save(p):
 imported_people = {}
 IMPORT_THRESHOLD = 3600*24*7 # import personal info infrequently
 NO_USERID_IMPORT_THRESHOLD = 3600*24*2 # import if we don't know their userid yet
+PEOPLE_BATCH_SIZE = 500 # emplids per query when fetching people in bulk
 def get_person(emplid, commit=True, force=False, grad_data=False):
     """
     Get/update personal info for this emplid and return (updated & saved) Person object.
@@ -296,6 +299,21 @@ def get_person(emplid, commit=True, force=False, grad_data=False):
         p = Person(emplid=emplid)
     imported_people[emplid] = p
 
+    if not _person_import_due(p, force=force):
+        return p
+
+    # actually import their data
+    new_p = import_person(p, commit=commit, grad_data=grad_data)
+    if new_p:
+        return new_p
+    elif p_old:
+        return p
+
+
+def _person_import_due(p, force=False):
+    """
+    Is it time to (re)import this Person's data from SIMS?
+    """
     if 'lastimport' in p.config:
         import_age = time.time() - p.config['lastimport']
     else:
@@ -303,24 +321,36 @@ def get_person(emplid, commit=True, force=False, grad_data=False):
 
     # active students with no userid: pay more attention to try to get their userid for login/email.
     if p.userid is None and import_age > NO_USERID_IMPORT_THRESHOLD:
-        new_p = import_person(p, commit=commit, grad_data=grad_data)
-        if new_p:
-            return new_p
-        elif p_old:
-            return p
+        return True
 
     # only import if data is older than IMPORT_THRESHOLD (unless forced)
     # Randomly occasionally import anyway, so new students don't stay bunched-up.
-    elif not force and import_age < IMPORT_THRESHOLD and random.random() < 0.99:
-        return p
+    return force or import_age >= IMPORT_THRESHOLD or random.random() >= 0.99
 
-    # actually import their data
-    else:
-        new_p = import_person(p, commit=commit, grad_data=grad_data)
-        if new_p:
-            return new_p
-        elif p_old:
-            return p
+
+def get_people(emplids, commit=True):
+    """
+    Like get_person, for many people at once: returns dict of emplid -> Person.
+
+    Existing Person objects are fetched in bulk; get_person (and its SIMS query) is only used for people who are new or
+    due for a refresh.
+    """
+    emplids = set(int(e) for e in emplids)
+    people = {e: imported_people[e] for e in emplids if e in imported_people}
+
+    todo = list(emplids - people.keys())
+    for i in range(0, len(todo), PEOPLE_BATCH_SIZE):
+        for p in Person.objects.filter(emplid__in=todo[i:i+PEOPLE_BATCH_SIZE]):
+            if not _person_import_due(p):
+                imported_people[p.emplid] = p
+                people[p.emplid] = p
+
+    for e in emplids - people.keys():
+        p = get_person(e, commit=commit)
+        if p:
+            people[e] = p
+
+    return people
 
 
 def get_person_grad(emplid, commit=True, force=False):
@@ -562,22 +592,32 @@ def import_offering_members(offering, students=True):
 # Refactored logic to replace import_offering_members
 
 
-def import_semester_offerings(strm, students=True, extra_where='1=1'):
-    offering_map = crseid_offering_map(strm)
+def import_semester_offerings(strm, students=True, extra_where='1=1', slugs=None):
+    """
+    Import all data for the semester's offerings (or those with these slugs): instructors, students, meeting times.
+    """
+    offering_map = crseid_offering_map(strm, slugs=slugs)
 
     import_all_instructors(strm, extra_where=extra_where, offering_map=offering_map)
     if students:
-        import_all_students(strm, extra_where=extra_where, offering_map=offering_map)
+        counts, timings = import_all_students(strm, extra_where=extra_where, offering_map=offering_map)
+        for slug, c in sorted(counts.items()):
+            logger.info('%s: %i added, %i dropped, %i changed' % (slug, c['add'], c['drop'], c['change']))
+        logger.info('student import for %s: %s' % (strm, ', '.join('%s %.1fs' % (k, v) for k, v in timings.items())))
     import_all_meeting_times(strm, extra_where=extra_where, offering_map=offering_map)
 
 
-def crseid_offering_map(strm):
+def crseid_offering_map(strm, slugs=None):
     '''
     Map things-from-SIMS to CourseOfferings we have, to lookup quickly later.
+
+    Combined offerings aren't in SIMS, so are left out.
     '''
-    # TODO: evaluate this for .select_related
-    return {(o.semester.name, "%06i" % (int(o.crse_id)), o.section): o
-            for o in CourseOffering.objects.filter(semester__name=strm)}
+    offerings = CourseOffering.objects.filter(semester__name=strm, crse_id__isnull=False) \
+        .exclude(flags=CourseOffering.flags.combined).select_related('semester')
+    if slugs is not None:
+        offerings = offerings.filter(slug__in=slugs)
+    return {(o.semester.name, "%06i" % (int(o.crse_id)), o.section): o for o in offerings}
 
 
 @transaction.atomic
@@ -585,7 +625,7 @@ def import_all_instructors(strm, extra_where='1=1', offering_map=None):
     if not offering_map:
         offering_map = crseid_offering_map(strm)
 
-    Member.objects.filter(added_reason="AUTO", offering__semester__name=strm, role="INST").update(role='DROP')
+    Member.objects.filter(added_reason="AUTO", offering__in=offering_map.values(), role="INST").update(role='DROP')
     db = SIMSConn()
     db.execute("SELECT CRSE_ID, CLASS_SECTION, STRM, EMPLID, INSTR_ROLE, SCHED_PRINT_INSTR FROM PS_CLASS_INSTR WHERE " \
                "STRM=%s AND INSTR_ROLE IN ('PI', 'SI') AND " + extra_where,
@@ -599,17 +639,156 @@ def import_all_instructors(strm, extra_where='1=1', offering_map=None):
         ensure_member(p, offering, "INST", 0, "AUTO", "NONS", sched_print_instr=sched_print_instr)
 
 
+MEMBER_BATCH_SIZE = 1000 # rows per INSERT/UPDATE when writing Members in bulk
+IGNORED_EMPLIDS = [200133427, 200133425, 200133426] # these are: ["Faculty", "Tba", "Sessional"]. Ignore them: they're ugly.
+
 @transaction.atomic
 def import_all_students(strm, extra_where='1=1', offering_map=None):
+    """
+    Set-based replacement for import_students on every offering in the semester: fetch the enrolments from SIMS and
+    the existing Members from our DB (one query each), diff them in memory, and write the changes in bulk.
+
+    extra_where may refer to the class table as C.
+
+    Returns (counts, timings): counts is {offering.slug: {'add': n, 'drop': n, 'change': n}} for the offerings that
+    changed, and timings is {phase: seconds}.
+    """
+    timings = {}
+    start = time.time()
     if not offering_map:
         offering_map = crseid_offering_map(strm)
+    offerings = {o.id: o for o in offering_map.values()}
 
-    Member.objects.filter(added_reason="AUTO", offering__semester__name=strm, role="STUD").update(role='DROP')
     db = SIMSConn()
+    # lab/tutorial sections: as in import_students, students in sections C2 related to lecture section C1
+    db.execute("SELECT C1.CRSE_ID, C1.CLASS_SECTION, C1.STRM, S.EMPLID, C2.CLASS_SECTION "
+               "FROM PS_CLASS_TBL C1, PS_CLASS_TBL C2, PS_STDNT_ENRL S "
+               "WHERE C1.SUBJECT=C2.SUBJECT AND C1.CATALOG_NBR=C2.CATALOG_NBR AND C2.STRM=C1.STRM "
+               "AND S.CLASS_NBR=C2.CLASS_NBR AND S.STRM=C2.STRM AND S.ENRL_STATUS_REASON IN ('ENRL','EWAT') "
+               "AND C1.STRM=%s AND C2.CLASS_SECTION LIKE LEFT(C1.CLASS_SECTION, 2)+'%%' "
+               "AND C2.CLASS_SECTION<>C1.CLASS_SECTION", (strm,))
+    labtut = {}
+    for crse_id, class_section, strm_, emplid, section in db:
+        labtut[(crse_id, class_section, int(emplid))] = section
+
+    # actual enrolments
+    db.execute("SELECT C.CRSE_ID, C.CLASS_SECTION, C.STRM, E.EMPLID, E.ACAD_CAREER, E.UNT_TAKEN, E.CRSE_GRADE_OFF, "
+               "R.CRSE_GRADE_INPUT "
+               "FROM PS_STDNT_ENRL E JOIN PS_CLASS_TBL C ON E.CLASS_NBR=C.CLASS_NBR AND E.STRM=C.STRM "
+               "LEFT JOIN PS_GRADE_ROSTER R "
+               "ON E.STRM=R.STRM AND E.ACAD_CAREER=R.ACAD_CAREER AND E.EMPLID=R.EMPLID AND E.CLASS_NBR=R.CLASS_NBR "
+               "WHERE E.STRM=%s AND E.STDNT_ENRL_STATUS='E' AND E.ENRL_STATUS_REASON IN ('ENRL','EWAT') "
+               "AND (" + extra_where + ")", (strm,))
+    enrolments = {}
+    for crse_id, class_section, strm_, emplid, acad_career, unt_taken, grade_official, grade_roster in db.rows():
+        offering = offering_map.get((strm_, crse_id, class_section))
+        emplid = int(emplid)
+        if not offering or emplid in IGNORED_EMPLIDS:
+            continue
+        sec = labtut.get((crse_id, class_section, emplid), None)
+        enrolments[(emplid, offering.id)] = (acad_career, unt_taken, grade_official or grade_roster, sec)
+
+    # drop dates, so the discipline app can display "students who have dropped, but not too long ago".
+    db.execute("SELECT C.CRSE_ID, C.CLASS_SECTION, C.STRM, E.EMPLID, E.ENRL_DROP_DT "
+               "FROM PS_STDNT_ENRL E JOIN PS_CLASS_TBL C ON E.CLASS_NBR=C.CLASS_NBR AND E.STRM=C.STRM "
+               "WHERE E.STRM=%s AND E.ENRL_STATUS_REASON NOT IN ('ENRL','EWAT') AND E.ENRL_DROP_DT IS NOT NULL "
+               "AND (" + extra_where + ")", (strm,))
+    drop_dates = {}
+    for crse_id, class_section, strm_, emplid, drop_dt in db:
+        offering = offering_map.get((strm_, crse_id, class_section))
+        if offering:
+            drop_dates[(int(emplid), offering.id)] = drop_dt.isoformat()
+    timings['sims'] = time.time() - start
+
+    # everything we know about the semester's memberships
+    start = time.time()
+    people = get_people(e for e, _ in enrolments)
+    existing = {}
+    for m in Member.objects.filter(offering__semester__name=strm).select_related('person'):
+        if m.offering_id not in offerings:
+            continue
+        existing.setdefault((m.person.emplid, m.offering_id), []).append(m)
+    letter_offerings = set(LetterActivity.objects.filter(offering__semester__name=strm, deleted=False)
+                           .values_list('offering_id', flat=True))
+    timings['fetch'] = time.time() - start
+
+    # diff SIMS against our Members
+    start = time.time()
+    counts = {}
+    def count(offering_id, what):
+        c = counts.setdefault(offerings[offering_id].slug, {'add': 0, 'drop': 0, 'change': 0})
+        c[what] += 1
+
+    new_members = []
+    changed_members = {}
+    labtut_offerings = set()
+    for (emplid, offering_id), (career, cred, grade, sec) in enrolments.items():
+        person = people.get(emplid)
+        if person is None:
+            continue
+        ms = existing.get((emplid, offering_id), [])
+        if len(ms) > 1:
+            # may be other manually-created dropped entries: that's okay.
+            ms = [m for m in ms if m.role != 'DROP'] or ms
+        if len(ms) > 1:
+            logger.warning("Already duplicate entries: %r" % (ms,))
+            continue
+
+        if ms:
+            m = ms[0]
+            was_student = m.role == 'STUD'
+        else:
+            m = Member(person=person, offering=offerings[offering_id])
+            was_student = False
+
+        m.role = 'STUD'
+        m.labtut_section = sec
+        m.credits = cred
+        m.added_reason = 'AUTO'
+        m.career = career
+        # record official grade if we have it (and might need it)
+        m.official_grade = (grade or None) if offering_id in letter_offerings else None
+        if sec:
+            labtut_offerings.add(offering_id)
+
+        if not m.id:
+            if (emplid, offering_id) in drop_dates:
+                # dropped and re-enrolled
+                m.config['drop_date'] = drop_dates[(emplid, offering_id)]
+            new_members.append(m)
+            count(offering_id, 'add')
+        elif m.is_dirty():
+            changed_members[m.id] = m
+            count(offering_id, 'change' if was_student else 'add')
+
+    # students no longer enrolled (only when we have seen all of the enrolments)
+    for (emplid, offering_id), ms in existing.items():
+        for m in ms:
+            if extra_where == '1=1' and m.added_reason == 'AUTO' and m.role == 'STUD' \
+                    and (emplid, offering_id) not in enrolments:
+                m.role = 'DROP'
+                count(offering_id, 'drop')
+            if (emplid, offering_id) in drop_dates:
+                m.config['drop_date'] = drop_dates[(emplid, offering_id)]
+            if m.is_dirty():
+                changed_members[m.id] = m
+    timings['diff'] = time.time() - start
+
+    # write it all
+    start = time.time()
+    Member.objects.bulk_create(new_members, batch_size=MEMBER_BATCH_SIZE)
+    Member.objects.bulk_update(changed_members.values(), ['role', 'labtut_section', 'credits', 'added_reason', 'career',
+                                                 'official_grade', 'config'], batch_size=MEMBER_BATCH_SIZE)
 
-    # TODO: remainder of this function not yet refactored. Needs to be broken up since >200k registrations shouldn't be
-    # processed at once.
+    # if offering is being given lab/tutorial sections, flag it as having them
+    for offering_id in labtut_offerings:
+        offering = offerings[offering_id]
+        if not offering.labtut():
+            offering.set_labtut(True)
+            offering.save_if_dirty()
+    timings['write'] = time.time() - start
 
+    return counts, timings
 
 
 @transaction.atomic
@@ -667,7 +846,7 @@ def import_all_meeting_times(strm, extra_where='1=1', offering_map=None):
 
     # delete any meeting times we haven't found in the DB
     if extra_where == '1=1':
-        MeetingTime.objects.filter(offering__semester__name=strm).exclude(id__in=found_mtg).delete()
+        MeetingTime.objects.filter(offering__in=offering_map.values()).exclude(id__in=found_mtg).delete()
 
 
 @transaction.atomic
@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coredata', '0027_auto_20250827_1659'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchIndexChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100)),
+                ('object_pk', models.CharField(max_length=100)),
+                ('time', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
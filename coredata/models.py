@@ -1992,4 +1992,18 @@ class EnrolmentHistory(models.Model):
             other.enrl_drp = self.enrl_drp
             other.wait_drp = self.wait_drp
             other.wait_add = self.wait_add
-            other.save()
\ No newline at end of file
+            other.save()
+
+class SearchIndexChange(models.Model):
+    """
+    Journal of changes to objects with a Haystack SearchIndex: recorded by courselib.search.JournalSignalProcessor when
+    they're saved/deleted, and consumed (and deleted) by courselib.search.consume_index_journal.
+
+    An object can appear many times: the consumer indexes it once.
+    """
+    model = models.CharField(max_length=100, null=False)  # model's label, like "coredata.person"
+    object_pk = models.CharField(max_length=100, null=False)
+    time = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return '%s %s' % (self.model, self.object_pk)
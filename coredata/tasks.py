@@ -2,6 +2,7 @@ import os
 from typing import Optional, Iterable, Type
 
 from django.conf import settings
+from django.core.cache import cache
 from django.db import models
 from haystack.exceptions import NotHandled
 from haystack.utils import loading
@@ -11,6 +12,7 @@ from coredata.csrpt import refresh_csrpt_auth
 from coredata.queries import SIMSConn, SIMSProblem
 from django.core.management import call_command
 from courselib.celerytasks import task
+from courselib.search import consume_index_journal, index_journal_lag, INDEX_JOURNAL_MAX_CHANGES
 from coredata.models import Role, Unit, EnrolmentHistory
 import celery
 
@@ -174,7 +176,7 @@ logger = logging.getLogger(__name__)
 from django.conf import settings
 from coredata.models import CourseOffering, Member
 from dashboard.models import NewsItem
-from log.models import LogEntry, EventLogEntry
+from log.models import LogEntry, EventLogEntry, MonitoringDataLog
 from coredata import importer
 import itertools, datetime, time
 import logging
@@ -248,7 +250,7 @@ def import_offerings(continue_import=False):
 
 def get_import_offerings_tasks():
     """
-    Get all of the offerings to import, and build tasks (in groups) to do the work.
+    Get all of the offerings to import, and build tasks (one per semester) to do the work.
 
     Doesn't actually call the jobs: just returns celery tasks to be called.
     """
@@ -257,26 +259,24 @@ def get_import_offerings_tasks():
     offerings = list(offerings)
     offerings.sort()
 
-    offering_groups = grouper(offerings, 10)
-    slug_groups = ([o.slug for o in offerings] for offerings in offering_groups)
-
-    #tasks = [import_offering_group.si(slugs) for slugs in slug_groups]
-    #return tasks
+    # all of a semester's members are imported at once: see importer.import_semester_offerings
+    semester_slugs = {}
+    for o in offerings:
+        semester_slugs.setdefault(o.semester.name, []).append(o.slug)
 
-    offering_import_chain = celery.chain(*[import_offering_group.si(slugs) for slugs in slug_groups])
+    offering_import_chain = celery.chain(*[import_semester_members.si(strm, slugs)
+                                           for strm, slugs in sorted(semester_slugs.items())])
     return offering_import_chain
 
 from requests.exceptions import Timeout
 @task(bind=True, queue='sims', default_retry_delay=300)
-def import_offering_group(self, slugs):
-    offerings = CourseOffering.objects.filter(slug__in=slugs)
-    for o in offerings:
-        logger.debug('Importing %s' % (o.slug,))
-        try:
-            importer.import_offering_members(o)
-        except Timeout as exc:
-            # elasticsearch timeout: have celery pause while it collects it thoughts, and retry
-            raise self.retry(exc=exc)
+def import_semester_members(self, strm, slugs):
+    logger.debug('Importing members for %s' % (strm,))
+    try:
+        importer.import_semester_offerings(strm, slugs=slugs)
+    except Timeout as exc:
+        # elasticsearch timeout: have celery pause while it collects it thoughts, and retry
+        raise self.retry(exc=exc)
 
 
 @task(queue='sims')
@@ -374,6 +374,37 @@ def haystack_rebuild():
     our_update_index.delay(update_only=False)
 
 
+INDEX_JOURNAL_LOCK_KEY = 'index-journal-consumer'
+
+
+@task(queue='batch')
+def index_journal_changes():
+    """
+    Index the objects that have changed since the last run, as recorded in the SearchIndexChange journal, and record
+    the indexing lag (age of the oldest change waiting) as a MonitoringDataLog metric.
+    """
+    # one consumer at a time: if a run is slow, the changes accumulate (and are coalesced) for the next one
+    if not cache.add(INDEX_JOURNAL_LOCK_KEY, True, timeout=3600):
+        return
+    try:
+        pending, lag = index_journal_lag()
+        start = datetime.datetime.now()
+        updated, removed = consume_index_journal()
+        MonitoringDataLog(
+            time=start,
+            duration=datetime.datetime.now() - start,
+            metric='search_index_lag',
+            value=lag.total_seconds(),
+            data={'pending': pending, 'updated': updated, 'removed': removed},
+        ).save()
+    finally:
+        cache.delete(INDEX_JOURNAL_LOCK_KEY)
+
+    if pending > INDEX_JOURNAL_MAX_CHANGES:
+        # more waiting than one run handles: carry on now rather than waiting for the schedule
+        index_journal_changes.delay()
+
+
 @task(queue='batch')
 def our_clear_index(commit: bool = True):
     """
@@ -1,9 +1,13 @@
 from django.test import TestCase
 from haystack.query import SearchQuerySet
-from haystack import connections
+from haystack import connections, connection_router
 
 from coredata.models import CourseOffering, Semester, Person, SemesterWeek, \
-                            Member, Role, Unit, EnrolmentHistory, ROLE_CHOICES
+                            Member, Role, Unit, EnrolmentHistory, ROLE_CHOICES, SearchIndexChange
+from coredata.tasks import index_journal_changes
+from courselib.search import consume_index_journal, index_journal_lag, JournalSignalProcessor
+from log.models import MonitoringDataLog
+from pages.models import Page
 
 from django.core.management import call_command
 from django.urls import reverse
@@ -11,7 +15,8 @@ from django.urls import reverse
 from courselib.testing import basic_page_tests, validate_content, Client, \
                               TEST_COURSE_SLUG, TEST_ROLE_EXPIRY
 
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
+from unittest import mock
 from datetime import date, datetime, timedelta
 import pytz, json
 
@@ -376,6 +381,130 @@ class SlowCoredataTest(TestCase):
         self.assertIn(str(p.emplid), emplids)
 
 
+class FakeSIMSConn(object):
+    """
+    Stand-in for SIMSConn for StudentImportTest: answers the enrolment queries of both importer.import_students and
+    importer.import_all_students from the same data, and nothing for anything else.
+    """
+    # (CLASS_NBR, CRSE_ID, CLASS_SECTION, EMPLID, enrolled?, ACAD_CAREER, UNT_TAKEN, lab/tutorial section, ENRL_DROP_DT)
+    enrolments = []
+    strm = None
+
+    def execute(self, query, args):
+        rows = []
+        if 'PS_CLASS_TBL C1, PS_CLASS_TBL C2' in query and 'C1.CLASS_NBR=%s' in query:
+            # import_students: lab/tutorial sections (including the lecture section)
+            rows = [(e[3], e[7] or e[2]) for e in self.enrolments if e[4] and e[0] == args[0]]
+        elif 'PS_CLASS_TBL C1, PS_CLASS_TBL C2' in query:
+            # import_all_students: lab/tutorial sections
+            rows = [(e[1], e[2], self.strm, e[3], e[7]) for e in self.enrolments if e[4] and e[7]]
+        elif 'PS_GRADE_ROSTER' in query and 'E.CLASS_NBR=%s' in query:
+            rows = [(e[3], e[5], e[6], None, None) for e in self.enrolments if e[4] and e[0] == args[0]]
+        elif 'PS_GRADE_ROSTER' in query:
+            rows = [(e[1], e[2], self.strm, e[3], e[5], e[6], None, None) for e in self.enrolments if e[4]]
+        elif 'ENRL_DROP_DT' in query and 'E.CLASS_NBR=%s' in query:
+            rows = [(e[3], e[8]) for e in self.enrolments if not e[4] and e[8] and e[0] == args[0]]
+        elif 'ENRL_DROP_DT' in query:
+            rows = [(e[1], e[2], self.strm, e[3], e[8]) for e in self.enrolments if not e[4] and e[8]]
+        self._rows = rows
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def rows(self):
+        return list(self._rows)
+
+
+def fake_import_person(p, commit=True, grad_data=False):
+    if not p.last_name:
+        p.last_name = 'Imported'
+        p.first_name = 'Newly'
+    p.config['lastimport'] = 0
+    p.save()
+    return p
+
+
+class StudentImportTest(TestCase):
+    fixtures = ['basedata', 'coredata']
+
+    def setUp(self):
+        from coredata import importer
+        self.o1 = CourseOffering.objects.get(slug=TEST_COURSE_SLUG)
+        self.o2 = CourseOffering.objects.get(slug='2026fa-cmpt-125-d1')
+        self.strm = self.o1.semester.name
+        members = Member.objects.filter(offering__in=[self.o1, self.o2]).values('person_id')
+        self.people = list(Person.objects.filter(emplid__gte=300000000).exclude(id__in=members).order_by('emplid')[:4])
+        p1, p2, p3, p4 = self.people
+        self.new_emplid = 301000001
+
+        # already imported: p1 has dropped, p2's credits have changed, p4 dropped earlier
+        Member(person=p1, offering=self.o1, role='STUD', added_reason='AUTO', credits=3, career='UGRD').save()
+        Member(person=p2, offering=self.o1, role='STUD', added_reason='AUTO', credits=3, career='UGRD').save()
+        Member(person=p4, offering=self.o1, role='DROP', added_reason='AUTO', credits=3, career='UGRD').save()
+
+        o1 = (self.o1.class_nbr, '%06i' % (self.o1.crse_id,), self.o1.section)
+        o2 = (self.o2.class_nbr, '%06i' % (self.o2.crse_id,), self.o2.section)
+        FakeSIMSConn.strm = self.strm
+        FakeSIMSConn.enrolments = [
+            o1 + (str(p1.emplid), False, 'UGRD', 3, None, date(2026, 9, 20)),
+            o1 + (str(p2.emplid), True, 'UGRD', 4, None, None),
+            o1 + (str(p4.emplid), False, 'UGRD', 3, None, date(2026, 9, 10)),
+            o1 + (str(self.new_emplid), True, 'GRAD', 3, None, None),
+            o2 + (str(p3.emplid), True, 'UGRD', 3, 'D101', None),
+        ]
+
+        importer.imported_people.clear()
+        for patch in [mock.patch('coredata.importer.SIMSConn', FakeSIMSConn),
+                      mock.patch('coredata.importer.import_person', fake_import_person),
+                      mock.patch('coredata.importer.random.random', return_value=0.5)]:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _result(self):
+        members = set(
+            (m.person.emplid, m.offering.slug, m.role, m.added_reason, m.credits, m.career, m.labtut_section,
+             m.config.get('drop_date'))
+            for m in Member.objects.filter(offering__semester__name=self.strm).select_related('person', 'offering'))
+        labtut = {o.slug: o.labtut() for o in CourseOffering.objects.filter(id__in=[self.o1.id, self.o2.id])}
+        return members, labtut, Person.objects.filter(emplid=self.new_emplid).count()
+
+    def test_import_all_students(self):
+        """
+        The semester-at-a-time import should give the same results as the offering-at-a-time one.
+        """
+        from coredata import importer
+        from coredata.tasks import import_semester_members
+        with transaction.atomic():
+            for o in importer.crseid_offering_map(self.strm).values():
+                importer.import_students(o)
+            expected = self._result()
+            transaction.set_rollback(True)
+        importer.imported_people.clear()
+
+        members, labtut, new_people = expected
+        p1, p2, p3, p4 = self.people
+        self.assertIn((p1.emplid, self.o1.slug, 'DROP', 'AUTO', 3, 'UGRD', None, '2026-09-20'), members)
+        self.assertIn((p2.emplid, self.o1.slug, 'STUD', 'AUTO', 4, 'UGRD', None, None), members)
+        self.assertIn((p3.emplid, self.o2.slug, 'STUD', 'AUTO', 3, 'UGRD', 'D101', None), members)
+        self.assertIn((p4.emplid, self.o1.slug, 'DROP', 'AUTO', 3, 'UGRD', None, '2026-09-10'), members)
+        self.assertIn((self.new_emplid, self.o1.slug, 'STUD', 'AUTO', 3, 'GRAD', None, None), members)
+        self.assertTrue(labtut[self.o2.slug])
+        self.assertEqual(new_people, 1)
+
+        with transaction.atomic():
+            counts, _ = importer.import_all_students(self.strm)
+            self.assertEqual(self._result(), expected)
+            transaction.set_rollback(True)
+        importer.imported_people.clear()
+        self.assertEqual(counts, {self.o1.slug: {'add': 1, 'drop': 1, 'change': 1},
+                                  self.o2.slug: {'add': 1, 'drop': 0, 'change': 0}})
+
+        # ... and the same from the import task
+        slugs = [o.slug for o in CourseOffering.objects.filter(semester__name=self.strm)]
+        import_semester_members(self.strm, slugs)
+        self.assertEqual(self._result(), expected)
+
+
 class EnrolmentHistoryTest(TestCase):
     fixtures = ['basedata', 'coredata']
 
@@ -499,6 +628,73 @@ class SearchTest(TestCase):
         results = SearchQuerySet().models(Member).filter(text__fuzzy=fname)
         self.assertEqual(results.count(), 0)
 
+    def test_search_journal(self):
+        """
+        Changes are journalled and indexed incrementally by consume_index_journal.
+        """
+        if 'elasticsearch' in connections['default'].options['ENGINE']:
+            return
+
+        # the journal is only used with Celery (so not in tests), unless we ask for it
+        processor = JournalSignalProcessor(connections, connection_router)
+        self.addCleanup(processor.teardown)
+
+        fname = 'TestStudentJournalName'
+        s, c = create_offering()
+        today = date.today()
+        s.start = today - timedelta(days=100)
+        s.end = today + timedelta(days=100)
+        s.save()
+        haystack_clear_index()
+        SearchIndexChange.objects.all().delete()
+        self.assertEqual(index_journal_lag(), (0, timedelta(0)))
+
+        p = Person(last_name='Test', first_name=fname, userid='0aaa99999', emplid=123456)
+        p.save()
+        m = Member(person=p, offering=c, role='STUD')
+        m.save()
+        m.save()
+        self.assertEqual(SearchIndexChange.objects.filter(model='coredata.member', object_pk=str(m.pk)).count(), 2)
+        self.assertEqual(index_journal_lag()[0], 3)
+        results = SearchQuerySet().models(Member).filter(text__fuzzy=fname)
+        self.assertEqual(results.count(), 0)
+
+        # each changed object is indexed once
+        updated, removed = consume_index_journal()
+        self.assertEqual((updated, removed), (2, 0))
+        self.assertFalse(SearchIndexChange.objects.exists())
+        results = SearchQuerySet().models(Member).filter(text__fuzzy=fname)
+        self.assertEqual(results.count(), 1)
+
+        # unlike update_index, objects leaving the index_queryset are removed
+        m.role = 'DROP'
+        m.save()
+        updated, removed = consume_index_journal()
+        self.assertEqual((updated, removed), (0, 1))
+        results = SearchQuerySet().models(Member).filter(text__fuzzy=fname)
+        self.assertEqual(results.count(), 0)
+
+        # objects the index says not to update are left alone, not removed
+        page = Page(offering=c, label='journalpage')
+        page.save()
+        updated, removed = consume_index_journal()
+        self.assertEqual((updated, removed), (0, 0))
+        self.assertFalse(SearchIndexChange.objects.exists())
+
+        # only the entries that were read are removed
+        p.save()
+        m.save()
+        consume_index_journal(max_changes=1)
+        self.assertEqual(list(SearchIndexChange.objects.values_list('model', flat=True)), ['coredata.member'])
+        consume_index_journal()
+        self.assertFalse(SearchIndexChange.objects.exists())
+
+        # the task records the lag
+        Person(last_name='Test', first_name='Other', userid='0aaa99998', emplid=123457).save()
+        index_journal_changes()
+        log = MonitoringDataLog.objects.get(metric='search_index_lag')
+        self.assertEqual(log.data, {'pending': 1, 'updated': 1, 'removed': 0})
+
 
 class DependencyTest(TestCase):
     """
@@ -0,0 +1,140 @@
+"""
+Lightweight per-request performance counters, recorded in RequestLog.data by courselib.middleware.LoggingMiddleware.
+
+Database queries are counted and timed with connection.execute_wrapper (so this works without DEBUG). Template render
+time and cache hits/misses are collected by wrapping the template backend's and cache backends' methods (once per
+process, by install()): the wrappers do nothing but call through if there is no request being measured.
+"""
+
+import contextlib
+import contextvars
+import functools
+import time
+
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache
+from django.db import connections
+from django.template.backends.django import Template as DjangoTemplate
+
+
+class RequestStats(object):
+    def __init__(self):
+        self.n_queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.template_depth = 0 # so nested render() calls aren't counted twice
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def as_data(self):
+        """
+        Values for RequestLog.data
+        """
+        return {
+            'n_queries': self.n_queries,
+            'db_time_ms': round(self.db_time * 1000, 2),
+            'template_time_ms': round(self.template_time * 1000, 2),
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+        }
+
+
+_current_stats = contextvars.ContextVar('request_stats', default=None)
+_installed = False
+_missing = object()
+
+
+def _query_wrapper(execute, sql, params, many, context):
+    stats = _current_stats.get()
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        if stats is not None:
+            stats.n_queries += 1
+            stats.db_time += time.perf_counter() - start
+
+
+def _wrap_render(render):
+    @functools.wraps(render)
+    def wrapper(self, *args, **kwargs):
+        stats = _current_stats.get()
+        if stats is None:
+            return render(self, *args, **kwargs)
+        start = time.perf_counter()
+        stats.template_depth += 1
+        try:
+            return render(self, *args, **kwargs)
+        finally:
+            stats.template_depth -= 1
+            if stats.template_depth == 0:
+                stats.template_time += time.perf_counter() - start
+    return wrapper
+
+
+def _wrap_cache_get(get):
+    @functools.wraps(get)
+    def wrapper(self, key, default=None, version=None):
+        stats = _current_stats.get()
+        if stats is None:
+            return get(self, key, default, version)
+        value = get(self, key, _missing, version)
+        if value is _missing:
+            stats.cache_misses += 1
+            return default
+        stats.cache_hits += 1
+        return value
+    return wrapper
+
+
+def _wrap_cache_get_many(get_many):
+    @functools.wraps(get_many)
+    def wrapper(self, keys, version=None):
+        stats = _current_stats.get()
+        if stats is None:
+            return get_many(self, keys, version)
+        keys = list(keys)
+        result = get_many(self, keys, version)
+        stats.cache_hits += len(result)
+        stats.cache_misses += len(keys) - len(result)
+        return result
+    return wrapper
+
+
+def install():
+    """
+    Wrap the template render and cache get methods, once per process.
+    """
+    global _installed
+    if _installed:
+        return
+    _installed = True
+
+    DjangoTemplate.render = _wrap_render(DjangoTemplate.render)
+
+    cache_classes = {caches[alias].__class__ for alias in caches.settings}
+    for cls in cache_classes:
+        cls.get = _wrap_cache_get(cls.get)
+        if cls.get_many is not BaseCache.get_many:
+            # BaseCache.get_many calls .get, which is already counted
+            cls.get_many = _wrap_cache_get_many(cls.get_many)
+
+
+@contextlib.contextmanager
+def measure():
+    """
+    Context manager that collects RequestStats for the work done inside it (in this thread).
+
+        with measure() as stats:
+            response = get_response(request)
+        log.data.update(stats.as_data())
+    """
+    stats = RequestStats()
+    token = _current_stats.set(stats)
+    try:
+        with contextlib.ExitStack() as stack:
+            for conn in connections.all():
+                stack.enter_context(conn.execute_wrapper(_query_wrapper))
+            yield stats
+    finally:
+        _current_stats.reset(token)
@@ -39,3 +39,41 @@ class JSONField(JSONFieldOriginal):
 
 #from south.modelsinspector import add_introspection_rules
 #add_introspection_rules([], ["^courselib\.json_fields\.JSONField$"])
+
+
+import re
+from django.db import NotSupportedError
+from django.db.models import Func, CharField
+
+
+class ConfigValue(Func):
+    """
+    The value of a key in a JSONField, for use in queries. These fields are stored as text, so this uses the database's
+    JSON functions on that text:
+
+        Person.objects.annotate(gender=ConfigValue('config', 'gender')).filter(gender='F')
+
+    The value is NULL if the key is missing or the field doesn't contain valid JSON. Values are returned as strings (on
+    MySQL): use Cast for anything else. Implemented for MySQL and SQLite.
+    """
+    output_field = CharField()
+
+    def __init__(self, expression, key, **extra):
+        if not re.match(r'^\w+$', key):
+            raise ValueError('Invalid config key %r' % (key,))
+        super().__init__(expression, **extra)
+        self.key = key
+
+    def _json_sql(self, compiler, template):
+        sql, params = compiler.compile(self.source_expressions[0])
+        return template % {'field': sql}, tuple(params) * 2 + ('$.' + self.key,)
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        return self._json_sql(compiler,
+            'CASE WHEN JSON_VALID(%(field)s) THEN JSON_UNQUOTE(JSON_EXTRACT(%(field)s, %%s)) END')
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return self._json_sql(compiler, 'CASE WHEN json_valid(%(field)s) THEN json_extract(%(field)s, %%s) END')
+
+    def as_sql(self, compiler, connection, **extra_context):
+        raise NotSupportedError('ConfigValue is not implemented for %s.' % (connection.vendor,))
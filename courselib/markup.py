@@ -5,15 +5,17 @@
 # TODO: just a "text with line breaks" markup
 # TODO: ... and then use for grade/marking comments?
 # TODO: the markup choice dropdown is going to be confusing for some people: simplify or something?
+import hashlib
 import random
-from typing import Iterable
+import threading
+from typing import Iterable, List, Dict, Any
 from xml.dom.minidom import parseString, Element, Document, Text, Node
 
 from django.db import models
 from django.utils.safestring import mark_safe, SafeText
 from django.utils.html import linebreaks
 from django.conf import settings
-from cache_utils.decorators import cached
+from django.core.cache import cache
 
 from grades.models import Activity
 
@@ -175,7 +177,21 @@ def markdown_to_html(md: str) -> str:
     return cmarkgfm.markdown_to_html_with_extensions(md, options=options, extensions=extensions)
 
 
-@cached(36000)
+MARKUP_CACHE_TIMEOUT = 36000
+
+
+def _markup_cache_key(markup, markuplang, math=None, offering=None, pageversion=None, html_already_safe=False,
+                      restricted=False, forum_links=False, hidden_llm=False):
+    # the offering and page are all the macros look at, so all that need to be in the key
+    offering_id = offering.id if offering else None
+    page_id = pageversion.page_id if pageversion else None
+    if page_id and not offering:
+        offering_id = pageversion.page.offering_id
+    options = (markuplang, math, offering_id, page_id, html_already_safe, restricted, forum_links, hidden_llm)
+    h = hashlib.sha1(repr(options).encode('utf-8') + b'\0' + markup.encode('utf-8', errors='surrogatepass'))
+    return 'markup-html-' + h.hexdigest()
+
+
 def markup_to_html(markup, markuplang, math=None, offering=None, pageversion=None, html_already_safe=False,
                    restricted=False, forum_links=False, hidden_llm=False):
     """
@@ -191,6 +207,73 @@ def markup_to_html(markup, markuplang, math=None, offering=None, pageversion=Non
     :param forum_links: If true, convert #123 forum post references into links
     :return: HTML markup
     """
+    key = _markup_cache_key(markup, markuplang, math=math, offering=offering, pageversion=pageversion,
+                            html_already_safe=html_already_safe, restricted=restricted, forum_links=forum_links,
+                            hidden_llm=hidden_llm)
+    html = cache.get(key)
+    if html is None:
+        html = _markup_to_html(markup, markuplang, math=math, offering=offering, pageversion=pageversion,
+                               html_already_safe=html_already_safe, restricted=restricted, forum_links=forum_links,
+                               hidden_llm=hidden_llm)
+        cache.set(key, html, MARKUP_CACHE_TIMEOUT)
+    return html
+
+
+def markup_to_html_many(items: List[Dict[str, Any]]) -> List[SafeText]:
+    """
+    Convert many pieces of markup to HTML, like markup_to_html(**item) for each of the items (dicts of its arguments),
+    but with one cache lookup and one cache write for all of them.
+
+    :return: the HTML for each item, in order
+    """
+    keys = [_markup_cache_key(**item) for item in items]
+    cached = cache.get_many(set(keys))
+
+    results = []
+    rendered = {}
+    for key, item in zip(keys, items):
+        html = cached.get(key)
+        if html is None:
+            html = rendered.get(key)
+        if html is None:
+            html = _markup_to_html(**item)
+            rendered[key] = html
+        results.append(html)
+
+    if rendered:
+        cache.set_many(rendered, MARKUP_CACHE_TIMEOUT)
+    return results
+
+
+def markup_html_for(obj, method: str) -> SafeText:
+    """
+    The HTML for obj.<method>(): what prefetch_markup_html stored for it if it was called, or else
+    markup_to_html(**obj.<method>_args()).
+    """
+    prefetched = obj.__dict__.get('_prefetched_markup_html', {})
+    if method in prefetched:
+        return prefetched[method]
+    return markup_to_html(**getattr(obj, method + '_args')())
+
+
+def prefetch_markup_html(objects: Iterable[Any], method: str) -> None:
+    """
+    Render obj.<method>() for all of these objects with markup_to_html_many, so the calls (e.g. from templates) don't
+    each have to look up or render their HTML. The method must be implemented with markup_html_for.
+
+        prefetch_markup_html(news_list, 'content_xhtml')
+    """
+    objects = list(objects)
+    htmls = markup_to_html_many([getattr(obj, method + '_args')() for obj in objects])
+    for obj, html in zip(objects, htmls):
+        obj.__dict__.setdefault('_prefetched_markup_html', {})[method] = html
+
+
+def _markup_to_html(markup, markuplang, math=None, offering=None, pageversion=None, html_already_safe=False,
+                    restricted=False, forum_links=False, hidden_llm=False):
+    """
+    markup_to_html, without the caching.
+    """
     assert isinstance(markup, str)
     if markuplang == 'creole':
         if offering:
@@ -467,14 +550,13 @@ def _find_activity(offering, arg_string):
 local_tz = pytz.timezone(settings.TIME_ZONE)
 
 
-def _duedate(offering, dateformat, macro, environ, *act_name):
+def _duedate(dateformat, macro, environ, *act_name):
     """
     creoleparser macro for due datetimes
 
-    Must be created in a closure by ParserFor with offering set (since that
-    doesn't come from the parser).
+    The offering comes from the environ passed to the parser's render (by ParserFor.text2html).
     """
-    act = _find_activity(offering, macro['arg_string'])
+    act = _find_activity(environ['offering'], macro['arg_string'])
     attrs = {}
     if isinstance(act, Activity):
         due = act.due_date
@@ -493,8 +575,16 @@ def _duedate(offering, dateformat, macro, environ, *act_name):
     return creoleparser.core.bldr.tag.__getattr__('span')(text, **attrs)
 
 
-def _activitylink(offering, macro, environ, *act_name):
-    act = _find_activity(offering, macro['arg_string'])
+def _duedate_macro(macro, environ, *act_name):
+    return _duedate('%A %B %d %Y', macro, environ, *act_name)
+
+
+def _duedatetime_macro(macro, environ, *act_name):
+    return _duedate('%A %B %d %Y, %H:%M', macro, environ, *act_name)
+
+
+def _activitylink_macro(macro, environ, *act_name):
+    act = _find_activity(environ['offering'], macro['arg_string'])
     attrs = {}
     if isinstance(act, Activity):
         text = act.name
@@ -507,9 +597,11 @@ def _activitylink(offering, macro, environ, *act_name):
     return creoleparser.core.bldr.tag.__getattr__('a')(text, **attrs)
 
 
-def _pagelist(offering, pageversion, macro, environ, prefix=None):
+def _pagelist_macro(macro, environ, prefix=None):
     # all pages [with the given prefix] for this offering
     from pages.models import Page
+    offering = environ['offering']
+    pageversion = environ['pageversion']
     if prefix:
         pages = Page.objects.filter(offering=offering, label__startswith=prefix)
     else:
@@ -527,63 +619,83 @@ def _pagelist(offering, pageversion, macro, environ, prefix=None):
     return creoleparser.core.bldr.tag.__getattr__('ul')(elements, **{'class': 'filelist'})
 
 
-class ParserFor(object):
+OFFERING_MACROS = {
+    'duedate': _duedate_macro,
+    'duedatetime': _duedatetime_macro,
+    'pagelist': _pagelist_macro,
+    'activitylink': _activitylink_macro,
+}
+
+
+def build_creole_parser(with_macros):
     """
-    Class to hold the creoleparser objects for a particular CourseOffering.
+    Build a new creoleparser Parser for our Creole dialect: compiling the dialect's regexes makes this expensive, so
+    use creole_parser() to get the shared one.
 
-    (Needs to be specific to the offering so we can select the right activities/pages in macros.)
+    :param with_macros: include the OFFERING_MACROS (which need an offering in the environ when rendering)
     """
+    nb_macros = OFFERING_MACROS if with_macros else {}
+    CreoleBase = creoleparser.creole11_base(non_bodied_macros=nb_macros, add_heading_ids='h-')
 
-    def __init__(self, offering, pageversion=None):
-        self.offering = offering
-        self.pageversion = pageversion
+    class CreoleDialect(CreoleBase):
+        codeblock = CodeBlock()
+        abbracronym = AbbrAcronym()
+        htmlentity = HTMLEntity()
+        strikethrough = creoleparser.elements.InlineElement('del', '--')
 
-        def duedate_macro(macro, environ, *act_name):
-            return _duedate(self.offering, '%A %B %d %Y', macro, environ, *act_name)
+        def __init__(self):
+            self.custom_elements = [self.abbracronym, self.strikethrough]
+            super(CreoleDialect, self).__init__()
 
-        def duedatetime_macro(macro, environ, *act_name):
-            return _duedate(self.offering, '%A %B %d %Y, %H:%M', macro, environ, *act_name)
+        @property
+        def inline_elements(self):
+            inline = super(CreoleDialect, self).inline_elements
+            inline.append(self.abbracronym)
+            inline.append(self.strikethrough)
+            inline.append(self.htmlentity)
+            return inline
 
-        def activitylink_macro(macro, environ, *act_name):
-            return _activitylink(self.offering, macro, environ, *act_name)
+        @property
+        def block_elements(self):
+            blocks = super(CreoleDialect, self).block_elements
+            blocks.insert(0, self.codeblock)
+            return blocks
 
-        def pagelist_macro(macro, environ, prefix=None):
-            return _pagelist(self.offering, self.pageversion, macro, environ, prefix)
+    return creoleparser.core.Parser(CreoleDialect)
 
-        if self.offering:
-            nb_macros = {
-                'duedate': duedate_macro,
-                'duedatetime': duedatetime_macro,
-                'pagelist': pagelist_macro,
-                'activitylink': activitylink_macro,
-            }
-        else:
-            nb_macros = {}
-        CreoleBase = creoleparser.creole11_base(non_bodied_macros=nb_macros, add_heading_ids='h-')
-
-        class CreoleDialect(CreoleBase):
-            codeblock = CodeBlock()
-            abbracronym = AbbrAcronym()
-            htmlentity = HTMLEntity()
-            strikethrough = creoleparser.elements.InlineElement('del', '--')
-
-            def __init__(self):
-                self.custom_elements = [self.abbracronym, self.strikethrough]
-                super(CreoleDialect, self).__init__()
-
-            @property
-            def inline_elements(self):
-                inline = super(CreoleDialect, self).inline_elements
-                inline.append(self.abbracronym)
-                inline.append(self.strikethrough)
-                inline.append(self.htmlentity)
-                return inline
-
-            @property
-            def block_elements(self):
-                blocks = super(CreoleDialect, self).block_elements
-                blocks.insert(0, self.codeblock)
-                return blocks
-
-        self.parser = creoleparser.core.Parser(CreoleDialect)
-        self.text2html = self.parser.render
+
+# Parsers are built once per process and shared by every offering: the dialect doesn't depend on the offering (the
+# macros get it from the environ), and rendering doesn't change the parser.
+_creole_parsers = {}
+_creole_parsers_lock = threading.Lock()
+
+
+def creole_parser(with_macros):
+    """
+    The shared creoleparser Parser for our Creole dialect, with or without the offering-specific macros.
+    """
+    parser = _creole_parsers.get(with_macros)
+    if parser is None:
+        with _creole_parsers_lock:
+            parser = _creole_parsers.get(with_macros)
+            if parser is None:
+                parser = build_creole_parser(with_macros)
+                _creole_parsers[with_macros] = parser
+    return parser
+
+
+class ParserFor(object):
+    """
+    Render Creole for a particular CourseOffering.
+
+    (Needs to be specific to the offering so we can select the right activities/pages in macros. The parser itself is
+    shared: the offering and pageversion are given to the macros in the render environ.)
+    """
+
+    def __init__(self, offering, pageversion=None):
+        self.offering = offering
+        self.pageversion = pageversion
+        self.parser = creole_parser(with_macros=bool(self.offering))
+
+    def text2html(self, text):
+        return self.parser.render(text, environ={'offering': self.offering, 'pageversion': self.pageversion})
@@ -11,7 +11,9 @@ from django.utils.deprecation import MiddlewareMixin
 from django.conf import settings
 from ipware import get_client_ip
 
+from courselib import instrumentation
 from log.models import RequestLog
+from log.sinks import request_log_sink
 
 logger = logging.getLogger(__name__)
 
@@ -103,10 +105,16 @@ class NonHtmlDebugToolbarMiddleware(object):
 
 
 class LoggingMiddleware:
+    """
+    Record a RequestLog for each request, written by the sink selected by settings.REQUEST_LOG_MODE. Query, template
+    and cache counters from courselib.instrumentation are included in its data.
+
+    Per-request state is kept on the request, since one instance of the middleware handles concurrent requests.
+    """
     def __init__(self, get_response):
         self.get_response = get_response
-        self.start = None
-        self.logged_exception = False
+        self.sink = request_log_sink()
+        instrumentation.install()
 
     def request_log(self, request: HttpRequest) -> RequestLog:
         """
@@ -131,42 +139,54 @@ class LoggingMiddleware:
             'request_id': request_id,
             'session_key': session_key,
             'request_content_length': request_content_length,
-            #'n_queries': len(connection.queries),  # connection.queries is only available when DEBUG==True
         }
+        if getattr(request, 'logging_stats', None):
+            log_data.update(request.logging_stats.as_data())
 
         if hasattr(request, 'resolver_match') and isinstance(request.resolver_match, ResolverMatch):
             log_data['view_name'] = request.resolver_match.view_name
 
+        start = request.logging_start
         return RequestLog(
-            time=self.start,
-            duration=datetime.datetime.now() - self.start,
+            time=start,
+            duration=datetime.datetime.now() - start,
             username=username,
             path=request.path,
             method=request.method,
             data=log_data
         )
 
+    @staticmethod
+    def response_content_length(response):
+        if 'Content-Length' in response:
+            return int(response['Content-Length'])
+        elif isinstance(response, HttpResponse):  # exclude streaming responses
+            try:
+                return sum(len(c) for c in response._container)
+            except Exception:
+                pass  # don't throw if the internal ._container implementation changes
+        return None
+
     def __call__(self, request):
-        self.start = datetime.datetime.now()
-        response = self.get_response(request)
+        request.logging_start = datetime.datetime.now()
+        with instrumentation.measure() as stats:
+            request.logging_stats = stats
+            response = self.get_response(request)
 
         # exceptions are logged in process_exception: don't double-log
-        if not self.logged_exception:
+        if not getattr(request, 'logging_exception', False):
             log = self.request_log(request)
             log.data['status_code'] = response.status_code
             log.data['response_content_type'] = response.headers.get('Content-Type', None)
             if 'Location' in response:
                 log.data['redirect-location'] = response['Location']
 
-            try:
-                if isinstance(response, HttpResponse):  # exclude streaming responses
-                    log.data['response_content_length'] = sum(len(c) for c in response._container)
-            except Exception:
-                pass  # don't throw if the internal ._container implementation changes
+            content_length = self.response_content_length(response)
+            if content_length is not None:
+                log.data['response_content_length'] = content_length
 
-            log.save()
+            self.sink.put(log)
 
-        self.logged_exception = False
         return response
 
     def process_exception(self, request, exception):
@@ -179,6 +199,6 @@ class LoggingMiddleware:
         log.data['exception'] = exception.__class__.__name__
         log.data['exception_message'] = str(exception)
         log.data['status_code'] = 500
-        log.save()
+        self.sink.put(log)
 
-        self.logged_exception = True
+        request.logging_exception = True
@@ -1,10 +1,15 @@
+import datetime
 import re
-from typing import Type, Iterable
+from collections import defaultdict
+from typing import Type, Iterable, Tuple
 
+from django.apps import apps
 from django.conf import settings
 from django.db import models
 
 from django.db.models import Q
+from haystack.exceptions import NotHandled
+from haystack.signals import BaseSignalProcessor
 from haystack.utils import loading
 
 
@@ -90,3 +95,107 @@ def haystack_index(model: Type[models.Model], qs: Iterable[models.Model], commit
         backend.update(index, qs, commit=commit)
 
 
+# incremental Haystack indexing: saves/deletes are journalled in SearchIndexChange by the signal processor, and
+# coredata.tasks.index_journal_changes indexes the journalled objects regularly.
+
+INDEX_JOURNAL_BATCH_SIZE = 500  # objects indexed in each backend.update call
+INDEX_JOURNAL_MAX_CHANGES = 20000  # journal entries consumed in one run: any more wait for the next
+
+
+class JournalSignalProcessor(BaseSignalProcessor):
+    """
+    Haystack signal processor (for settings.HAYSTACK_SIGNAL_PROCESSOR) that records changes to indexed models in the
+    SearchIndexChange journal, so they can be indexed in batches later, instead of in the request.
+    """
+    def setup(self):
+        models.signals.post_save.connect(self.handle_save)
+        models.signals.post_delete.connect(self.handle_delete)
+
+    def teardown(self):
+        models.signals.post_save.disconnect(self.handle_save)
+        models.signals.post_delete.disconnect(self.handle_delete)
+
+    def _is_indexed(self, model: Type[models.Model]) -> bool:
+        for using in self.connections.connections_info.keys():
+            try:
+                self.connections[using].get_unified_index().get_index(model)
+                return True
+            except NotHandled:
+                pass
+        return False
+
+    def handle_save(self, sender, instance, raw=False, **kwargs):
+        if raw or not self._is_indexed(sender):
+            return
+        from coredata.models import SearchIndexChange
+        SearchIndexChange.objects.create(model=sender._meta.label_lower, object_pk=str(instance.pk))
+
+    def handle_delete(self, sender, instance, **kwargs):
+        if not self._is_indexed(sender):
+            return
+        from coredata.models import SearchIndexChange
+        SearchIndexChange.objects.create(model=sender._meta.label_lower, object_pk=str(instance.pk))
+
+
+def index_journal_lag() -> Tuple[int, datetime.timedelta]:
+    """
+    The number of entries waiting in the SearchIndexChange journal, and how long the oldest has been waiting.
+    """
+    from coredata.models import SearchIndexChange
+    pending = SearchIndexChange.objects.aggregate(n=models.Count('id'), oldest=models.Min('time'))
+    if pending['oldest'] is None:
+        return 0, datetime.timedelta(0)
+    return pending['n'], datetime.datetime.now() - pending['oldest']
+
+
+def consume_index_journal(max_changes: int = INDEX_JOURNAL_MAX_CHANGES,
+                          batch_size: int = INDEX_JOURNAL_BATCH_SIZE) -> Tuple[int, int]:
+    """
+    Index the objects in (the oldest max_changes entries of) the SearchIndexChange journal, and remove those entries.
+    Each object is indexed once, however many times it was changed. Objects that have been deleted or are no longer in
+    their index's index_queryset are removed from the index; those whose index.should_update is False are left alone.
+
+    Returns the number of objects updated and removed.
+    """
+    from coredata.models import SearchIndexChange
+    changes = list(SearchIndexChange.objects.order_by('id').values_list('id', 'model', 'object_pk')[:max_changes])
+    if not changes:
+        return 0, 0
+
+    pks_by_model = defaultdict(set)
+    for _, label, pk in changes:
+        pks_by_model[label].add(pk)
+
+    updated = 0
+    removed = 0
+    haystack_connections = loading.ConnectionHandler(settings.HAYSTACK_CONNECTIONS)
+    for using in haystack_connections.connections_info.keys():
+        backend = haystack_connections[using].get_backend()
+        unified_index = haystack_connections[using].get_unified_index()
+        for label, pks in pks_by_model.items():
+            try:
+                model = apps.get_model(label)
+                index = unified_index.get_index(model)
+            except (LookupError, NotHandled):
+                continue
+
+            pks = sorted(pks)
+            for i in range(0, len(pks), batch_size):
+                batch = pks[i:i+batch_size]
+                objs = list(index.index_queryset(using=using).filter(pk__in=batch))
+                found = {str(o.pk) for o in objs}
+                objs = [o for o in objs if index.should_update(o)]  # others are left as they are in the index
+                if objs:
+                    backend.update(index, objs)
+                    updated += len(objs)
+                for pk in batch:
+                    if pk not in found:
+                        backend.remove('%s.%s' % (label, pk))
+                        removed += 1
+
+    # delete only the entries we read: others (even with lower ids, from transactions that committed late) are left
+    # for next time
+    ids = [cid for cid, _, _ in changes]
+    for i in range(0, len(ids), batch_size):
+        SearchIndexChange.objects.filter(id__in=ids[i:i+batch_size]).delete()
+    return updated, removed
@@ -0,0 +1,205 @@
+"""
+Streaming ZIP archives: the archive is assembled while it is sent to the client, instead of being written to a
+temporary file first.
+
+Usage:
+    z = ZipStream()
+    z.write('/path/to/file', 'dir/file')   # or anything else that expects a zipfile.ZipFile in 'w' mode
+    z.writestr('summary.csv', data)
+    return StreamingHttpResponse(z, content_type='application/zip')
+
+Each entry is given a signature (stored as its comment in the archive) so that a later archive with the same contents
+can be recognized by its fingerprint(), and unchanged entries copied from a previous archive with reuse().
+"""
+
+import hashlib
+import io
+import os
+import tempfile
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_SIZE = 64*1024 # bytes read from each file at a time
+READ_AHEAD = 4 # number of upcoming files read in parallel
+READ_AHEAD_MAX_SIZE = 4*1024*1024 # files up to this size are read into memory ahead of time; larger ones are streamed
+
+
+class _StreamBuffer(io.RawIOBase):
+    """
+    Unseekable file-like object for zipfile to write into: the generator drains it as the archive is built.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _read_ahead(filename, size):
+    """
+    Get an upcoming file ready: small files are read into memory; for large ones, just ask the OS to start reading.
+    """
+    if size <= READ_AHEAD_MAX_SIZE:
+        with open(filename, 'rb') as fh:
+            return fh.read()
+
+    if hasattr(os, 'posix_fadvise'):
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    return None
+
+
+class ZipStream(object):
+    """
+    A ZIP archive produced as an iterable of bytes, suitable for a StreamingHttpResponse.
+
+    Has the .write and .writestr methods of zipfile.ZipFile, but they only record the entries: the archive is
+    produced as the object is iterated, with a few upcoming files read in parallel threads. Memory use is bounded
+    by READ_AHEAD files of READ_AHEAD_MAX_SIZE.
+    """
+    def __init__(self, compression=zipfile.ZIP_STORED):
+        self.compression = compression
+        self.entries = [] # (ZipInfo, filename|None, data|None, (previous ZipFile, ZipInfo)|None)
+        self.previous = [] # previous archives (zipfile.ZipFile) that entries are copied from
+
+    def write(self, filename, arcname=None):
+        """
+        Add the file to the archive. Raises OSError (now, not when streaming) if the file doesn't exist.
+        """
+        zinfo = zipfile.ZipInfo.from_file(filename, arcname)
+        zinfo.compress_type = self.compression
+        signature = '%s:%i:%r' % (filename, zinfo.file_size, zinfo.date_time)
+        zinfo.comment = hashlib.sha1(signature.encode('utf-8')).hexdigest().encode('ascii')
+        self.entries.append((zinfo, filename, None, None))
+
+    def writestr(self, arcname, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        zinfo = zipfile.ZipInfo(arcname, date_time=time.localtime(time.time())[:6])
+        zinfo.compress_type = self.compression
+        zinfo.external_attr = 0o600 << 16
+        zinfo.file_size = len(data)
+        zinfo.comment = hashlib.sha1(data).hexdigest().encode('ascii')
+        self.entries.append((zinfo, None, data, None))
+
+    def fingerprint(self):
+        """
+        A hash of the archive's contents: archives with the same fingerprint have the same files.
+        """
+        h = hashlib.sha256()
+        for zinfo, _, _, _ in self.entries:
+            h.update(zinfo.filename.encode('utf-8') + b'\0' + zinfo.comment + b'\0')
+        return h.hexdigest()
+
+    def reuse(self, archive):
+        """
+        Copy entries that are unchanged from this previously-built archive, instead of reading their sources again.
+        Returns the number of entries that will be reused.
+
+        Entries are only reused if they have the same compression, so for ZIP_STORED archives (the default) they are
+        byte-for-byte copies with nothing recompressed.
+        """
+        try:
+            old = zipfile.ZipFile(archive)
+        except (OSError, zipfile.BadZipFile):
+            return 0
+        # kept open until the archive is produced, so the old archive can be safely removed in the meantime
+        self.previous.append(old)
+        old_entries = {i.filename: i for i in old.infolist()}
+
+        reused = 0
+        for i, (zinfo, filename, data, _) in enumerate(self.entries):
+            old_info = old_entries.get(zinfo.filename)
+            if old_info is not None and old_info.comment == zinfo.comment \
+                    and old_info.compress_type == zinfo.compress_type:
+                self.entries[i] = (zinfo, None, None, (old, old_info))
+                reused += 1
+        return reused
+
+    def __iter__(self):
+        buffer = _StreamBuffer()
+        z = zipfile.ZipFile(buffer, 'w', compression=self.compression)
+        entries = iter(self.entries)
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers=READ_AHEAD) as pool:
+            def fill():
+                # keep READ_AHEAD upcoming entries in flight
+                while len(pending) < READ_AHEAD:
+                    entry = next(entries, None)
+                    if entry is None:
+                        return
+                    zinfo, filename, data, copy_from = entry
+                    future = pool.submit(_read_ahead, filename, zinfo.file_size) if filename else None
+                    pending.append((zinfo, filename, data, copy_from, future))
+
+            try:
+                fill()
+                while pending:
+                    zinfo, filename, data, copy_from, future = pending.popleft()
+                    fill()
+                    if future:
+                        data = future.result()
+
+                    if copy_from:
+                        old, old_info = copy_from
+                        with old.open(old_info) as src, z.open(zinfo, 'w') as dest:
+                            for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                                dest.write(chunk)
+                                out = buffer.drain()
+                                if out:
+                                    yield out
+                    elif data is not None:
+                        z.writestr(zinfo, data)
+                    else:
+                        with open(filename, 'rb') as src, z.open(zinfo, 'w') as dest:
+                            for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                                dest.write(chunk)
+                                out = buffer.drain()
+                                if out:
+                                    yield out
+
+                    out = buffer.drain()
+                    if out:
+                        yield out
+            finally:
+                for old in self.previous:
+                    old.close()
+
+        z.close()
+        yield buffer.drain()
+
+    def save_as(self, path):
+        """
+        Iterate the archive (like iter(self)) while also saving it to path. The file only appears at path once it's
+        complete.
+        """
+        handle, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        complete = False
+        try:
+            with os.fdopen(handle, 'wb') as fh:
+                for chunk in self:
+                    fh.write(chunk)
+                    yield chunk
+            os.replace(tmp, path)
+            complete = True
+        finally:
+            if not complete:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
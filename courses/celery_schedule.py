@@ -29,8 +29,11 @@ CELERY_BEAT_SCHEDULE = dict([
     beat('coredata.tasks.check_sims_connection', crontab(minute=0, hour='*/3'), queue='sims'),
     beat('coredata.tasks.expire_sessions_conveniently', crontab(minute='0', hour=h(4))),
     beat('coredata.tasks.haystack_rebuild', crontab(minute='0', hour=h(2), day_of_week='saturday'), queue='batch'),
+    beat('coredata.tasks.index_journal_changes', 60, queue='batch'),
     beat('coredata.tasks.expiring_roles', crontab(minute='30', hour=h(7), day_of_week='mon,thu')),
     beat('dashboard.tasks.photo_password_update_task', crontab(day_of_month="10,20,30", hour=h(2), minute=0)),
+    beat('dashboard.tasks.remove_old_bulk_pdfs_task', crontab(minute='20', hour=h(3)), queue='batch'),
+    beat('dashboard.tasks.prune_pdf_cache_task', crontab(hour='*', minute='25'), queue='batch'),
     beat('advisornotes.tasks.cleanup_advising_surveys', crontab(minute=0, hour=h(2))),
     beat('advisornotes.tasks.program_info_for_advisorvisits', crontab(minute=5, hour=h(2))),
     beat('forum.tasks.send_digests', crontab(hour='*', minute='0')),
@@ -38,9 +41,12 @@ CELERY_BEAT_SCHEDULE = dict([
     beat('onlineforms.tasks.waiting_forms_reminder', crontab(day_of_week="1", hour=h(13), minute="0")),
     beat('onlineforms.tasks.reject_dormant_initial', crontab(hour=h(18), minute="0")),
     beat('ra.tasks.expiring_ras_reminder', crontab(minute='0', hour=h(13))),
+    beat('quizzes.tasks.apply_quiz_autosaves', 60, queue='fast'),
     beat('reminders.tasks.daily_reminders', crontab(minute='0', hour=h(9))),
     beat('reports.tasks.run_regular_reports', crontab(hour=h(9), minute=15), queue='sims'),
+    beat('submission.tasks.warm_submission_archives', crontab(hour='*', minute='10')),
     beat('ta.tasks.check_and_execute_reminders', crontab(minute='0', hour=h(8))),
     beat('log.tasks.log_regular', crontab(hour='*', minute='0,15,30,45'), queue='fast'),
     beat('log.tasks.log_avg_request_duration', crontab(hour='*', minute=0), queue='fast'),
+    beat('log.tasks.load_request_log_spool', crontab(minute='*/5'), queue='fast'),
 ])
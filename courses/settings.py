@@ -252,7 +252,6 @@ else:
     }
     DB_BACKUP_DIR = getattr(localsettings, 'DB_BACKUP_DIR', os.path.join(BASE_DIR, 'db_backup'))
 
-HAYSTACK_SIGNAL_PROCESSOR = getattr(localsettings, 'HAYSTACK_SIGNAL_PROCESSOR', 'haystack.signals.BaseSignalProcessor')
 HAYSTACK_CONNECTIONS = getattr(localsettings, 'HAYSTACK_CONNECTIONS', HAYSTACK_CONNECTIONS)
 #HAYSTACK_SILENTLY_FAIL = False
 
@@ -279,9 +278,29 @@ else:
     BASE_ABS_URL = getattr(localsettings, 'BASE_ABS_URL', "http://localhost:8000")
     EMAIL_BACKEND = getattr(localsettings, 'EMAIL_BACKEND', 'django.core.mail.backends.console.EmailBackend')
 
+# pre-built "all submissions" ZIP archives, named by the fingerprint of their contents
+SUBMISSION_ARCHIVE_CACHE_PATH = getattr(localsettings, 'SUBMISSION_ARCHIVE_CACHE_PATH',
+                                        os.path.join(SUBMISSION_PATH, 'archive-cache'))
+SUBMISSION_ARCHIVE_CACHE_AGE = getattr(localsettings, 'SUBMISSION_ARCHIVE_CACHE_AGE', 30) # days unused before removal
+
+# multi-form PDFs generated in the background (see dashboard/bulkpdf.py)
+BULK_PDF_PATH = getattr(localsettings, 'BULK_PDF_PATH', os.path.join(SUBMISSION_PATH, 'bulk-pdf'))
+
+# generated letters and forms, named by the hash of their contents (see dashboard/pdfcache.py)
+PDF_CACHE_PATH = getattr(localsettings, 'PDF_CACHE_PATH', os.path.join(SUBMISSION_PATH, 'pdf-cache'))
+PDF_CACHE_MAX_SIZE = getattr(localsettings, 'PDF_CACHE_MAX_SIZE', 500*1024*1024) # bytes: least-recently used removed beyond this
+PDF_CACHE_AGE = getattr(localsettings, 'PDF_CACHE_AGE', 7) # days unused before removal
+
 
 # should we use the Celery task queue (for sending email, etc)?  Must have celeryd running to process jobs.
 USE_CELERY = getattr(localsettings, 'USE_CELERY', DEPLOY_MODE != 'devel') and not IN_TESTING
+
+# with Celery, search index changes are journalled and indexed by coredata.tasks.index_journal_changes; without it,
+# nothing would consume the journal, so the index is left to update_index (coredata.tasks.haystack_update) as before
+HAYSTACK_SIGNAL_PROCESSOR = getattr(localsettings, 'HAYSTACK_SIGNAL_PROCESSOR',
+                                    'courselib.search.JournalSignalProcessor' if USE_CELERY
+                                    else 'haystack.signals.BaseSignalProcessor')
+
 if USE_CELERY:
     RABBITMQ_USER = getattr(localsettings, 'RABBITMQ_USER', 'coursys')
     RABBITMQ_PASSWORD = getattr(localsettings, 'RABBITMQ_PASSWORD', 'the_rabbitmq_password')
@@ -363,6 +382,14 @@ NTP_REFERENCE = getattr(localsettings, 'NTP_REFERENCE', 'ns2.sfu.ca' if DEPLOY_M
 
 LOGGING = getattr(localsettings, 'LOGGING', {'version': 1,'disable_existing_loggers': False})
 
+# how LoggingMiddleware records RequestLog entries: 'sync', 'buffered', or 'spool' (see log/sinks.py)
+REQUEST_LOG_MODE = getattr(localsettings, 'REQUEST_LOG_MODE', 'sync' if IN_TESTING else 'buffered')
+REQUEST_LOG_SPOOL_PATH = getattr(localsettings, 'REQUEST_LOG_SPOOL_PATH', os.path.join(BASE_DIR, 'request_log_spool'))
+
+# how quiz auto-saves are stored: 'delta' (changed answers as a quizzes.models.QuizAutosave, applied to the answers in
+# batches by quizzes.tasks.apply_quiz_autosaves) or 'full' (a QuizSubmission and QuestionAnswer updates, like submitting)
+QUIZ_AUTOSAVE_MODE = getattr(localsettings, 'QUIZ_AUTOSAVE_MODE', 'delta')
+
 AUTOSLUG_SLUGIFY_FUNCTION = 'courselib.slugs.make_slug'
 
 FORCE_CAS = getattr(localsettings, 'FORCE_CAS', False)
@@ -46,6 +46,7 @@ toplevel_patterns = [
     url(r'^$', dashboard_views.index, name='index'),
     url(r'^history$', dashboard_views.index_full, name='index_full'),
     url(r'^search$', dashboard_views.site_search, name='site_search'),
+    url(r'^pdf/(?P<job_id>[0-9a-f]{32})$', dashboard_views.bulk_pdf, name='bulk_pdf'),
 
     url(r'^my_grads/$', grad_views.supervisor_index, name='supervisor_index'),
     url(r'^my_grads/download/$', grad_views.download_my_grads_csv, name='download_my_grads_csv'),
@@ -0,0 +1,145 @@
+"""
+Big multi-form PDFs (like the TA forms for a whole posting) are generated by a Celery job instead of in the request.
+
+Views call bulk_pdf_response(): small batches are generated immediately as before. Larger ones start a job and
+redirect to the dashboard:bulk_pdf page, which shows the job's progress and then serves the finished file.
+"""
+
+import os
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseRedirect
+from django.urls import reverse
+
+from dashboard.letters import card_req_forms, fasnet_forms, ta_forms, tacontract_forms
+
+BULK_PDF_INLINE_MAX = 20  # batches up to this size are generated in the request
+BULK_PDF_STATUS_KEY = 'bulk-pdf-%s'
+BULK_PDF_STATUS_TIMEOUT = 86400
+
+
+def _load_grads(ids):
+    from grad.models import GradStudent
+    return GradStudent.objects.filter(id__in=ids).select_related('person', 'program__unit')
+
+
+def _load_ta_contracts(ids):
+    from ta.models import TAContract
+    return TAContract.objects.filter(id__in=ids).select_related('application__person', 'posting__semester',
+                                                                 'posting__unit')
+
+
+def _load_tacontracts(ids):
+    from tacontracts.models import TAContract
+    return TAContract.objects.filter(id__in=ids).select_related('person', 'category__hiring_semester__semester',
+                                                                 'category__hiring_semester__unit')
+
+
+# kind: (generating function, function to load the items by id)
+BULK_PDF_KINDS = {
+    'card_req': (card_req_forms, _load_grads),
+    'fasnet': (fasnet_forms, _load_grads),
+    'ta': (ta_forms, _load_ta_contracts),
+    'tacontract': (tacontract_forms, _load_tacontracts),
+}
+
+
+def bulk_pdf_path(job_id):
+    return os.path.join(settings.BULK_PDF_PATH, '%s.pdf' % (job_id,))
+
+
+def bulk_pdf_status(job_id):
+    """
+    The job's status, as a dict of 'kind', 'ids', 'userid', 'filename', 'done', 'total', 'finished', 'error'; or None
+    if there isn't one (recently).
+    """
+    return cache.get(BULK_PDF_STATUS_KEY % (job_id,))
+
+
+def _set_status(job_id, status):
+    cache.set(BULK_PDF_STATUS_KEY % (job_id,), status, BULK_PDF_STATUS_TIMEOUT)
+
+
+def start_bulk_pdf(kind, items, userid, filename):
+    """
+    Start a job to generate the kind of PDF for these items (in this order). Returns the job id.
+    """
+    from dashboard.tasks import bulk_pdf_task
+    assert kind in BULK_PDF_KINDS
+    job_id = uuid.uuid4().hex
+    ids = [item.id for item in items]
+    _set_status(job_id, {'kind': kind, 'ids': ids, 'userid': userid, 'filename': filename,
+                         'done': 0, 'total': len(ids), 'finished': False, 'error': False})
+    if settings.USE_CELERY:
+        bulk_pdf_task.delay(job_id)
+    else:
+        generate_bulk_pdf(job_id)
+    return job_id
+
+
+def generate_bulk_pdf(job_id):
+    """
+    Do the work of the job: write the PDF to bulk_pdf_path(job_id), recording progress as we go.
+    """
+    status = bulk_pdf_status(job_id)
+    if status is None or status['finished']:
+        return
+
+    generate, load = BULK_PDF_KINDS[status['kind']]
+    items = {item.id: item for item in load(status['ids'])}
+    items = [items[i] for i in status['ids'] if i in items]
+
+    def progress(done):
+        if done % 10 == 0:
+            status['done'] = done
+            _set_status(job_id, status)
+
+    path = bulk_pdf_path(job_id)
+    os.makedirs(settings.BULK_PDF_PATH, exist_ok=True)
+    tmp = path + '.tmp'
+    try:
+        with open(tmp, 'wb') as fh:
+            generate(items, fh, progress=progress)
+        os.replace(tmp, path)
+    except Exception:
+        status['error'] = True
+        raise
+    else:
+        status['done'] = len(items)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        status['finished'] = True
+        _set_status(job_id, status)
+
+
+def bulk_pdf_response(request, kind, items, filename):
+    """
+    Response for a request for a PDF of the forms for all of these items: the PDF itself if there are only a few,
+    or a redirect to the progress page of a job building it if there are many.
+    """
+    items = list(items)
+    if len(items) <= BULK_PDF_INLINE_MAX:
+        generate, _ = BULK_PDF_KINDS[kind]
+        response = HttpResponse(content_type='application/pdf')
+        response['Content-Disposition'] = 'inline; filename="%s"' % (filename,)
+        generate(items, response)
+        return response
+
+    job_id = start_bulk_pdf(kind, items, request.user.username, filename)
+    return HttpResponseRedirect(reverse('dashboard:bulk_pdf', kwargs={'job_id': job_id}))
+
+
+def remove_old_bulk_pdfs():
+    """
+    Remove generated files once the job has been forgotten.
+    """
+    if not os.path.isdir(settings.BULK_PDF_PATH):
+        return
+    cutoff = time.time() - BULK_PDF_STATUS_TIMEOUT
+    for entry in os.scandir(settings.BULK_PDF_PATH):
+        if entry.is_file() and entry.stat().st_mtime < cutoff:
+            os.remove(entry.path)
@@ -17,9 +17,11 @@ from reportlab.lib.colors import CMYKColor
 from reportlab.lib.enums import TA_JUSTIFY, TA_LEFT
 from coredata.models import Role
 from django.conf import settings
-import os
+import os, io, threading
 import datetime, decimal
+from collections import OrderedDict, namedtuple
 from dashboard.models import Signature
+from dashboard.pdfcache import cached_pdf
 from coredata.models import Semester, Person
 from grad.models import STATUS_APPLICANT
 from courselib.branding import product_name
@@ -34,42 +36,112 @@ logofile = os.path.join(media_path, 'logo.png')
 
 from reportlab.platypus.doctemplate import PageTemplate, BaseDocTemplate
 
+# translate digits to old-style numerals (in their Bembo character positions)
+DIGIT_TRANS = {48+d: chr(0xF643 + d) for d in range(10)}
+
+
+def _smallcaps_bembo():
+    # translate letters to smallcaps characters (in their [strange] Bembo character positions)
+    trans = {}
+    for d in range(26):
+        if d<3: # A-C
+            offset = d
+        elif d<4: # D
+            offset = d+2
+        elif d<21: # E-U
+            offset = d+3
+        else: # V-Z
+            offset = d+4
+        trans[65+d] = chr(0xE004 + offset)
+        trans[97+d] = chr(0xE004 + offset)
+    return trans
+
+SC_TRANS_BEMBO = _smallcaps_bembo()
+
+SIGNATURE_CACHE_SIZE = 100  # decoded signature images kept by PDFMedia
+
+SignatureImage = namedtuple('SignatureImage', ['reader', 'data', 'width', 'height'])
+# reader: an ImageReader for Canvas.drawImage; data: the image file's contents (for platypus.Image);
+# width/height: size in pixels
+
+
+class PDFMedia(object):
+    """
+    The fonts, logo and signature images needed for PDFs, loaded once per process instead of for every document (or
+    page). Use the module-level instance, media.
+    """
+    FONTS = [
+        ("BemboMTPro", 'BemboMTPro-Regular.ttf'),
+        ("BemboMTPro-Bold", 'BemboMTPro-Bold.ttf'),
+        ("DINPro", 'DINPro-Regular.ttf'),
+        ("DINPro-Bold", 'DINPro-Bold.ttf'),
+    ]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fonts_registered = False
+        self._logo = None
+        self.signatures = OrderedDict()  # (Signature.id, file name): SignatureImage, least-recently used first
+
+    def register_fonts(self):
+        if self.fonts_registered:
+            return
+        with self.lock:
+            if not self.fonts_registered:
+                for name, filename in self.FONTS:
+                    pdfmetrics.registerFont(TTFont(name, os.path.join(media_path, filename)))
+                self.fonts_registered = True
+
+    def logo(self):
+        """
+        ImageReader for the SFU logo.
+        """
+        if self._logo is None:
+            self._logo = ImageReader(logofile)
+        return self._logo
+
+    def signature(self, sig):
+        """
+        The decoded image for this Signature, as a SignatureImage.
+        """
+        key = (sig.id, sig.sig.name)
+        with self.lock:
+            img = self.signatures.get(key)
+            if img is not None:
+                self.signatures.move_to_end(key)
+                return img
+
+        import PIL
+        sig.sig.open('rb')
+        try:
+            data = sig.sig.read()
+        finally:
+            sig.sig.close()
+        width, height = PIL.Image.open(io.BytesIO(data)).size
+        img = SignatureImage(ImageReader(io.BytesIO(data)), data, width, height)
+
+        with self.lock:
+            self.signatures[key] = img
+            while len(self.signatures) > SIGNATURE_CACHE_SIZE:
+                self.signatures.popitem(last=False)
+        return img
+
+media = PDFMedia()
+
+
 class SFUMediaMixin():
     def _media_setup(self):
         "Get all of the media needed for the letterhead"
         # fonts and logo
-        ttfFile = os.path.join(media_path, 'BemboMTPro-Regular.ttf')
-        pdfmetrics.registerFont(TTFont("BemboMTPro", ttfFile))
-        ttfFile = os.path.join(media_path, 'BemboMTPro-Bold.ttf')
-        pdfmetrics.registerFont(TTFont("BemboMTPro-Bold", ttfFile))
-        ttfFile = os.path.join(media_path, 'DINPro-Regular.ttf')
-        pdfmetrics.registerFont(TTFont("DINPro", ttfFile))
-        ttfFile = os.path.join(media_path, 'DINPro-Bold.ttf')
-        pdfmetrics.registerFont(TTFont("DINPro-Bold", ttfFile))
+        media.register_fonts()
 
         # graphic standards colours
         self.sfu_red = CMYKColor(0, 1, 0.79, 0.2)
         self.sfu_grey = CMYKColor(0, 0, 0.15, 0.82)
         self.sfu_blue = CMYKColor(1, 0.68, 0, 0.12)
 
-        # translate digits to old-style numerals (in their Bembo character positions)
-        self.digit_trans = {}
-        for d in range(10):
-            self.digit_trans[48+d] = chr(0xF643 + d)
-
-        self.sc_trans_bembo = {}
-        # translate letters to smallcaps characters (in their [strange] Bembo character positions)
-        for d in range(26):
-            if d<3: # A-C
-                offset = d
-            elif d<4: # D
-                offset = d+2
-            elif d<21: # E-U
-                offset = d+3
-            else: # V-Z
-                offset = d+4
-            self.sc_trans_bembo[65+d] = chr(0xE004 + offset)
-            self.sc_trans_bembo[97+d] = chr(0xE004 + offset)
+        self.digit_trans = DIGIT_TRANS
+        self.sc_trans_bembo = SC_TRANS_BEMBO
 
     def _drawStringLeading(self, canvas, x, y, text, charspace=0, mode=None):
         """
@@ -150,7 +222,7 @@ class LetterheadTemplate(LetterPageTemplate):
         Draw the top-of-page part of the letterhead (used only on first page of letter)
         """
         # SFU logo
-        c.drawImage(logofile, x=self.lr_margin + 6, y=self.pg_h-self.top_margin-0.5*inch, width=1*inch, height=0.5*inch)
+        c.drawImage(media.logo(), x=self.lr_margin + 6, y=self.pg_h-self.top_margin-0.5*inch, width=1*inch, height=0.5*inch)
 
         # unit text
         c.setFont('BemboMTPro', 12)
@@ -303,16 +375,12 @@ class LetterContents(object):
         signature = [Paragraph(self.closing+",", style)]
         img = None
         if self.signer and self.use_sig:
-            import PIL
             try:
                 sig = Signature.objects.get(user=self.signer)
-                sig.sig.open('rb')
-                img = PIL.Image.open(sig.sig)
-                width, height = img.size
-                wid = width / float(sig.resolution) * inch
-                hei = height / float(sig.resolution) * inch
-                sig.sig.open('rb')
-                img = Image(sig.sig, width=wid, height=hei)
+                sigimg = media.signature(sig)
+                wid = sigimg.width / float(sig.resolution) * inch
+                hei = sigimg.height / float(sig.resolution) * inch
+                img = Image(io.BytesIO(sigimg.data), width=wid, height=hei)
                 img.hAlign = 'LEFT'
                 signature.append(Spacer(1, space_height))
                 signature.append(img)
@@ -534,7 +602,7 @@ class FASLetterheadTemplate(FASLetterPageTemplate):
         Draw the top-of-page part of the letterhead (used only on first page of letter)
         """
         # SFU logo
-        c.drawImage(logofile, x=self.lr_margin + 6, y=self.pg_h-self.top_margin-0.5*inch, width=1*inch, height=0.5*inch)
+        c.drawImage(media.logo(), x=self.lr_margin + 6, y=self.pg_h-self.top_margin-0.5*inch, width=1*inch, height=0.5*inch)
 
         # unit text
         c.setFont('BemboMTPro', 12)
@@ -646,7 +714,7 @@ class RARequestForm(SFUMediaMixin):
 
         # SFU logo
         self.c.setStrokeColor(black)
-        self.c.drawImage(logofile, x=0, y=247*mm, width=20*mm, height=10*mm)
+        self.c.drawImage(media.logo(), x=0, y=247*mm, width=20*mm, height=10*mm)
         self.c.setFont('BemboMTPro', 10)
         self.c.setFillColor(self.sfu_red)
         self._drawStringLeading(self.c, 23*mm, 250*mm, 'Simon Fraser University'.translate(self.sc_trans_bembo), charspace=1.4)
@@ -1557,7 +1625,7 @@ class RAForm(SFUMediaMixin):
         self.c.setStrokeColor(black)
 
         # SFU logo
-        self.c.drawImage(logofile, x=0, y=247*mm, width=20*mm, height=10*mm)
+        self.c.drawImage(media.logo(), x=0, y=247*mm, width=20*mm, height=10*mm)
         self.c.setFont('BemboMTPro', 10)
         self.c.setFillColor(self.sfu_red)
         self._drawStringLeading(self.c, 23*mm, 250*mm, 'Simon Fraser University'.translate(self.sc_trans_bembo), charspace=1.4)
@@ -1856,7 +1924,7 @@ class RAForm_old(object):
         self.c.setFont("Helvetica-Bold", 14)
         self.c.drawCentredString(4*inch, 8*inch, "Student, Research & Other Non-Union")
         self.c.drawCentredString(4*inch, 7.75*inch, "Appointments")
-        self.c.drawImage(logofile, x=0.5*inch, y=7.75*inch, width=1*inch, height=0.5*inch)
+        self.c.drawImage(media.logo(), x=0.5*inch, y=7.75*inch, width=1*inch, height=0.5*inch)
         self.c.setFont("Helvetica", 6)
         self.c.drawCentredString(4*inch, 7.6*inch, "PLEASE SEE GUIDE TO THE COMPLETION OF APPOINTMENT FOR FPP4")
 
@@ -2023,6 +2091,10 @@ def ra_form(ra, outfile):
     form = RAForm(ra)
     return form.draw_pdf(outfile)
 
+def _ra_paf_inputs(ra, config):
+    return [ra, ra.person, ra.supervisor, ra.unit, config]
+
+@cached_pdf('ra_paf', _ra_paf_inputs)
 def ra_paf(ra, config, outfile):
     """
     Generate PAF form for this RAAppointment.
@@ -2207,7 +2279,7 @@ class TAForm(object):
         main_width = 7.25*inch
 
         # header
-        self.c.drawImage(logofile, x=main_width/2 - 0.5*inch, y=227*mm, width=1*inch, height=0.5*inch)
+        self.c.drawImage(media.logo(), x=main_width/2 - 0.5*inch, y=227*mm, width=1*inch, height=0.5*inch)
         self.c.setFont("Helvetica-Bold", 9)
         self.c.drawString(main_width/2 + 1*inch, 233*mm, "SIMON FRASER UNIVERSITY")
         self.c.drawRightString(main_width/2 - 1*inch, 233*mm, "Teaching Assistant Appointment Form")
@@ -2343,16 +2415,10 @@ class TAForm(object):
 
         # signatures
         if sigs:
-            import PIL
-            sig = sigs[0]
-            sig.sig.open()
-            img = PIL.Image.open(sig.sig)
-            width, height = img.size
+            sigimg = media.signature(sigs[0])
             hei = 8*mm
-            wid = 1.0*width/height * hei
-            sig.sig.open()
-            ir = ImageReader(sig.sig)
-            self.c.drawImage(ir, x=3*mm, y=9*mm, width=wid, height=hei)
+            wid = 1.0*sigimg.width/sigimg.height * hei
+            self.c.drawImage(sigimg.reader, x=3*mm, y=9*mm, width=wid, height=hei)
 
         self.c.setLineWidth(1)
         self.c.line(0, 18*mm, main_width, 18*mm)
@@ -2404,6 +2470,13 @@ class TAForm(object):
 
 
 
+def _ta_form_inputs(contract):
+    courses = list(contract.tacourse_set.filter(bu__gt=0).select_related('course', 'description'))
+    return [contract, contract.application.person, contract.posting, contract.posting.unit, contract.position_number,
+            courses, [(crs.course, crs.description) for crs in courses],
+            list(Signature.objects.filter(user__userid=contract.created_by))]
+
+@cached_pdf('ta_form', _ta_form_inputs)
 def ta_form(contract, outfile):
     """
     Generate TA Appointment Form for this TAContract (ta module).
@@ -2412,15 +2485,25 @@ def ta_form(contract, outfile):
     doc.draw_form_cmptcontract(contract)
     doc.save()
 
-def ta_forms(contracts, outfile):
+def ta_forms(contracts, outfile, progress=None):
     """
     Generate TA Appointment Forms for this list of TAContracts (ta module) in one PDF
     """
     doc = TAForm(outfile)
-    for c in contracts:
+    for i, c in enumerate(contracts, start=1):
         doc.draw_form_cmptcontract(c)
+        if progress:
+            progress(i)
     doc.save()
 
+def _tacontract_form_inputs(contract):
+    courses = list(contract.course.filter(bu__gt=0).select_related('course', 'description'))
+    account = contract.category.account
+    return [contract, contract.person, contract.category, account, account.unit,
+            courses, [(crs.course, crs.description) for crs in courses],
+            list(Signature.objects.filter(user__userid=contract.created_by))]
+
+@cached_pdf('tacontract_form', _tacontract_form_inputs)
 def tacontract_form(contract, outfile):
     """
     Generate TA Appointment Form for this TAContract (tacontract module).
@@ -2430,13 +2513,15 @@ def tacontract_form(contract, outfile):
     doc.save()
 
 
-def tacontract_forms(contracts, outfile):
+def tacontract_forms(contracts, outfile, progress=None):
     """
     Generate TA Appointment Form for this list of TAContracts (tacontract module).
     """
     doc = TAForm(outfile)
-    for c in contracts:
+    for i, c in enumerate(contracts, start=1):
         doc.draw_form_contract(c)
+        if progress:
+            progress(i)
     doc.save()
 
 
@@ -2472,7 +2557,7 @@ class GradeChangeForm(SFUMediaMixin):
         main_width = 7.0*inch
 
         # header
-        self.c.drawImage(logofile, x=0, y=224*mm, width=1*inch, height=0.5*inch)
+        self.c.drawImage(media.logo(), x=0, y=224*mm, width=1*inch, height=0.5*inch)
         self.c.setFont("BemboMTPro", 11)
         self.c.drawString(43*mm, 228*mm, "RECORDS AND REGISTRATION".translate(self.sc_trans_bembo))
         self.c.drawString(43*mm, 223*mm, "STUDENT SERVICES".translate(self.sc_trans_bembo))
@@ -2887,17 +2972,12 @@ class CardReqForm(object):
         sgn_userid = ''
         sgn_phone = ''
         for role in signers:
-            import PIL
             try:
                 sig = Signature.objects.get(user=role.person)
-                sig.sig.open('rb')
-                img = PIL.Image.open(sig.sig)
-                width, height = img.size
+                sigimg = media.signature(sig)
                 hei = 7*mm
-                wid = 1.0*width/height * hei
-                sig.sig.open('rb')
-                ir = ImageReader(sig.sig)
-                self.c.drawImage(ir, x=24*mm, y=27*mm, width=wid, height=hei)
+                wid = 1.0*sigimg.width/sigimg.height * hei
+                self.c.drawImage(sigimg.reader, x=24*mm, y=27*mm, width=wid, height=hei)
                 # info about the person who is signing it (for use below)
                 sgn_name = role.person.name()
                 sgn_userid = role.person.userid
@@ -3107,17 +3187,12 @@ class CardReqForm_old(object):
         # find a sensible person to sign the form
         signers = list(Role.objects_fresh.filter(unit=grad.program.unit, role='ADMN').order_by('-id')) + list(Role.objects_fresh.filter(unit=grad.program.unit, role='GRPD').order_by('-id'))
         for role in signers:
-            import PIL
             try:
                 sig = Signature.objects.get(user=role.person)
-                sig.sig.open('rb')
-                img = PIL.Image.open(sig.sig)
-                width, height = img.size
+                sigimg = media.signature(sig)
                 hei = 7*mm
-                wid = 1.0*width/height * hei
-                sig.sig.open('rb')
-                ir = ImageReader(sig.sig)
-                self.c.drawImage(ir, x=114*mm, y=50*mm, width=wid, height=hei)
+                wid = 1.0*sigimg.width/sigimg.height * hei
+                self.c.drawImage(sigimg.reader, x=114*mm, y=50*mm, width=wid, height=hei)
                 break
             except Signature.DoesNotExist:
                 pass
@@ -3160,10 +3235,12 @@ class CardReqForm_old(object):
 
         self.c.showPage()
 
-def card_req_forms(grads, outfile):
+def card_req_forms(grads, outfile, progress=None):
     doc = CardReqForm(outfile)
-    for g in grads:
+    for i, g in enumerate(grads, start=1):
         doc.draw_form(g)
+        if progress:
+            progress(i)
     doc.save()
 
 
@@ -3256,17 +3333,12 @@ class FASnetForm(object):
                   + list(Role.objects_fresh.filter(unit=grad.program.unit, role='ADMN').order_by('-id')) \
                   + list(Role.objects_fresh.filter(unit=grad.program.unit, role='GRPD').order_by('-id'))
         for role in signers:
-            import PIL
             try:
                 sig = Signature.objects.get(user=role.person)
-                sig.sig.open('rb')
-                img = PIL.Image.open(sig.sig)
-                width, height = img.size
+                sigimg = media.signature(sig)
                 hei = 10*mm
-                wid = 1.0*width/height * hei
-                sig.sig.open('rb')
-                ir = ImageReader(sig.sig)
-                self.c.drawImage(ir, x=45*mm, y=base_y - 15*self.ENTRY_HEIGHT, width=wid, height=hei)
+                wid = 1.0*sigimg.width/sigimg.height * hei
+                self.c.drawImage(sigimg.reader, x=45*mm, y=base_y - 15*self.ENTRY_HEIGHT, width=wid, height=hei)
                 self.entry_font()
                 self.c.drawString(42*mm, base_y - 12*self.ENTRY_HEIGHT, role.person.name())
                 break
@@ -3307,10 +3379,12 @@ class FASnetForm(object):
         self.c.showPage()
 
 
-def fasnet_forms(grads, outfile):
+def fasnet_forms(grads, outfile, progress=None):
     doc = FASnetForm(outfile)
-    for g in grads:
+    for i, g in enumerate(grads, start=1):
         doc.draw_form(g)
+        if progress:
+            progress(i)
     doc.save()
 
 
@@ -4279,7 +4353,7 @@ class SessionalForm(FormMixin, SFUMediaMixin):
         self.c.setStrokeColor(black)
 
         # SFU logo
-        self.c.drawImage(logofile, x=0, y=247 * mm, width=15 * mm, height=8 * mm)
+        self.c.drawImage(media.logo(), x=0, y=247 * mm, width=15 * mm, height=8 * mm)
         self.c.setFont('BemboMTPro', 10)
         self.c.setFillColor(self.sfu_red)
         self._drawStringLeading(self.c, 17 * mm, 250 * mm, 'Simon Fraser University'.translate(self.sc_trans_bembo),
@@ -4524,7 +4598,7 @@ class KeyForm(FormMixin, SFUMediaMixin):
         self.c.setStrokeColor(black)
 
         # SFU logo
-        self.c.drawImage(logofile, x=0.5, y=200 * mm, width=24 * mm, height=10 * mm)
+        self.c.drawImage(media.logo(), x=0.5, y=200 * mm, width=24 * mm, height=10 * mm)
         self.c.setFont('BemboMTPro', 10)
         self.c.setFillColor(self.sfu_red)
         self._drawStringLeading(self.c, 28 * mm, 204 * mm, 'SIMON FRASER UNIVERSITY'.translate(self.sc_trans_bembo),
@@ -4614,6 +4688,10 @@ def key_form(booking, outfile):
     doc.draw_form(booking)
     doc.save()
 
+def _ta_evaluation_form_inputs(ta_evaluation, member, course):
+    return [ta_evaluation, member, member.person, course, course.owner, course.semester, list(course.instructors())]
+
+@cached_pdf('ta_evaluation_form', _ta_evaluation_form_inputs)
 def ta_evaluation_form(ta_evaluation, member, course, outfile):
     """
     Generate TUG Form for individual TA.
@@ -4690,7 +4768,7 @@ class TAEvalForm(object):
         self.c.drawString(0, 225*mm, "APPENDIX E")
         p.moveTo(0, 224*mm)   #x, y
         p.lineTo(22*mm, 224*mm)
-        self.c.drawImage(logofile, x=20.5*mm, y=210*mm, width=20.5*mm, height=10.3*mm)
+        self.c.drawImage(media.logo(), x=20.5*mm, y=210*mm, width=20.5*mm, height=10.3*mm)
         self.c.setFont("Helvetica-Oblique", 10)
         self.c.drawString(60.35*mm, 215*mm, "SIMON FRASER UNIVERSITY")
         p.moveTo(60.35*mm, 214*mm)   #x, y
@@ -5259,6 +5337,12 @@ class TAEvalForm(object):
     def save(self):
         self.c.save()    
 
+def _tug_form_inputs(tug, contract_info, new_format):
+    # contract_info is ignored by TUGForm.draw_form_tug
+    offering = tug.member.offering
+    return [tug, tug.member, tug.member.person, offering, offering.semester, list(offering.instructors()), new_format]
+
+@cached_pdf('tug_form', _tug_form_inputs)
 def tug_form(tug, contract_info, new_format, outfile):
     """
     Generate TUG Form for individual TA.
@@ -5397,8 +5481,8 @@ class TUGForm(object):
         self.c.drawPath(p, stroke=1, fill=0)
 
         # header
-        #self.c.drawImage(logofile, x=main_width/2 - 0.5*inch, y=227*mm, width=1*inch, height=0.5*inch)
-        self.c.drawImage(logofile, x=0, y=227*mm, width=1*inch, height=0.5*inch)
+        #self.c.drawImage(media.logo(), x=main_width/2 - 0.5*inch, y=227*mm, width=1*inch, height=0.5*inch)
+        self.c.drawImage(media.logo(), x=0, y=227*mm, width=1*inch, height=0.5*inch)
         self.c.setFont("Times-Roman", 12)
         self.c.drawString(2.5*inch, 235*mm, "Simon Fraser University")
         self.c.setFont("Times-Roman", 12)
@@ -5520,8 +5604,8 @@ class TUGForm(object):
         self.c.drawPath(p, stroke=1, fill=0)
 
         # header
-        #self.c.drawImage(logofile, x=main_width/2 - 0.5*inch, y=227*mm, width=1*inch, height=0.5*inch)
-        self.c.drawImage(logofile, x=0, y=227*mm, width=1*inch, height=0.5*inch)
+        #self.c.drawImage(media.logo(), x=main_width/2 - 0.5*inch, y=227*mm, width=1*inch, height=0.5*inch)
+        self.c.drawImage(media.logo(), x=0, y=227*mm, width=1*inch, height=0.5*inch)
         self.c.setFont("Times-Roman", 12)
         self.c.drawString(2.5*inch, 235*mm, "Simon Fraser University")
         self.c.setFont("Times-Roman", 12)
@@ -5707,8 +5791,8 @@ class WRForm(object):
         p = self.c.beginPath()
 
         # WR
-        #self.c.drawImage(logofile, x=main_width/2 - 0.5*inch, y=227*mm, width=1*inch, height=0.5*inch)
-        self.c.drawImage(logofile, x=0, y=227*mm, width=1*inch, height=0.5*inch)
+        #self.c.drawImage(media.logo(), x=main_width/2 - 0.5*inch, y=227*mm, width=1*inch, height=0.5*inch)
+        self.c.drawImage(media.logo(), x=0, y=227*mm, width=1*inch, height=0.5*inch)
         self.c.setFont("Times-Roman", 12)
         self.c.drawString(2.8*inch, 235*mm, "Simon Fraser University")
         self.c.setFont("Times-Roman", 12)
@@ -3,13 +3,14 @@ from coredata.models import Person, CourseOffering, Member
 from django.utils.safestring import mark_safe
 from pytz import timezone
 from django.conf import settings
-from django.core.mail import EmailMultiAlternatives
+from django.core.cache import cache
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.urls import reverse
 from autoslug.settings import slugify
 from courselib.json_fields import JSONField, config_property
 from courselib.branding import product_name
 from courselib.storage import UploadedFileStorage, upload_path
-import random, hashlib, os, datetime
+import random, hashlib, os, datetime, copy, time
 
 
 def _rfc_format(dt):
@@ -58,13 +59,17 @@ class NewsItem(models.Model):
         super(NewsItem, self).save(*args, **kwargs)
 
         # see if this user wants news by email
-        ucs = UserConfig.objects.filter(user=self.user, key="newsitems")
-        if ucs and 'email' in ucs[0].value and not ucs[0].value['email']:
-            # user has requested no email
-            pass
-        else:
+        uc = UserConfig.objects.filter(user=self.user, key="newsitems").first()
+        if self.wants_email(uc):
             self.email_user()
 
+    @staticmethod
+    def wants_email(userconfig):
+        """
+        Does this user want news by email, according to their "newsitems" UserConfig (or None if they have none)?
+        """
+        return not (userconfig and 'email' in userconfig.value and not userconfig.value['email'])
+
     def email_from(self):
         """
         Determine who the email should appear to come from: perfer to use course contact email if exists.
@@ -96,7 +101,12 @@ class NewsItem(models.Model):
         """
         if not self.user.email():
             return
+        self.email_message().send()
 
+    def email_message(self):
+        """
+        Build the email for this news item to the user.
+        """
         headers = {
                 'Precedence': 'bulk',
                 'Auto-Submitted': 'auto-generated',
@@ -134,14 +144,17 @@ class NewsItem(models.Model):
         
         msg = EmailMultiAlternatives(subject, text_content, from_email, [to_email], headers=headers)
         msg.attach_alternative(html_content, "text/html")
-        msg.send()
-        
+        return msg
+
+    def content_xhtml_args(self):
+        return {'markup': self.content, 'markuplang': self.markup, 'html_already_safe': False, 'restricted': True}
+
     def content_xhtml(self):
         """
         Render content field as XHTML.
         """
-        from courselib.markup import markup_to_html
-        return markup_to_html(self.content, self.markup, html_already_safe=False, restricted=True)
+        from courselib.markup import markup_html_for
+        return markup_html_for(self, 'content_xhtml')
 
     def rfc_updated(self):
         """
@@ -177,15 +190,85 @@ class NewsItem(models.Model):
         newsitem_kwargs.
         """
         # randomize order in the hopes of throwing off any spam filters
-        members = Member.objects.exclude(role="DROP").exclude(role="APPR").filter(**member_kwargs)
+        members = Member.objects.exclude(role="DROP").exclude(role="APPR").filter(**member_kwargs) \
+            .select_related('person')
         members = list(members)
         random.shuffle(members)
 
         markup = newsitem_kwargs.pop('markup', 'textile')
+        items = []
         for m in members:
             n = NewsItem(user=m.person, **newsitem_kwargs)
             n.markup = markup
-            n.save()
+            items.append(n)
+
+        cls.bulk_create_and_email(items)
+
+    @classmethod
+    def bulk_create_and_email(cls, items):
+        """
+        Save these NewsItems, which must be the same story for different users, and email them to the users who want
+        news by email. Equivalent to .save() on each, but the UserConfigs are fetched in one query, the email is
+        rendered once, and the messages are sent together over one connection (which is chunked into tasks on the
+        Celery email queue, if we're sending email that way).
+        """
+        if not items:
+            return
+        NewsItem.objects.bulk_create(items, batch_size=500)
+
+        user_ids = [n.user_id for n in items]
+        configs = {uc.user_id: uc for uc in UserConfig.objects.filter(user_id__in=user_ids, key="newsitems")}
+        recipients = [n.user for n in items if n.wants_email(configs.get(n.user_id)) and n.user.email()]
+        if not recipients:
+            return
+
+        template = items[0].email_message()
+        messages = []
+        for person in recipients:
+            msg = copy.copy(template)
+            msg.to = [person.full_email()]
+            messages.append(msg)
+
+        get_connection().send_messages(messages)
+
+
+# versions of the calendar data for each offering, for dashboard.views.calendar_ical's caching
+CALENDAR_HOLIDAYS = 'holidays'
+CALENDAR_VERSION_KEY = 'calendar-version-%s'
+
+def calendar_versions(offering_ids):
+    """
+    Current version of the calendar data for each of these offerings (and holidays, as key CALENDAR_HOLIDAYS): the
+    timestamp of its last change (or of when we started tracking it).
+    """
+    idents = {CALENDAR_VERSION_KEY % (i,): i for i in [CALENDAR_HOLIDAYS] + list(offering_ids)}
+    found = cache.get_many(idents.keys())
+    missing = {key: time.time() for key in idents if key not in found}
+    if missing:
+        cache.set_many(missing, None)
+        found.update(missing)
+    return {idents[key]: version for key, version in found.items()}
+
+
+def calendar_changed(instance, **kwargs):
+    """
+    Signal handler: update the calendar version when something on the calendar changes.
+    """
+    from coredata.models import MeetingTime, Holiday
+    from grades.models import Activity
+    if isinstance(instance, Holiday):
+        ident = CALENDAR_HOLIDAYS
+    elif isinstance(instance, (MeetingTime, Activity)) and instance.offering_id:
+        ident = instance.offering_id
+    else:
+        return
+    cache.set(CALENDAR_VERSION_KEY % (ident,), time.time(), None)
+
+# grades.models imports this module, so the Activity classes are given by name
+for sender in ['coredata.Holiday', 'coredata.MeetingTime', 'grades.Activity', 'grades.NumericActivity',
+               'grades.LetterActivity', 'grades.CalNumericActivity', 'grades.CalLetterActivity']:
+    models.signals.post_save.connect(calendar_changed, sender=sender)
+    models.signals.post_delete.connect(calendar_changed, sender=sender)
 
 
 class UserConfig(models.Model):
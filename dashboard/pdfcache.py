@@ -0,0 +1,188 @@
+"""
+On-disk cache of generated letters and forms, so opening the same document again doesn't re-run the reportlab layout.
+
+A cached PDF is named by a hash of everything it's drawn from: the fields of the model objects it depends on, any
+other arguments, the signature image files it includes, and PDF_CACHE_VERSION. If any of those change, the document
+gets a new name and is regenerated. The hash is also the document's ETag, so browsers can revalidate cheaply.
+
+Files are stored in a directory for their "owner" (the Letter, RARequest, TAContract, TUG, ...), which is removed when
+the owner is saved or deleted: see remove_cached_pdfs. prune_pdf_cache (run regularly by Celery) removes files unused
+for settings.PDF_CACHE_AGE days (some of these documents contain SINs, so they shouldn't stay on disk indefinitely), and
+the least-recently-used files beyond that to keep the cache under settings.PDF_CACHE_MAX_SIZE.
+"""
+
+import datetime
+import decimal
+import functools
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from django.conf import settings
+from django.db import models
+from django.db.models.fields.files import FieldFile
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+
+PDF_CACHE_VERSION = 1  # increment when the layout of any cached document changes
+
+
+def _file_value(f):
+    """
+    Identify the contents of the file by name, size, and modification time (since a replaced file can reuse a name).
+    """
+    if not f:
+        return None
+    try:
+        return [f.name, f.size, f.storage.get_modified_time(f.name).timestamp()]
+    except (OSError, NotImplementedError):
+        return [f.name]
+
+
+def _input_value(obj):
+    """
+    JSON-able representation of one of a document's inputs.
+    """
+    if isinstance(obj, models.Model):
+        values = [obj._meta.label_lower]
+        for field in obj._meta.concrete_fields:
+            value = field.value_from_object(obj)
+            if isinstance(value, FieldFile):
+                values.append(_file_value(value))
+            else:
+                values.append(_input_value(value))
+        return values
+    elif isinstance(obj, (list, tuple)):
+        return [_input_value(o) for o in obj]
+    elif isinstance(obj, dict):
+        return {str(k): _input_value(v) for k, v in obj.items()}
+    elif isinstance(obj, (datetime.date, datetime.datetime, datetime.time, decimal.Decimal)):
+        return str(obj)
+    else:
+        return obj
+
+
+def pdf_fingerprint(kind, inputs):
+    """
+    Hash identifying the document of this kind, drawn from these inputs.
+    """
+    data = json.dumps([PDF_CACHE_VERSION, kind, _input_value(inputs)], sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def _owner_path(owner):
+    return os.path.join(settings.PDF_CACHE_PATH, owner._meta.label_lower, str(owner.pk))
+
+
+def _cached_pdf(owner, fingerprint, generate):
+    """
+    The contents of the cached PDF, generating it with generate(outfile) if it's not already there.
+    """
+    path = os.path.join(_owner_path(owner), fingerprint + '.pdf')
+    try:
+        with open(path, 'rb') as fh:
+            data = fh.read()
+        os.utime(path)  # mark as recently used, for prune_pdf_cache
+        return data
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            generate(fh)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    with open(path, 'rb') as fh:
+        return fh.read()
+
+
+def cached_pdf(kind, inputs):
+    """
+    Decorator for a function generate(owner, *args, outfile) that draws one document: inputs(owner, *args) must return
+    a list of everything the document is drawn from.
+
+    The decorated function writes the cached PDF to outfile, generating it only if necessary. It also has a
+    .fingerprint(*args) method, and can be passed to pdf_response.
+    """
+    def decorator(generate):
+        def fingerprint(*args):
+            return pdf_fingerprint(kind, inputs(*args))
+
+        def write_pdf(fingerprint, args, outfile):
+            data = _cached_pdf(args[0], fingerprint, lambda fh: generate(*args, fh))
+            outfile.write(data)
+
+        @functools.wraps(generate)
+        def wrapper(*args):
+            *args, outfile = args
+            write_pdf(fingerprint(*args), args, outfile)
+
+        wrapper.fingerprint = fingerprint
+        wrapper.write_pdf = write_pdf
+        return wrapper
+    return decorator
+
+
+def pdf_response(request, pdf_function, args, filename):
+    """
+    Response for the document drawn by pdf_function(*args, outfile) (which must be decorated with @cached_pdf): from
+    the cache if possible, or a 304 if the browser already has it.
+    """
+    fingerprint = pdf_function.fingerprint(*args)
+    etag = quote_etag(fingerprint)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(content_type='application/pdf')
+        response['Content-Disposition'] = 'inline; filename="%s"' % (filename,)
+        pdf_function.write_pdf(fingerprint, args, response)
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def remove_cached_pdfs(sender, instance, **kwargs):
+    """
+    Signal handler to remove the cached documents owned by this instance: connected to post_save and post_delete of
+    the owner models.
+    """
+    if instance.pk is None:
+        return
+    shutil.rmtree(_owner_path(instance), ignore_errors=True)
+
+
+def prune_pdf_cache():
+    """
+    Remove cached documents unused for settings.PDF_CACHE_AGE days, and the least-recently-used others until the
+    cache is no bigger than settings.PDF_CACHE_MAX_SIZE.
+    """
+    cutoff = time.time() - settings.PDF_CACHE_AGE * 86400
+    files = []
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(settings.PDF_CACHE_PATH):
+        for fn in filenames:
+            path = os.path.join(dirpath, fn)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+    files.sort()
+    for mtime, size, path in files:
+        if mtime >= cutoff and total <= settings.PDF_CACHE_MAX_SIZE:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
@@ -14,3 +14,21 @@ if not settings.USE_CELERY:
 def photo_password_update_task():
     if settings.DO_IMPORTING_HERE:
         change_photo_password()
+
+
+@task(queue='batch')
+def bulk_pdf_task(job_id):
+    from dashboard.bulkpdf import generate_bulk_pdf
+    generate_bulk_pdf(job_id)
+
+
+@task(queue='batch')
+def remove_old_bulk_pdfs_task():
+    from dashboard.bulkpdf import remove_old_bulk_pdfs
+    remove_old_bulk_pdfs()
+
+
+@task(queue='batch')
+def prune_pdf_cache_task():
+    from dashboard.pdfcache import prune_pdf_cache
+    prune_pdf_cache()
@@ -1,11 +1,12 @@
 from coredata.tests import create_offering
-from coredata.models import Person, Member, CourseOffering, Role, Semester
-from dashboard.models import UserConfig, NewsItem
+from coredata.models import Person, Member, CourseOffering, Role, Semester, MeetingTime
+from dashboard.models import UserConfig, NewsItem, calendar_versions
 from courselib.testing import TEST_COURSE_SLUG, Client, validate_content, create_test_offering, test_views, \
     freshen_roles
 from django.test import TestCase
 from django.urls import reverse
 from django.core.management import call_command
+from django.core import mail
 from haystack.query import SearchQuerySet
 from pages.models import Page, PageVersion
 import re, datetime
@@ -275,6 +276,71 @@ class DashboardTest(TestCase):
         self.assertEqual(len(confs), 1)
         self.assertIsNotNone(tokenre.match(confs[0].value['token']))
 
+    def test_calendar_ical(self):
+        """
+        iCalendar feeds: cached fragments, conditional GET, invalidation.
+        """
+        offering = CourseOffering.objects.get(slug=TEST_COURSE_SLUG)
+        s = offering.semester
+        today = datetime.date.today()
+        s.start = today - datetime.timedelta(days=100)
+        s.end = today + datetime.timedelta(days=100)
+        s.save()
+        member = Member.objects.filter(offering=offering, role="STUD")[0]
+        userid = member.person.userid
+        UserConfig(user=member.person, key='calendar-config', value={'token': '0123456789abcdef0123456789abcdef'}).save()
+        activity = offering.activity_set.filter(deleted=False)[0]
+        activity.due_date = datetime.datetime.combine(today + datetime.timedelta(days=3), datetime.time(12, 0))
+        activity.save()
+
+        client = Client()
+        url = reverse('calendar:calendar_ical', kwargs={'token': '0123456789abcdef0123456789abcdef', 'userid': userid})
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "BEGIN:VCALENDAR")
+        self.assertContains(response, "SUMMARY:%s: %s due" % (offering.name(), activity.name))
+        etag = response['ETag']
+
+        # unchanged: not modified
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # changed due date: new content
+        activity.due_date += datetime.timedelta(days=1)
+        activity.save()
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertContains(response, activity.due_date.strftime("%Y%m%dT%H%M%S"))
+
+        # only calendar models change the versions
+        versions = calendar_versions([offering.id])
+        member.person.save()
+        self.assertEqual(calendar_versions([offering.id]), versions)
+        MeetingTime(offering=offering, weekday=1, start_time=datetime.time(10, 30), end_time=datetime.time(11, 20),
+                    start_day=s.start, end_day=s.end, room='AQ 3000').save()
+        self.assertNotEqual(calendar_versions([offering.id])[offering.id], versions[offering.id])
+
+    def test_news_for_members(self):
+        """
+        Bulk creation and emailing of news items for a class.
+        """
+        offering = CourseOffering.objects.get(slug=TEST_COURSE_SLUG)
+        members = Member.objects.exclude(role__in=["DROP", "APPR"]).filter(offering=offering).select_related('person')
+        optout = members.filter(role='STUD')[0].person
+        UserConfig(user=optout, key='newsitems', value={'email': False}).save()
+        mail.outbox = []
+
+        NewsItem.for_members(member_kwargs={'offering': offering}, newsitem_kwargs={
+            'author': None, 'course': offering, 'source_app': 'dashboard', 'title': 'Announcement',
+            'content': 'Something *important*.', 'url': '', 'markup': 'markdown'})
+
+        self.assertEqual(NewsItem.objects.filter(course=offering, title='Announcement').count(), members.count())
+        self.assertEqual(len(mail.outbox), members.count() - 1)
+        recipients = {msg.to[0] for msg in mail.outbox}
+        self.assertEqual(recipients, {m.person.full_email() for m in members if m.person != optout})
+        self.assertIn('<em>important</em>', mail.outbox[0].alternatives[0][0])
+
     def test_pages(self):
         person = Person.objects.filter(userid__isnull=False)[0]
         c = Client()
@@ -1,7 +1,8 @@
 import os
 
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponse, HttpResponseRedirect, HttpResponsePermanentRedirect, Http404, HttpResponseForbidden
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponsePermanentRedirect, Http404, HttpResponseForbidden, \
+    FileResponse
 from django.urls import reverse
 from django.contrib.auth.decorators import login_required
 from django.db.models import Count, Q
@@ -9,6 +10,9 @@ from django.template import TemplateDoesNotExist
 from django.views.decorators.gzip import gzip_page
 from django.conf import settings
 from django.contrib import messages
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 from coredata.models import Member, CourseOffering, Person, Role, Semester, MeetingTime, Holiday
 from grades.models import Activity, NumericActivity
 from privacy.models import RELEVANT_ROLES as PRIVACY_ROLES
@@ -16,8 +20,10 @@ from courselib.auth import requires_course_staff_by_slug, NotFoundResponse, \
     has_role, requires_global_role
 from courselib.auth import get_person
 from courselib.branding import product_name
-from dashboard.models import NewsItem, UserConfig, Signature, new_feed_token
+from courselib.markup import prefetch_markup_html
+from dashboard.models import NewsItem, UserConfig, Signature, new_feed_token, calendar_versions, CALENDAR_HOLIDAYS
 from dashboard.forms import FeedSetupForm, NewsConfigForm, SignatureForm, PhotoAgreementForm
+from dashboard.bulkpdf import bulk_pdf_status, bulk_pdf_path
 from grad.models import GradStudent, Supervisor, STATUS_ACTIVE
 from discuss.models import DiscussionTopic
 from onlineforms.models import FormGroup
@@ -25,7 +31,7 @@ from pages.models import Page, ACL_ROLES
 from ra.models import RAAppointment, RARequest
 from reports.models import AccessRule
 from log.models import LogEntry
-import datetime, json, urllib.parse
+import datetime, json, urllib.parse, hashlib
 from courselib.auth import requires_role
 from icalendar import Calendar, Event
 from haystack.query import SearchQuerySet
@@ -237,7 +243,9 @@ def config(request):
 
 def _get_news_list(userid, count):
     past_1mo = datetime.datetime.today() - datetime.timedelta(days=20)
-    return NewsItem.objects.filter(user__userid=userid, updated__gte=past_1mo).order_by('-updated').select_related('course')[:count]
+    news_list = list(NewsItem.objects.filter(user__userid=userid, updated__gte=past_1mo).order_by('-updated').select_related('course')[:count])
+    prefetch_markup_html(news_list, 'content_xhtml')
+    return news_list
 
 
 def atom_feed(request, token, userid, course_slug=None):
@@ -259,8 +267,9 @@ def atom_feed(request, token, userid, course_slug=None):
     if course_slug:
         course = get_object_or_404(CourseOffering, slug=course_slug)
         news_list = news_list.filter(course=course)
-    news_list = news_list[:20]
-    
+    news_list = list(news_list[:20])
+    prefetch_markup_html(news_list, 'content_xhtml')
+
     if news_list:
         updated = news_list[0].rfc_updated()
     else:
@@ -306,17 +315,12 @@ def _holiday_colour(h):
     return "#060680"
 
 ICAL_SEQUENCE = '3' # used to perturb the icalendar idents when the output changes
-def _offerings_calendar_data(offerings, labsecs, start, end, local_tz, dt_string=True, colour=False, browse_titles=False):
+def _holiday_calendar_data(start, end, dt_string=True, colour=False, cancellations=None):
     """
-    Get calendar data for this set of offerings and lab sections.
-    
-    Used both in _calendar_event_data and by the course browser (coredata.views.browse_courses_info)
+    Calendar data for holidays in this range. Days when classes are cancelled are added to the cancellations set.
     """
-
-    # holidays and cancellations
-    cancellations = set() # days when classes cancelled
     for h in Holiday.objects.filter(date__gte=start, date__lte=end):
-        if h.holiday_type in ['FULL', 'CLAS']:
+        if cancellations is not None and h.holiday_type in ['FULL', 'CLAS']:
             cancellations.add(h.date)
 
         ident = "holiday-" + str(h.id) + "-" + h.date.strftime("%Y%m%d") + "-" + ICAL_SEQUENCE + "@courses.cs.sfu.ca"
@@ -338,7 +342,12 @@ def _offerings_calendar_data(offerings, labsecs, start, end, local_tz, dt_string
             e['color'] = _holiday_colour(h)
         yield e
 
-    # map of offering_id -> this student's lab section (so we only output the right one)
+
+def _meeting_calendar_data(offerings, labsecs, start, end, local_tz, cancellations, dt_string=True, colour=False,
+                           browse_titles=False):
+    """
+    Calendar data for meeting times of these offerings, as (MeetingTime, event) pairs.
+    """
     class_list = MeetingTime.objects.filter(offering__in=offerings).select_related('offering')
     
     # meeting times
@@ -379,19 +388,73 @@ def _offerings_calendar_data(offerings, labsecs, start, end, local_tz, dt_string
                 }
             if colour:
                 e['color'] = _meeting_colour(mt)
-            yield e
+            yield mt, e
 
 
+def _offerings_calendar_data(offerings, labsecs, start, end, local_tz, dt_string=True, colour=False, browse_titles=False):
+    """
+    Get calendar data for this set of offerings and lab sections.
+    
+    Used both in _calendar_event_data and by the course browser (coredata.views.browse_courses_info)
+    """
+    cancellations = set() # days when classes cancelled
+    yield from _holiday_calendar_data(start, end, dt_string, colour, cancellations)
+    for _, e in _meeting_calendar_data(offerings, labsecs, start, end, local_tz, cancellations, dt_string, colour,
+                                       browse_titles):
+        yield e
 
-def _calendar_event_data(user, start, end, local_tz, dt_string, colour=False,
+
+def _activity_calendar_data(activities, start, end, local_tz, dt_string, colour=False,
         due_before=datetime.timedelta(minutes=1), due_after=datetime.timedelta(minutes=0)):
     """
-    Data needed to render either calendar AJAX or iCalendar.  Yields series of event dictionaries.
+    Calendar data for the due dates of these activities.
+    """
+    for a in activities:
+        if not a.due_date:
+            continue
+        st = local_tz.localize(a.due_date - due_before)
+        en = local_tz.localize(a.due_date + due_after)
+        if en < start or st > end:
+            continue
+        
+        ident = a.offering.slug.replace("-","") + "-" + str(a.id) + "-" + a.slug.replace("-","") + "-" + a.due_date.strftime("%Y%m%dT%H%M%S") + "-" + ICAL_SEQUENCE + "@courses.cs.sfu.ca"
+        title = '%s: %s due' % (a.offering.name(), a.name)
+        if dt_string:
+            st = st.isoformat()
+            en = en.isoformat()
+        
+        e = {
+            'id': ident,
+            'title': title,
+            'start': st,
+            'end': en,
+            'allDay': False,
+            #'className': 'ev-due',
+            'url': urllib.parse.urljoin(settings.BASE_ABS_URL, _activity_url(a)),
+            'category': 'DUE',
+            }
+        if colour:
+            e['color'] = _activity_colour(a)
+        yield e
+
+
+def _calendar_memberships(user, start, end):
+    """
+    The memberships whose offerings should appear on this user's calendar.
     """
-    memberships = Member.objects.filter(person=user, offering__graded=True).exclude(role="DROP").exclude(role="APPR")\
+    return Member.objects.filter(person=user, offering__graded=True).exclude(role="DROP").exclude(role="APPR")\
         .exclude(offering__component="CAN").filter(offering__semester__start__lte=end,
-                                                   offering__semester__end__gte=start-datetime.timedelta(days=30))
+                                                   offering__semester__end__gte=start-datetime.timedelta(days=30))\
+        .select_related('offering')
             # start - 30 days to make sure we catch exam/end of semester events
+
+
+def _calendar_event_data(user, start, end, local_tz, dt_string, colour=False,
+        due_before=datetime.timedelta(minutes=1), due_after=datetime.timedelta(minutes=0)):
+    """
+    Data needed to render either calendar AJAX or iCalendar.  Yields series of event dictionaries.
+    """
+    memberships = _calendar_memberships(user, start, end)
     classes = set((m.offering for m in memberships))
     labsecs = dict(((m.offering_id, m.labtut_section) for m in memberships))
 
@@ -401,33 +464,8 @@ def _calendar_event_data(user, start, end, local_tz, dt_string, colour=False,
 
     # add every assignment with a due datetime
     for m in memberships:
-        for a in m.offering.activity_set.filter(deleted=False):
-            if not a.due_date:
-                continue
-            st = local_tz.localize(a.due_date - due_before)
-            en = end = local_tz.localize(a.due_date + due_after)
-            if en < start or st > end:
-                continue
-            
-            ident = a.offering.slug.replace("-","") + "-" + str(a.id) + "-" + a.slug.replace("-","") + "-" + a.due_date.strftime("%Y%m%dT%H%M%S") + "-" + ICAL_SEQUENCE + "@courses.cs.sfu.ca"
-            title = '%s: %s due' % (a.offering.name(), a.name)
-            if dt_string:
-                st = st.isoformat()
-                en = en.isoformat()
-            
-            e = {
-                'id': ident,
-                'title': title,
-                'start': st,
-                'end': en,
-                'allDay': False,
-                #'className': 'ev-due',
-                'url': urllib.parse.urljoin(settings.BASE_ABS_URL, _activity_url(a)),
-                'category': 'DUE',
-                }
-            if colour:
-                e['color'] = _activity_colour(a)
-            yield e
+        yield from _activity_calendar_data(m.offering.activity_set.filter(deleted=False), start, end, local_tz,
+                                           dt_string, colour, due_before, due_after)
     
 
 def _ical_datetime(utc, dt):
@@ -437,12 +475,70 @@ def _ical_datetime(utc, dt):
         return dt
 
 
+def _ical_event(data):
+    """
+    iCalendar VEVENT for this event data.
+    """
+    utc = pytz.utc
+    e = Event()
+    e['uid'] = str(data['id'])
+    e.add('summary', data['title'])
+    e.add('dtstart', _ical_datetime(utc, data['start']))
+    e.add('dtend', _ical_datetime(utc, data['end']))
+    if data['category'] in ('DUE', 'HOLIDAY'):
+        # these shouldn't be "busy" on calendars
+        e.add('transp', 'TRANSPARENT')
+    else:
+        e.add('transp', 'OPAQUE')
+
+    # spec says no TZID on UTC times
+    if 'TZID' in e['dtstart'].params:
+        del e['dtstart'].params['TZID']
+    if 'TZID' in e['dtend'].params:
+        del e['dtend'].params['TZID']
+    
+    e.add('categories', data['category'])
+    if 'url' in data:
+        e.add('url', data['url'])
+    if 'location' in data:
+        e.add('location', data['location'])
+    return e
+
+
+ICAL_FRAGMENT_TIMEOUT = 24*3600
+def _ical_holiday_fragment(start, end):
+    """
+    The holidays' VEVENTs, as bytes.
+    """
+    return b''.join(_ical_event(e).to_ical() for e in _holiday_calendar_data(start, end, dt_string=False))
+
+
+def _ical_offering_fragment(offering, start, end, local_tz):
+    """
+    The VEVENTs for this offering, as a list of (labtut_section, bytes) pairs: labtut_section is None for events for
+    everyone in the offering.
+    """
+    cancellations = set()
+    for _ in _holiday_calendar_data(start, end, dt_string=False, cancellations=cancellations):
+        pass
+
+    events = [(mt.labtut_section, _ical_event(e).to_ical())
+              for mt, e in _meeting_calendar_data([offering], None, start, end, local_tz, cancellations, dt_string=False)]
+    activities = offering.activity_set.filter(deleted=False).select_related('offering')
+    events.extend((None, _ical_event(e).to_ical())
+                  for e in _activity_calendar_data(activities, start, end, local_tz, dt_string=False))
+    return events
+
+
 def calendar_ical(request, token, userid):
     """
     Return an iCalendar for this user, authenticated by the token in the URL
+
+    The VEVENTs for holidays and each offering are cached (per day, and versioned by dashboard.models.calendar_versions
+    so changes appear immediately), and merged for the user's memberships. The ETag/Last-Modified come from those
+    versions, so unchanged polls get a 304 without building anything.
     """
     local_tz = pytz.timezone(settings.TIME_ZONE)
-    utc = pytz.utc
     user = get_object_or_404(Person, userid=userid)
     
     # make sure the token in the URL (32 hex characters) matches the token stored in the DB
@@ -453,41 +549,59 @@ def calendar_ical(request, token, userid):
     #else:
         # authenticated
 
-    now = datetime.datetime.now()
-    start = local_tz.localize(now - datetime.timedelta(days=180))
-    end = local_tz.localize(now + datetime.timedelta(days=365))
-    
+    today = datetime.date.today()
+    midnight = datetime.datetime.combine(today, datetime.time())
+    start = local_tz.localize(midnight - datetime.timedelta(days=180))
+    end = local_tz.localize(midnight + datetime.timedelta(days=365))
+
+    memberships = list(_calendar_memberships(user, start, end))
+    offering_ids = sorted(set(m.offering_id for m in memberships))
+    versions = calendar_versions(offering_ids)
+
+    # conditional GET
+    sections = sorted((m.offering_id, m.labtut_section or '') for m in memberships)
+    version_list = [versions[CALENDAR_HOLIDAYS]] + [versions[oid] for oid in offering_ids]
+    etag = hashlib.sha1(repr((ICAL_SEQUENCE, today, sections, version_list)).encode('utf-8')).hexdigest()
+    last_modified = max([midnight.timestamp()] + list(versions.values()))
+    response = get_conditional_response(request, etag=quote_etag(etag), last_modified=int(last_modified))
+    if response is not None:
+        return response
+
+    # cached fragments
+    day = today.strftime('%Y%m%d')
+    holiday_version = versions[CALENDAR_HOLIDAYS]
+    holiday_key = 'calendar-ical-holidays-%s-%s' % (day, holiday_version)
+    offering_keys = {oid: 'calendar-ical-%i-%s-%s-%s' % (oid, day, versions[oid], holiday_version)
+                     for oid in offering_ids}
+    fragments = cache.get_many([holiday_key] + list(offering_keys.values()))
+    missing = {}
+    if holiday_key not in fragments:
+        missing[holiday_key] = _ical_holiday_fragment(start, end)
+    for m in memberships:
+        key = offering_keys[m.offering_id]
+        if key not in fragments and key not in missing:
+            missing[key] = _ical_offering_fragment(m.offering, start, end, local_tz)
+    if missing:
+        cache.set_many(missing, ICAL_FRAGMENT_TIMEOUT)
+        fragments.update(missing)
+
     cal = Calendar()
     cal.add('version', '2.0')
     cal.add('prodid', '-//SFU CourSys//courses.cs.sfu.ca//')
     cal.add('X-PUBLISHED-TTL', 'PT1D')
-    
-    for data in _calendar_event_data(user, start, end, local_tz, dt_string=False):
-        e = Event()
-        e['uid'] = str(data['id'])
-        e.add('summary', data['title'])
-        e.add('dtstart', _ical_datetime(utc, data['start']))
-        e.add('dtend', _ical_datetime(utc, data['end']))
-        if data['category'] in ('DUE', 'HOLIDAY'):
-            # these shouldn't be "busy" on calendars
-            e.add('transp', 'TRANSPARENT')
-        else:
-            e.add('transp', 'OPAQUE')
+    header = cal.to_ical()
+    footer = b'END:VCALENDAR\r\n'
+    assert header.endswith(footer)
 
-        # spec says no TZID on UTC times
-        if 'TZID' in e['dtstart'].params:
-            del e['dtstart'].params['TZID']
-        if 'TZID' in e['dtend'].params:
-            del e['dtend'].params['TZID']
-        
-        e.add('categories', data['category'])
-        if 'url' in data:
-            e.add('url', data['url'])
-        if 'location' in data:
-            e.add('location', data['location'])
-        cal.add_component(e)
-
-    resp = HttpResponse(cal.to_ical(), content_type="text/calendar")
+    content = [header[:-len(footer)], fragments[holiday_key]]
+    for m in memberships:
+        content.extend(ical for section, ical in fragments[offering_keys[m.offering_id]]
+                       if section is None or section == m.labtut_section)
+    content.append(footer)
+
+    resp = HttpResponse(b''.join(content), content_type="text/calendar")
+    resp['ETag'] = quote_etag(etag)
+    resp['Last-Modified'] = http_date(last_modified)
     return resp
 
 
@@ -622,8 +736,9 @@ def news_config(request):
 @login_required
 def news_list(request):
     user = get_object_or_404(Person, userid = request.user.username)
-    news_list = NewsItem.objects.filter(user = user).order_by('-updated')
-    
+    news_list = list(NewsItem.objects.filter(user = user).order_by('-updated'))
+    prefetch_markup_html(news_list, 'content_xhtml')
+
     return render(request, "dashboard/all_news.html", {"news_list": news_list})
 
 
@@ -732,6 +847,25 @@ def new_signature(request):
     return render(request, "dashboard/new_signature.html", context)
 
 
+@login_required
+def bulk_pdf(request, job_id):
+    """
+    Progress of a dashboard.bulkpdf job, and the PDF once it's done.
+    """
+    status = bulk_pdf_status(job_id)
+    if status is None or status['userid'] != request.user.username:
+        return NotFoundResponse(request, errormsg="That PDF doesn't exist, or is too old to still be available.")
+
+    path = bulk_pdf_path(job_id)
+    if status['finished'] and not status['error'] and os.path.exists(path):
+        response = FileResponse(open(path, 'rb'), content_type='application/pdf')
+        response['Content-Disposition'] = 'inline; filename="%s"' % (status['filename'],)
+        return response
+
+    context = {'status': status}
+    return render(request, "dashboard/bulk_pdf.html", context)
+
+
 
 def student_info(request, userid=None):
     # old student search view: new search is better in every way.
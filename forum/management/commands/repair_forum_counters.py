@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from forum.models import Thread, recount_thread_counters
+
+
+class Command(BaseCommand):
+    help = 'Recalculate the forum threads\' reply/reaction counters (and so their answered status) from their replies.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--offering', type=str, help='only check threads in the offering with this slug')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        threads = Thread.objects.order_by('id')
+        if options['offering']:
+            threads = threads.filter(post__offering__slug=options['offering'])
+
+        with transaction.atomic():
+            fixed = recount_thread_counters(threads)
+            if options['dry_run']:
+                transaction.set_rollback(True)
+
+        self.stdout.write('%i threads %s.' % (fixed, 'would be fixed' if options['dry_run'] else 'fixed'))
@@ -0,0 +1,62 @@
+from django.db import migrations, models
+
+
+APPROVAL_REACTIONS = ['UP', 'LOVE', 'CLAP']  # forum.models.APPROVAL_REACTIONS, at the time of this migration
+APPROVAL_ROLES = ['INST', 'TA']
+
+
+def fill_counters(apps, schema_editor):
+    # count the existing replies and reactions into the new Thread fields
+    Thread = apps.get_model('forum', 'Thread')
+    Reply = apps.get_model('forum', 'Reply')
+    Reaction = apps.get_model('forum', 'Reaction')
+
+    def count_by_thread(qs, thread_field):
+        return dict(qs.values_list(thread_field).annotate(n=models.Count('id')).order_by())
+
+    reactions = Reaction.objects.filter(reaction__in=APPROVAL_REACTIONS)
+    counts = {
+        'reply_count': count_by_thread(Reply.objects.all(), 'thread_id'),
+        'instr_reply_count': count_by_thread(Reply.objects.filter(post__author__role__in=APPROVAL_ROLES), 'thread_id'),
+        'approval_count': count_by_thread(reactions.filter(member__role__in=APPROVAL_ROLES), 'post__reply__thread_id'),
+        'asker_approval_count': count_by_thread(reactions.filter(member=models.F('post__reply__thread__post__author')),
+                                                'post__reply__thread_id'),
+    }
+
+    thread_ids = set()
+    for count in counts.values():
+        thread_ids.update(count.keys())
+    thread_ids.discard(None)
+    for thread_id in thread_ids:
+        Thread.objects.filter(id=thread_id).update(**{f: count.get(thread_id, 0) for f, count in counts.items()})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='reply_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='instr_reply_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='approval_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='asker_approval_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_counters, reverse_code=migrations.RunPython.noop),
+    ]
@@ -17,7 +17,7 @@ from django.utils.safestring import SafeString, mark_safe
 
 from coredata.models import CourseOffering, Member
 from courselib.json_fields import JSONField, config_property
-from courselib.markup import markup_to_html
+from courselib.markup import markup_to_html, markup_html_for
 from forum import DEFAULT_FORUM_MARKUP
 from forum.names_generator import get_random_name
 
@@ -305,8 +305,12 @@ class Post(models.Model):
         # if view_thread encounters a Reply and not a Thread, it will redirect
         return reverse('offering:forum:view_thread', kwargs={'course_slug': self.offering.slug, 'post_number': self.number})
 
+    def html_content_args(self) -> Dict[str, Any]:
+        return {'markup': self.content, 'markuplang': self.markup, 'math': self.math, 'restricted': True,
+                'forum_links': True}
+
     def html_content(self):
-        return markup_to_html(self.content, self.markup, math=self.math, restricted=True, forum_links=True)
+        return markup_html_for(self, 'html_content')
 
     def sees_real_name(self, viewer: Member) -> bool:
         return self.identity == 'NAME' or (self.identity == 'INST' and viewer.role != 'STUD')
@@ -361,38 +365,32 @@ class Post(models.Model):
         if self.status in ['HIDD', 'LOCK']:
             return
 
-        replies = Reply.objects.filter(parent=self).select_related('post', 'post__author')
-
         if self.type != 'QUES':
             self.status = 'NOAN'
 
         else:
             self.status = 'OPEN'
 
-            post_ids = [r.post_id for r in replies]
-            approvals = Reaction.objects.filter(
-                post_id__in=post_ids,
-                member__role__in=APPROVAL_ROLES,
-                reaction__in=APPROVAL_REACTIONS
-            )
-            self.approved_answer = approvals.exists()
+            # the replies/reactions are counted in the Thread's counters (Thread.adjust_counters)
+            try:
+                thread = self.thread
+            except Thread.DoesNotExist:
+                # a new question: no replies yet
+                thread = Thread()
+
+            self.approved_answer = thread.approval_count > 0
             if self.approved_answer:
                 # there's an instructor-approved answer
                 self.status = 'ANSW'
                 self.answered_reason = 'REACT'
 
-            approvals = Reaction.objects.filter(
-                post_id__in=post_ids,
-                member=self.author,
-                reaction__in=APPROVAL_REACTIONS
-            )
-            self.asker_approved_answer = approvals.exists()
+            self.asker_approved_answer = thread.asker_approval_count > 0
             if self.asker_approved_answer:
                 # there's an asker-approved answer
                 self.status = 'ANSW'
                 self.answered_reason = 'AREACT'
 
-            self.instr_answer = replies.filter(post__author__role__in=APPROVAL_ROLES).exists()
+            self.instr_answer = thread.instr_reply_count > 0
             if self.instr_answer:
                 # there's an answer from an instructor
                 self.status = 'ANSW'
@@ -448,6 +446,12 @@ class Thread(models.Model):
     privacy = models.CharField(max_length=4, null=False, blank=False, default='ALL', choices=THREAD_PRIVACY_CHOICES)
     # most recent post under this thread, so we can easily order by activity
     last_activity = models.DateTimeField(default=datetime.datetime.now, null=False, blank=False)
+    # denormalized counts of the replies, which determine the .post.status: maintained by Reply.save and
+    # .reaction_changed, and can be rebuilt by recount_thread_counters.
+    reply_count = models.PositiveIntegerField(default=0)
+    instr_reply_count = models.PositiveIntegerField(default=0)  # replies by instructors/TAs
+    approval_count = models.PositiveIntegerField(default=0)  # approving reactions to replies by instructors/TAs
+    asker_approval_count = models.PositiveIntegerField(default=0)  # approving reactions to replies by the asker
     config = JSONField(null=False, blank=False, default=dict)
 
     was_broadcast = config_property('was_broadcast', False)  # was this an broadcast_announcement thread that was pushed?
@@ -504,6 +508,33 @@ class Thread(models.Model):
         })
         return data
 
+    def adjust_counters(self, **deltas: int) -> None:
+        """
+        Add to the counters (with an atomic update in the database), and update the .post.status accordingly.
+        """
+        Thread.objects.filter(id=self.id).update(**{f: models.F(f) + d for f, d in deltas.items()})
+        self.refresh_from_db(fields=list(deltas.keys()))
+        self.post.update_status(commit=True)
+
+    def reaction_changed(self, member: Member, old_reaction: str, new_reaction: str) -> None:
+        """
+        Update the counters for the member's reaction to one of this thread's replies changing from old_reaction to
+        new_reaction (either can be None for no reaction).
+        """
+        was_approval = old_reaction in APPROVAL_REACTIONS
+        is_approval = new_reaction in APPROVAL_REACTIONS
+        if was_approval == is_approval:
+            return
+
+        delta = 1 if is_approval else -1
+        deltas = {}
+        if member.role in APPROVAL_ROLES:
+            deltas['approval_count'] = delta
+        if member.id == self.post.author_id:
+            deltas['asker_approval_count'] = delta
+        if deltas:
+            self.adjust_counters(**deltas)
+
     def broadcast_announcement(self):
         """
         Email contents of this post to everyone in the course.
@@ -578,10 +609,19 @@ class Reply(models.Model):
     def save(self, real_change=False, create_history=False, *args, **kwargs):
         # real_change: user-noticeable changes that should bump last_updated and clear "read" statuses
         with transaction.atomic():
+            new_reply = self.id is None
             self.post.save(real_change=real_change)
             self.post_id = self.post.id
-            # the .update should be an one-field update, not risking racing some other process
-            Thread.objects.filter(id=self.thread_id).update(last_activity=datetime.datetime.now())
+            # the .update should be an one-field update (or increments), not risking racing some other process
+            thread_updates = {'last_activity': datetime.datetime.now()}
+            if new_reply:
+                thread_updates['reply_count'] = models.F('reply_count') + 1
+                if self.post.author.role in APPROVAL_ROLES:
+                    thread_updates['instr_reply_count'] = models.F('instr_reply_count') + 1
+            Thread.objects.filter(id=self.thread_id).update(**thread_updates)
+            if new_reply and Reply.thread.is_cached(self):
+                # keep the in-memory counters current, so callers can .update_status() with them
+                self.thread.refresh_from_db(fields=['reply_count', 'instr_reply_count'])
             result = super().save(*args, **kwargs)
 
             if create_history:
@@ -728,3 +768,45 @@ class Reaction(models.Model):
 
     def __str__(self):
         return '%s says %s' % (self.member.person.name_pref(), REACTION_ICONS[self.reaction])
+
+
+def recount_thread_counters(threads) -> int:
+    """
+    Recalculate the denormalized counters for these threads (a Thread QuerySet) from their replies and reactions, and
+    fix the status of any that were wrong. Returns the number of threads fixed.
+    """
+    def count_by_thread(qs, thread_field):
+        return dict(qs.values_list(thread_field).annotate(n=models.Count('id')).order_by())
+
+    thread_ids = threads.values('id')
+    replies = Reply.objects.filter(thread_id__in=thread_ids)
+    reactions = Reaction.objects.filter(post__reply__thread_id__in=thread_ids, reaction__in=APPROVAL_REACTIONS)
+    counts = {
+        'reply_count': count_by_thread(replies, 'thread_id'),
+        'instr_reply_count': count_by_thread(replies.filter(post__author__role__in=APPROVAL_ROLES), 'thread_id'),
+        'approval_count': count_by_thread(reactions.filter(member__role__in=APPROVAL_ROLES), 'post__reply__thread_id'),
+        'asker_approval_count': count_by_thread(reactions.filter(member=models.F('post__reply__thread__post__author')),
+                                                'post__reply__thread_id'),
+    }
+
+    fixed = 0
+    for thread in threads.select_related('post'):
+        changed = False
+        for field, count in counts.items():
+            if getattr(thread, field) != count.get(thread.id, 0):
+                setattr(thread, field, count.get(thread.id, 0))
+                changed = True
+
+        status = (thread.post.status, thread.post.approved_answer, thread.post.asker_approved_answer,
+                  thread.post.instr_answer)
+        thread.post.update_status()
+        if status != (thread.post.status, thread.post.approved_answer, thread.post.asker_approved_answer,
+                      thread.post.instr_answer):
+            thread.post.save()
+            changed = True
+
+        if changed:
+            Thread.objects.filter(id=thread.id).update(**{field: getattr(thread, field) for field in counts})
+            fixed += 1
+
+    return fixed
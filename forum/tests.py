@@ -1,6 +1,9 @@
 import datetime
+import io
 
+from django.core.management import call_command
 from django.test import TestCase
+from django.urls import reverse
 
 from coredata.models import CourseOffering, Member
 from courselib.markup import convert_forum_links, markup_to_html
@@ -144,3 +147,74 @@ class ForumTest(TestCase):
                    {'course_slug': self.offering.slug},
                    qs='q=sure')
 
+
+    def test_thread_counters(self):
+        """
+        The Thread's counters (and so the question status) are maintained as replies and reactions arrive.
+        """
+        thread = Thread.objects.get(id=self.thread.id)
+        self.assertEqual(thread.reply_count, 1)
+        self.assertEqual(thread.instr_reply_count, 1)
+        self.assertEqual(thread.approval_count, 0)
+        thread.post.update_status(commit=True)
+        self.assertEqual(thread.post.status, 'ANSW')
+        self.assertEqual(thread.post.answered_reason, 'INST')
+
+        # a student question with a student reply
+        student = Member.objects.get(offering=self.offering, person__userid='0aaa0')
+        other = Member.objects.filter(offering=self.offering, role='STUD').exclude(id=student.id).first()
+        p = Post(offering=self.offering, author=student, type='QUES')
+        p.content = 'Another?'
+        p.markup = 'plain'
+        t = Thread(title='Another Question', post=p)
+        t.save()
+        p = Post(offering=self.offering, author=other, type='DISC', status='NOAN')
+        p.content = 'Probably not.'
+        p.markup = 'plain'
+        r = Reply(thread=t, parent=t.post, post=p)
+        r.save()
+        t.post.update_status(commit=True)
+        t = Thread.objects.get(id=t.id)
+        self.assertEqual((t.reply_count, t.instr_reply_count), (1, 0))
+        self.assertEqual(t.post.status, 'OPEN')
+
+        # instructor approves the reply; then changes their mind
+        c = Client()
+        c.login_user('ggbaker')
+        url = reverse('offering:forum:react', kwargs={'course_slug': self.offering.slug,
+                                                      'post_number': r.post.number, 'reaction': 'UP'})
+        c.get(url)
+        t = Thread.objects.get(id=t.id)
+        self.assertEqual((t.approval_count, t.asker_approval_count), (1, 0))
+        self.assertEqual(t.post.status, 'ANSW')
+        self.assertEqual(t.post.answered_reason, 'REACT')
+        c.get(url)  # same reaction again: no double-counting
+        self.assertEqual(Thread.objects.get(id=t.id).approval_count, 1)
+        c.get(url.replace('/UP', '/CONF'))
+        t = Thread.objects.get(id=t.id)
+        self.assertEqual(t.approval_count, 0)
+        self.assertEqual(t.post.status, 'OPEN')
+
+        # the asker approves
+        c.login_user(student.person.userid)
+        c.get(url)
+        t = Thread.objects.get(id=t.id)
+        self.assertEqual((t.approval_count, t.asker_approval_count), (0, 1))
+        self.assertEqual(t.post.status, 'ANSW')
+        self.assertEqual(t.post.answered_reason, 'AREACT')
+
+        # broken counters are fixed by the repair command
+        Thread.objects.filter(id__in=[t.id, self.thread.id]).update(reply_count=0, instr_reply_count=0,
+                                                                     asker_approval_count=0)
+        out = io.StringIO()
+        call_command('repair_forum_counters', '--dry-run', stdout=out)
+        self.assertEqual(out.getvalue().strip(), '2 threads would be fixed.')
+        self.assertEqual(Thread.objects.get(id=t.id).reply_count, 0)
+        out = io.StringIO()
+        call_command('repair_forum_counters', stdout=out)
+        self.assertEqual(out.getvalue().strip(), '2 threads fixed.')
+        t = Thread.objects.get(id=t.id)
+        self.assertEqual((t.reply_count, t.instr_reply_count, t.approval_count, t.asker_approval_count), (1, 0, 0, 1))
+        self.assertEqual(t.post.status, 'ANSW')
+        thread = Thread.objects.get(id=self.thread.id)
+        self.assertEqual((thread.reply_count, thread.instr_reply_count), (1, 1))
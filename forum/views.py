@@ -15,6 +15,7 @@ from haystack.query import SearchQuerySet
 
 from coredata.models import Member, CourseOffering
 from courselib.auth import user_passes_test, is_course_member_by_slug, ForbiddenResponse
+from courselib.markup import prefetch_markup_html
 from forum.forms import ThreadForm, ReplyForm, SearchForm, AvatarForm, InstrThreadForm, InstrReplyForm, DigestForm, \
     PseudonymForm, InstrEditReplyForm, InstrEditThreadForm
 from forum.models import Thread, Identity, Forum, Reply, Reaction, \
@@ -103,7 +104,11 @@ def thread_list_context(member: Member) -> Dict[str, Any]:
     read_thread_ids = ReadThread.objects.filter(member=member).values_list('thread_id', flat=True)
     unread_threads = threads.exclude(id__in=read_thread_ids)
 
-    threads = threads[:THREAD_LIST_MAX]
+    # the thread's status and counts are denormalized into .post and the Thread, so this is all we need to query
+    threads = list(threads[:THREAD_LIST_MAX])
+    read_ids = set(read_thread_ids.filter(thread_id__in=[t.id for t in threads]))
+    for t in threads:
+        t.unread = t.id not in read_ids
     return {
         'threads': threads,
         'unread_threads': unread_threads,
@@ -245,6 +250,9 @@ def view_thread(request: ForumHttpRequest, post_number: int) -> HttpResponse:
     viewer_reactions = Reaction.objects.exclude(reaction='NONE').filter(post_id__in=all_post_ids, member=request.member)
     viewer_reactions = {r.post_id: r.reaction for r in viewer_reactions}
 
+    # render all of the posts' markup together
+    prefetch_markup_html([thread.post] + [r.post for r in replies], 'html_content')
+
     context['reply_form'] = reply_form
     context['replies'] = replies
     context['post_reactions'] = post_reactions
@@ -409,17 +417,22 @@ def react(request: ForumHttpRequest, post_number: int, reaction: str) -> HttpRes
         thread = get_object_or_404(Thread.objects.filter_for(request.member).select_related('post'), post__number=post_number)
         post = thread.post
         locked = thread.post.status == 'LOCK'
+        reply = None
 
     if post.author_id != request.member.id and not locked:
-        if Reaction.objects.filter(member=request.member, post=post).exists():
-            Reaction.objects.filter(member=request.member, post=post).update(reaction=reaction)
-        else:
-            r = Reaction(member=request.member, post=post, reaction=reaction)
-            r.save()
+        with transaction.atomic():
+            old = Reaction.objects.select_for_update().filter(member=request.member, post=post).first()
+            if old:
+                old_reaction = old.reaction
+                Reaction.objects.filter(id=old.id).update(reaction=reaction)
+            else:
+                old_reaction = None
+                r = Reaction(member=request.member, post=post, reaction=reaction)
+                r.save()
 
-        # update the .status of the parent post
-        for r in Reply.objects.filter(post=post).select_related('parent'):
-            r.parent.update_status(commit=True)
+            # update the thread's counters, and so the .status of the parent post
+            if reply:
+                reply.thread.reaction_changed(request.member, old_reaction, reaction)
 
         if not request.fragment_request:
             messages.add_message(request, messages.SUCCESS, 'Reaction recorded.')
@@ -7,7 +7,7 @@ from grad.models import Supervisor, GradProgram, GradStudent, GradStatus, \
         GradProgramHistory, GradRequirement, CompletedRequirement, \
         LetterTemplate, Letter, Promise, Scholarship, ScholarshipType, \
         SavedSearch, OtherFunding, GradFlagValue, FinancialComment, \
-        ProgressReport, ExternalDocument, \
+        ProgressReport, ExternalDocument, GradSemesterStatus, \
         GRAD_CAMPUS_CHOICES, THESIS_TYPE_CHOICES, THESIS_OUTCOME_CHOICES
 from courselib.forms import StaffSemesterField
 from coredata.models import Person, Semester, Role, VISA_STATUSES, GENDER_CHOICES
@@ -22,6 +22,11 @@ from django.utils.safestring import mark_safe
 from django.core.validators import EMPTY_VALUES
 from advisornotes.forms import StudentSearchForm
 from functools import reduce
+from collections import defaultdict
+from decimal import Decimal
+from django.db.models import DecimalField, Value
+from django.db.models.functions import Cast, Coalesce
+from courselib.json_fields import ConfigValue
 
 class QuickSearchForm(StudentSearchForm):
     pass
@@ -669,6 +674,87 @@ COLUMN_WIDTHS_DATA = (
         )
 COLUMN_WIDTHS = dict(COLUMN_WIDTHS_DATA)
 
+
+# Functions that fetch a column's values for many GradStudents at once, instead of getattribute's queries per student:
+# COLUMN_LOADERS[column](grads, column) returns a dict of GradStudent.id to value.
+COLUMN_LOADERS = {}
+
+def column_loader(*columns):
+    def decorator(loader):
+        for c in columns:
+            COLUMN_LOADERS[c] = loader
+        return loader
+    return decorator
+
+
+@column_loader('senior_supervisors', 'senior_supervisors_email', 'supervisors', 'supervisors_email')
+def _load_supervisors(grads, column):
+    supervisors = defaultdict(list)
+    for s in Supervisor.objects.filter(student__in=grads, removed=False).select_related('supervisor'):
+        supervisors[s.student_id].append(s)
+
+    values = {}
+    for g in grads:
+        sups = supervisors[g.id]
+        if column.startswith('senior_supervisors'):
+            senior = [s for s in sups if s.supervisor_type == 'SEN']
+            potential = [s for s in sups if s.supervisor_type == 'POT']
+            if column == 'senior_supervisors':
+                names = [s.sortname() for s in senior] or [s.sortname()+"*" for s in potential]
+            else:
+                names = [s.sfuemail() for s in senior] or [s.sfuemail() for s in potential]
+        else:
+            committee = [s for s in sups if s.supervisor_type in ['SEN','COM','COS']]
+            if column == 'supervisors':
+                names = [s.sortname() for s in committee]
+            else:
+                names = [s.sfuemail() for s in committee]
+        values[g.id] = '; '.join(names)
+    return values
+
+
+@column_loader('completed_req')
+def _load_completed_req(grads, column):
+    reqs = defaultdict(list)
+    for cr in CompletedRequirement.objects.filter(student__in=grads).select_related('requirement'):
+        reqs[cr.student_id].append(cr.requirement.description)
+    return {g.id: ', '.join(reqs[g.id]) for g in grads}
+
+
+@column_loader('scholarships')
+def _load_scholarships(grads, column):
+    scholarships = defaultdict(list)
+    for sch in Scholarship.objects.filter(student__in=grads).select_related('scholarship_type'):
+        scholarships[sch.student_id].append(str(sch))
+    return {g.id: '; '.join(scholarships[g.id]) for g in grads}
+
+
+@column_loader('visa')
+def _load_visa(grads, column):
+    from visas.models import Visa
+    visas = defaultdict(list)
+    for v in Visa.get_visas([g.person_id for g in grads]):
+        visas[v.person_id].append("%s (%s)" % (v.status, v.get_validity()))
+    return {g.id: '; '.join(visas[g.person_id]) for g in grads}
+
+
+@column_loader('active_semesters')
+def _load_active_semesters(grads, column):
+    return gradmodels.active_semesters_display_many(grads)
+
+
+def search_column_values(grads, columns, html=True):
+    """
+    The values of these columns (from COLUMN_CHOICES) for each of the grads, as a list of rows. Columns with a
+    COLUMN_LOADERS entry are fetched for all of the students at once; the rest with getattribute.
+    """
+    loaded = {c: COLUMN_LOADERS[c](grads, c) for c in columns if c in COLUMN_LOADERS}
+    return [
+        [loaded[c][g.id] if c in loaded else getattribute(g, c, html=html) for c in columns]
+        for g in grads
+    ]
+
+
 def _is_not_empty(v):
     """
     Finds not-specified values from search form
@@ -696,8 +782,7 @@ class SearchForm(forms.Form):
     student_status = forms.MultipleChoiceField(choices=gradmodels.STATUS_CHOICES + (('', 'None'),),
             required=False, help_text="Student's current status"
             ) # choices updated in views/search.py
-    # The "Status as of" field causes nested queries that time out the DB.  Removing it.
-    # status_asof = StaffSemesterField(label='Status as of', required=False, initial='')
+    status_asof = StaffSemesterField(label='Status as of', required=False, initial='')
 
     program = forms.ModelMultipleChoiceField(GradProgram.objects.all(), required=False)
     grad_flags = forms.MultipleChoiceField(choices=[],
@@ -818,17 +903,25 @@ class SearchForm(forms.Form):
 
         manual_queries = []
 
-        if not self.cleaned_data.get('status_asof', None):
+        asof = self.cleaned_data.get('status_asof', None)
+        statuses = self.cleaned_data.get('student_status')
+        if not statuses:
+            pass
+        elif not asof:
             # current status: is in table
-            statuses = self.cleaned_data.get('student_status')
-            if not statuses:
-                pass
-            elif '' in statuses:
+            if '' in statuses:
                 # we're allowing gs.student_status is None
                 manual_queries.append( Q(current_status__in=statuses) | Q(current_status__isnull=True) )
             else:
                 manual_queries.append( Q(current_status__in=statuses) )
-        # else:  selected semester so must calculate. Handled in secondary_filter
+        else:
+            # status in the selected semester: from the materialized timeline
+            gradmodels.ensure_timelines(GradStudent.objects.all())
+            timeline = GradSemesterStatus.objects.filter(semester=asof)
+            query = Q(id__in=timeline.filter(status__in=statuses).values('student_id'))
+            if '' in statuses:
+                query |= ~Q(id__in=timeline.filter(status__isnull=False).values('student_id'))
+            manual_queries.append(query)
 
         if self.cleaned_data.get('start_semester_start', None) is not None:
             manual_queries.append( Q(start_semester__name__gte=self.cleaned_data['start_semester_start'].name) )
@@ -895,44 +988,38 @@ class SearchForm(forms.Form):
         #print self.cleaned_data
         return query#, exclude_query
     
-    def _secondary_filter(self, gradstudent):
-        return ((gradstudent.person.gender() == self.cleaned_data['gender']
-                if _is_not_empty(self.cleaned_data.get('gender', None))
-                else True) and
-                
-                (gradstudent.person.gpa() >= self.cleaned_data['gpa_min']
-                if _is_not_empty(self.cleaned_data.get('gpa_min', None))
-                else True) and
-                
-                (gradstudent.person.gpa() <= self.cleaned_data['gpa_max']
-                if _is_not_empty(self.cleaned_data.get('gpa_max', None))
-                else True)
-#                and
-#                ((gradstudent.person.config['citizen'].lower() == 'canadian') ==
-#                self.cleaned_data['is_canadian']
-#                if _is_not_empty(self.cleaned_data.get('is_canadian', None))
-#                else True)
-                and
-                (gradstudent.person.visa() in self.cleaned_data['visa']
-                if _is_not_empty(self.cleaned_data.get('visa', None))
-                else True)
-                and
-                (
-                    not self.cleaned_data.get('status_asof', None) or not self.cleaned_data.get('student_status', None)
-                    or gradstudent.status_as_of(self.cleaned_data.get('status_asof', None)) in self.cleaned_data.get('student_status', None)
-                )
-
-                )
-    
-    def secondary_filter(self):
-        # this returns a function in case it needs to use a closure
-        # to cache some data used in the filter
-        return self._secondary_filter
+    def _config_filter(self, grads):
+        """
+        Filter the GradStudent queryset by the values from Person.config that are searchable.
+        """
+        gender = self.cleaned_data.get('gender', None)
+        if _is_not_empty(gender):
+            grads = grads.annotate(person_gender=Coalesce(ConfigValue('person__config', 'gender'), Value('U'))) \
+                .filter(person_gender=gender)
+
+        gpa_min = self.cleaned_data.get('gpa_min', None)
+        gpa_max = self.cleaned_data.get('gpa_max', None)
+        if _is_not_empty(gpa_min) or _is_not_empty(gpa_max):
+            gpa_field = DecimalField(max_digits=8, decimal_places=4)
+            grads = grads.annotate(person_gpa=Coalesce(Cast(ConfigValue('person__config', 'gpa'), gpa_field),
+                                                       Value(Decimal(0)), output_field=gpa_field))
+            if _is_not_empty(gpa_min):
+                grads = grads.filter(person_gpa__gte=gpa_min)
+            if _is_not_empty(gpa_max):
+                grads = grads.filter(person_gpa__lte=gpa_max)
+
+        visa = self.cleaned_data.get('visa', None)
+        if _is_not_empty(visa):
+            grads = grads.annotate(person_visa=ConfigValue('person__config', 'visa')).filter(person_visa__in=visa)
+
+        return grads
 
     def search_results(self, units):
         query = self.get_query()
-        grads = GradStudent.objects.filter(program__unit__in=units).filter(query).select_related('person', 'program').distinct()
-        return list(filter(self.secondary_filter(), grads))
+        grads = GradStudent.objects.filter(program__unit__in=units).filter(query)
+        grads = self._config_filter(grads)
+        grads = grads.select_related('person', 'program', 'program__unit', 'start_semester', 'end_semester').distinct()
+        return list(grads)
 
 
 class SaveSearchForm(ModelForm):
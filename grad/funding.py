@@ -0,0 +1,366 @@
+"""
+The funding ledger: all of the funding (TA, RA, scholarship, other) for a set of grad students, or paid by a set of
+units, loaded with one query per source and spread over the semesters it pays in.
+
+The result is a table of FundingEntry rows, one for each funding source in each semester. The financials page,
+promise calculations, financials report and funding report all summarize this table, but each still applies its own
+(historical) rules about what counts: see counts_for_promises, counts_on_financials, and the funding report.
+"""
+
+import bisect
+import datetime
+import decimal
+from collections import defaultdict, namedtuple
+
+from coredata.models import Semester
+from grad.models import GradScholarship, OtherFunding, Promise, Scholarship
+
+CATEGORIES = ['ta', 'ra', 'scholarship', 'other']
+YEAR_KEYS = ['year1', 'year2', 'year3', 'year4', 'otheryear']
+
+FundingEntry = namedtuple('FundingEntry', [
+    'person_id',  # the Person being paid
+    'student_id',  # the GradStudent, for funding recorded against a grad record (scholarship, other); else None
+    'semester',  # Semester
+    'category',  # one of CATEGORIES
+    'amount',  # Decimal: the amount for this semester
+    'promise_eligible',  # does this count towards promises of support?
+    'status',  # status of the TA contract for TA funding; else None
+    'source',  # the model object the funding comes from
+])
+
+
+def _is_old_ta(entry):
+    from ta.models import TACourse
+    return isinstance(entry.source, TACourse)
+
+
+def counts_for_promises(entry):
+    """
+    Does this entry count in GradStudent.financials_from (and so Promise.received)? Any ta.TACourse (whatever the
+    contract status) and other funding (even if removed) count, but not tacontracts.
+    """
+    from tacontracts.models import TACourse as NewTACourse
+    return not isinstance(entry.source, NewTACourse)
+
+
+def counts_on_financials(entry):
+    """
+    Does this entry count on the financials page and in GradStudent.get_receive_all? ta.TACourse only if the contract
+    is really TAing and has BUs; other funding only if it hasn't been removed.
+    """
+    from ta.models import STATUSES_NOT_TAING
+    if _is_old_ta(entry):
+        return entry.status not in STATUSES_NOT_TAING and entry.source.bu != 0
+    elif entry.category == 'other':
+        return not entry.source.removed
+    return True
+
+
+def _semester_name(date):
+    """
+    Name of the semester containing the date, like RAAppointment.semester_guess.
+    """
+    if date.month <= 4:
+        se = 1
+    elif date.month <= 8:
+        se = 4
+    else:
+        se = 7
+    return str((date.year - 1900) * 10 + se)
+
+
+class FundingLedger(object):
+    """
+    All funding for the grads (or paid by the units: both if both are given) from semester start to end inclusive
+    (either can be None for unbounded).
+
+    Funding with a person but no grad record (TA and RA) is in the ledger by Person, so it is included for each of
+    a person's GradStudent records, as it always has been.
+
+    Besides the entries, the ledger keeps the things that don't fit in a semester: .ras (every RAAppointment and
+    RARequest loaded, even those that pay in no semester), .tacontracts (signed tacontracts.TAContract, whose total
+    isn't quite the sum of their courses), and .old_scholarships (Scholarship records, for grads with no start
+    semester).
+    """
+    def __init__(self, grads=None, units=None, start=None, end=None):
+        self.grads = list(grads) if grads is not None else None
+        self.units = units
+        self.start = start
+        self.end = end
+
+        self.semesters = list(Semester.objects.order_by('name'))
+        self.semester_index = {s.name: i for i, s in enumerate(self.semesters)}
+        self._semester_starts = [s.start for s in self.semesters]
+
+        self.entries = []
+        self.ras = []
+        self.tacontracts = []
+        self.old_scholarships = defaultdict(list)
+        self._load_ta()
+        self._load_tacontracts()
+        self._load_ra()
+        self._load_scholarships()
+        self._load_old_scholarships()
+        self._load_other()
+
+        self.by_person = defaultdict(list)
+        self.by_student = defaultdict(list)
+        for e in self.entries:
+            if e.student_id is None:
+                self.by_person[e.person_id].append(e)
+            else:
+                self.by_student[e.student_id].append(e)
+        self.ras_by_person = defaultdict(list)
+        for ra in self.ras:
+            self.ras_by_person[ra.person_id].append(ra)
+
+    def _in_range(self, name):
+        return (self.start is None or name >= self.start.name) and (self.end is None or name <= self.end.name)
+
+    def _semester_filter(self, qs, field):
+        if self.start is not None:
+            qs = qs.filter(**{field + '__name__gte': self.start.name})
+        if self.end is not None:
+            qs = qs.filter(**{field + '__name__lte': self.end.name})
+        return qs
+
+    def _person_ids(self):
+        return set(g.person_id for g in self.grads)
+
+    def semester_at(self, date):
+        """
+        The semester the date is in, like Semester.get_semester(date) (or None if it's before them all).
+        """
+        i = bisect.bisect_right(self._semester_starts, date)
+        return self.semesters[i-1] if i else None
+
+    def _load_ta(self):
+        from ta.models import TACourse
+        tacourses = TACourse.objects \
+            .select_related('contract__posting__semester', 'contract__posting__unit', 'contract__application__person',
+                            'course__semester', 'description')
+        if self.grads is not None:
+            tacourses = tacourses.filter(contract__application__person_id__in=self._person_ids())
+        if self.units is not None:
+            tacourses = tacourses.filter(contract__posting__unit__in=self.units)
+        tacourses = self._semester_filter(tacourses, 'contract__posting__semester')
+
+        for crs in tacourses:
+            contract = crs.contract
+            crs.semlength = 1
+            crs.semvalue = crs.pay()
+            crs.promiseeligible = True
+            self.entries.append(FundingEntry(contract.application.person_id, None, contract.posting.semester, 'ta',
+                                             crs.semvalue, True, contract.status, crs))
+
+    def _load_tacontracts(self):
+        from tacontracts.models import TAContract as NewTAContract
+        contracts = NewTAContract.objects.filter(status='SGN') \
+            .select_related('category__hiring_semester__semester', 'category__hiring_semester__unit', 'person') \
+            .prefetch_related('course__course')
+        if self.grads is not None:
+            contracts = contracts.filter(person_id__in=self._person_ids())
+        if self.units is not None:
+            contracts = contracts.filter(category__hiring_semester__unit__in=self.units)
+        contracts = self._semester_filter(contracts, 'category__hiring_semester__semester')
+
+        for contract in contracts:
+            self.tacontracts.append(contract)
+            for crs in contract.course.all():
+                crs.semlength = 1
+                crs.semvalue = crs.total
+                crs.promiseeligible = True
+                self.entries.append(FundingEntry(contract.person_id, None, contract.category.hiring_semester.semester,
+                                                 'ta', crs.semvalue, True, contract.status, crs))
+
+    def _ra_semesters(self, ra):
+        """
+        The first and last Semesters of the RA, like ra.start_semester() and ra.end_semester(), and the number of
+        semesters between, like ra.semester_length(), without a query for each.
+        """
+        from ra.models import SEMESTER_SLIDE
+        st = self.semester_index.get(_semester_name(ra.start_date))
+        en = self.semester_index.get(_semester_name(ra.end_date))
+        if st is None or en is None:
+            return None, None, 1
+
+        # eliminate a few days of hang at either end, as RAAppointment.start_semester/end_semester do
+        _, st_end = Semester.start_end_dates(self.semesters[st])
+        if st_end - ra.start_date < datetime.timedelta(SEMESTER_SLIDE):
+            st += 1
+        en_start, _ = Semester.start_end_dates(self.semesters[en])
+        if ra.end_date - en_start < datetime.timedelta(SEMESTER_SLIDE):
+            en -= 1
+
+        first = self.semesters[st] if 0 <= st < len(self.semesters) else None
+        last = self.semesters[en] if 0 <= en < len(self.semesters) else None
+        return first, last, en - st + 1
+
+    def _load_ra(self):
+        from ra.models import RAAppointment, RARequest
+        appointments = RAAppointment.objects.filter(deleted=False) \
+            .select_related('person', 'hiring_faculty', 'unit', 'project')
+        requests = RARequest.objects.filter(deleted=False, complete=True, draft=False) \
+            .select_related('person', 'supervisor', 'unit')
+        if self.grads is not None:
+            appointments = appointments.filter(person_id__in=self._person_ids())
+            requests = requests.filter(person_id__in=self._person_ids())
+        if self.units is not None:
+            appointments = appointments.filter(unit__in=self.units)
+            requests = requests.filter(unit__in=self.units)
+        if self.start is not None:
+            st, _ = Semester.start_end_dates(self.start)
+            appointments = appointments.filter(end_date__gte=st)
+            requests = requests.filter(end_date__gte=st)
+        if self.end is not None:
+            _, en = Semester.start_end_dates(self.end)
+            appointments = appointments.filter(start_date__lte=en)
+            requests = requests.filter(start_date__lte=en)
+
+        for ras, pay_field in ((appointments, 'lump_sum_pay'), (requests, 'total_pay')):
+            for ra in ras:
+                first, last, semlength = self._ra_semesters(ra)
+                ra.funding_start = first
+                ra.funding_end = last
+                ra.semlength = semlength if semlength != 0 else 1
+                ra.semvalue = getattr(ra, pay_field) / ra.semlength
+                ra.promiseeligible = True
+                self.ras.append(ra)
+                if first is None or last is None:
+                    continue
+                for sem in self.semesters[self.semester_index[first.name]:self.semester_index[last.name]+1]:
+                    if self._in_range(sem.name):
+                        self.entries.append(FundingEntry(ra.person_id, None, sem, 'ra', ra.semvalue, True, None, ra))
+
+    def _student_filter(self, qs):
+        if self.grads is not None:
+            qs = qs.filter(student__in=self.grads)
+        if self.units is not None:
+            qs = qs.filter(student__program__unit__in=self.units)
+        return self._semester_filter(qs, 'semester')
+
+    def _load_scholarships(self):
+        scholarships = self._student_filter(GradScholarship.objects.filter(removed=False)) \
+            .select_related('semester', 'student__person', 'student__program__unit')
+        for schol in scholarships:
+            schol.semlength = 1
+            schol.semvalue = schol.amount
+            schol.promiseeligible = schol.eligible
+            self.entries.append(FundingEntry(schol.student.person_id, schol.student_id, schol.semester, 'scholarship',
+                                             schol.amount, schol.eligible, None, schol))
+
+    def _load_old_scholarships(self):
+        # grads with no start semester have always been totalled from the old Scholarship records
+        if self.grads is None:
+            return
+        nostart = [g for g in self.grads if g.start_semester_id is None]
+        if not nostart:
+            return
+        scholarships = Scholarship.objects.filter(student__in=nostart, removed=False, scholarship_type__eligible=True) \
+            .select_related('start_semester', 'end_semester')
+        for schol in scholarships:
+            self.old_scholarships[schol.student_id].append(schol)
+
+    def _load_other(self):
+        others = self._student_filter(OtherFunding.objects.all()) \
+            .select_related('semester', 'student__person', 'student__program__unit')
+        for other in others:
+            other.semlength = 1
+            other.semvalue = other.amount
+            other.promiseeligible = other.eligible
+            self.entries.append(FundingEntry(other.student.person_id, other.student_id, other.semester, 'other',
+                                             other.amount, other.eligible, None, other))
+
+    def for_student(self, grad):
+        """
+        The entries for this GradStudent.
+        """
+        return self.by_student[grad.id] + self.by_person[grad.person_id]
+
+    def by_semester(self, grad, start=None, end=None):
+        """
+        The grad's funding in the format of GradStudent.financials_from: {Semester: {category: [source objects]}} with
+        an entry for every semester from start to end.
+        """
+        start = start or self.start
+        end = end or self.end
+        semesters = {sem: {c: [] for c in CATEGORIES}
+                     for sem in self.semesters if start.name <= sem.name <= end.name}
+        for e in self.for_student(grad):
+            if e.semester in semesters and counts_for_promises(e):
+                semesters[e.semester][e.category].append(e.source)
+        return semesters
+
+    def received_by_year(self, grad, category=None):
+        """
+        Promise-eligible funding received by the grad in each year of their program, as GradStudent.get_receive_all.
+        """
+        nostart = grad.start_semester_id is None
+        amounts = []
+        remarks = ''
+        for e in self.for_student(grad):
+            if category is not None and e.category != category:
+                continue
+            if nostart and e.category == 'scholarship':
+                continue
+            if e.promise_eligible and counts_on_financials(e):
+                amounts.append((e.semester, e.amount))
+
+        if category in (None, 'ra'):
+            # an RA too short to pay in any semester (after the slide at either end) has always counted once, in its
+            # start semester
+            for ra in self.ras_by_person[grad.person_id]:
+                if ra.funding_start is not None and ra.funding_end is not None \
+                        and ra.funding_end - ra.funding_start == -1:
+                    remarks += 'ra semlen:0 sem:' + str(ra.funding_start) + '-' + str(ra.funding_end)
+                    amounts.append((ra.funding_start, ra.semvalue))
+
+        if nostart and category in (None, 'scholarship'):
+            for schol in self.old_scholarships[grad.id]:
+                semlen = schol.end_semester - schol.start_semester + 1
+                if semlen == 0:
+                    semlen = 1
+                    remarks += 'scholarship semlen:0 sem:' + str(schol.start_semester) + '-' + str(schol.end_semester)
+                amt = schol.amount / semlen
+                amounts.extend((schol.start_semester, amt) for _ in range(semlen))
+
+        received = year_amounts(grad, amounts)
+        received['remarks'] = remarks
+        return received
+
+
+def _year_key(start_semester, semester):
+    """
+    Which of YEAR_KEYS the semester falls into, for a student who started in start_semester (or None if it's before they
+    started).
+    """
+    if start_semester is None:
+        return 'otheryear'
+    years = (int(semester.name) - int(start_semester.name)) // 10  # semester names jump 10 per year
+    if years < 0:
+        return None
+    return YEAR_KEYS[min(years, 4)]
+
+
+def year_amounts(grad, semester_amounts):
+    """
+    Total the (Semester, amount) pairs into the years of the grad's program.
+    """
+    totals = {k: decimal.Decimal(0) for k in YEAR_KEYS}
+    for semester, amount in semester_amounts:
+        key = _year_key(grad.start_semester, semester)
+        if key:
+            totals[key] += amount
+    return totals
+
+
+def promised_by_year(grads):
+    """
+    Promised funding for each grad in each year of their program, as GradStudent.get_promise_amount_all, for all of the
+    grads in one query: returns a dict of GradStudent.id to amounts.
+    """
+    promises = defaultdict(list)
+    for p in Promise.objects.filter(student__in=grads, removed=False).select_related('end_semester'):
+        promises[p.student_id].append((p.end_semester, p.amount))
+    return {g.id: year_amounts(g, promises[g.id]) for g in grads}
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from grad.models import GradStudent, rebuild_timelines
+from coredata.tasks import grouper
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the per-semester grad status timeline (GradSemesterStatus) from the students\' statuses and programs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--student', type=str, help='only rebuild the grad student with this slug')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        students = GradStudent.objects.order_by('id')
+        if options['student']:
+            students = students.filter(slug=options['student'])
+
+        rows = 0
+        with transaction.atomic():
+            for student_ids in grouper(students.values_list('id', flat=True), 500):
+                rows += rebuild_timelines(student_ids)
+            if options['dry_run']:
+                transaction.set_rollback(True)
+
+        self.stdout.write('%i timeline rows %s.' % (rows, 'would be written' if options['dry_run'] else 'written'))
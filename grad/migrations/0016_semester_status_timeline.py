@@ -0,0 +1,28 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coredata', '0028_searchindexchange'),
+        ('grad', '0015_trivial_migration_updates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GradSemesterStatus',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('INCO', 'Incomplete Application'), ('COMP', 'Complete Application'), ('INRE', 'Application In-Review'), ('HOLD', 'Hold Application'), ('OFFO', 'Offer Out'), ('REJE', 'Rejected Application'), ('DECL', 'Declined Offer'), ('EXPI', 'Expired Application'), ('CONF', 'Confirmed Acceptance'), ('CANC', 'Cancelled Acceptance'), ('ARIV', 'Arrived'), ('ACTI', 'Active'), ('PART', 'Part-Time'), ('LEAV', 'On-Leave'), ('WIDR', 'Withdrawn'), ('GRAD', 'Graduated'), ('NOND', 'Non-degree'), ('GONE', 'Gone'), ('ARSP', 'Completed Special'), ('TRIN', 'Transferred from another department'), ('TROU', 'Transferred to another department'), ('DELE', 'Deleted Record'), ('DEFR', 'Deferred'), ('GAPL', 'Applied for Graduation'), ('GAPR', 'Graduation Approved'), ('WAIT', 'Waitlisted')], max_length=4, null=True)),
+                ('term_status', models.CharField(choices=[('INCO', 'Incomplete Application'), ('COMP', 'Complete Application'), ('INRE', 'Application In-Review'), ('HOLD', 'Hold Application'), ('OFFO', 'Offer Out'), ('REJE', 'Rejected Application'), ('DECL', 'Declined Offer'), ('EXPI', 'Expired Application'), ('CONF', 'Confirmed Acceptance'), ('CANC', 'Cancelled Acceptance'), ('ARIV', 'Arrived'), ('ACTI', 'Active'), ('PART', 'Part-Time'), ('LEAV', 'On-Leave'), ('WIDR', 'Withdrawn'), ('GRAD', 'Graduated'), ('NOND', 'Non-degree'), ('GONE', 'Gone'), ('ARSP', 'Completed Special'), ('TRIN', 'Transferred from another department'), ('TROU', 'Transferred to another department'), ('DELE', 'Deleted Record'), ('DEFR', 'Deferred'), ('GAPL', 'Applied for Graduation'), ('GAPR', 'Graduation Approved'), ('WAIT', 'Waitlisted')], max_length=4, null=True)),
+                ('program', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='grad.gradprogram')),
+                ('semester', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='coredata.semester')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='grad.gradstudent')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['semester', 'status'], name='grad_gradse_semeste_c895f9_idx')],
+                'unique_together': {('student', 'semester')},
+            },
+        ),
+    ]
@@ -9,7 +9,9 @@ from courselib.json_fields import JSONField, config_property
 from courselib.text import normalize_newlines, many_newlines
 from courselib.conditional_save import ConditionalSaveMixin
 from courselib.storage import UploadedFileStorage, upload_path
+from dashboard.pdfcache import remove_cached_pdfs
 import itertools, datetime, os, uuid
+from collections import defaultdict
 import coredata.queries
 from django.conf import settings
 import django.db.transaction
@@ -103,6 +105,7 @@ STATUS_ACTIVE = ('ACTI', 'PART', 'NOND') # statuses that mean "still around"
 STATUS_GPA = ('GAPL', 'GAPR',) + STATUS_ACTIVE  # Statuses for which we want to import the GPA
 STATUS_DONE = ('WIDR', 'GRAD', 'GONE', 'ARSP', 'GAPL', 'GAPR') # statuses that mean "done"
 STATUS_INACTIVE = ('LEAV',) + STATUS_DONE # statuses that mean "not here"
+STATUS_COUNTED = STATUS_ACTIVE + tuple(s for s in STATUS_INACTIVE if s not in STATUS_DONE) # statuses counted in the active_semesters total
 STATUS_OBSOLETE = ('APPL', 'INCO', 'REFU', 'INRE', 'ARIV', 'GONE', 'DELE') # statuses we don't let users enter
 STATUS_REAL_PROGRAM = STATUS_CURRENTAPPLICANT + STATUS_ACTIVE + STATUS_INACTIVE # things to report for TAs
 SHORT_STATUSES = dict([  # a shorter status description we can use in compact tables
@@ -155,8 +158,6 @@ PROGRESS_REPORT_CHOICES = (
     ('CONC', "Satisfactory with Concerns"),
     ('UNST',  "Unsatisfactory"))
 
-# floated out here to allow caching by pk
-@cached(24*3600)
 def _active_semesters(pk, program=None):
     self = GradStudent.objects.get(pk=pk)
     next_sem = Semester.current().offset(1)
@@ -166,29 +167,11 @@ def _active_semesters(pk, program=None):
         start = self.start_semester or next_sem
     end = self.end_semester or next_sem
 
-    statuses_that_indicate_a_change_in_state = STATUS_ACTIVE + STATUS_INACTIVE
-    statuses = GradStatus.objects.filter(student=self, hidden=False, status__in=statuses_that_indicate_a_change_in_state) \
-               .order_by('start__name', 'start_date', 'created_at') \
-               .select_related('start')
-
-    statuses = list(statuses)
-    sem = start
-    active = 0
-    total = 0
-    while sem.name < end.name:
-        prev_statuses = [st for st in statuses if st.start.name <= sem.name]
-        if prev_statuses:
-            this_status = prev_statuses[-1]
-            if this_status.status in STATUS_ACTIVE:
-                active += 1
-                total += 1
-            elif this_status.status in STATUS_INACTIVE and this_status.status not in STATUS_DONE:
-                total += 1
-        sem = sem.next_semester()
-
-    return active, total
+    counts = self._timeline().filter(semester__name__gte=start.name, semester__name__lt=end.name) \
+        .aggregate(active=models.Count('id', filter=models.Q(term_status__in=STATUS_ACTIVE)),
+                   total=models.Count('id', filter=models.Q(term_status__in=STATUS_COUNTED)))
+    return counts['active'], counts['total']
 
-@cached(24*3600)
 def _active_semesters_display(pk):
     self = GradStudent.objects.get(pk=pk)
     active, total = self.active_semesters()
@@ -203,6 +186,161 @@ def _active_semesters_display(pk):
     return res
 
 
+def active_semesters_display_many(grads):
+    """
+    GradStudent.active_semesters_display() for each of the grads, as a dict keyed by GradStudent.id, with a few queries
+    in total.
+    """
+    ensure_timelines(GradStudent.objects.filter(id__in=[g.id for g in grads]))
+    next_sem = Semester.current().offset(1)
+    semesters = {s.id: s for s in Semester.objects.filter(
+        id__in=[g.start_semester_id for g in grads] + [g.end_semester_id for g in grads])}
+
+    term_statuses = defaultdict(list)  # student_id: [(semester.name, term_status)]
+    for student_id, name, term_status in GradSemesterStatus.objects.filter(student__in=grads, term_status__isnull=False) \
+            .values_list('student_id', 'semester__name', 'term_status'):
+        term_statuses[student_id].append((name, term_status))
+
+    histories = defaultdict(list)
+    for gph in GradProgramHistory.objects.filter(student__in=grads).order_by('-starting', '-start_semester') \
+            .select_related('program', 'start_semester'):
+        histories[gph.student_id].append(gph)
+
+    def count(student_id, start_name, end_name):
+        terms = [st for name, st in term_statuses[student_id] if start_name <= name < end_name]
+        return sum(st in STATUS_ACTIVE for st in terms), sum(st in STATUS_COUNTED for st in terms)
+
+    result = {}
+    for g in grads:
+        start = semesters.get(g.start_semester_id) or next_sem
+        end = semesters.get(g.end_semester_id) or next_sem
+        active, total = count(g.id, start.name, end.name)
+        res = "%i/%i" % (active, total)
+        if len(histories[g.id]) > 1:
+            currentprog = histories[g.id][0]
+            active, total = count(g.id, currentprog.start_semester.name, end.name)
+            res += ' (%i/%i in %s)' % (active, total, currentprog.program.label)
+        result[g.id] = res
+
+    return result
+
+
+TIMELINE_FUTURE_SEMESTERS = 6  # GradSemesterStatus rows are kept up to this many semesters after the current one
+
+
+def _timeline_status(statuses, semester):
+    """
+    The status_as_of the semester, given the student's visible GradStatuses ordered by ('-start__name', '-start_date').
+    """
+    future_name = semester.offset_name(3)
+    statuses = [st for st in statuses
+                if (st.start.name <= semester.name or (st.start.name <= future_name and st.status in STATUS_APPLICANT_FUTURE))
+                and not st.ignore_status]
+    if not statuses:
+        return None
+
+    # find all statuses in the most-recent semester: the one that sorts last wins.
+    status_sem = statuses[0].start
+    semester_statuses = [(
+                             st.start.name,
+                             st.start_date or st.created_at.date() or datetime.date(1970, 1, 1),
+                             st)
+                         for st in statuses if st.start == status_sem]
+    semester_statuses.sort(key=lambda tup: (tup[0], tup[1]))
+    return semester_statuses[-1][2].status
+
+
+def rebuild_timelines(student_ids):
+    """
+    Recalculate the GradSemesterStatus rows for these students (from their GradStatuses and GradProgramHistory).
+    Returns the number of rows written.
+    """
+    student_ids = list(student_ids)
+    all_semesters = list(Semester.objects.order_by('name'))
+    horizon = Semester.current().offset_name(TIMELINE_FUTURE_SEMESTERS)
+
+    statuses = defaultdict(list)
+    for st in GradStatus.objects.filter(student_id__in=student_ids, hidden=False) \
+            .order_by('-start__name', '-start_date').select_related('start'):
+        statuses[st.student_id].append(st)
+    programs = defaultdict(list)
+    for gph in GradProgramHistory.objects.filter(student_id__in=student_ids).select_related('start_semester'):
+        programs[gph.student_id].append(gph)
+    end_semesters = dict(GradStudent.objects.filter(id__in=student_ids).values_list('id', 'end_semester__name'))
+
+    rows = []
+    for student_id in student_ids:
+        if student_id not in end_semesters:
+            # student has been deleted
+            continue
+        student_statuses = statuses[student_id]
+        student_programs = programs[student_id]
+        # for counting active semesters, like status_as_of but only active/inactive statuses, and the last one entered wins
+        term_statuses = sorted((st for st in student_statuses if st.status in STATUS_ACTIVE + STATUS_INACTIVE),
+                               key=lambda st: (st.start.name, st.start_date or datetime.date.min, st.created_at))
+        starts = [st.start.name for st in student_statuses] + [gph.start_semester.name for gph in student_programs]
+        if not starts:
+            continue
+        first = min(starts)
+        last = max(starts + [horizon, end_semesters.get(student_id) or ''])
+
+        for semester in all_semesters:
+            if semester.name > last:
+                break
+            if semester.offset_name(3) < first:
+                continue
+            status = _timeline_status(student_statuses, semester)
+            prog = max((gph for gph in student_programs if gph.start_semester.name <= semester.name),
+                       key=lambda gph: (gph.start_semester_id, gph.starting), default=None)
+            terms = [st for st in term_statuses if st.start.name <= semester.name]
+            term_status = terms[-1].status if terms else None
+            if status is None and prog is None and term_status is None:
+                continue
+            rows.append(GradSemesterStatus(student_id=student_id, semester=semester, status=status,
+                                           program_id=prog.program_id if prog else None, term_status=term_status))
+
+    with django.db.transaction.atomic():
+        GradSemesterStatus.objects.filter(student_id__in=student_ids).delete()
+        GradSemesterStatus.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+def ensure_timelines(students):
+    """
+    Build the GradSemesterStatus rows for any of these students (a GradStudent queryset) that don't have them yet, with
+    one query if they all do. Call before looking up the timeline of many students.
+    """
+    # students with no (visible) statuses or program history never get rows: don't rebuild them every time
+    missing = students.exclude(id__in=GradSemesterStatus.objects.values('student_id')) \
+        .filter(models.Q(id__in=GradStatus.objects.filter(hidden=False).values('student_id'))
+                | models.Q(id__in=GradProgramHistory.objects.values('student_id'))) \
+        .values_list('id', flat=True)
+    missing = list(missing)
+    if missing:
+        rebuild_timelines(missing)
+
+
+def extend_timelines():
+    """
+    Make sure every student's GradSemesterStatus rows reach TIMELINE_FUTURE_SEMESTERS into the future, by repeating
+    their last row (since nothing changes after that).
+    """
+    horizon = Semester.current().offset_name(TIMELINE_FUTURE_SEMESTERS)
+    future_semesters = list(Semester.objects.filter(name__gt=Semester.current().name, name__lte=horizon).order_by('name'))
+    last_rows = GradSemesterStatus.objects.values('student_id').annotate(last=models.Max('semester__name')) \
+        .filter(last__lt=horizon)
+    last_names = {r['student_id']: r['last'] for r in last_rows}
+    rows = []
+    for row in GradSemesterStatus.objects.filter(student_id__in=last_names.keys()).select_related('semester'):
+        if row.semester.name != last_names[row.student_id]:
+            continue
+        rows.extend(GradSemesterStatus(student_id=row.student_id, semester=sem, status=row.status,
+                                       program_id=row.program_id, term_status=row.term_status)
+                    for sem in future_semesters if sem.name > row.semester.name)
+    GradSemesterStatus.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
 @cached(24*3600)
 def _program_start_end_semesters_display(pk):
     self = GradStudent.objects.get(pk=pk)
@@ -340,31 +478,17 @@ class GradStudent(models.Model, ConditionalSaveMixin):
         if semester == None:
             semester = Semester.current()
 
-        timely_status = models.Q(start__name__lte=semester.name)
-        application_status = models.Q(start__name__lte=semester.offset_name(3), status__in=STATUS_APPLICANT_FUTURE)
-
-        statuses = GradStatus.objects.filter(student=self, hidden=False) \
-                    .filter(timely_status | application_status) \
-                    .order_by('-start__name', '-start_date').select_related('start')
-
-        # Only keep the statuses that don't have the ignore_status flag set, which should be all of them in almost all
-        # cases, as the flag was introduced for a particular edge case.
-
-        statuses = [s for s in statuses if not s.ignore_status]
-
-        if not statuses:
+        # the timeline row for the semester, or the last one before it: the status doesn't change after that
+        row = self._timeline().filter(semester__name__lte=semester.name).order_by('-semester__name').first()
+        if row is None:
             return None
+        return row.status
 
-        # find all statuses in the most-recent semester: the one that sorts last wins.
-        status_sem = statuses[0].start
-
-        semester_statuses = [(
-                                 st.start.name,
-                                 st.start_date or st.created_at.date() or datetime.date(1970, 1, 1),
-                                 st)
-                             for st in statuses if st.start == status_sem]
-        semester_statuses.sort(key=lambda tup: (tup[0], tup[1]))
-        return semester_statuses[-1][2].status
+    def _timeline(self):
+        """
+        This student's GradSemesterStatus rows.
+        """
+        return GradSemesterStatus.objects.filter(student=self)
 
 
     def status_as_of_old(self, semester=None):
@@ -477,8 +601,6 @@ class GradStudent(models.Model, ConditionalSaveMixin):
         current = (self.start_semester_id, self.end_semester_id, self.current_status, self.program_id)
         if old != current:
             self.save()
-            _active_semesters.invalidate(self.pk)
-            _active_semesters_display.invalidate(self.pk)
             _program_start_end_semesters_display.invalidate(self.pk)
 
 
@@ -489,11 +611,8 @@ class GradStudent(models.Model, ConditionalSaveMixin):
         If present, program should be a GradProgramHistory object for the program we're interested in: will return the
         number of semesters since the start of that program.
 
-        Cache is invalidated by self.update_status_fields.
+        Counted from the GradSemesterStatus rows, so they're up to date as soon as statuses change.
         """
-        # actually flips through every relevant semester and checks to see
-        # their (final) status in that semester. The data is messy enough
-        # that I don't see any better way.
         return _active_semesters(self.pk, program)
 
     def _has_committee(self):
@@ -545,8 +664,6 @@ class GradStudent(models.Model, ConditionalSaveMixin):
     def active_semesters_display(self):
         """
         Format self.active_semesters_display for display
-
-        Cache is invalidated by self.update_status_fields.
         """
         return _active_semesters_display(self.pk)
 
@@ -890,252 +1007,21 @@ class GradStudent(models.Model, ConditionalSaveMixin):
         return ls
 
     def get_promise_amount_all(self):
-        if self.start_semester is not None:
-            frs = int(self.start_semester.name)   # semester name jump 10 digits per year
-            promises = Promise.objects.filter(student=self, removed=False).select_related('start_semester').order_by('start_semester')
-            #print(frs)
-            import decimal
-
-            promise_amt = {"year1": decimal.Decimal(0.0), "year2": decimal.Decimal(0.0), "year3": decimal.Decimal(0.0), "year4": decimal.Decimal(0.0), "otheryear": decimal.Decimal(0.0)}
-            
-            for promise in promises:
-                en = promise.end_semester
-                
-                if int(en.name) >= frs and int(en.name) < frs+10:
-                        promise_amt['year1'] += promise.amount
-                if int(en.name) >= frs+10 and int(en.name) < frs+20:
-                        promise_amt['year2'] += promise.amount
-                if int(en.name) >= frs+20 and int(en.name) < frs+30:
-                        promise_amt['year3'] += promise.amount
-                if int(en.name) >= frs+30 and int(en.name) < frs+40:
-                        promise_amt['year4'] += promise.amount
-                if int(en.name) >= frs+40:
-                        promise_amt['otheryear'] += promise.amount
-        else:
-            promises = Promise.objects.filter(student=self, removed=False).select_related('start_semester').order_by('start_semester')
-            import decimal
-
-            promise_amt = {"year1": decimal.Decimal(0.0), "year2": decimal.Decimal(0.0), "year3": decimal.Decimal(0.0), "year4": decimal.Decimal(0.0), "otheryear": decimal.Decimal(0.0)}
-            
-            for promise in promises:
-                en = promise.end_semester                
-                promise_amt['otheryear'] += promise.amount
+        """
+        Promised funding in each year of the student's program (everything is 'otheryear' if we don't know their
+        start semester).
+        """
+        from grad.funding import promised_by_year
+        return promised_by_year([self])[self.id]
 
-        return promise_amt
-    
     def get_receive_all(self, type=None):
-        if self.start_semester is not None:
-            frs = int(self.start_semester.name)   # semester name jump 10 digits per year
-            
-            import decimal
-
-            received_amt = {"year1": decimal.Decimal(0.0), "year2": decimal.Decimal(0.0), "year3": decimal.Decimal(0.0), "year4": decimal.Decimal(0.0), "otheryear": decimal.Decimal(0.0), "remarks": ''}
-
-            from ta.models import TAContract, TACourse
-            from ra.models import RAAppointment, RARequest
-            from tacontracts.models import TAContract as NewTAContract
-            
-            if (type==None or type=='ta'):
-                # TA
-                STATUSES_NOT_TAING = ['NEW', 'REJ', 'CAN'] # statuses that mean "not actually TAing"
-
-                contracts = TAContract.objects.filter(application__person=self.person).exclude(status__in=STATUSES_NOT_TAING).select_related('posting__semester')
-                other_contracts = NewTAContract.objects.filter(person=self.person, status__in=['NEW', 'SGN']).select_related('category').prefetch_related('course')
-                    
-                for contract in contracts:
-                        if (int(contract.posting.semester.name) >= frs) & (int(contract.posting.semester.name) < (frs+10)):
-                            for course in TACourse.objects.filter(contract=contract).exclude(bu=0).select_related('course'):
-                                received_amt['year1'] +=  course.pay()
-                        if (int(contract.posting.semester.name) >= (frs+10)) & (int(contract.posting.semester.name) < (frs+20)):
-                            for course in TACourse.objects.filter(contract=contract).exclude(bu=0).select_related('course'):
-                                received_amt['year2'] +=  course.pay()
-                        if (int(contract.posting.semester.name) >= (frs+20)) & (int(contract.posting.semester.name) < (frs+30)):
-                            for course in TACourse.objects.filter(contract=contract).exclude(bu=0).select_related('course'):
-                                received_amt['year3'] +=  course.pay()
-                        if (int(contract.posting.semester.name) >= (frs+30)) & (int(contract.posting.semester.name) < (frs+40)):
-                            for course in TACourse.objects.filter(contract=contract).exclude(bu=0).select_related('course'):
-                                received_amt['year4'] +=  course.pay()
-                        if (int(contract.posting.semester.name) >= (frs+40)):
-                            for course in TACourse.objects.filter(contract=contract).exclude(bu=0).select_related('course'):
-                                received_amt['otheryear'] +=  course.pay()
-                        
-                        
-                for contract in other_contracts:
-                        if (int(contract.category.hiring_semester.semester.name) >= frs) & (int(contract.category.hiring_semester.semester.name) < (frs+10)):
-                            if contract.status == 'SGN':
-                                for course in contract.course.all():
-                                    received_amt['year1'] += course.total
-                        if (int(contract.category.hiring_semester.semester.name) >= (frs+10)) & (int(contract.category.hiring_semester.semester.name) < (frs+20)):
-                            if contract.status == 'SGN':
-                                for course in contract.course.all():
-                                    received_amt['year2'] += course.total
-                        if (int(contract.category.hiring_semester.semester.name) >= (frs+20)) & (int(contract.category.hiring_semester.semester.name) < (frs+30)):
-                            if contract.status == 'SGN':
-                                for course in contract.course.all():
-                                    received_amt['year3'] += course.total
-                        if (int(contract.category.hiring_semester.semester.name) >= (frs+30)) & (int(contract.category.hiring_semester.semester.name) < (frs+40)):
-                            if contract.status == 'SGN':
-                                for course in contract.course.all():
-                                    received_amt['year4'] += course.total
-                        if (int(contract.category.hiring_semester.semester.name) >= (frs+40)):
-                            if contract.status == 'SGN':
-                                for course in contract.course.all():
-                                    received_amt['otheryear'] += course.total
-            
-            if (type==None or type=='ra'):  
-                # RA
-                ras = RAAppointment.objects.filter(person=self.person, deleted=False)
-                reqs = RARequest.objects.filter(person=self.person, deleted=False, complete=True, draft=False)
-                for ra in ras:
-                        st = ra.start_semester()
-                        en = ra.end_semester()
-                        semlen =  ra.semester_length()
-                        if semlen == 0:
-                            semlen = 1
-                            received_amt['remarks'] += 'ra semlen:0 sem:' + str(st) + '-' + str(en)
-                        sem_pay = ra.lump_sum_pay / semlen
-                        for i in range(semlen):
-                            if int(st.name) >= frs and int(st.name) < frs+10:
-                                received_amt['year1'] += sem_pay
-                            if int(st.name) >= frs+10 and int(st.name) < frs+20:
-                                received_amt['year2'] += sem_pay
-                            if int(st.name) >= frs+20 and int(st.name) < frs+30:
-                                received_amt['year3'] += sem_pay
-                            if int(st.name) >= frs+30 and int(st.name) < frs+40:
-                                received_amt['year4'] += sem_pay
-                            if int(st.name) >= frs+40:
-                                received_amt['otheryear'] += sem_pay
-                            st = st.next_semester()
-
-                for ra in reqs:
-                        st = ra.start_semester()
-                        en = ra.end_semester()
-                        semlen =  ra.semester_length()
-                        if semlen == 0:
-                            semlen = 1
-                            received_amt['remarks'] += 'ra semlen:0 sem:' + str(st) + '-' + str(en)
-                        sem_pay = ra.total_pay / semlen
-                        
-                        for i in range(semlen):
-                            if int(st.name) >= frs and int(st.name) < frs+10:
-                                received_amt['year1'] += sem_pay
-                            if int(st.name) >= frs+10 and int(st.name) < frs+20:
-                                received_amt['year2'] += sem_pay
-                            if int(st.name) >= frs+20 and int(st.name) < frs+30:
-                                received_amt['year3'] += sem_pay
-                            if int(st.name) >= frs+30 and int(st.name) < frs+40:
-                                received_amt['year4'] += sem_pay
-                            if int(st.name) >= frs+40:
-                                received_amt['otheryear'] += sem_pay
-                            st = st.next_semester()
-
-            if (type==None or type=='scholarship'): 
-                # scholarships - using new scholarship table which data is imported from SIMS, no more manual input
-                scholarships = GradScholarship.objects.filter(student=self, removed=False, eligible=True).select_related('semester')                    
-                for ss in scholarships:
-                        if int(ss.semester.name) >= frs and int(ss.semester.name) < frs+10:
-                            received_amt['year1'] += ss.amount
-                        if int(ss.semester.name) >= frs+10 and int(ss.semester.name) < frs+20:
-                            received_amt['year2'] += ss.amount
-                        if int(ss.semester.name) >= frs+20 and int(ss.semester.name) < frs+30:
-                            received_amt['year3'] += ss.amount
-                        if int(ss.semester.name) >= frs+30 and int(ss.semester.name) < frs+40:
-                            received_amt['year4'] += ss.amount
-                        if int(ss.semester.name) >= frs+40:
-                            received_amt['otheryear'] += ss.amount
-
-
-
-            if (type==None or type=='other'):
-                # other funding
-                others = OtherFunding.objects.filter(student=self, removed=False, eligible=True).select_related('semester')
-                for other in others:
-                        if (int(other.semester.name) >= frs) & (int(other.semester.name) < (frs+10)):
-                            received_amt['year1'] += other.amount
-                        if (int(other.semester.name) >= (frs+10)) & (int(other.semester.name) < (frs+20)):
-                            received_amt['year2'] += other.amount
-                        if (int(other.semester.name) >= (frs+20)) & (int(other.semester.name) < (frs+30)):
-                            received_amt['year3'] += other.amount
-                        if (int(other.semester.name) >= (frs+30)) & (int(other.semester.name) < (frs+40)):
-                            received_amt['year4'] += other.amount
-                        if (int(other.semester.name) >= (frs+40)):
-                            received_amt['otheryear'] += other.amount
-        else:
-            import decimal
-
-            received_amt = {"year1": decimal.Decimal(0.0), "year2": decimal.Decimal(0.0), "year3": decimal.Decimal(0.0), "year4": decimal.Decimal(0.0), "otheryear": decimal.Decimal(0.0), "remarks": ''}
+        """
+        Promise-eligible funding received in each year of the student's program (in the categories of
+        grad.funding.CATEGORIES, or only the one given as type), with any 'remarks' about odd data found along the way.
+        """
+        from grad.funding import FundingLedger
+        return FundingLedger([self]).received_by_year(self, category=type)
 
-            from ta.models import TAContract, TACourse
-            from ra.models import RAAppointment, RARequest
-            from tacontracts.models import TAContract as NewTAContract
-            
-            if (type==None or type=='ta'): 
-                # TA
-                STATUSES_NOT_TAING = ['NEW', 'REJ', 'CAN'] # statuses that mean "not actually TAing"
-
-                contracts = TAContract.objects.filter(application__person=self.person).exclude(status__in=STATUSES_NOT_TAING).select_related('posting__semester')
-                other_contracts = NewTAContract.objects.filter(person=self.person, status__in=['NEW', 'SGN']).select_related('category').prefetch_related('course')
-                    
-                for contract in contracts:                    
-                            for course in TACourse.objects.filter(contract=contract).exclude(bu=0).select_related('course'):
-                                received_amt['otheryear'] +=  course.pay()
-                        
-                        
-                for contract in other_contracts:                    
-                            if contract.status == 'SGN':
-                                for course in contract.course.all():
-                                    received_amt['otheryear'] += course.total
-
-            if (type==None or type=='ra'):
-                # RA
-                ras = RAAppointment.objects.filter(person=self.person, deleted=False)
-                reqs = RARequest.objects.filter(person=self.person, deleted=False, complete=True, draft=False)
-                for ra in ras:
-                        st = ra.start_semester()
-                        en = ra.end_semester()
-                        semlen =  ra.semester_length()
-                        if semlen == 0:
-                            semlen = 1
-                            received_amt['remarks'] += 'ra semlen:0 sem:' + str(st) + '-' + str(en)
-                        sem_pay = ra.lump_sum_pay / semlen
-                        for i in range(semlen):
-                            received_amt['otheryear'] += sem_pay
-                            st = st.next_semester()
-
-                for ra in reqs:
-                        st = ra.start_semester()
-                        en = ra.end_semester()
-                        semlen =  ra.semester_length()
-                        if semlen == 0:
-                            semlen = 1
-                            received_amt['remarks'] += 'ra semlen:0 sem:' + str(st) + '-' + str(en)
-                        sem_pay = ra.total_pay / semlen
-                        
-                        for i in range(semlen):
-                            received_amt['otheryear'] += sem_pay
-                            st = st.next_semester()
-
-            if (type==None or type=='scholarship'):
-                # scholarships
-                scholarships = Scholarship.objects.filter(student=self, removed=False).filter(scholarship_type__eligible=True).select_related('start_semester')
-                    
-                for ss in scholarships:
-                        semlen =  (ss.end_semester-ss.start_semester+1)  
-                        if semlen == 0:
-                            semlen = 1
-                            received_amt['remarks'] += 'scholarship semlen:0 sem:' + str(ss.start_semester) + '-' + str(ss.end_semester)
-                        amt = ss.amount/semlen   
-                        for i in range(semlen):
-                            received_amt['otheryear'] += amt
-                            ss.start_semester = ss.start_semester.next_semester()
-
-            if (type==None or type=='other'):
-                # other funding
-                others = OtherFunding.objects.filter(student=self, removed=False, eligible=True).select_related('semester')
-                for other in others:                    
-                            received_amt['otheryear'] += other.amount
-        return received_amt
-    
     def financials_from(self, start, end):
         """
         Return information about finances from the start to end semester. eligible_only: include only things ineligible for promises?
@@ -1143,8 +1029,8 @@ class GradStudent(models.Model, ConditionalSaveMixin):
         Returns a data structure:
         {Semester: {
           'ta': [TACourse],
-          'ra': [RAAppointment],
-          'scholarship: [Scholarship],
+          'ra': [RAAppointment or RARequest],
+          'scholarship: [GradScholarship],
           'other': [OtherFunding]
           }
         }
@@ -1153,74 +1039,9 @@ class GradStudent(models.Model, ConditionalSaveMixin):
           object.semvalue: the dollar amount for one semester
           object.promiseeligible: is eligible to count towards a promise?
         """
-        from ta.models import TACourse
-        from ra.models import RAAppointment, RARequest
-        
-        semesters = {}
-        for sem in Semester.objects.filter(name__gte=start.name, name__lte=end.name):
-            semesters[sem] = {'ta': [], 'ra': [], 'scholarship': [], 'other': []}
-        
-        # TAs
-        tas = TACourse.objects.filter(contract__application__person=self.person,
-                                      contract__posting__semester__name__lte=end.name, contract__posting__semester__name__gte=start.name)
-        for tacrs in tas:
-            tacrs.semlength = 1
-            tacrs.semvalue = tacrs.pay()
-            tacrs.promiseeligible = True
-            semesters[tacrs.contract.posting.semester]['ta'].append(tacrs)
-        
-        # RAs
-        ras = RAAppointment.objects.filter(person=self.person, deleted=False)
-        for ra in ras:
-            # RAs are by date, not semester, so have to filter more here...
-            st = ra.start_semester()
-            en = ra.end_semester()
-            ra.semlength = ra.semester_length()
-            if ra.semlength == 0:
-                ra.semlength = 1
-            ra.semvalue = ra.lump_sum_pay / ra.semlength
-            ra.promiseeligible = True
-            sem = st
-            while sem <= en:
-                if sem in semesters:
-                    semesters[sem]['ra'].append(ra)
-                sem = sem.next_semester()
-        
-        reqs = RARequest.objects.filter(person=self.person, deleted=False, complete=True, draft=False)
-        for ra in reqs:
-            st = ra.start_semester()
-            en = ra.end_semester()
-            ra.semlength = ra.semester_length()
-            if ra.semlength == 0:
-                ra.semlength = 1
-            ra.semvalue = ra.total_pay / ra.semlength
-            ra.promiseeligible = True
-            sem = st
-            while sem <= en:
-                if sem in semesters:
-                    semesters[sem]['ra'].append(ra)
-                sem = sem.next_semester()
-        
-        # scholarships
-        scholarships = GradScholarship.objects.filter(student=self, semester__name__lte=end.name, semester__name__gte=start.name, removed=False)
-        for schol in scholarships:
-            # annotate object with useful fields
-            schol.semlength = 1
-            schol.semvalue = schol.amount
-            schol.promiseeligible = schol.eligible
-            semesters[schol.semester]['scholarship'].append(schol)
-        
-        # other funding
-        others = OtherFunding.objects.filter(student=self, semester__name__lte=end.name, semester__name__gte=start.name)
-        for other in others:
-            # annotate object with useful fields
-            other.semlength = 1
-            other.semvalue = other.amount
-            other.promiseeligible = other.eligible
-            semesters[other.semester]['other'].append(other)
-            
-        return semesters
-    
+        from grad.funding import FundingLedger
+        return FundingLedger([self], start=start, end=end).by_semester(self)
+
     def thesis_type(self):
         if 'thesis_type' in self.config:
             for code, description in THESIS_TYPE_CHOICES:
@@ -1255,6 +1076,7 @@ class GradStudent(models.Model, ConditionalSaveMixin):
             semester = Semester.current() 
 
         student_records = GradStudent.objects.filter(person=person).order_by('-start_semester')
+        ensure_timelines(student_records)
 
         students_and_statuses = [(gs, gs.status_as_of(semester)) for gs in student_records]
 
@@ -1637,6 +1459,44 @@ class GradStatus(models.Model, ConditionalSaveMixin):
             status.save()
         student.update_status_fields()
 
+
+class GradSemesterStatus(models.Model):
+    """
+    Materialized per-semester timeline for each student: one row for every semester from their first status/program
+    until TIMELINE_FUTURE_SEMESTERS in the future, so "status as of" questions are one indexed query.
+
+    Rebuilt for the student by rebuild_timelines whenever their GradStatus or GradProgramHistory changes; the
+    rebuild_grad_timeline management command rebuilds everything.
+    """
+    student = models.ForeignKey(GradStudent, null=False, on_delete=models.CASCADE)
+    semester = models.ForeignKey(Semester, null=False, on_delete=models.PROTECT)
+    # GradStudent.status_as_of(semester)
+    status = models.CharField(max_length=4, choices=STATUS_CHOICES, null=True)
+    # the active/inactive status in effect this semester, as used to count active semesters
+    term_status = models.CharField(max_length=4, choices=STATUS_CHOICES, null=True)
+    # GradStudent.program_as_of(semester)
+    program = models.ForeignKey(GradProgram, null=True, on_delete=models.CASCADE)
+
+    class Meta:
+        unique_together = [('student', 'semester')]
+        indexes = [models.Index(fields=['semester', 'status'])]
+
+    def __str__(self):
+        return "%s in %s: %s" % (self.student, self.semester.name, self.status)
+
+
+def rebuild_student_timeline(sender, instance, **kwargs):
+    """
+    Keep GradSemesterStatus up to date when a status or program change is saved/deleted.
+    """
+    rebuild_timelines([instance.student_id])
+
+models.signals.post_save.connect(rebuild_student_timeline, sender=GradStatus)
+models.signals.post_delete.connect(rebuild_student_timeline, sender=GradStatus)
+models.signals.post_save.connect(rebuild_student_timeline, sender=GradProgramHistory)
+models.signals.post_delete.connect(rebuild_student_timeline, sender=GradProgramHistory)
+
+
 """
 Letters
 """
@@ -1786,6 +1646,18 @@ class Promise(models.Model):
             self._contributions_cache = self.student.financials_from(start=self.start_semester, end=self.end_semester)
         return self._contributions_cache
 
+    @classmethod
+    def prefetch_contributions(cls, promises):
+        """
+        Fill in .contributions_to() for all of these promises from one funding ledger.
+        """
+        from grad.funding import FundingLedger
+        promises = list(promises)
+        ledger = FundingLedger([p.student for p in promises])
+        for p in promises:
+            p._contributions_cache = ledger.by_semester(p.student, start=p.start_semester, end=p.end_semester)
+        return promises
+
     def received(self):
         """
         Amount actually received towards this promise
@@ -1903,3 +1775,7 @@ class ExternalDocument(models.Model):
         _, filename = os.path.split(self.file_attachment.name)
         return filename
 
+
+# cached PDFs of the letter (see dashboard/pdfcache.py) are out of date when it changes
+models.signals.post_save.connect(remove_cached_pdfs, sender=Letter)
+models.signals.post_delete.connect(remove_cached_pdfs, sender=Letter)
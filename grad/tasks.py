@@ -1,7 +1,7 @@
 import datetime, itertools
 from coredata.models import Semester
 from courselib.celerytasks import task
-from grad.models import GradStatus, GradProgramHistory, GradStudent, STATUS_ACTIVE, STATUS_APPLICANT
+from grad.models import GradStatus, GradProgramHistory, GradStudent, STATUS_ACTIVE, STATUS_APPLICANT, extend_timelines
 from grad import importer as grad_importer
 from coredata.tasks import grouper
 import celery
@@ -41,6 +41,9 @@ def update_statuses_to_current():
     for gs in students:
         gs.update_status_fields()
 
+    # keep the GradSemesterStatus timelines reaching into the future
+    extend_timelines()
+
 
 def import_grad_task_chain(start=False):
     """
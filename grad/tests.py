@@ -1,15 +1,23 @@
 from django.test import TestCase
 from django.urls import reverse
-import json, datetime
-from coredata.models import Person, Semester, Role
+from django.conf import settings
+import json, datetime, decimal, io, os, tempfile, time
+from unittest import mock
+from django.core.management import call_command
+from coredata.models import Person, Semester, Role, Unit
 from grad.models import GradStudent, GradRequirement, GradProgram, Letter, LetterTemplate, \
         Supervisor, GradStatus, CompletedRequirement, ScholarshipType, Scholarship, OtherFunding, \
-        Promise, GradProgramHistory, FinancialComment, STATUS_ORDER, SHORT_STATUSES, STATUS_CHOICES
+        Promise, GradProgramHistory, FinancialComment, GradSemesterStatus, GradScholarship, STATUS_ORDER, SHORT_STATUSES, STATUS_CHOICES, \
+        ensure_timelines
 from grad.views.financials import STYLES
 from courselib.testing import basic_page_tests, Client, test_views, freshen_roles
 from grad.views.view import all_sections
 from django.http import QueryDict
 from grad.forms import SearchForm
+from grad.funding import FundingLedger, counts_on_financials, promised_by_year, YEAR_KEYS
+from grad.views.funding_report import _build_funding_totals
+from dashboard.bulkpdf import bulk_pdf_status
+from dashboard.pdfcache import prune_pdf_cache
 
 
 class GradTest(TestCase):
@@ -75,6 +83,41 @@ class GradTest(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response['Content-Type'], 'application/vnd.ms-excel')
 
+    def test_bulk_pdf_job(self):
+        """
+        Big batches of forms are built by a job (run immediately here, without Celery) and served from its page.
+        """
+        client = Client()
+        client.login_user('dzhao')
+
+        with mock.patch('dashboard.bulkpdf.BULK_PDF_INLINE_MAX', 1000):
+            response = client.get(reverse('grad:search'), {'columns':'person.first_name', 'cardforms':'sure'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'application/pdf')
+
+        with tempfile.TemporaryDirectory() as tmpdir, self.settings(BULK_PDF_PATH=tmpdir), \
+                mock.patch('dashboard.bulkpdf.BULK_PDF_INLINE_MAX', 1):
+            response = client.get(reverse('grad:search'), {'columns':'person.first_name', 'fasnetforms':'sure'})
+            self.assertEqual(response.status_code, 302)
+            url = response['Location']
+            job_id = url.rstrip('/').split('/')[-1]
+            status = bulk_pdf_status(job_id)
+            self.assertTrue(status['finished'])
+            self.assertFalse(status['error'])
+            self.assertEqual(status['done'], status['total'])
+            self.assertTrue(status['total'] > 1)
+
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'application/pdf')
+            self.assertTrue(b''.join(response.streaming_content).startswith(b'%PDF'))
+            response.close()
+
+            # only the person who asked can see it
+            client.login_user('ggbaker')
+            response = client.get(url)
+            self.assertEqual(response.status_code, 404)
+
     def test_grad_pages(self):
         """
         Check overall pages for the grad module and make sure they all load
@@ -231,11 +274,61 @@ class GradTest(TestCase):
         response = basic_page_tests(self, client, url)
         self.assertEqual(response.status_code, 200)
 
+    def test_letter_pdf_cache(self):
+        """
+        Letter PDFs are cached by content, served with an ETag, and forgotten when the letter changes.
+        """
+        client = Client()
+        client.login_user('dzhao')
+        gs = self.gs
+        lt = LetterTemplate.objects.get(label="Funding")
+        l = Letter(student=gs, date=datetime.date.today(), to_lines="The Student\nSFU", template=lt,
+                   created_by='ggbaker', content="Some letter content.")
+        l.save()
+        url = reverse('grad:get_letter', kwargs={'grad_slug': gs.slug, 'letter_slug': l.slug})
+
+        with tempfile.TemporaryDirectory() as tmpdir, self.settings(PDF_CACHE_PATH=tmpdir):
+            cache_dir = os.path.join(tmpdir, 'grad.letter', str(l.pk))
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'application/pdf')
+            self.assertTrue(response.content.startswith(b'%PDF'))
+            etag = response['ETag']
+            self.assertEqual(os.listdir(cache_dir), [etag.strip('"') + '.pdf'])
+
+            # same letter: from the cache, or not at all if the browser has it
+            response = client.get(url)
+            self.assertEqual(response['ETag'], etag)
+            response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+
+            # saving the letter clears its cache; changing it changes the ETag
+            l.content = "Different letter content."
+            l.save()
+            self.assertFalse(os.path.exists(cache_dir))
+            response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+
+            # documents unused for too long are removed, even if the cache is small
+            cached = os.path.join(cache_dir, response['ETag'].strip('"') + '.pdf')
+            prune_pdf_cache()
+            self.assertTrue(os.path.exists(cached))
+            old = time.time() - (settings.PDF_CACHE_AGE + 1) * 86400
+            os.utime(cached, (old, old))
+            prune_pdf_cache()
+            self.assertFalse(os.path.exists(cached))
+
+            # pruning to nothing removes everything
+            with self.settings(PDF_CACHE_MAX_SIZE=0):
+                prune_pdf_cache()
+            self.assertEqual(os.listdir(cache_dir), [])
+
     def test_advanced_search_1(self):
         """
         Basics of the advanced search toolkit
         """
-        from grad.forms import COLUMN_CHOICES, COLUMN_WIDTHS_DATA
+        from grad.forms import COLUMN_CHOICES, COLUMN_WIDTHS_DATA, search_column_values
         from grad.templatetags.getattribute import getattribute
         
         cols = set(k for k,v in COLUMN_CHOICES)
@@ -247,6 +340,14 @@ class GradTest(TestCase):
             # make sure each column returns *something* without error
             getattribute(gs, key)
 
+        # the bulk column loaders must agree with getattribute
+        grads = list(GradStudent.objects.filter(program__unit__slug='cmpt').select_related('person', 'program__unit'))
+        columns = [k for k, v in COLUMN_CHOICES]
+        rows = search_column_values(grads, columns, html=False)
+        for g, row in zip(grads, rows):
+            for column, value in zip(columns, row):
+                self.assertEqual(value, getattribute(g, column, html=False), column)
+
     def test_advanced_search_2(self):
         client = Client()
         client.login_user('dzhao')
@@ -299,6 +400,21 @@ class GradTest(TestCase):
         form = SearchForm(QueryDict('gpa_min=4.1&columns=person.emplid'))
         high_gpa = form.search_results(units)
         self.assertNotIn(gs, high_gpa)
+        form = SearchForm(QueryDict('gpa_max=2.2&columns=person.emplid'))
+        self.assertIn(gs, form.search_results(units))
+
+        # gender and visa are also searched in the database
+        gs.person.config['gender'] = 'F'
+        gs.person.config['visa'] = 'Perm Resid'
+        gs.person.save()
+        form = SearchForm(QueryDict('gender=F&visa=Perm Resid&columns=person.emplid'))
+        self.assertIn(gs, form.search_results(units))
+        form = SearchForm(QueryDict('gender=M&columns=person.emplid'))
+        self.assertNotIn(gs, form.search_results(units))
+        del gs.person.config['gender']
+        gs.person.save()
+        form = SearchForm(QueryDict('gender=U&columns=person.emplid'))
+        self.assertIn(gs, form.search_results(units))
 
     def test_advanced_search_3(self):
         client = Client()
@@ -325,22 +441,130 @@ class GradTest(TestCase):
         leave_now = form.search_results(units)
         self.assertNotIn(gs, leave_now)
 
-        # test status-as-of searching  -- DISABLED since we removed this from the form.
-        #form = SearchForm(QueryDict('student_status=ACTI&status_asof=%s&columns=person.emplid' % (this_sem.offset(-4).name)))
-        #active_past = form.search_results(units)
-        #self.assertNotIn(gs, active_past)
-        #form = SearchForm(QueryDict('student_status=COMP&status_asof=%s&columns=person.emplid' % (this_sem.offset(-4).name)))
-        #applic_past = form.search_results(units)
-        #self.assertIn(gs, applic_past)
+        # test status-as-of searching
+        form = SearchForm(QueryDict('student_status=ACTI&status_asof=%s&columns=person.emplid' % (this_sem.offset(-4).name)))
+        active_past = form.search_results(units)
+        self.assertNotIn(gs, active_past)
+        form = SearchForm(QueryDict('student_status=COMP&status_asof=%s&columns=person.emplid' % (this_sem.offset(-4).name)))
+        applic_past = form.search_results(units)
+        self.assertIn(gs, applic_past)
+
+        form = SearchForm(QueryDict('student_status=ACTI&status_asof=%s&columns=person.emplid' % (this_sem.offset(3).name)))
+        active_later = form.search_results(units)
+        self.assertNotIn(gs, active_later)
+        form = SearchForm(QueryDict('student_status=LEAV&status_asof=%s&columns=person.emplid' % (this_sem.offset(3).name)))
+        leave_later = form.search_results(units)
+        self.assertIn(gs, leave_later)
+
+    def test_semester_timeline(self):
+        """
+        The materialized GradSemesterStatus rows should agree with the statuses they're built from.
+        """
+        this_sem = Semester.current()
+        gs = GradStudent.objects.filter(program__unit__slug='cmpt')[0]
+        gs.gradstatus_set.all().delete()
+        GradStatus(student=gs, status='COMP', start=this_sem.offset(-4)).save()
+        GradStatus(student=gs, status='ACTI', start=this_sem.offset(-3)).save()
+        GradStatus(student=gs, status='LEAV', start=this_sem.offset(-1)).save()
+        GradStatus(student=gs, status='ACTI', start=this_sem).save()
+
+        self.assertEqual(gs.status_as_of(this_sem.offset(-5)), None)
+        self.assertEqual(gs.status_as_of(this_sem.offset(-4)), 'COMP')
+        self.assertEqual(gs.status_as_of(this_sem.offset(-2)), 'ACTI')
+        self.assertEqual(gs.status_as_of(this_sem.offset(-1)), 'LEAV')
+        self.assertEqual(gs.status_as_of(this_sem.offset(2)), 'ACTI')
 
-        #form = SearchForm(QueryDict('student_status=ACTI&status_asof=%s&columns=person.emplid' % (this_sem.offset(3).name)))
-        #active_later = form.search_results(units)
-        #self.assertNotIn(gs, active_later)
-        #form = SearchForm(QueryDict('student_status=LEAV&status_asof=%s&columns=person.emplid' % (this_sem.offset(3).name)))
-        #leave_later = form.search_results(units)
-        #self.assertIn(gs, leave_later)
+        gs.start_semester = this_sem.offset(-3)
+        gs.end_semester = this_sem.offset(1)
+        gs.save()
+        self.assertEqual(gs.active_semesters(), (3, 4))
+
+        # hiding a status updates the timeline
+        st = GradStatus.objects.get(student=gs, status='LEAV')
+        st.hidden = True
+        st.save(close_others=False)
+        self.assertEqual(gs.status_as_of(this_sem.offset(-1)), 'ACTI')
+        self.assertEqual(gs.active_semesters(), (4, 4))
+
+        # ... and the full rebuild gives the same rows
+        rows = set(GradSemesterStatus.objects.filter(student=gs).values_list('semester_id', 'status', 'term_status', 'program_id'))
+        GradSemesterStatus.objects.filter(student=gs).delete()
+        self.assertIsNone(gs.status_as_of(this_sem.offset(-1)))
+        with self.assertNumQueries(1):
+            ensure_timelines(GradStudent.objects.exclude(id=gs.id))  # nothing missing: no rebuild
+        ensure_timelines(GradStudent.objects.all())
+        self.assertEqual(gs.status_as_of(this_sem.offset(-1)), 'ACTI')
+        # a student with nothing to build a timeline from isn't rebuilt every time
+        other = GradStudent.objects.exclude(id=gs.id)[0]
+        GradStatus.objects.filter(student=other).update(hidden=True)
+        GradProgramHistory.objects.filter(student=other).delete()
+        GradSemesterStatus.objects.filter(student=other).delete()
+        with self.assertNumQueries(1):
+            ensure_timelines(GradStudent.objects.all())
+        self.assertEqual(rows, set(GradSemesterStatus.objects.filter(student=gs).values_list('semester_id', 'status', 'term_status', 'program_id')))
+
+        out = io.StringIO()
+        call_command('rebuild_grad_timeline', student=gs.slug, stdout=out)
+        self.assertEqual(rows, set(GradSemesterStatus.objects.filter(student=gs).values_list('semester_id', 'status', 'term_status', 'program_id')))
+
+
+    def test_funding_ledger(self):
+        """
+        The funding ledger should agree with the single-student funding methods, and drive the reports.
+        """
+        this_sem = Semester.current()
+        gs = GradStudent.objects.filter(program__unit__slug='cmpt')[0]
+        gs.start_semester = this_sem.offset(-2)
+        gs.save()
+        GradScholarship.objects.filter(student=gs).update(removed=True)
+        OtherFunding.objects.filter(student=gs).update(removed=True)
+        Promise.objects.filter(student=gs).update(removed=True)
+        GradScholarship(student=gs, semester=this_sem.offset(-2), description='Award', amount=1000).save()
+        GradScholarship(student=gs, semester=this_sem, description='Ineligible', amount=500, eligible=False).save()
+        OtherFunding(student=gs, semester=this_sem.offset(1), description='Other', amount=250).save()
+        OtherFunding(student=gs, semester=this_sem.offset(1), description='Gone', amount=999, removed=True).save()
+        promise = Promise(student=gs, amount=2000, start_semester=this_sem.offset(-2), end_semester=this_sem.offset(1))
+        promise.save()
+
+        ledger = FundingLedger([gs])
+        entries = ledger.for_student(gs)
+        self.assertEqual(sorted(e.amount for e in entries if e.student_id == gs.id and counts_on_financials(e)),
+                         [250, 500, 1000])
+
+        # per-semester structure for promises
+        funding = gs.financials_from(this_sem.offset(-2), this_sem.offset(1))
+        self.assertEqual(len(funding), 4)
+        self.assertEqual([s.description for s in funding[this_sem]['scholarship']], ['Ineligible'])
+        # ... which has always counted removed other funding
+        self.assertEqual(promise.received(), 2249)
+        promise = Promise.prefetch_contributions(Promise.objects.filter(id=promise.id))[0]
+        self.assertEqual(promise.received(), 2249)
+        self.assertEqual(promise.difference(), 249)
+
+        # ... and by program year for the financials report
+        received = gs.get_receive_all()
+        self.assertEqual((received['year1'], received['year2']), (1000, 250))
+        self.assertEqual(sum(received[k] for k in YEAR_KEYS), 1250)
+        self.assertEqual(gs.get_receive_all(type='other')['year2'], 250)
+        self.assertEqual(gs.get_promise_amount_all()['year2'], 2000)
+        self.assertEqual(promised_by_year([gs])[gs.id], gs.get_promise_amount_all())
 
+        client = Client()
+        client.login_user('dzhao')
+        response = client.get(reverse('grad:financials_report') + '?csv=yes&finrpt=other')
+        self.assertEqual(response.status_code, 200)
 
+        # funding report: the eligible amounts in the semester, by unit
+        units = [gs.program.unit]
+        programs = _build_funding_totals(this_sem.offset(1), GradProgram.objects.filter(unit__in=units, hidden=False), units)
+        total = programs[-1]
+        for model, amount in [(OtherFunding, total.funding_other), (GradScholarship, total.funding_schol)]:
+            expected = sum(f.amount for f in model.objects.filter(student__program__unit__in=units, removed=False,
+                                                                   eligible=True, semester=this_sem.offset(1)))
+            self.assertEqual(amount, expected)
+        for type in ['tas', 'ras', 'scholarships', 'other']:
+            response = client.get(reverse('grad:funding_report_' + type, kwargs={'semester_name': this_sem.offset(1).name}))
+            self.assertEqual(response.status_code, 200)
 
     def test_grad_status(self):
         self.assertEqual(set(dict(STATUS_CHOICES).keys()) | set([None]), set(SHORT_STATUSES.keys()))
@@ -390,3 +614,99 @@ class GradTest(TestCase):
         self.assertEqual(gs.status_as_of(this_sem.offset(-3 )), 'DEFR')
         self.assertEqual(gs.status_as_of(this_sem), 'REJE')
         self.assertEqual(gs.status_as_of(this_sem.offset(1)), 'REJE')
+
+
+class FundingTest(TestCase):
+    """
+    The funding totals from each report, pinned on the fixture data (with a few odd cases added), so changes to the
+    funding ledger can't quietly change what each report counts.
+    """
+    fixtures = ['basedata', 'coredata', 'grad', 'ta_ra']
+
+    def setUp(self):
+        freshen_roles()
+        from ta.models import TAContract, TACourse
+        from ra.models import RAAppointment
+        TAContract.objects.filter(id=2).update(status='CAN')
+        TACourse.objects.filter(id=13).update(bu=0)
+        # zero-length, three-semester, and slid-start RAs
+        RAAppointment.objects.filter(id=15).update(start_date=datetime.date(2026, 4, 20), end_date=datetime.date(2026, 5, 10))
+        RAAppointment.objects.filter(id=17).update(start_date=datetime.date(2025, 9, 1), end_date=datetime.date(2026, 8, 31))
+        RAAppointment.objects.filter(id=22).update(start_date=datetime.date(2026, 4, 25), end_date=datetime.date(2026, 8, 31))
+        OtherFunding.objects.filter(id=1).update(removed=True)
+        OtherFunding.objects.filter(id=2).update(eligible=False)
+        GradStudent.objects.filter(id=2).update(start_semester=None)
+        s1244, s1247, s1257 = (Semester.objects.get(name=n) for n in ['1244', '1247', '1257'])
+        Scholarship(scholarship_type_id=2, student_id=2, amount=900, start_semester=s1247, end_semester=s1244).save()
+        GradScholarship(student_id=3, semester=s1257, description='Award', amount=1000).save()
+        GradScholarship(student_id=3, semester=s1257, description='Ineligible', amount=500, eligible=False).save()
+        GradScholarship(student_id=3, semester=s1257, description='Gone', amount=700, removed=True).save()
+
+    def _totals(self):
+        totals = {}
+        grads = list(GradStudent.objects.order_by('id'))
+
+        received = [g.get_receive_all() for g in grads]
+        totals['received'] = tuple(sum(r[k] for r in received) for k in YEAR_KEYS)
+        totals['remarks'] = {g.id: r['remarks'] for g, r in zip(grads, received) if r['remarks']}
+        for type in ['ta', 'ra', 'scholarship', 'other']:
+            totals['received', type] = sum(sum(g.get_receive_all(type=type)[k] for k in YEAR_KEYS) for g in grads)
+
+        promises = list(Promise.objects.order_by('id'))
+        totals['promises'] = sum(p.received() for p in promises)
+        totals['promises unmet'] = sum(1 for p in promises if p.difference() < 0)
+
+        client = Client()
+        client.login_user('dzhao')
+        financials = {'ta': 0, 'ra': 0, 'scholarship': 0, 'other': 0, 'total': 0, 'semesters': 0}
+        for g in grads:
+            if g.start_semester is None:
+                continue  # the page can't display a student with no start semester
+            response = client.get(reverse('grad:financials', kwargs={'grad_slug': g.slug}))
+            for k, v in response.context['totals'].items():
+                financials[k] += v
+            financials['semesters'] += len(response.context['semesters'])
+        totals['financials'] = financials
+
+        units = Unit.objects.filter(slug='cmpt')
+        for name in ['1257', '1261', '1264', '1267']:
+            semester = Semester.objects.get(name=name)
+            programs = _build_funding_totals(semester, GradProgram.objects.filter(unit__in=units, hidden=False), units)
+            total = programs[-1]
+            totals['funding report', name] = (total.funding_ta, total.funding_ra, total.funding_schol, total.funding_other)
+            for type in ['tas', 'ras']:
+                response = client.get(reverse('grad:funding_report_' + type, kwargs={'semester_name': name}))
+                totals['funding report', name, type] = response.content.decode('utf8').count('\n')
+
+        return totals
+
+    def test_funding_totals(self):
+        D = decimal.Decimal
+        totals = self._totals()
+
+        # financials report: RA and other funding by program year, the old Scholarship records for the student with no
+        # start semester; NEW/REJ/CAN and 0 BU TA courses don't count
+        self.assertEqual(totals['received'], (D('84725.24'), D('106679.72'), D('61287.72'), D('0'), D('14900')))
+        self.assertEqual(totals['remarks'], {2: 'ra semlen:0 sem:Summer 2026-Spring 2026'
+                                                'scholarship semlen:0 sem:Fall 2024-Summer 2024'})
+        self.assertEqual(totals['received', 'ta'], D('33792.68'))
+        self.assertEqual(totals['received', 'ra'], D('202000'))
+        self.assertEqual(totals['received', 'scholarship'], D('1900'))
+        self.assertEqual(totals['received', 'other'], D('29900'))
+
+        # promises: any TA contract, and even removed other funding
+        self.assertEqual(totals['promises'], D('116925.24'))
+        self.assertEqual(totals['promises unmet'], 46)
+
+        # financials page
+        self.assertEqual(totals['financials'], {'ta': D('33792.68'), 'ra': D('188000'), 'scholarship': D('1500'),
+                                                'other': D('29900'), 'total': D('252692.68'), 'semesters': 146})
+
+        # funding report: accepted TA contracts with any BU, and every RA overlapping the semester
+        self.assertEqual(totals['funding report', '1257'], (D('0'), D('10000') / 3, D('1000'), D('5200')))
+        self.assertEqual(totals['funding report', '1261'], (D('0'), D('610000') / 3, D('0'), D('1300')))
+        self.assertEqual(totals['funding report', '1264'], (D('0'), D('52000') / 3, D('0'), D('6500')))
+        self.assertEqual(totals['funding report', '1267'], (D('20178.20'), D('0'), D('0'), D('2600')))
+        # CSV lines, including the header
+        self.assertEqual([totals['funding report', name, type] for name in ['1257', '1261', '1264', '1267']
+                          for type in ['tas', 'ras']], [1, 2, 1, 31, 1, 4, 6, 1])
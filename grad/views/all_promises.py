@@ -13,7 +13,10 @@ def all_promises(request, semester_name=None):
     else:
         semester = get_object_or_404(Semester, name=semester_name)
     promises = Promise.objects.filter(end_semester=semester, 
-                                      student__program__unit__in=request.units, removed=False)
+                                      student__program__unit__in=request.units, removed=False) \
+                              .select_related('student__person', 'student__program', 'student__start_semester',
+                                              'start_semester', 'end_semester')
+    promises = Promise.prefetch_contributions(promises)
     context = {'promises': promises, 'semester': semester}
     return render(request, 'grad/all_promises.html', context)
 
@@ -30,7 +33,10 @@ def download_promises(request, semester_name=None):
     writer = csv.writer(response)
     writer.writerow(['Student', 'Program', 'Start Semester', 'Status', 'Promised', 'Received', 'Difference'])
     promises = Promise.objects.filter(end_semester=semester,
-                                      student__program__unit__in=request.units)
+                                      student__program__unit__in=request.units) \
+                              .select_related('student__person', 'student__program', 'student__start_semester',
+                                              'start_semester', 'end_semester')
+    promises = Promise.prefetch_contributions(promises)
     for p in promises:
         student = p.student.person.sortname()
         program = p.student.program.label
@@ -1,12 +1,14 @@
 from django.contrib.auth.decorators import login_required
 from courselib.auth import ForbiddenResponse, NotFoundResponse
 from django.shortcuts import render
-from grad.models import Promise, OtherFunding, GradStatus, GradScholarship, \
+from grad.models import Promise, GradStatus, \
         GradProgramHistory, FinancialComment, STATUS_ACTIVE
+from grad.funding import FundingLedger, counts_on_financials
 from coredata.models import Semester
 from ta.models import TAContract, TACourse, STATUSES_NOT_TAING
 from tacontracts.models import TAContract as NewTAContract
-from ra.models import RAAppointment, RARequest
+from ra.models import RAAppointment
+from collections import defaultdict
 import itertools, decimal
 from grad.views.view import _can_view_student
 
@@ -24,17 +26,22 @@ def financials(request, grad_slug, style='complete'):
 
     current_status = GradStatus.objects.filter(student=grad, hidden=False).order_by('-start')[0]
     grad_status_qs = GradStatus.objects.filter(student=grad, hidden=False, status__in=STATUS_ACTIVE).select_related('start','end')
-    scholarships_qs = GradScholarship.objects.filter(student=grad, removed=False).select_related('semester')
+    all_statuses = list(GradStatus.objects.filter(student=grad, hidden=False).order_by('start_date').select_related('start', 'end'))
     promises_qs = Promise.objects.filter(student=grad, removed=False).select_related('start_semester','end_semester')
-    other_fundings = OtherFunding.objects.filter(student=grad, removed=False).select_related('semester')
-    
-    contracts = TAContract.objects.filter(application__person=grad.person).exclude(status__in=STATUSES_NOT_TAING).select_related('posting__semester')
-    other_contracts = NewTAContract.objects.filter(person=grad.person, status__in=['NEW', 'SGN'])\
-                    .select_related('category')\
-                    .prefetch_related('course')
-    appointments = RAAppointment.objects.filter(person=grad.person, deleted=False)
-    # new ra
-    reqs = RARequest.objects.filter(person=grad.person, deleted=False, complete=True, draft=False)
+
+    # all of the funding, as FundingEntry rows
+    ledger = FundingLedger([grad])
+    funding = defaultdict(list)
+    for entry in ledger.for_student(grad):
+        if counts_on_financials(entry):
+            funding[entry.semester].append(entry)
+    contracts = TAContract.objects.filter(application__person=grad.person).exclude(status__in=STATUSES_NOT_TAING)\
+                    .select_related('posting__semester')
+    ras = ledger.ras_by_person[grad.person_id]
+    # draft contracts are displayed, but aren't funding yet
+    draft_contracts = NewTAContract.objects.filter(person=grad.person, status='NEW')\
+                    .select_related('category__hiring_semester__semester')\
+                    .prefetch_related('course__course')
     program_history = GradProgramHistory.objects.filter(student=grad).select_related('start_semester', 'program')
     financial_comments = FinancialComment.objects.filter(student=grad, removed=False).select_related('semester')
     
@@ -45,14 +52,11 @@ def financials(request, grad_slug, style='complete'):
                       (s.end for s in grad_status_qs),
                       (p.start_semester for p in promises_qs),
                       (p.end_semester for p in promises_qs),
-                      (s.semester for s in scholarships_qs),
-                      (o.semester for o in other_fundings),
+                      (e.semester for e in itertools.chain(*funding.values()) if e.category in ('scholarship', 'other')),
                       (c.posting.semester for c in contracts),
                       (c.semester for c in financial_comments),
-                      (get_semester(a.start_date) for a in appointments),
-                      (get_semester(a.end_date) for a in appointments),
-                      (get_semester(r.start_date) for r in reqs),
-                      (get_semester(r.end_date) for r in reqs),
+                      (ledger.semester_at(a.start_date) for a in ras),
+                      (ledger.semester_at(a.end_date) for a in ras),
                       (ph.start_semester for ph in program_history),
                     )
     all_semesters = filter(lambda x: isinstance(x, Semester), all_semesters)
@@ -69,6 +73,7 @@ def financials(request, grad_slug, style='complete'):
     # build data structure with funding for each semester
     for semester in semesters_qs:
         semester_total = decimal.Decimal(0)
+        semester_funding = funding[semester]
 
         yearpos = (semester - grad.start_semester) % 3 # position in academic year: 0 is start of a new academic year for this student
         if not current_acad_year or yearpos == 2:
@@ -76,7 +81,7 @@ def financials(request, grad_slug, style='complete'):
             current_acad_year = {'total': 0, 'semcount': 0, 'endsem': semester}
 
         # other funding
-        other_funding = other_fundings.filter(semester=semester)
+        other_funding = [e.source for e in semester_funding if e.category == 'other']
         other_total = 0
         for other in other_funding:
             if other.eligible:
@@ -84,23 +89,19 @@ def financials(request, grad_slug, style='complete'):
                 semester_total += other.amount
         
         # scholarships
-        semester_scholarships = scholarships_qs.filter(semester=semester)
-        semester_eligible_scholarships = semester_scholarships.filter(eligible=True)
         scholarships = []
-
         scholarship_total = 0
-        for ss in semester_scholarships:
-            amt = ss.amount
-            scholarship_total += ss.amount
-            scholarships.append({'scholarship': ss, 'semester_amount': amt})
-
-        for semester_eligible_scholarship in semester_eligible_scholarships:
-            semester_total += semester_eligible_scholarship.amount
+        for e in semester_funding:
+            if e.category == 'scholarship':
+                scholarship_total += e.amount
+                scholarships.append({'scholarship': e.source, 'semester_amount': e.amount})
+                if e.promise_eligible:
+                    semester_total += e.amount
 
         # grad status        
         status = None
         status_short = None
-        for s in GradStatus.objects.filter(student=grad, hidden=False).order_by('start_date'):
+        for s in all_statuses:
             if s.start <= semester and (s.end == None or semester <= s.end) :
                 status = s.get_status_display()
                 status_short = s.get_short_status_display()
@@ -120,27 +121,22 @@ def financials(request, grad_slug, style='complete'):
         # TAs
         ta_total = 0
         courses = []
-        for contract in contracts:
-            if contract.posting.semester == semester:
-                for course in TACourse.objects.filter(contract=contract).exclude(bu=0).select_related('course'):
-                    ta_total += course.pay()
-                    if contract.status == 'SGN':
-                        text = "%s (%s BU)" % (course.course.name(), course.total_bu)
-                    else:
-                        text = "%s (%s BU, current status: %s)" \
-                             % (course.course.name(), course.total_bu, contract.get_status_display().lower())
-                    courses.append({'course': text,'amount': course.pay()})
-        for contract in other_contracts:
+        for e in semester_funding:
+            if e.category != 'ta':
+                continue
+            course = e.source
+            ta_total += e.amount
+            if isinstance(course, TACourse) and course.contract.status != 'SGN':
+                text = "%s (%s BU, current status: %s)" \
+                     % (course.course.name(), course.total_bu, course.contract.get_status_display().lower())
+            else:
+                text = "%s (%s BU)" % (course.course.name(), course.total_bu)
+            courses.append({'course': text, 'amount': e.amount})
+        for contract in draft_contracts:
             if contract.category.hiring_semester.semester == semester:
-                if contract.status == 'SGN':
-                    for course in contract.course.all():
-                        ta_total += course.total
-                        courses.append({'course': "%s (%s BU)" % (course.course.name(), course.total_bu),
-                                        'amount': course.total })
-                else:
-                    for course in contract.course.all():
-                        courses.append({'course': "%s (%s BU - $%.02f) - Draft" % (course.course.name(), course.total_bu, course.total),
-                                        'amount': 0 })
+                for course in contract.course.all():
+                    courses.append({'course': "%s (%s BU - $%.02f) - Draft" % (course.course.name(), course.total_bu, course.total),
+                                    'amount': 0 })
         ta = {'courses':courses,'amount':ta_total}
         semester_total += ta_total
 
@@ -148,32 +144,22 @@ def financials(request, grad_slug, style='complete'):
         ra_total = 0
         appt = []
         req = []
-        for appointment in appointments:
-            app_start_sem = appointment.start_semester()
-            app_end_sem = appointment.end_semester()
-            length = appointment.semester_length()
-            if app_start_sem <= semester and app_end_sem >= semester:
-                sem_pay = appointment.lump_sum_pay/length
-                ra_total += sem_pay
+        for e in semester_funding:
+            if e.category != 'ra':
+                continue
+            appointment = e.source
+            ra_total += e.amount
+            if isinstance(appointment, RAAppointment):
                 appt.append({'desc':"RA for %s - %s" % (appointment.hiring_faculty.name(), appointment.project),
-                             'amount':sem_pay, 'semesters': appointment.semester_length() })
-        for appointment in reqs:
-            app_start_sem = appointment.start_semester()
-            app_end_sem = appointment.end_semester()
-            length = appointment.semester_length()
-            if app_start_sem <= semester and app_end_sem >= semester:
-                sem_pay = appointment.total_pay/length
-                ra_total += sem_pay
+                             'amount':e.amount, 'semesters': appointment.semlength })
+            else:
                 req.append({'desc':"RA for %s" % (appointment.supervisor.name()), 
-                            'amount':sem_pay, 'semesters': appointment.semester_length()})
+                            'amount':e.amount, 'semesters': appointment.semlength})
         ra = {'appt':appt, 'req':req, 'amount':ra_total}
         semester_total += ra_total
         
         # promises (ending in this semester, so we display them in the right spot)
-        try:
-            promise = promises_qs.filter(end_semester=semester)[0]
-        except IndexError:
-            promise = None
+        promise = next((p for p in promises_qs if p.end_semester == semester), None)
         
         current_acad_year['total'] += semester_total
         current_acad_year['semcount'] += 1
@@ -9,7 +9,8 @@ from django.shortcuts import render, get_object_or_404
 from coredata.models import Semester
 import datetime
 import csv
-from grad.templatetags.getattribute import getattribute
+from grad.funding import FundingLedger, promised_by_year
+from grad.forms import search_column_values
 
 @requires_role("GRAD")
 def financials_report(request):
@@ -62,6 +63,20 @@ def _financials_report_promise(units, finrpt):
     
     return grads
 
+
+def _promised_received(grads):
+    """
+    Generate (grad, senior supervisors, promised amounts, received amounts) for each grad, with the funding for all of
+    them loaded at once.
+    """
+    grads = list(grads)
+    ledger = FundingLedger(grads)
+    promised = promised_by_year(grads)
+    supervisors = search_column_values(grads, ['senior_supervisors'])
+    for g, (sups,) in zip(grads, supervisors):
+        yield g, sups, promised[g.id], ledger.received_by_year(g)
+
+
 @requires_role("GRAD")
 def _generate_csv(request, response, grads):
     writer = csv.writer(response) 
@@ -95,8 +110,7 @@ def _generate_csv(request, response, grads):
     ])
 
 
-    for g in grads:
-         promise_amt =  g.get_promise_amount_all()
+    for g, supervisors, promise_amt, received_amt in _promised_received(grads):
          y1_promise = promise_amt['year1'] #g.get_year1_promise_amount()
          y2_promise = promise_amt['year2'] #g.get_year2_promise_amount()
          y3_promise = promise_amt['year3'] #g.get_year3_promise_amount()
@@ -104,7 +118,6 @@ def _generate_csv(request, response, grads):
          oth_promise =  promise_amt['otheryear'] #g.get_otheryear_promise_amount()
          ttl_promise = y1_promise + y2_promise + y3_promise + y4_promise + oth_promise
 
-         received_amt = g.get_receive_all()
          y1_received =  received_amt['year1'] # g.get_year1_received()
          y2_received =  received_amt['year2'] #g.get_year2_received()
          y3_received =  received_amt['year3'] #g.get_year3_received()
@@ -118,7 +131,7 @@ def _generate_csv(request, response, grads):
             g.person.first_name,
             g.person.userid,
             g.program.label,
-            getattribute(g, 'senior_supervisors'),
+            supervisors,
             g.current_status,
             g.start_semester.label(),
             y1_promise,
@@ -187,8 +200,7 @@ def _generate_excel(request, response, grads, finrpt):
     sheet.write(1, 27, 'Remarks', hdrstyle)
     
     # data rows
-    for i,g in enumerate(grads):
-        promise_amt =  g.get_promise_amount_all()
+    for i, (g, supervisors, promise_amt, received_amt) in enumerate(_promised_received(grads)):
         y1_promise = promise_amt['year1'] #g.get_year1_promise_amount()
         y2_promise = promise_amt['year2'] #g.get_year2_promise_amount()
         y3_promise = promise_amt['year3'] #g.get_year3_promise_amount()
@@ -196,7 +208,6 @@ def _generate_excel(request, response, grads, finrpt):
         oth_promise =  promise_amt['otheryear'] #g.get_otheryear_promise_amount()
         ttl_promise = y1_promise + y2_promise + y3_promise + y4_promise + oth_promise
 
-        received_amt = g.get_receive_all()
         y1_received =  received_amt['year1'] # g.get_year1_received()
         y2_received =  received_amt['year2'] #g.get_year2_received()
         y3_received =  received_amt['year3'] #g.get_year3_received()
@@ -209,7 +220,7 @@ def _generate_excel(request, response, grads, finrpt):
         sheet.write(i+2, 3, g.person.first_name)
         sheet.write(i+2, 4, g.person.userid)
         sheet.write(i+2, 5, g.program.label)
-        sheet.write(i+2, 6, getattribute(g, 'senior_supervisors'))
+        sheet.write(i+2, 6, supervisors)
         sheet.write(i+2, 7, g.current_status)
         sheet.write(i+2, 8, g.start_semester.label())
         sheet.write(i+2, 9, y1_promise)
@@ -1,10 +1,10 @@
 from courselib.auth import requires_role
 from django.shortcuts import render, get_object_or_404
 from coredata.models import Semester
-from grad.models import GradProgram, GradStudent, GradScholarship, OtherFunding
+from grad.models import GradProgram, GradStudent
 from grad.views.quick_search import ACTIVE_STATUS_ORDER
+from grad.funding import FundingLedger
 from ta.models import TACourse
-from tacontracts.models import TAContract
 from ra.models import RAAppointment, RARequest
 
 from django.http import HttpResponse
@@ -22,95 +22,36 @@ class _FakeProgram(object):
         self.label = label
         self.id = pid
 
-def _funding_ra_old(units, semester, prog_lookup, student_programs, non_grad):
-    funding = []
-    sem_st, sem_en = RAAppointment.start_end_dates(semester)
-    raappt = RAAppointment.objects.filter(unit__in=units, deleted=False, end_date__gte=sem_st, start_date__lte=sem_en)
-    for ra in raappt:
-        person_id = ra.person_id
-        if person_id in student_programs:
-            prog_id = student_programs[person_id]
-            prog = prog_lookup[prog_id]
-        else:
-            prog = non_grad
-        semlen = ra.semester_length()
-        if semlen == 0:
-            semlen = 1
-        pay = ra.lump_sum_pay/semlen
-        funding.append((ra, prog, pay, semlen))
-    return funding
-
-def _funding_ra_new(units, semester, prog_lookup, student_programs, non_grad):
-    funding = []
-    sem_st, sem_en = RARequest.start_end_dates(semester)
-    reqs = RARequest.objects.filter(unit__in=units, deleted=False, complete=True, draft=False, end_date__gte=sem_st, start_date__lte=sem_en)
-    for ra in reqs:
-        person_id = ra.person_id
-        if person_id in student_programs:
-            prog_id = student_programs[person_id]
-            prog = prog_lookup[prog_id]
-        else:
-            prog = non_grad
-        semlen = ra.semester_length()
-        if semlen == 0:
-            semlen = 1
-        pay = ra.total_pay/semlen
-        funding.append((ra, prog, pay, semlen))
-    return funding
-
-def _funding_ta(units, semester, prog_lookup, student_programs, non_grad):
-    funding = []
-    tacourses = TACourse.objects.filter(contract__posting__semester=semester,
-                                        contract__posting__unit__in=units,
-                                        contract__status__in=['ACC', 'SGN']) \
-                        .select_related('contract__application')
-    for crs in tacourses:
-        person_id = crs.contract.application.person_id
-        if person_id in student_programs:
-            prog_id = student_programs[person_id]
-            prog = prog_lookup[prog_id]
-        else:
-            prog = non_grad
-        pay = crs.pay()
-        funding.append((crs, prog, pay))
-    return funding
-
-def _funding_tacontracts(units, semester, prog_lookup, student_programs, non_grad):
-    funding = []
-    tacontracts = TAContract.objects.filter(category__hiring_semester__semester=semester, category__hiring_semester__unit__in=units, status='SGN')
-    for tac in tacontracts: 
-        person_id = tac.person_id
-        if person_id in student_programs:
-            prog_id = student_programs[person_id]
-            prog = prog_lookup[prog_id]
-        else:
-            prog = non_grad
-        pay = tac.total
-        funding.append((tac, prog, pay))
-    return funding
-
-def _funding_schol(units, semester, prog_lookup):
-    funding = []
-    schols = GradScholarship.objects.filter(student__program__unit__in=units,
-                                            semester=semester,
-                                            removed=False, eligible=True) \
-                            .select_related('student', 'semester')
-    for sch in schols:
-        prog_id = sch.student.program_id
-        prog = prog_lookup[prog_id]
-        pay = sch.amount
-        funding.append((sch, prog, pay))
-    return funding
-
-def _funding_other(units, semester, prog_lookup):
-    funding = []
-    others = OtherFunding.objects.filter(student__program__unit__in=units, semester=semester, removed=False, eligible=True).select_related('student')
-    for oth in others:
-        prog_id = oth.student.program_id
-        prog = prog_lookup[prog_id]
-        pay = oth.amount
-        funding.append((oth, prog, pay))
-    return funding
+def _person_program(person_id, prog_lookup, student_programs, non_grad):
+    if person_id in student_programs:
+        return prog_lookup[student_programs[person_id]]
+    else:
+        return non_grad
+
+def _funding_ra_old(ledger, prog_lookup, student_programs, non_grad):
+    # every RA overlapping the semester's dates, whether or not it pays in it
+    return [(ra, _person_program(ra.person_id, prog_lookup, student_programs, non_grad), ra.semvalue, ra.semlength)
+            for ra in ledger.ras if isinstance(ra, RAAppointment)]
+
+def _funding_ra_new(ledger, prog_lookup, student_programs, non_grad):
+    return [(ra, _person_program(ra.person_id, prog_lookup, student_programs, non_grad), ra.semvalue, ra.semlength)
+            for ra in ledger.ras if isinstance(ra, RARequest)]
+
+def _funding_ta(ledger, prog_lookup, student_programs, non_grad):
+    return [(e.source, _person_program(e.person_id, prog_lookup, student_programs, non_grad), e.amount)
+            for e in ledger.entries if e.category == 'ta' and isinstance(e.source, TACourse) and e.status in ['ACC', 'SGN']]
+
+def _funding_tacontracts(ledger, prog_lookup, student_programs, non_grad):
+    return [(tac, _person_program(tac.person_id, prog_lookup, student_programs, non_grad), tac.total)
+            for tac in ledger.tacontracts]
+
+def _funding_schol(ledger, prog_lookup):
+    return [(e.source, prog_lookup[e.source.student.program_id], e.amount)
+            for e in ledger.entries if e.category == 'scholarship' and e.promise_eligible]
+
+def _funding_other(ledger, prog_lookup):
+    return [(e.source, prog_lookup[e.source.student.program_id], e.amount)
+            for e in ledger.entries if e.category == 'other' and e.promise_eligible and not e.source.removed]
 
 def _build_grad_mapping(programs, units):
     # build mapping of Person.id to most-likely-currently-interesting GradProgram they're in
@@ -135,6 +76,7 @@ def _build_funding_totals(semester, programs, units):
     Returns list of programs annotated with the totals
     """
     prog_lookup, student_programs, non_grad, programs = _build_grad_mapping(programs, units)
+    ledger = FundingLedger(units=units, start=semester, end=semester)
     total = _FakeProgram(label="Total **", pid=-2)
     programs.append(total)
     for prog in programs:
@@ -144,40 +86,40 @@ def _build_funding_totals(semester, programs, units):
         prog.funding_other = decimal.Decimal(0)
 
     # - ta: /ta
-    funding_ta = _funding_ta(units, semester, prog_lookup, student_programs, non_grad)
+    funding_ta = _funding_ta(ledger, prog_lookup, student_programs, non_grad)
     for ta in funding_ta:    
         prog, pay = ta[1], ta[2]
         prog.funding_ta += pay
         total.funding_ta += pay
     # - ta: /tacontracts
-    funding_tacontracts = _funding_tacontracts(units, semester, prog_lookup, student_programs, non_grad)
+    funding_tacontracts = _funding_tacontracts(ledger, prog_lookup, student_programs, non_grad)
     for ta in funding_tacontracts:    
         prog, pay = ta[1], ta[2]
         prog.funding_ta += pay
         total.funding_ta += pay
 
     # - ra: old
-    funding_ra_old = _funding_ra_old(units, semester, prog_lookup, student_programs, non_grad)
+    funding_ra_old = _funding_ra_old(ledger, prog_lookup, student_programs, non_grad)
     for ra_old in funding_ra_old:
         prog, pay = ra_old[1], ra_old[2]
         prog.funding_ra += pay
         total.funding_ra += pay
     # - ra: new
-    funding_ra_new = _funding_ra_new(units, semester, prog_lookup, student_programs, non_grad)
+    funding_ra_new = _funding_ra_new(ledger, prog_lookup, student_programs, non_grad)
     for ra_new in funding_ra_new:
         prog, pay = ra_new[1], ra_new[2]
         prog.funding_ra += pay
         total.funding_ra += pay
 
     # scholarships
-    funding_schol = _funding_schol(units, semester, prog_lookup)
+    funding_schol = _funding_schol(ledger, prog_lookup)
     for sch in funding_schol:
         prog, pay = sch[1], sch[2]
         prog.funding_schol += pay
         total.funding_schol += pay
 
     # other funding
-    funding_other = _funding_other(units, semester, prog_lookup)
+    funding_other = _funding_other(ledger, prog_lookup)
     for oth in funding_other:
         prog, pay = oth[1], oth[2]
         prog.funding_other += pay
@@ -211,6 +153,7 @@ def _build_funding_csv(semester, programs, units, type):
     Returns a csv response
     """
     prog_lookup, student_programs, non_grad, programs = _build_grad_mapping(programs, units)
+    ledger = FundingLedger(units=units, start=semester, end=semester)
 
     response = HttpResponse(content_type='text/csv')
     response['Content-Disposition'] = 'inline; filename="funding-report-%s-%s.csv"' % (semester.name, type)
@@ -219,36 +162,36 @@ def _build_funding_csv(semester, programs, units, type):
     if type == 'ras':
         writer.writerow(['Unit', 'Name', 'ID', 'Program', 'Supervisor', 'Start Date', 'End Date', 'Total Appointment Pay', 'Length (In Semesters)', str(semester) + " Pay", "URL"])
         # old
-        funding_ra_old = _funding_ra_old(units, semester, prog_lookup, student_programs, non_grad)
+        funding_ra_old = _funding_ra_old(ledger, prog_lookup, student_programs, non_grad)
         for ra in funding_ra_old:
             funding, prog, pay, semlen = ra[0], ra[1], ra[2], ra[3]
             writer.writerow([funding.unit.label, funding.person.sortname(), funding.person.emplid, prog.label, funding.hiring_faculty.sortname(), funding.start_date, funding.end_date, funding.lump_sum_pay, semlen, "{:.2f}".format(pay), funding.get_absolute_url()]) 
         # new
-        funding_ra_new = _funding_ra_new(units, semester, prog_lookup, student_programs, non_grad)
+        funding_ra_new = _funding_ra_new(ledger, prog_lookup, student_programs, non_grad)
         for ra in funding_ra_new:
             funding, prog, pay, semlen = ra[0], ra[1], ra[2], ra[3]
             writer.writerow([funding.unit.label, funding.get_sort_name(), funding.get_id(), prog.label, funding.supervisor.sortname(), funding.start_date, funding.end_date, funding.total_pay, semlen, "{:.2f}".format(pay), funding.get_absolute_url()])
     elif type == 'tas':
         # - /ta
         writer.writerow(['Unit', 'Name', 'ID', 'Program', str(semester) + " Pay"])
-        funding_ta = _funding_ta(units, semester, prog_lookup, student_programs, non_grad)
+        funding_ta = _funding_ta(ledger, prog_lookup, student_programs, non_grad)
         for crs in funding_ta:
             funding, prog, pay = crs[0], crs[1], crs[2]
             writer.writerow([funding.contract.posting.unit.label, funding.contract.application.person.sortname(), funding.contract.application.person.emplid, prog.label, "{:.2f}".format(pay)])
         # - /tacontracts
-        funding_tacontracts = _funding_tacontracts(units, semester, prog_lookup, student_programs, non_grad)
+        funding_tacontracts = _funding_tacontracts(ledger, prog_lookup, student_programs, non_grad)
         for tac in funding_tacontracts: 
             funding, prog, pay = tac[0], tac[1], tac[2]
             writer.writerow([funding.category.hiring_semester.unit.label, funding.person.sortname(), funding.person.emplid, prog.label, "{:.2f}".format(pay), "!"])
     elif type == 'scholarships':
         writer.writerow(['Unit', 'Name', 'ID', 'Program', 'Total Pay', str(semester) + " Pay"])
-        funding_schol = _funding_schol(units, semester, prog_lookup)
+        funding_schol = _funding_schol(ledger, prog_lookup)
         for sch in funding_schol:
             funding, prog, pay = sch[0], sch[1], sch[2]
             writer.writerow([funding.student.program.unit.label, funding.student.person.sortname(), funding.student.person.emplid, prog.label, funding.amount, "{:.2f}".format(pay)])
     elif type == 'other':
         writer.writerow(['Unit', 'Name', 'ID', 'Program', str(semester) + " Pay"])
-        funding_other = _funding_other(units, semester, prog_lookup)
+        funding_other = _funding_other(ledger, prog_lookup)
         for oth in funding_other:
             funding, prog, pay = oth[0], oth[1], oth[2]
             writer.writerow([funding.student.program.unit.label, funding.student.person.sortname(), funding.student.person.emplid, prog.label, pay])
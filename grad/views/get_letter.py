@@ -2,20 +2,18 @@ from courselib.auth import ForbiddenResponse
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import get_object_or_404
 from grad.models import Letter
-from django.http import HttpResponse
 from dashboard.letters import OfficialLetter, LetterContents
+from dashboard.models import Signature
+from dashboard.pdfcache import cached_pdf, pdf_response
 from grad.views.view import _can_view_student
 
-@login_required
-def get_letter(request, grad_slug, letter_slug):
-    grad, authtype, units = _can_view_student(request, grad_slug)
-    if grad is None or authtype == 'student':
-        return ForbiddenResponse(request)
-    letter = get_object_or_404(Letter, slug=letter_slug, student=grad, student__program__unit__in=units)
-    response = HttpResponse(content_type="application/pdf")
-    response['Content-Disposition'] = 'inline; filename="%s.pdf"' % (letter_slug)
+def _letter_inputs(letter):
+    signatures = list(Signature.objects.filter(user=letter.from_person)) if letter.use_sig() else []
+    return [letter, letter.template, letter.student.program.unit, signatures]
 
-    doc = OfficialLetter(response, unit=letter.student.program.unit)
+@cached_pdf('grad_letter', _letter_inputs)
+def _letter_pdf(letter, outfile):
+    doc = OfficialLetter(outfile, unit=letter.student.program.unit)
     l = LetterContents(to_addr_lines=letter.to_lines.split("\n"), 
                        from_name_lines=letter.from_lines.split("\n"),
                        date=letter.date,
@@ -27,4 +25,11 @@ def get_letter(request, grad_slug, letter_slug):
     l.add_paragraphs(content_lines)
     doc.add_letter(l)
     doc.write() 
-    return response
+
+@login_required
+def get_letter(request, grad_slug, letter_slug):
+    grad, authtype, units = _can_view_student(request, grad_slug)
+    if grad is None or authtype == 'student':
+        return ForbiddenResponse(request)
+    letter = get_object_or_404(Letter, slug=letter_slug, student=grad, student__program__unit__in=units)
+    return pdf_response(request, _letter_pdf, (letter,), '%s.pdf' % (letter_slug))
@@ -5,13 +5,13 @@ from grad.models import GradStudent, GradFlag, GradProgram, SavedSearch, GradReq
 from django.http import HttpResponseRedirect, HttpResponse
 from django.utils.safestring import mark_safe
 from django.contrib import messages
-from grad.forms import SearchForm, SaveSearchForm, QuickSearchForm, COLUMN_CHOICES, COLUMN_WIDTHS
+from grad.forms import SearchForm, SaveSearchForm, QuickSearchForm, COLUMN_CHOICES, COLUMN_WIDTHS, \
+    search_column_values
 from django.urls import reverse
 from coredata.models import Person, Role
 import csv
 import copy, datetime, json
-from grad.templatetags.getattribute import getattribute
-from dashboard.letters import card_req_forms, fasnet_forms
+from dashboard.bulkpdf import bulk_pdf_response
 from django.db.models import Q
 from grad.views.add_supervisors import _get_grads_missing_supervisors
 
@@ -56,11 +56,7 @@ def _parse_sort(sortstr):
 def _generate_csv(response, columns, headers, grads):
     writer = csv.writer(response)
     writer.writerow( headers )
-    for grad in grads:
-        row = []
-        for column in columns:
-            value = getattribute(grad, column, html=False)
-            row.append(value)
+    for row in search_column_values(grads, columns, html=False):
         writer.writerow( row )
 
 
@@ -79,10 +75,10 @@ def _generate_excel(response, columns, headers, grads):
         sheet.write(1, i, hdr, hdrstyle)
     
     # data rows
-    for i,grad in enumerate(grads):
+    for i,row in enumerate(search_column_values(grads, columns, html=False)):
         style = [oddstyle, evenstyle][i%2]
-        for j,column in enumerate(columns):
-            sheet.write(i+2, j, getattribute(grad, column, html=False), style)
+        for j,value in enumerate(row):
+            sheet.write(i+2, j, value, style)
     
     # set column widths
     for i,c in enumerate(columns):
@@ -189,23 +185,18 @@ def search(request):
         
         elif 'cardforms' in request.GET:
             # access card requisition output
-            response = HttpResponse(content_type='application/pdf')
-            response['Content-Disposition'] = 'inline; filename="card_access.pdf"'
-            card_req_forms(grads, response)
-            return response
+            return bulk_pdf_response(request, 'card_req', grads, 'card_access.pdf')
         
         elif 'fasnetforms' in request.GET:
             # access card requisition output
-            response = HttpResponse(content_type='application/pdf')
-            response['Content-Disposition'] = 'inline; filename="fasnet_access.pdf"'
-            fasnet_forms(grads, response)
-            return response
+            return bulk_pdf_response(request, 'fasnet', grads, 'fasnet_access.pdf')
         
         if overflow:
             messages.warning(request, "Too many result found: limited to %i." % (MAX_RESULTS))
 
         context = {
                    'grads': grads,
+                   'grad_rows': list(zip(grads, search_column_values(grads, columns))),
                    'human_readable_column_headers': human_readable_column_headers,
                    'columns': columns,
                    'saveform' : saveform,
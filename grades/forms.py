@@ -3,7 +3,6 @@ from grades.models import ACTIVITY_STATUS_CHOICES, NumericActivity, LetterActivi
 from coredata.models import CourseOffering
 from groups.models import GroupMember
 from django.utils.safestring import mark_safe
-import pickle
 import datetime
 from grades.utils import parse_and_validate_formula, ValidationError
 from submission.models import Submission
@@ -296,7 +295,7 @@ class FormulaFormEntry(forms.Form):
                 except ValidationError as e:
                     raise forms.ValidationError(e.args[0])
                 else:
-                    self.pickled_formula = pickle.dumps(parsed_expr)
+                    self.parsed_formula = parsed_expr
         return formula
 
 class StudentSearchForm(forms.Form):
@@ -10,10 +10,18 @@
 #   act_dict = activities_dictionary(activities)        
 # then pass it into the evaluator along with a Member object for the student:
 #   result = eval_parse(parsed_expr, act_dict, member, visible)
+# (parse results are cached per-process: pass labels=frozenset(act_dict) to parse if you have the activities handy.)
+# or, to calculate for many students at once without walking the tree (or querying) for each:
+#   func = compile_parse(parsed_expr, activity, act_dict, visible)
+#   matrix = grade_matrix([act_dict[c] for c in cols_used(parsed_expr)])
+#   result = func(matrix.get(member.id, {}))
 
 from pyparsing import ParseException
+from collections import OrderedDict
+import copy
 import itertools
-from grades.models import NumericActivity
+import threading
+from grades.models import NumericActivity, NumericGrade
 
 class EvalException(Exception):
     pass
@@ -126,11 +134,51 @@ def fix_used_acts(parsed, course, activity):
         else:
             acts.update([a.short_name for a in all_na if a.id != activity.id])
 
-def parse(expr, course, activity):
+# process-wide LRU cache of parse trees, keyed by (formula text, set of activity labels in the offering).
+PARSE_CACHE_SIZE = 500
+_parse_cache = OrderedDict()
+_parse_cache_lock = threading.Lock()
+
+def _parse_tree(expr, labels):
+    """
+    Parse the formula text with the (once-per-process) parser, through the LRU cache.
+
+    Returns a fresh copy of the tree each time: callers (fix_used_acts in particular) modify the column sets in place.
+    """
+    key = (expr, labels)
+    with _parse_cache_lock:
+        tree = _parse_cache.get(key)
+        if tree is not None:
+            _parse_cache.move_to_end(key)
+
+    if tree is None:
+        tree = parser.parseString(expr)[0]
+        with _parse_cache_lock:
+            _parse_cache[key] = tree
+            while len(_parse_cache) > PARSE_CACHE_SIZE:
+                _parse_cache.popitem(last=False)
+
+    return copy.deepcopy(tree)
+
+def invalidate_formula_cache(labels):
+    """
+    Forget cached parse trees for offerings that had any of these activity labels (because the activity was renamed
+    or deleted).
+    """
+    labels = set(labels)
+    with _parse_cache_lock:
+        stale = [key for key in _parse_cache if key[1] is not None and not labels.isdisjoint(key[1])]
+        for key in stale:
+            del _parse_cache[key]
+
+def parse(expr, course, activity, labels=None):
     """
     Parse expression and return parse tree.
+
+    labels should be the set of activity labels (as in activities_dictionary) that the formula can refer to, if the
+    caller knows them: it keeps renamed activities from hitting stale cache entries.
     """
-    parsed = parser.parseString(expr)[0]
+    parsed = _parse_tree(expr, labels)
     fix_used_acts(parsed, course, activity)
     return parsed
 
@@ -280,6 +328,157 @@ def eval_parse(tree, activity, act_dict, member, visible):
         raise EvalException("Unknown element in parse tree: %s" % (tree,))
     
 
+def grade_matrix(activities, members=None):
+    """
+    Bulk-load the grades for these activities into a students-by-activities matrix, in one query.
+
+    Returns a dictionary of {member.id: {activity.id: float grade}}. Missing grades are simply absent from the
+    row and "no grade" values are 0.0, so row.get(activity.id, 0.0) gives what visible_grade would.
+
+    If members is given, only those members' grades are loaded.
+    """
+    grades = NumericGrade.objects.filter(activity__in=activities)
+    if members is not None:
+        grades = grades.filter(member__in=members)
+
+    matrix = {}
+    for member_id, activity_id, value, flag in grades.values_list('member_id', 'activity_id', 'value', 'flag'):
+        row = matrix.setdefault(member_id, {})
+        if flag == 'NOGR':
+            row[activity_id] = 0.0
+        else:
+            row[activity_id] = float(value)
+    return matrix
+
+
+def compile_parse(tree, activity, act_dict, visible):
+    """
+    Compile the parse tree into a function that evaluates the formula for one student.
+
+    The returned function takes that student's row from grade_matrix and returns the same value eval_parse would,
+    without walking the tree or querying the database, so it can be applied to a whole class cheaply.
+
+    Throws KeyError for unknown column (when compiling). The returned function throws EvalException if there's a
+    problem evaluating.
+    """
+    calculating_leak = activity.calculation_leak()
+
+    def constant(value):
+        return lambda row: value
+
+    def grade_of(act):
+        # the compiled equivalent of visible_grade
+        if not calculating_leak and visible and act.status != 'RLS':
+            return constant(0.0)
+        act_id = act.id
+        return lambda row: row.get(act_id, 0.0)
+
+    def final_of(act):
+        # the compiled equivalent of [act.final]
+        max_grade = float(act.max_grade)
+        if not act.percent or not max_grade:
+            return constant(0.0)
+        percent = float(act.percent)
+        grade = grade_of(act)
+        return lambda row: grade(row)/max_grade * percent
+
+    def comp(tree):
+        t = tree[0]
+        if t == 'sign' and tree[2] == '+':
+            return comp(tree[3])
+        elif t == 'sign' and tree[2] == '-':
+            operand = comp(tree[3])
+            return lambda row: -operand(row)
+        elif t == 'col':
+            act = act_dict[tree[2]]
+            part = tree[3]
+            if part == "val":
+                return grade_of(act)
+            elif part == "max":
+                return constant(float(act.max_grade))
+            elif part == "per":
+                if act.percent:
+                    return constant(float(act.percent))
+                else:
+                    return constant(0.0)
+            elif part == "fin":
+                return final_of(act)
+            else:
+                raise EvalException("Unknown column modifier in parse tree: %s" % (part,))
+
+        elif t == 'num':
+            return constant(tree[2])
+        elif t == 'expr':
+            first = comp(tree[2])
+            rest = []
+            for operator, operand in zip(tree[3::2], tree[4::2]):
+                if operator not in ('+', '-', '*', '/'):
+                    raise EvalException("Unknown operator in parse tree: %s" % (operator,))
+                rest.append((operator, comp(operand)))
+
+            def evaluate_expr(row):
+                val = first(row)
+                for operator, operand in rest:
+                    v = operand(row)
+                    if operator == "+":
+                        val += v
+                    elif operator == "-":
+                        val -= v
+                    elif operator == "*":
+                        val *= v
+                    elif v == 0:
+                        val = 0.0
+                    else:
+                        val /= v
+                return val
+            return evaluate_expr
+
+        elif t == 'func':
+            func = tree[2]
+            args = [comp(t) for t in tree[3:]]
+            if func == 'SUM':
+                return lambda row: sum(a(row) for a in args)
+            elif func == 'MAX':
+                return lambda row: max(a(row) for a in args)
+            elif func == 'MIN':
+                return lambda row: min(a(row) for a in args)
+            elif func == 'COUNT':
+                return lambda row: sum(1 for a in args if a(row) > 0.0)
+            elif func == 'AVG':
+                if not args:
+                    return constant(0)
+                return lambda row: sum(a(row) for a in args) / len(args)
+            elif func == 'BEST':
+                count, marks = args[0], args[1:]
+
+                def evaluate_best(row):
+                    # round first argument to an int: it's the number of best items to pick
+                    n = int(round(count(row)) + 0.1)
+                    if n < 1:
+                        raise EvalException('Bad number of "best" selected, %i.' % (n,))
+                    if n > len(marks):
+                        raise EvalException("Not enough arguments to choose %i best." % (n,))
+                    values = sorted(m(row) for m in marks)
+                    return sum(values[-n:])
+                return evaluate_best
+            else:
+                raise EvalException("Unknown function in parse tree: %s" % (func,))
+
+        elif t == 'flag':
+            flag = tree[2]
+            if flag == 'activitytotal':
+                # total [activity.final] for all activities
+                fix_used_acts(tree, activity.offering, activity)
+                finals = [final_of(act_dict[label]) for label in tree[1]]
+                return lambda row: sum((f(row) for f in finals), 0.0)
+            else:
+                raise EvalException("Unknown flag in parse tree: %s" % (flag,))
+        else:
+            raise EvalException("Unknown element in parse tree: %s" % (tree,))
+
+    return comp(tree)
+
+
 def create_display(tree, act_dict):
     if isinstance(tree, str):
         return str(tree)
@@ -330,8 +529,8 @@ def display_formula(activity, activities):
     """
     Return user-understandable version of this activity's formula
     """
-    tree = parse(activity.formula, activity.offering, activity)
     act_dict = activities_dictionary(activities)
+    tree = parse(activity.formula, activity.offering, activity, labels=frozenset(act_dict))
     return str(create_display(tree, act_dict))
 
 
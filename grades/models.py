@@ -135,6 +135,10 @@ class Activity(models.Model):
         
         super(Activity, self).save(*args, **kwargs)
 
+        # formulas, letter cutoffs, or the set of activities may have changed
+        from grades.utils import invalidate_calculation_graph
+        invalidate_calculation_graph(self.offering_id)
+
         if newsitem and old and self.status == 'RLS' and old != None and old.status != 'RLS':
             from grades.tasks import send_grade_released_news, create_grade_released_history
 
@@ -146,6 +150,11 @@ class Activity(models.Model):
             # newly-released grades: create news items
             send_grade_released_news(self.id)
 
+        if old and (old.name != self.name or old.short_name != self.short_name or old.deleted != self.deleted):
+            # renamed or deleted: cached formulas referring to the old labels are no longer valid
+            from grades.formulas import invalidate_formula_cache
+            invalidate_formula_cache([old.name, old.short_name])
+
         if old and old.group and not self.group:
             # activity changed group -> individual. Clean out any group memberships
             from groups.models import GroupMember
@@ -549,7 +558,7 @@ class NumericGrade(models.Model):
         else:
             return '%s/%s (%.2f%%)' % (self.value, self.activity.max_grade, float(self.value)/float(self.activity.max_grade)*100)
 
-    def save(self, entered_by, mark=None, newsitem=True, group=None, is_temporary=False):
+    def save(self, entered_by, mark=None, newsitem=True, group=None, is_temporary=False, recalculate=True):
         """Save the grade.
 
         entered_by must be one of:
@@ -560,6 +569,8 @@ class NumericGrade(models.Model):
         mark is a reference to the StudentActivityMark or GroupActivity mark, if that's where the grade came from
 
         newsitem controls the posting of a NewsItem for the student.
+
+        recalculate controls updating this student's already-calculated grades that depend on this one.
         """
         if self.flag == "NOGR":
             # make sure "no grade" values have a zero: just in case the value is used in some other calc
@@ -587,6 +598,10 @@ class NumericGrade(models.Model):
                 url=self.activity.get_absolute_url())
             n.save()
 
+        if recalculate and not is_temporary:
+            from grades.utils import recalculate_dependents
+            recalculate_dependents(self.activity, self.member)
+
     def get_absolute_url(self):
         """        
         for regular numeric activity return the mark summary page
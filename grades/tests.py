@@ -1,10 +1,12 @@
 # coding=utf-8
 
-from grades.formulas import parse, cols_used, eval_parse, EvalException, ParseException
+from grades import formulas
+from grades.formulas import parse, cols_used, eval_parse, compile_parse, grade_matrix, EvalException, ParseException
 from grades.models import Activity, NumericActivity, LetterActivity, CalNumericActivity, CalLetterActivity, \
     NumericGrade, LetterGrade, GradeHistory, all_activities_filter, ACTIVITY_STATUS, sorted_letters, \
     median_letters
-from grades.utils import activities_dictionary, generate_grade_range_stat
+from grades.utils import activities_dictionary, generate_grade_range_stat, calculate_numeric_grade, \
+    calculate_letter_grade, calculation_graph, recalculate_dependents, recalculate_dependents_many
 from coredata.models import Person, Member, CourseOffering, Unit
 from dashboard.models import UserConfig
 from submission.models import StudentSubmission
@@ -80,6 +82,18 @@ class GradesTest(TestCase):
         self.assertEqual(tree, tree2)
         # check that it found the right list of columns used
         self.assertEqual(cols_used(tree), set(['A1', 'A2', 'Assignment #1']))
+
+        # cached parse trees must come back as independent copies, and be forgotten when an activity is renamed
+        labels = frozenset(act_dict)
+        tree = parse("[[activitytotal]] + [A1]", c, ca, labels=labels)
+        tree[1].add('X')
+        self.assertEqual(cols_used(parse("[[activitytotal]] + [A1]", c, ca, labels=labels)), set(['A1', 'A2', '\u00b6']))
+        self.assertIn(("[[activitytotal]] + [A1]", labels), formulas._parse_cache)
+        a1.name = "Assignment One"
+        a1.save()
+        self.assertNotIn(("[[activitytotal]] + [A1]", labels), formulas._parse_cache)
+        a1.name = "Assignment #1"
+        a1.save()
         
         # test parsing and evaluation to make sure we get the right values out
         for expr, correct in test_formulas:
@@ -87,11 +101,19 @@ class GradesTest(TestCase):
             res = eval_parse(tree, ca, act_dict, m, False)
             self.assertAlmostEqual(correct, res, msg="Incorrect result for %s"%(expr,))
 
+        # ... and the compiled version should agree
+        matrix = grade_matrix(activities)
+        for expr, correct in test_formulas:
+            tree = parse(expr, c, ca)
+            res = compile_parse(tree, ca, act_dict, False)(matrix[m.id])
+            self.assertAlmostEqual(correct, res, msg="Incorrect compiled result for %s"%(expr,))
+
         # test some badly-formed stuff for appropriate exceptions
         tree = parse("1 + BEST(3, [A1], [A2])", c, ca)
         self.assertRaises(EvalException, eval_parse, tree, ca, act_dict, m, True)
         tree = parse("1 + BEST(0, [A1], [A2])", c, ca)
         self.assertRaises(EvalException, eval_parse, tree, ca, act_dict, m, True)
+        self.assertRaises(EvalException, compile_parse(tree, ca, act_dict, True), matrix[m.id])
         tree = parse("[Foo] /2", c, ca)
         self.assertRaises(KeyError, eval_parse, tree, ca, act_dict, m, True)
         tree = parse("[a1] /2", c, ca)
@@ -148,6 +170,84 @@ class GradesTest(TestCase):
         tree = parse(expr, c, ca)
         res = eval_parse(tree, ca, act_dict, m, True)
         self.assertAlmostEqual(res, 7.229166666)
+        res = compile_parse(tree, ca, act_dict, True)(grade_matrix(activities).get(m.id, {}))
+        self.assertAlmostEqual(res, 7.229166666)
+
+    def test_calculate_numeric(self):
+        """
+        Test calculating a CalNumericActivity for the whole class.
+        """
+        s, c = create_offering()
+        members = []
+        for u in ["0aaa0", "0aaa1", "0aaa2"]:
+            m = Member(person=Person.objects.get(userid=u), offering=c, role="STUD", added_reason="UNK")
+            m.save()
+            members.append(m)
+
+        a1 = NumericActivity(name="Assignment 1", short_name="A1", status="RLS", offering=c, position=1, max_grade=10, percent=50)
+        a1.save()
+        a2 = NumericActivity(name="Assignment 2", short_name="A2", status="RLS", offering=c, position=2, max_grade=20, percent=50)
+        a2.save()
+        for m, v1, v2 in zip(members, [5, 10, 0], [20, 10, 0]):
+            NumericGrade(activity=a1, member=m, value=v1, flag="GRAD").save(entered_by='ggbaker')
+            NumericGrade(activity=a2, member=m, value=v2, flag="GRAD").save(entered_by='ggbaker')
+        NumericGrade.objects.filter(activity=a2, member=members[2]).update(flag="NOGR")
+
+        ca = CalNumericActivity(name="Total", short_name="T", status="URLS", offering=c, position=3, max_grade=100,
+                                formula="[[activitytotal]] + MAX([A1], [A2]/2)")
+        ca.save()
+
+        ignored, hiding_info = calculate_numeric_grade(c, ca)
+        self.assertEqual(ignored, 0)
+        self.assertFalse(hiding_info)
+        values = dict(NumericGrade.objects.filter(activity=ca).values_list('member_id', 'value'))
+        self.assertEqual(values, {members[0].id: decimal.Decimal('85'), members[1].id: decimal.Decimal('85'),
+                                  members[2].id: decimal.Decimal('0')})
+
+        # manually-set grades are left alone; changed grades are recalculated
+        NumericGrade.objects.filter(activity=ca, member=members[0]).update(flag="GRAD", value=1)
+        NumericGrade.objects.filter(activity=a1, member=members[2]).update(value=2)
+        ignored, _ = calculate_numeric_grade(c, ca)
+        self.assertEqual(ignored, 1)
+        values = dict(NumericGrade.objects.filter(activity=ca).values_list('member_id', 'value'))
+        self.assertEqual(values[members[0].id], decimal.Decimal('1'))
+        self.assertEqual(values[members[2].id], decimal.Decimal('12'))
+
+        # saving a grade recalculates the dependent calculated grades for that student, including letters
+        cl = CalLetterActivity(name="Letter", short_name="L", status="URLS", offering=c, position=4, numeric_activity=ca)
+        cl.save()
+        calculate_letter_grade(c, cl)
+        self.assertEqual(LetterGrade.objects.get(activity=cl, member=members[1]).letter_grade, 'A-')
+        g = NumericGrade.objects.get(activity=a2, member=members[1])
+        g.value = 20
+        g.save(entered_by='ggbaker')
+        self.assertEqual(NumericGrade.objects.get(activity=ca, member=members[1]).value, decimal.Decimal('110'))
+        self.assertEqual(LetterGrade.objects.get(activity=cl, member=members[1]).letter_grade, 'A+')
+        # ... but not manually-set ones
+        g = NumericGrade.objects.get(activity=a2, member=members[0])
+        g.value = 0
+        g.save(entered_by='ggbaker')
+        self.assertEqual(NumericGrade.objects.get(activity=ca, member=members[0]).value, decimal.Decimal('1'))
+
+        # the graph is cached until an activity changes, so grades nothing depends on cost no extra queries
+        calculation_graph(c)
+        with self.assertNumQueries(0):
+            calculated, dependents = calculation_graph(c)
+            recalculate_dependents(cl, members[1])
+        self.assertEqual(dependents[a1.id], {ca.id})
+        self.assertEqual(dependents[ca.id], {cl.id})
+        a3 = NumericActivity(name="Assignment 3", short_name="A3", status="RLS", offering=c, position=5, max_grade=10)
+        a3.save()
+        ca.formula = "[[activitytotal]] + MAX([A1], [A2]/2) + [A3]"
+        ca.save()
+        self.assertEqual(calculation_graph(c)[1][a3.id], {ca.id})
+
+        # bulk changes recalculate all at once
+        NumericGrade.objects.filter(activity=a1, member__in=members[1:]).update(value=0)
+        recalculate_dependents_many(a1, members)
+        values = dict(NumericGrade.objects.filter(activity=ca).values_list('member_id', 'value'))
+        self.assertEqual(values, {members[0].id: decimal.Decimal('1'), members[1].id: decimal.Decimal('60'),
+                                  members[2].id: decimal.Decimal('0')})
 
     def test_activities(self):
         """
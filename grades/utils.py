@@ -6,8 +6,10 @@ from grades.models import Activity, NumericActivity, LetterActivity, NumericGrad
                           LetterGrade, ACTIVITY_TYPES, FLAGS, \
                           CalNumericActivity,CalLetterActivity, median_letters, min_letters, max_letters,sorted_letters
 from coredata.models import CourseOffering, Member
-from grades.formulas import parse, activities_dictionary, cols_used, eval_parse, EvalException
+from grades.formulas import parse, activities_dictionary, cols_used, compile_parse, grade_matrix, EvalException
 from pyparsing import ParseException
+from collections import defaultdict
+from django.core.cache import cache
 import math
 import decimal
 
@@ -460,7 +462,7 @@ def fetch_students_letter_grade(activity):
 
     return student_grade_list
 
-def calculate_letter_grade(course, activity):
+def calculate_letter_grade(course, activity, student=None):
     """
     Calculate all the student's grade in the course's CalletterActivity.
     If student param is specified, this student's grade is calculated instead
@@ -472,33 +474,38 @@ def calculate_letter_grade(course, activity):
     if not isinstance(activity, CalLetterActivity):
         raise TypeError('CalLetterActivity type is required')
 
-    # calculate for all student
-    student_list = Member.objects.filter(offering=course, role='STUD')
-    letter_grade_list = LetterGrade.objects.filter(activity = activity).select_related('member') 
+    if student != None: # calculate for one student
+        if not isinstance(student, Member):
+            raise TypeError('Member type is required')
+        student_list = [student]
+        letter_grade_list = LetterGrade.objects.filter(activity=activity, member=student)
+    else: # calculate for all student
+        student_list = Member.objects.filter(offering=course, role='STUD')
+        letter_grade_list = LetterGrade.objects.filter(activity=activity)
+    letter_grades = {g.member_id: g for g in letter_grade_list}
 
     ignored = 0
+    changed_grades = []
+    new_grades = []
     for s in student_list:
         # calculate grade
-
         result = generate_lettergrades(s,activity)
 
         # save grade
-        member_found = False
-        for letter_grade in letter_grade_list:
-            if letter_grade.member == s:
-                member_found = True     
-                if letter_grade.flag != "CALC":
-                    ignored += 1
-                elif result != letter_grade.letter_grade or letter_grade.flag != "CALC":
-                    # ignore manually-set grades; only save when the value changes
-                    letter_grade.letter_grade = result
-                    letter_grade.flag = "CALC"
-                    letter_grade.save(newsitem=False, entered_by=None)
-                break
-        if not member_found:
-            letter_grade = LetterGrade(activity=activity, member=s,
-                                         letter_grade=result, flag='CALC')
-            letter_grade.save(newsitem=False, entered_by=None)
+        letter_grade = letter_grades.get(s.id)
+        if letter_grade is None:
+            new_grades.append(LetterGrade(activity=activity, member=s, letter_grade=result, flag='CALC'))
+        elif letter_grade.flag != "CALC":
+            # ignore manually-set grades
+            ignored += 1
+        elif result != letter_grade.letter_grade:
+            # only save when the value changes
+            letter_grade.letter_grade = result
+            changed_grades.append(letter_grade)
+
+    # calculated grades have no GradeHistory or NewsItem, so LetterGrade.save() has nothing to add to a bulk write.
+    LetterGrade.objects.bulk_update(changed_grades, ['letter_grade'], batch_size=500)
+    LetterGrade.objects.bulk_create(new_grades, batch_size=500)
     return ignored
 
 def generate_lettergrades(s,activity):
@@ -574,8 +581,8 @@ def parse_and_validate_formula(formula, course, activity, numeric_activities):
         if not isinstance(a, NumericActivity):
             raise TypeError('NumericActivity list is required')
     try:
-        parsed_expr = parse(formula, course, activity)
         activities_dict = activities_dictionary(numeric_activities)
+        parsed_expr = parse(formula, course, activity, labels=frozenset(activities_dict))
         cols = set([])
         cols = cols_used(parsed_expr)
         for col in cols:
@@ -610,37 +617,46 @@ def calculate_numeric_grade(course, activity, student=None):
         student_list = [student]
         numeric_grade_list = NumericGrade.objects.filter(activity=activity, member=student)
     else: # calculate for all student
-        student_list = Member.objects.filter(offering=course, role='STUD')
-        numeric_grade_list = NumericGrade.objects.filter(activity = activity).select_related('member')
+        student_list = Member.objects.filter(offering=course, role='STUD').select_related('person')
+        numeric_grade_list = NumericGrade.objects.filter(activity=activity)
+    numeric_grades = {g.member_id: g for g in numeric_grade_list}
 
-    ignored = 0
+    # compile the formula once and load all of the grades it needs in one query
     visible = activity.status=="RLS"
+    formula_func = compile_parse(parsed_expr, activity, act_dict, visible)
+    source_activities = [act_dict[c] for c in cols_used(parsed_expr)]
+    if student != None:
+        grades = grade_matrix(source_activities, members=[student])
+    else:
+        grades = grade_matrix(source_activities)
+
+    ignored = 0
+    changed_grades = []
+    new_grades = []
     for s in student_list:
         # calculate grade
         try:
-            result = eval_parse(parsed_expr, activity, act_dict, s, visible)
+            result = formula_func(grades.get(s.id, {}))
             result = decimal.Decimal(str(result)) # convert to decimal
         except EvalException:
             raise EvalException("Formula Error: Can not evaluate formula for student: '%s'" % s.person.name())
 
         # save grade
-        member_found = False
-        for numeric_grade in numeric_grade_list:
-            if numeric_grade.member == s:
-                member_found = True     
-                if numeric_grade.flag != "CALC":
-                    # ignore manually-set grades
-                    ignored += 1
-                elif result != numeric_grade.value:
-                    # only save when the value changes
-                    numeric_grade.value = result
-                    numeric_grade.flag = "CALC"
-                    numeric_grade.save(newsitem=False, entered_by=None)
-                break
-        if not member_found:
-            numeric_grade = NumericGrade(activity=activity, member=s,
-                                         value=str(result), flag='CALC')
-            numeric_grade.save(newsitem=False, entered_by=None)
+        numeric_grade = numeric_grades.get(s.id)
+        if numeric_grade is None:
+            numeric_grade = NumericGrade(activity=activity, member=s, value=str(result), flag='CALC')
+            new_grades.append(numeric_grade)
+        elif numeric_grade.flag != "CALC":
+            # ignore manually-set grades
+            ignored += 1
+        elif result != numeric_grade.value:
+            # only save when the value changes
+            numeric_grade.value = result
+            changed_grades.append(numeric_grade)
+
+    # calculated grades have no GradeHistory or NewsItem, so NumericGrade.save() has nothing to add to a bulk write.
+    NumericGrade.objects.bulk_update(changed_grades, ['value'], batch_size=500)
+    NumericGrade.objects.bulk_create(new_grades, batch_size=500)
 
     uses_unreleased = True in (act_dict[c].status != 'RLS' for c in cols_used(parsed_expr))
     hiding_info = visible and uses_unreleased and not activity.calculation_leak()
@@ -649,3 +665,147 @@ def calculate_numeric_grade(course, activity, student=None):
         return StudentActivityInfo(student, activity, FLAGS['CALC'], numeric_grade.value, None).display_grade_staff(), hiding_info
     else:
         return ignored, hiding_info
+
+
+CALCULATION_GRAPH_KEY = 'grades-calculation-graph-%i'
+CALCULATION_GRAPH_TIMEOUT = 24*3600
+
+
+def _build_calculation_graph(course):
+    calculated = {}
+    dependents = defaultdict(set)
+    cal_numeric = list(CalNumericActivity.objects.filter(offering=course, deleted=False))
+    cal_letter = list(CalLetterActivity.objects.filter(offering=course, deleted=False))
+    if not cal_numeric and not cal_letter:
+        # nothing to recalculate: don't bother with the formulas
+        return calculated, {}
+
+    if cal_numeric:
+        numeric_activities = NumericActivity.objects.filter(offering=course, deleted=False)
+        act_dict = activities_dictionary(numeric_activities)
+    for a in cal_numeric:
+        try:
+            parsed_expr = parse(a.formula, course, a, labels=frozenset(act_dict))
+        except ParseException:
+            continue
+        calculated[a.id] = 'N'
+        for col in cols_used(parsed_expr):
+            if col in act_dict:
+                dependents[act_dict[col].id].add(a.id)
+
+    for a in cal_letter:
+        calculated[a.id] = 'L'
+        dependents[a.numeric_activity_id].add(a.id)
+        if a.exam_activity_id:
+            dependents[a.exam_activity_id].add(a.id)
+
+    return calculated, dict(dependents)
+
+
+def calculation_graph(course):
+    """
+    The dependency graph of the calculated activities in this offering.
+
+    Returns (calculated, dependents) where calculated is {activity.id: 'N' or 'L'} for the CalNumericActivity and
+    CalLetterActivity objects, and dependents is {activity.id: set of ids of calculated activities that use it}.
+    Formulas that no longer parse are left out: they can't be calculated anyway.
+
+    The graph is cached until an activity in the offering is saved: see invalidate_calculation_graph.
+    """
+    key = CALCULATION_GRAPH_KEY % (course.id,)
+    graph = cache.get(key)
+    if graph is None:
+        graph = _build_calculation_graph(course)
+        cache.set(key, graph, CALCULATION_GRAPH_TIMEOUT)
+    return graph
+
+
+def invalidate_calculation_graph(offering_id):
+    """
+    Forget the cached calculation_graph for this offering (because one of its activities changed).
+    """
+    cache.delete(CALCULATION_GRAPH_KEY % (offering_id,))
+
+
+def dependent_order(activity_id, dependents):
+    """
+    The ids of the calculated activities that (directly or indirectly) depend on this activity, in an order where
+    each comes after everything it depends on. Cycles in the graph are broken arbitrarily.
+    """
+    visited = set([activity_id])
+    order = []
+    def visit(aid):
+        for d in dependents.get(aid, ()):
+            if d not in visited:
+                visited.add(d)
+                visit(d)
+                order.append(d)
+    visit(activity_id)
+    order.reverse()
+    return order
+
+
+def _dependent_activities(activity):
+    """
+    The calculated activities that depend on this activity, in dependency order. No queries if the (cached) graph
+    says there are none.
+    """
+    calculated, dependents = calculation_graph(activity.offering)
+    order = dependent_order(activity.id, dependents)
+    if not order:
+        return []
+
+    numeric_ids = [aid for aid in order if calculated[aid] == 'N']
+    letter_ids = [aid for aid in order if calculated[aid] == 'L']
+    activities = {}
+    if numeric_ids:
+        activities.update((a.id, a) for a in CalNumericActivity.objects.filter(id__in=numeric_ids).select_related('offering'))
+    if letter_ids:
+        activities.update((a.id, a) for a in CalLetterActivity.objects.filter(id__in=letter_ids).select_related('offering'))
+    return [activities[aid] for aid in order if aid in activities]
+
+
+def recalculate_dependents(activity, member):
+    """
+    Recalculate this member's grades in the calculated activities that depend on this activity (after one of their
+    grades changed), in dependency order.
+
+    Only grades that are already calculated are updated: columns that have never been calculated for this student, and
+    manually-set grades, are left for the instructor.
+    """
+    for a in _dependent_activities(activity):
+        try:
+            if isinstance(a, CalNumericActivity):
+                if NumericGrade.objects.filter(activity=a, member=member, flag='CALC').exists():
+                    calculate_numeric_grade(a.offering, a, member)
+            else:
+                if LetterGrade.objects.filter(activity=a, member=member, flag='CALC').exists():
+                    calculate_letter_grade(a.offering, a, member)
+        except (ValidationError, EvalException):
+            # broken formula: the instructor will see the error when they next calculate.
+            continue
+
+
+def recalculate_dependents_many(activity, members):
+    """
+    Like recalculate_dependents, for grades of many members that have changed (e.g. by bulk grade entry, which saves
+    with NumericGrade.save(recalculate=False)). Each dependent activity's already-calculated grades are found with one
+    query.
+    """
+    dependent_activities = _dependent_activities(activity)
+    if not dependent_activities:
+        return
+    member_ids = [m.id for m in members]
+    for a in dependent_activities:
+        GradeClass = NumericGrade if isinstance(a, CalNumericActivity) else LetterGrade
+        calc_members = Member.objects.filter(id__in=GradeClass.objects.filter(activity=a, member_id__in=member_ids,
+                                                                                flag='CALC').values('member_id'))
+        try:
+            for member in calc_members:
+                if isinstance(a, CalNumericActivity):
+                    calculate_numeric_grade(a.offering, a, member)
+                else:
+                    calculate_letter_grade(a.offering, a, member)
+        except (ValidationError, EvalException):
+            # broken formula: the instructor will see the error when they next calculate.
+            continue
@@ -1,5 +1,4 @@
 import csv
-import pickle
 import datetime
 import os
 import urllib.request, urllib.parse, urllib.error
@@ -783,7 +782,7 @@ def formula_tester(request, course_slug):
         if has_error:
             messages.error(request, "Please correct the error below")
         else:
-            parsed_expr = pickle.loads(formula_form_entry.pickled_formula)
+            parsed_expr = formula_form_entry.parsed_formula
             act_dict = activities_dictionary(faked_activities)
             try:
                 result = eval_parse(parsed_expr, FakeEvalActivity(course), act_dict, None, True)
@@ -1482,17 +1481,15 @@ def export_all(request, course_slug):
     """
     Export everything we can about this offering
     """
-    import io, tempfile, zipfile, os, json
+    import io, os, json
     from django.http import StreamingHttpResponse
-    from wsgiref.util import FileWrapper
+    from courselib.zipstream import ZipStream
     from marking.views import _mark_export_data, _DecimalEncoder
     from discuss.models import DiscussionTopic
 
     course = get_object_or_404(CourseOffering, slug=course_slug)
 
-    handle, filename = tempfile.mkstemp('.zip')
-    os.close(handle)
-    z = zipfile.ZipFile(filename, 'w')
+    z = ZipStream()
 
     # add all grades CSV
     allgrades = io.StringIO()
@@ -1526,14 +1523,7 @@ def export_all(request, course_slug):
         z.writestr("discussion.json", discussout.getvalue())
         del discussion_data, discussout
 
-    # return the zip file
-    z.close()
-    zipdata = open(filename, 'rb')
-    response = StreamingHttpResponse(FileWrapper(zipdata), content_type='application/zip')
-    response['Content-Length'] = os.path.getsize(filename)    
+    # return the zip file, streamed as it's built
+    response = StreamingHttpResponse(z, content_type='application/zip')
     response['Content-Disposition'] = 'attachment; filename="' + course.slug + '.zip"'
-    try:
-        os.remove(filename)
-    except OSError:
-        pass
     return response
@@ -1,6 +1,8 @@
 import copy
 import datetime
+import math
 import uuid
+from collections import defaultdict
 from typing import Any, Dict, Tuple, List
 
 from django.db import models, connection
@@ -144,6 +146,9 @@ class RequestLog(EventLogEntry):
     session_key = data_property('session_key')
     view_name = data_property('view_name')
     status_code = data_property('status_code')
+    n_queries = data_property('n_queries')
+    db_time_ms = data_property('db_time_ms')
+    template_time_ms = data_property('template_time_ms')
 
     display_columns = ['time', 'duration', 'username', 'method', 'path', 'status_code']
     table_column_config = [None, None, None, None, None, {'orderable': False}]
@@ -157,6 +162,36 @@ class RequestLog(EventLogEntry):
         df = qs.to_polars(schema)
         return df.group_by('ip').agg(pl.count('*')).rename({'method': 'count'}).sort('count', descending=True)
 
+    @classmethod
+    def view_performance_report(cls, days=7) -> List[Dict[str, Any]]:
+        """
+        Per-view summary of queries per request and response time over the last few days: worst queries-per-request
+        first. Requests logged before the counters were recorded are ignored.
+        """
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+        by_view = defaultdict(list)
+        for duration, data in cls.objects.filter(time__gte=cutoff).values_list('duration', 'data'):
+            if data.get('n_queries') is not None:
+                by_view[data.get('view_name')].append((duration.total_seconds() * 1000, data))
+
+        report = []
+        for view_name, entries in by_view.items():
+            n = len(entries)
+            durations = sorted(d for d, _ in entries)
+            queries = [data['n_queries'] for _, data in entries]
+            report.append({
+                'view_name': view_name,
+                'count': n,
+                'queries_mean': sum(queries) / n,
+                'queries_max': max(queries),
+                'db_time_ms_mean': sum(data.get('db_time_ms') or 0 for _, data in entries) / n,
+                'template_time_ms_mean': sum(data.get('template_time_ms') or 0 for _, data in entries) / n,
+                'duration_ms_mean': sum(durations) / n,
+                'duration_ms_p95': durations[math.ceil(0.95 * n) - 1],
+            })
+        report.sort(key=lambda r: (-r['queries_mean'], r['view_name'] or ''))
+        return report
+
 
 class CeleryTaskLog(EventLogEntry):
     """
@@ -0,0 +1,180 @@
+"""
+Destinations for RequestLog entries created by courselib.middleware.LoggingMiddleware, selected by
+settings.REQUEST_LOG_MODE:
+
+* 'sync': save each entry as the request finishes (one INSERT in the request's critical path).
+* 'buffered': queue entries in-process; a background thread writes them with bulk_create when enough have queued or
+  enough time has passed. The queue is bounded: if it's full, entries are dropped (and counted) rather than slowing
+  requests. Anything queued is written when the process exits.
+* 'spool': append entries to a per-process JSON-lines file in settings.REQUEST_LOG_SPOOL_PATH, which
+  log.tasks.load_request_log_spool loads into the database.
+"""
+
+import atexit
+import datetime
+import json
+import logging
+import os
+import queue
+import threading
+import uuid
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from log.models import RequestLog
+
+logger = logging.getLogger(__name__)
+
+BUFFER_SIZE = 10000 # maximum number of entries waiting to be written
+FLUSH_SIZE = 200 # write when this many entries are waiting...
+FLUSH_INTERVAL = 5 # ... or after this many seconds
+
+
+class SyncSink(object):
+    def put(self, log: RequestLog):
+        log.save()
+
+    def flush(self):
+        pass
+
+
+class BufferedSink(object):
+    def __init__(self, maxsize=BUFFER_SIZE, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.maxsize = maxsize
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.dropped = 0 # entries dropped because the queue was full, since the last warning
+        self.dropped_lock = threading.Lock() # for updating self.dropped (without waiting for a write in progress)
+        self.lock = threading.Lock() # held while writing, so a flush at shutdown doesn't overlap the thread's
+        self.wake = threading.Event() # set when a batch is ready to write, before flush_interval is up
+        self.pid = None
+        atexit.register(self.flush)
+
+    def _start(self):
+        """
+        Start the queue and writer thread for this process (again, in a child after a fork).
+        """
+        self.queue = queue.Queue(maxsize=self.maxsize)
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self._run, name='RequestLog writer', daemon=True)
+        self.thread.start()
+
+    def put(self, log: RequestLog):
+        if self.pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(log)
+        except queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
+            return
+        if self.queue.qsize() >= self.flush_size:
+            self.wake.set()
+
+    def _take(self):
+        """
+        Take up to flush_size entries from the queue, without waiting for more.
+        """
+        batch = []
+        while len(batch) < self.flush_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        with self.dropped_lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            logger.warning('RequestLog queue full: %i entries dropped.' % (dropped,))
+        if not batch:
+            return
+        try:
+            RequestLog.objects.bulk_create(batch)
+        except Exception:
+            logger.exception('Could not write %i RequestLog entries.' % (len(batch),))
+
+    def _write_queued(self):
+        while True:
+            batch = self._take()
+            self._write(batch)
+            if len(batch) < self.flush_size:
+                break
+
+    def _run(self):
+        while True:
+            # wait without the lock (and without holding any entries), so a flush never waits for flush_interval
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            with self.lock:
+                self._write_queued()
+            close_old_connections()
+
+    def flush(self):
+        """
+        Write everything that's queued.
+        """
+        if self.pid != os.getpid():
+            return
+        with self.lock:
+            self._write_queued()
+
+
+class SpoolSink(object):
+    def __init__(self, path=None):
+        self.path = path or settings.REQUEST_LOG_SPOOL_PATH
+
+    def put(self, log: RequestLog):
+        line = json.dumps(request_log_to_json(log)) + '\n'
+        os.makedirs(self.path, exist_ok=True)
+        fn = os.path.join(self.path, 'requests-%i.jsonl' % (os.getpid(),))
+        with open(fn, 'a', encoding='utf-8') as fh:
+            fh.write(line)
+
+    def flush(self):
+        pass
+
+
+def request_log_to_json(log: RequestLog) -> dict:
+    return {
+        'id': str(log.id),
+        'time': log.time.isoformat(),
+        'duration': log.duration.total_seconds(),
+        'username': log.username,
+        'method': log.method,
+        'path': log.path,
+        'data': log.data,
+    }
+
+
+def request_log_from_json(d: dict) -> RequestLog:
+    return RequestLog(
+        id=uuid.UUID(d['id']),
+        time=datetime.datetime.fromisoformat(d['time']),
+        duration=datetime.timedelta(seconds=d['duration']),
+        username=d['username'],
+        method=d['method'],
+        path=d['path'],
+        data=d['data'],
+    )
+
+
+SINKS = {
+    'sync': SyncSink,
+    'buffered': BufferedSink,
+    'spool': SpoolSink,
+}
+
+_sink = None
+
+
+def request_log_sink():
+    """
+    The sink for this process, as selected by settings.REQUEST_LOG_MODE.
+    """
+    global _sink
+    if _sink is None:
+        _sink = SINKS[settings.REQUEST_LOG_MODE]()
+    return _sink
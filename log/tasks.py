@@ -1,14 +1,19 @@
 import datetime
 import json
+import logging
 import os
 import shutil
 import subprocess
+import time
 import psutil
+from django.conf import settings
 from django.db.models import Avg, Count
 
 from courselib.celerytasks import task
 from log.models import MonitoringDataLog, RequestLog
 
+logger = logging.getLogger(__name__)
+
 
 # sort out the docker executables
 docker = ["docker"]
@@ -228,3 +233,46 @@ def log_avg_request_duration():
             value=avg.total_seconds() * 1000,
             data={},
         ).save()
+
+
+@task(queue="fast")
+def load_request_log_spool():
+    """
+    Load RequestLog entries spooled to files (with settings.REQUEST_LOG_MODE == 'spool') into the database.
+    """
+    spool_path = settings.REQUEST_LOG_SPOOL_PATH
+    if not os.path.isdir(spool_path):
+        return
+
+    for fn in os.listdir(spool_path):
+        if fn.endswith('.jsonl'):
+            # move the file aside so the process writing it starts a new one, then give it a moment to finish any write
+            loading = os.path.join(spool_path, fn + '.loading')
+            os.replace(os.path.join(spool_path, fn), loading)
+            time.sleep(1)
+        elif fn.endswith('.jsonl.loading'):
+            # left by a previous run that failed: try again (entries already loaded are ignored as duplicates)
+            loading = os.path.join(spool_path, fn)
+        else:
+            continue
+        _load_spool_file(loading)
+
+
+def _load_spool_file(loading):
+    from log.sinks import request_log_from_json
+    logs = []
+    skipped = 0
+    with open(loading, 'rt', encoding='utf-8') as fh:
+        for line in fh:
+            if not line.endswith('\n'):
+                # the write was cut off
+                skipped += 1
+                continue
+            try:
+                logs.append(request_log_from_json(json.loads(line)))
+            except (ValueError, KeyError, TypeError):
+                skipped += 1
+    if skipped:
+        logger.warning('Skipped %i incomplete or invalid lines in %s.' % (skipped, loading))
+    RequestLog.objects.bulk_create(logs, batch_size=1000, ignore_conflicts=True)
+    os.remove(loading)
@@ -1,3 +1,11 @@
+import datetime
+import json
+import os
+import queue
+import tempfile
+import time
+
+from django.core.cache import cache
 from django.test import TestCase
 from django.urls import reverse
 
@@ -5,12 +13,18 @@ from courselib.testing import Client, test_views
 from courses import settings
 from log.forms import EVENT_FORM_TYPES, EventLogFilterForm
 from log.models import EventLogEntry, RequestLog, EVENT_LOG_TYPES, CeleryTaskLog
+from log.sinks import BufferedSink, SpoolSink, request_log_to_json
+from log.tasks import load_request_log_spool
 from log.views import EVENT_DATA_VIEWS
 
 
 class EventLogEntryTest(TestCase):
     fixtures = ['basedata', 'coredata']
 
+    def setUp(self):
+        # some pages (like browse_courses) are cached, and the requests below should really hit the database
+        cache.clear()
+
     def test_code_coherence(self):
         """
         Make sure the various EventLogEntry discovery stuff is coherent.
@@ -47,6 +61,9 @@ class EventLogEntryTest(TestCase):
         self.assertEqual(log.path, url)
         self.assertEqual(log.data['ip'], '127.0.0.1')
         self.assertEqual(log.data['status_code'], 200)
+        self.assertGreater(log.n_queries, 0)
+        self.assertIn('db_time_ms', log.data)
+        self.assertGreater(log.template_time_ms, 0)
 
         c.login_user('ggbaker')
         response = c.get('/')
@@ -64,6 +81,56 @@ class EventLogEntryTest(TestCase):
         self.assertEqual(log.data['status_code'], 500)
         self.assertIn('exception', log.data)
 
+    def test_request_log_sinks(self):
+        """
+        Check the buffered and spooled ways of writing RequestLogs.
+        """
+        def make_log(path):
+            return RequestLog(time=datetime.datetime.now(), duration=datetime.timedelta(seconds=1), username='ggbaker',
+                              method='GET', path=path, data={'status_code': 200})
+
+        # buffered: test the queue without the writer thread
+        sink = BufferedSink(maxsize=3, flush_size=2)
+        sink.pid = os.getpid()
+        sink.queue = queue.Queue(maxsize=sink.maxsize)
+        for i in range(5):
+            sink.put(make_log('/buffered/%i' % (i,)))
+        self.assertEqual(sink.dropped, 2)
+        self.assertFalse(RequestLog.objects.filter(path__startswith='/buffered/').exists())
+        sink.flush()
+        self.assertEqual(RequestLog.objects.filter(path__startswith='/buffered/').count(), 3)
+        self.assertEqual(sink.dropped, 0)
+
+        # ... and with the thread waiting for more entries, a flush doesn't wait for it
+        sink = BufferedSink(flush_size=2, flush_interval=60)
+        sink.put(make_log('/buffered/waiting'))
+        start = time.monotonic()
+        sink.flush()
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertTrue(RequestLog.objects.filter(path='/buffered/waiting').exists())
+
+        # spooled to files, and loaded by the task
+        with tempfile.TemporaryDirectory() as spool_path, self.settings(REQUEST_LOG_SPOOL_PATH=spool_path):
+            sink = SpoolSink()
+            sink.put(make_log('/spooled/0'))
+            sink.put(make_log('/spooled/1'))
+            self.assertFalse(RequestLog.objects.filter(path__startswith='/spooled/').exists())
+            load_request_log_spool()
+            logs = RequestLog.objects.filter(path__startswith='/spooled/')
+            self.assertEqual(logs.count(), 2)
+            self.assertEqual(logs[0].data['status_code'], 200)
+            self.assertEqual(os.listdir(spool_path), [])
+
+            # files left by a failed load are retried; incomplete lines are skipped (and counted)
+            line = json.dumps(request_log_to_json(make_log('/spooled/2')))
+            with open(os.path.join(spool_path, 'requests-1.jsonl.loading'), 'w') as fh:
+                fh.write(line + '\n' + '{"broken"\n' + line[:20])
+            with self.assertLogs('log.tasks', 'WARNING') as cm:
+                load_request_log_spool()
+            self.assertIn('Skipped 2 incomplete or invalid lines', cm.output[0])
+            self.assertEqual(RequestLog.objects.filter(path__startswith='/spooled/').count(), 3)
+            self.assertEqual(os.listdir(spool_path), [])
+
     def test_celerytasklog_creation(self):
         """
         If possible, test logging of celery tasks.
@@ -94,4 +161,50 @@ class EventLogEntryTest(TestCase):
         self.assertEqual(response.status_code, 403)
 
         c.login_user('ggbaker')
-        test_views(self, c, 'sysadmin:', ['log_explore'], {})
+        test_views(self, c, 'sysadmin:', ['log_explore', 'log_performance'], {})
+
+    def test_view_performance_report(self):
+        """
+        Per-view summary of the RequestLog counters.
+        """
+        now = datetime.datetime.now()
+
+        def log(view_name, n_queries, ms, days_ago=0, counters=True):
+            data = {'view_name': view_name}
+            if counters:
+                data.update({'n_queries': n_queries, 'db_time_ms': n_queries * 2.0, 'template_time_ms': 5.0})
+            RequestLog(time=now - datetime.timedelta(days=days_ago), duration=datetime.timedelta(milliseconds=ms),
+                       method='GET', path='/' + view_name, data=data).save()
+
+        log('dashboard:index', 10, 100)
+        log('dashboard:index', 20, 300)
+        for ms in range(1, 21):
+            log('grades:course_info', 50, ms)
+        log('grades:course_info', 1000, 1000, days_ago=10)  # too old
+        log('dashboard:index', None, 5000, counters=False)  # logged without counters
+        log('onlineforms:index', 5, 50)
+
+        report = RequestLog.view_performance_report(days=7)
+        self.assertEqual([r['view_name'] for r in report], ['grades:course_info', 'dashboard:index', 'onlineforms:index'])
+
+        course_info, index, forms = report
+        self.assertEqual(course_info['count'], 20)
+        self.assertEqual(course_info['queries_mean'], 50)
+        self.assertEqual(course_info['queries_max'], 50)
+        self.assertAlmostEqual(course_info['duration_ms_mean'], 10.5)
+        self.assertAlmostEqual(course_info['duration_ms_p95'], 19.0)
+
+        self.assertEqual(index['count'], 2)
+        self.assertEqual(index['queries_mean'], 15)
+        self.assertEqual(index['queries_max'], 20)
+        self.assertAlmostEqual(index['db_time_ms_mean'], 30.0)
+        self.assertAlmostEqual(index['template_time_ms_mean'], 5.0)
+        self.assertAlmostEqual(index['duration_ms_mean'], 200.0)
+        self.assertAlmostEqual(index['duration_ms_p95'], 300.0)
+
+        # also displayed
+        c = Client()
+        c.login_user('ggbaker')
+        response = c.get(reverse('sysadmin:log_performance'))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'grades:course_info')
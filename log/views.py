@@ -248,3 +248,19 @@ def log_view(request, log_type: str, log_id: str):
         'display_data': display_data,
     }
     return render(request, 'log/log_view.html', context)
+
+
+@requires_global_role("SYSA")
+def log_performance(request):
+    """
+    Per-view query counts and response times, from the RequestLog counters.
+    """
+    try:
+        days = int(request.GET.get('days', 7))
+    except ValueError:
+        days = 7
+    context = {
+        'days': days,
+        'report': RequestLog.view_performance_report(days=days),
+    }
+    return render(request, 'log/performance.html', context)
@@ -5,6 +5,7 @@ from django.urls import reverse
 from django.core.files.base import ContentFile
 from grades.models import Activity, NumericActivity, LetterActivity, CalNumericActivity, CalLetterActivity, NumericGrade,LetterGrade,LETTER_GRADE_CHOICES
 from grades.models import all_activities_filter, neaten_activity_positions, get_entry_person, COMMENT_LENGTH
+from grades.utils import recalculate_dependents_many
 #from submission.models import SubmissionComponent, COMPONENT_TYPES
 from coredata.models import Semester, Member
 from groups.models import Group, GroupMember
@@ -187,13 +188,16 @@ class GroupActivityMark(ActivityMark):
     def get_absolute_url(self):
         return reverse('offering:marking:mark_history_group', kwargs={'course_slug': self.numeric_activity.offering.slug, 'activity_slug': self.numeric_activity.slug, 'group_slug': self.group.slug})
     
-    def setMark(self, grade, entered_by, details=True):
+    def setMark(self, grade, entered_by, details=True, recalculate=True):
         """         
-        Set the mark of the group members
+        Set the mark of the group members. Returns the group members' Members.
+
+        If recalculate is False, the caller must recalculate_dependents_many for them.
         """
         super(GroupActivityMark, self).setMark(grade)
         #assign mark for each member in the group
-        group_members = GroupMember.objects.filter(group=self.group, activity=self.numeric_activity, confirmed=True)
+        group_members = GroupMember.objects.filter(group=self.group, activity=self.numeric_activity, confirmed=True) \
+            .select_related('student')
         entered_by = get_entry_person(entered_by)
         for g_member in group_members:
             try:            
@@ -206,10 +210,15 @@ class GroupActivityMark(ActivityMark):
             else:
                 ngrade.flag = 'GRAD'
             if details:
-                ngrade.save(entered_by=entered_by, mark=self, group=self.group)
+                ngrade.save(entered_by=entered_by, mark=self, group=self.group, recalculate=False)
             else:
                 # this is just a placeholder for a number-only mark
-                ngrade.save(entered_by=entered_by, mark=None, group=self.group)
+                ngrade.save(entered_by=entered_by, mark=None, group=self.group, recalculate=False)
+
+        members = [g_member.student for g_member in group_members]
+        if recalculate:
+            recalculate_dependents_many(self.numeric_activity, members)
+        return members
             
  
 class ActivityComponentMark(models.Model):
@@ -704,6 +713,7 @@ def activity_marks_from_JSON(activity, userid, data, save=False):
     components = dict((ac.slug, ac) for ac in components)
     found = set()
     not_found = set()
+    marked_members = []  # grades changed, so dependent calculated grades need updating
     combine = False # are we combining these marks with existing (as opposed to overwriting)?
     if 'combine' in data and bool(data['combine']):
         combine = True
@@ -905,8 +915,9 @@ def activity_marks_from_JSON(activity, userid, data, save=False):
 
             numeric_grade.value = value
             if save:
-                numeric_grade.save(entered_by=userid)
+                numeric_grade.save(entered_by=userid, recalculate=False)
                 am.numeric_grade = numeric_grade
+                marked_members.append(member)
 
         else:
             group_members = GroupMember.objects.filter(group=group, activity_id=activity.id, confirmed=True)
@@ -918,7 +929,8 @@ def activity_marks_from_JSON(activity, userid, data, save=False):
                 ngrade.value = value
                 ngrade.flag = 'GRAD'
                 if save:
-                    ngrade.save(entered_by=userid)
+                    ngrade.save(entered_by=userid, recalculate=False)
+                    marked_members.append(g_member.student)
 
         if save:
             am.save()
@@ -926,4 +938,7 @@ def activity_marks_from_JSON(activity, userid, data, save=False):
                 cm.activity_mark = am
                 cm.save()
 
+    if save:
+        recalculate_dependents_many(activity, marked_members)
+
     return found, not_found
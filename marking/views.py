@@ -21,6 +21,7 @@ from .models import copyCourseSetup, neaten_activity_positions, activity_marks_f
 from coredata.models import Person, CourseOffering, Member
 from grades.models import FLAGS, Activity, NumericActivity, NumericGrade
 from grades.models import LetterActivity, LetterGrade, LETTER_GRADE_CHOICES_IN, get_entry_person
+from grades.utils import recalculate_dependents_many
 from log.models import LogEntry
 from groups.models import Group, GroupMember, all_activities_filter
 
@@ -973,6 +974,7 @@ def _mark_all_groups_numeric(request, course, activity):
             
             if not error_info:
                 updated = 0
+                marked_members = []
                 i = -1
                 for group in groups:
                     i += 1
@@ -984,7 +986,7 @@ def _mark_all_groups_numeric(request, course, activity):
                         # so do not override the status
                         continue
                     act_mark = GroupActivityMark(group=group, numeric_activity=activity, created_by=request.user.username)
-                    act_mark.setMark(new_value, entered_by=entered_by, details=False)
+                    marked_members.extend(act_mark.setMark(new_value, entered_by=entered_by, details=False, recalculate=False))
                     act_mark.save()
 
                     updated += 1
@@ -999,6 +1001,8 @@ def _mark_all_groups_numeric(request, course, activity):
                          related_object=act_mark)
                     l.save()                  
                      
+                recalculate_dependents_many(activity, marked_members)
+
                 if updated > 0:
                     messages.add_message(request, messages.SUCCESS, "Marks for all groups on %s saved (%s groups' grades updated)!" % (activity.name, updated))
                 for warning in warning_info:
@@ -1274,6 +1278,7 @@ def _mark_all_students_numeric(request, course, activity):
             if not error_info:
                 entered_by = get_entry_person(request.user.username)
                 updated = 0                 
+                marked_members = []
                 for i in range(len(memberships)):
                     student = memberships[i].person  
                     ngrade = ngrades[i]
@@ -1290,7 +1295,8 @@ def _mark_all_students_numeric(request, course, activity):
                         ngrade = NumericGrade(activity=activity, member=memberships[i]);
                     ngrade.value = new_value
                     ngrade.flag = "GRAD"
-                    ngrade.save(entered_by=entered_by)
+                    ngrade.save(entered_by=entered_by, recalculate=False)
+                    marked_members.append(ngrade.member)
                     
                     updated += 1     
                     if new_value < 0:
@@ -1304,6 +1310,8 @@ def _mark_all_students_numeric(request, course, activity):
                           related_object=ngrade)
                     l.save()                  
                
+                recalculate_dependents_many(activity, marked_members)
+
                 if updated > 0:
                     messages.add_message(request, messages.SUCCESS, "Marks for all students on %s saved (%s students' grades updated)!" % (activity.name, updated))
                     for warning in warning_info:
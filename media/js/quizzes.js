@@ -102,7 +102,7 @@ function do_autosave(interval) {
 
     $.ajax({
         type: "POST",
-        url: form.attr('action') + '?autosave=yes',
+        url: form.attr('data-autosave'),
         data: data,
         processData: false,
         contentType: false,
@@ -113,6 +113,11 @@ function do_autosave(interval) {
                     showDuration: 5000
                 })({ message: 'Answers auto-saved.' });
                 form.removeClass('dirty'); // will mean no "are you sure" warning if autosave and no changes since then
+            } else if ( resp.status == 'closed' ) {
+                window.createNotification({
+                    theme: 'warning',
+                    showDuration: 5000
+                })({ message: 'Unable to auto-save your answers: the quiz is not open.' });
             } else {
                 // form validation problem
                 var errors = resp.errors;
@@ -11,7 +11,7 @@ from autoslug import AutoSlugField
 from courselib.slugs import make_slug
 from courselib.json_fields import getter_setter
 from courselib.storage import UploadedFileStorage, upload_path
-from django.db.models import Max
+from django.db.models import Max, Count
 from django.urls import reverse
 from django.conf import settings
 from django.template.loader import get_template
@@ -48,6 +48,9 @@ VIEWABLE_SHORT = {
         'INI': 'Can only see initial sheet',
         }
 
+# number of FormSubmissions handled at a time when producing summaries
+SUMMARY_CHUNK_SIZE = 500
+
 # choices for the Field.fieldtype field
 FIELD_TYPE_CHOICES = [
         ('SMTX', 'Small Text (single line)'),
@@ -460,14 +463,70 @@ class Form(models.Model, _FormCoherenceMixin):
                 print("Copied sheet %s." % s.title)
             print("Done!")
 
+    def _summary_formsubs(self, statuses, fromdate, todate):
+        """
+        The FormSubmissions to include in a summary (with FormSubmission statuses in given statuses list, and last
+        sheet completed in the date range).
+        """
+        formsubs = FormSubmission.objects.filter(form__original_id=self.original_id, status__in=statuses) \
+                .select_related('initiator__sfuFormFiller', 'initiator__nonSFUFormFiller', 'form') \
+                .annotate(last_sheet_dt=Max('sheetsubmission__completed_at'))
+                # selecting only fully completed forms: does it make sense to be more liberal and report status?
+
+        if fromdate != None and fromdate != "":
+                fromdate = datetime.datetime.strptime(fromdate, "%Y-%m-%d").date()
+                formsubs = formsubs.filter(last_sheet_dt__gte=fromdate)        
+        if todate != None and todate != "" :                
+                todate = datetime.datetime.strptime(todate, "%Y-%m-%d").date() + datetime.timedelta(days = 1)
+                formsubs = formsubs.filter(last_sheet_dt__lte=todate) 
+        return formsubs
+
+    @staticmethod
+    def _summary_chunks(formsubs):
+        """
+        Iterate through the formsubs in chunks of SUMMARY_CHUNK_SIZE (by primary key), so only one chunk (and its sheet
+        and field submissions) is in memory at a time.
+        """
+        last_id = None
+        while True:
+            chunk = formsubs.order_by('id')
+            if last_id is not None:
+                chunk = chunk.filter(id__gt=last_id)
+            chunk = list(chunk[:SUMMARY_CHUNK_SIZE])
+            if not chunk:
+                return
+            yield chunk
+            last_id = chunk[-1].id
+
+    @staticmethod
+    def _summary_fieldsub_lookup(formsub_ids):
+        """
+        The FieldSubmissions for these FormSubmissions, keyed by (sheet_submission_id, field.original_id).
+        """
+        fieldsubs = FieldSubmission.objects.filter(sheet_submission__form_submission_id__in=formsub_ids) \
+                .order_by('sheet_submission__given_at') \
+                .select_related('sheet_submission', 'field', 'fieldsubmissionfile')
+        return dict(
+            ((fs.sheet_submission_id, fs.field.original_id), fs)
+            for fs in fieldsubs)
+
     def all_submission_summary(self, statuses=['DONE'], fromdate=None, todate=None):
         """
         Generate summary data of each submission for CSV output
         (with FormSubmission and SheetSubmission statuses in given statuses list).
+
+        Returns the header row and a list of all rows: submission_summary produces the rows incrementally.
+        """
+        headers, rows = self.submission_summary(statuses=statuses, fromdate=fromdate, todate=todate)
+        return headers, list(rows)
+
+    def submission_summary(self, statuses=['DONE'], fromdate=None, todate=None):
+        """
+        Like all_submission_summary, but rows is a generator that works through the submissions in chunks, suitable
+        for streaming a CSV of a form with many submissions.
         """
         DATETIME_FMT = "%Y-%m-%d"
         headers = []
-        data = []
 
         # find all active sheets
         sheets = Sheet.objects.filter(form__original_id=self.original_id).order_by('order', '-created_date')
@@ -508,79 +567,69 @@ class Form(models.Model, _FormCoherenceMixin):
         headers.append('Last Sheet Completed')
         headers.append('Link')
 
-        # go through FormSubmissions and create a row for each
-        formsubs = FormSubmission.objects.filter(form__original_id=self.original_id, status__in=statuses) \
-                .select_related('initiator__sfuFormFiller', 'initiator__nonSFUFormFiller', 'form') \
-                .annotate(last_sheet_dt=Max('sheetsubmission__completed_at'))
-                # selecting only fully completed forms: does it make sense to be more liberal and report status?
-
-        # choose a winning SheetSubmission: there may be multiples of each sheet but we're only outputting one
-        if fromdate != None and fromdate != "":
-                fromdate = datetime.datetime.strptime(fromdate, "%Y-%m-%d").date()
-                formsubs = formsubs.filter(last_sheet_dt__gte=fromdate)        
-        if todate != None and todate != "" :                
-                todate = datetime.datetime.strptime(todate, "%Y-%m-%d").date() + datetime.timedelta(days = 1)
-                formsubs = formsubs.filter(last_sheet_dt__lte=todate) 
-        sheetsubs = SheetSubmission.objects.filter(form_submission__form__original_id=self.original_id, form_submission__status__in=statuses) \
-                .order_by('given_at').select_related('sheet', 'filler__sfuFormFiller', 'filler__nonSFUFormFiller')
-        # Docs for the dict constructor: "If a key occurs more than once, the last value for that key becomes the corresponding value in the new dictionary."
-        # Result is that the sheetsub with most recent given_at wins.
-        winning_sheetsub = dict(
-            ((ss.form_submission_id, ss.sheet.original_id), ss)
-            for ss in sheetsubs)
-
-        # collect fieldsubs to output
-        fieldsubs = FieldSubmission.objects.filter(sheet_submission__form_submission__form__original_id=self.original_id) \
-                .order_by('sheet_submission__given_at') \
-                .select_related('sheet_submission', 'field', 'fieldsubmissionfile')
-        fieldsub_lookup = dict(
-            ((fs.sheet_submission_id, fs.field.original_id), fs)
-            for fs in fieldsubs)
-
-        for formsub in formsubs:
-            row = []
-            found_anything = False
-            last_completed = None
-            for sid, info in sheet_info.items():
-                if (formsub.id, sid) in winning_sheetsub:
-                    ss = winning_sheetsub[(formsub.id, sid)]
-                    row.append(ss.filler.name())
-                    row.append(ss.filler.email())
-                    row.append(ss.filler.emplid())
-                    if not last_completed or ss.completed_at > last_completed:
-                        last_completed = ss.completed_at
-                else:
-                    ss = None
-                    row.append(None)
-                    row.append(None)
-                    row.append(None)
-
-                if info['is_initial']:
-                    if ss:
-                        row.append(ss.completed_at.strftime(DATETIME_FMT))
-                    else:
-                        row.append(None)
-
-                for fid, finfo in info['fields'].items():
-                    if ss and (ss.id, fid) in fieldsub_lookup:
-                        fs = fieldsub_lookup[(ss.id, fid)]
-                        handler = FIELD_TYPE_MODELS[fs.field.fieldtype](fs.field.config)
-                        row.append(handler.to_text(fs))
-                        found_anything = True
+        formsubs = self._summary_formsubs(statuses, fromdate, todate)
+
+        def rows():
+            # go through FormSubmissions and create a row for each
+            for chunk in self._summary_chunks(formsubs):
+                formsub_ids = [fs.id for fs in chunk]
+
+                # choose a winning SheetSubmission: there may be multiples of each sheet but we're only outputting one
+                sheetsubs = SheetSubmission.objects.filter(form_submission_id__in=formsub_ids, form_submission__status__in=statuses) \
+                        .order_by('given_at').select_related('sheet', 'filler__sfuFormFiller', 'filler__nonSFUFormFiller')
+                # Docs for the dict constructor: "If a key occurs more than once, the last value for that key becomes the corresponding value in the new dictionary."
+                # Result is that the sheetsub with most recent given_at wins.
+                winning_sheetsub = dict(
+                    ((ss.form_submission_id, ss.sheet.original_id), ss)
+                    for ss in sheetsubs)
+
+                # collect fieldsubs to output
+                fieldsub_lookup = self._summary_fieldsub_lookup(formsub_ids)
+
+                for formsub in chunk:
+                    row = []
+                    found_anything = False
+                    last_completed = None
+                    for sid, info in sheet_info.items():
+                        if (formsub.id, sid) in winning_sheetsub:
+                            ss = winning_sheetsub[(formsub.id, sid)]
+                            row.append(ss.filler.name())
+                            row.append(ss.filler.email())
+                            row.append(ss.filler.emplid())
+                            if not last_completed or ss.completed_at > last_completed:
+                                last_completed = ss.completed_at
+                        else:
+                            ss = None
+                            row.append(None)
+                            row.append(None)
+                            row.append(None)
+
+                        if info['is_initial']:
+                            if ss:
+                                row.append(ss.completed_at.strftime(DATETIME_FMT))
+                            else:
+                                row.append(None)
+
+                        for fid, finfo in info['fields'].items():
+                            if ss and (ss.id, fid) in fieldsub_lookup:
+                                fs = fieldsub_lookup[(ss.id, fid)]
+                                handler = FIELD_TYPE_MODELS[fs.field.fieldtype](fs.field.config)
+                                row.append(handler.to_text(fs))
+                                found_anything = True
+                            else:
+                                row.append(None)
+
+                    if last_completed:
+                        row.append(last_completed.strftime(DATETIME_FMT))
                     else:
                         row.append(None)
 
-            if last_completed:
-                row.append(last_completed.strftime(DATETIME_FMT))
-            else:
-                row.append(None)
-
-            row.append(settings.BASE_ABS_URL + formsub.get_absolute_url())
+                    row.append(settings.BASE_ABS_URL + formsub.get_absolute_url())
 
-            if found_anything:
-                data.append(row)
+                    if found_anything:
+                        yield row
 
-        return headers, data
+        return headers, rows()
 
     def all_submission_summary_special(self, statuses=['DONE'], recurring_sheet_slug=None, fromdate=None, todate=None):
         """
@@ -588,21 +637,26 @@ class Form(models.Model, _FormCoherenceMixin):
         is done.  The recurring_sheet_slug gives us a sheet for which we want *all* the submissions.  For the purposes
         of this method, we assume that all others have only one entry, and that this sheet is also the last sheet,
         order-wise.  This is a horrible hack, and very fragile.
+
+        Returns the header row and a list of all rows: submission_summary_special produces the rows incrementally.
+        """
+        headers, rows = self.submission_summary_special(statuses=statuses, recurring_sheet_slug=recurring_sheet_slug,
+                                                        fromdate=fromdate, todate=todate)
+        return headers, list(rows)
+
+    def submission_summary_special(self, statuses=['DONE'], recurring_sheet_slug=None, fromdate=None, todate=None):
+        """
+        Like all_submission_summary_special, but rows is a generator that works through the submissions in chunks.
         """
         DATETIME_FMT = "%Y-%m-%d"
         headers = []
-        data = []
 
         recurring_sheet = Sheet.objects.get(form__original_id=self.id, slug=recurring_sheet_slug)
         # find all currently active sheets (in the correct order.  Ignore deleted ones.)
         sheets = Sheet.objects.filter(form__original_id=self.original_id, active=True).order_by('order',
                                                                                               '-created_date')
         #  The problem is there may be other versions of the active sheets.  Find those too.
-        sheets_list = []
-        for s in sheets:
-            matching_sheets = Sheet.objects.filter(original_id=s.original_id)
-            for sheet in matching_sheets:
-                sheets_list.append(sheet)
+        sheets_list = list(Sheet.objects.filter(original_id__in=[s.original_id for s in sheets]))
 
         # Order the sheets in the correct order:  First by order, then newest first, so we get the attributes of the
         # latest.
@@ -630,66 +684,14 @@ class Form(models.Model, _FormCoherenceMixin):
                     'label': f.label,
                 }
 
-        # go through FormSubmissions and create a row for each
-        formsubs = FormSubmission.objects.filter(form__original_id=self.original_id, status__in=statuses) \
-            .select_related('initiator__sfuFormFiller', 'initiator__nonSFUFormFiller', 'form') \
-            .annotate(last_sheet_dt=Max('sheetsubmission__completed_at'))
-
-        if fromdate != None and fromdate != "":
-                fromdate = datetime.datetime.strptime(fromdate, "%Y-%m-%d").date()
-                formsubs = formsubs.filter(last_sheet_dt__gte=fromdate)        
-        if todate != None and todate != "" :                
-                todate = datetime.datetime.strptime(todate, "%Y-%m-%d").date() + datetime.timedelta(days = 1)
-                formsubs = formsubs.filter(last_sheet_dt__lte=todate) 
-                
-        sheetsubs = SheetSubmission.objects.filter(form_submission__form__original_id=self.original_id,
-                                                   form_submission__status__in=statuses, sheet__in=sheets_list) \
-            .order_by('given_at').select_related('sheet', 'filler__sfuFormFiller', 'filler__nonSFUFormFiller')
-
+        formsubs = self._summary_formsubs(statuses, fromdate, todate)
+        sheetsubs = SheetSubmission.objects.filter(form_submission__status__in=statuses, sheet__in=sheets_list)
 
-        # collect fieldsubs to output
-        fieldsubs = FieldSubmission.objects.filter(sheet_submission__form_submission__form__original_id=self.original_id) \
-                .order_by('sheet_submission__given_at') \
-                .select_related('sheet_submission', 'field', 'fieldsubmissionfile')
-        fieldsub_lookup = dict(
-            ((fs.sheet_submission_id, fs.field.original_id), fs)
-            for fs in fieldsubs)
-
-        # A counter to keep track of how many of our relevant sheet we have.
-        max_relevant_count = 0
-
-        for formsub in formsubs:
-            row = []
-            found_anything = False
-            last_completed = None
-            sheets = sheetsubs.filter(form_submission=formsub, sheet__in=sheets_list)\
-                .order_by('sheet__order', 'given_at').select_related('sheet', 'filler__sfuFormFiller',
-                                                                     'filler__nonSFUFormFiller')
-            relevant_count = sheets.filter(sheet__original_id=recurring_sheet.original_id).count()
-            if relevant_count > max_relevant_count:
-                max_relevant_count = relevant_count
-            for ss in sheets:
-                row.append(ss.filler.name())
-                row.append(ss.filler.email())
-                row.append(ss.filler.emplid())
-                if not last_completed or ss.completed_at > last_completed:
-                    last_completed = ss.completed_at
-                if ss.sheet.is_initial:
-                    row.append(ss.completed_at.strftime(DATETIME_FMT))
-
-                info = sheet_info[ss.sheet.original_id]
-
-                for fid, finfo in info['fields'].items():
-                    if ss and (ss.id, fid) in fieldsub_lookup:
-                        fs = fieldsub_lookup[(ss.id, fid)]
-                        handler = FIELD_TYPE_MODELS[fs.field.fieldtype](fs.field.config)
-                        row.append(handler.to_text(fs))
-                        found_anything = True
-                    else:
-                        row.append(None)
-
-            if found_anything:
-                data.append(row)
+        # How many of our relevant sheet the submissions have (at most), so the header row can be built before the rows.
+        relevant_counts = sheetsubs.filter(form_submission__in=formsubs.values('id'),
+                                           sheet__original_id=recurring_sheet.original_id) \
+            .values('form_submission_id').annotate(count=Count('id')).order_by('-count').values_list('count', flat=True)
+        max_relevant_count = relevant_counts.first() or 0
 
         # build header row
         for sid, info in sheet_info.items():
@@ -708,7 +710,48 @@ class Form(models.Model, _FormCoherenceMixin):
                     headers.append('ID')
                     for fid, finfo in info['fields'].items():
                         headers.append(finfo['label'])
-        return headers, data
+
+        def rows():
+            # go through FormSubmissions and create a row for each
+            for chunk in self._summary_chunks(formsubs):
+                formsub_ids = [fs.id for fs in chunk]
+                chunk_sheetsubs = collections.defaultdict(list)
+                for ss in sheetsubs.filter(form_submission_id__in=formsub_ids) \
+                        .order_by('sheet__order', 'given_at').select_related('sheet', 'filler__sfuFormFiller',
+                                                                             'filler__nonSFUFormFiller'):
+                    chunk_sheetsubs[ss.form_submission_id].append(ss)
+
+                # collect fieldsubs to output
+                fieldsub_lookup = self._summary_fieldsub_lookup(formsub_ids)
+
+                for formsub in chunk:
+                    row = []
+                    found_anything = False
+                    last_completed = None
+                    for ss in chunk_sheetsubs[formsub.id]:
+                        row.append(ss.filler.name())
+                        row.append(ss.filler.email())
+                        row.append(ss.filler.emplid())
+                        if not last_completed or ss.completed_at > last_completed:
+                            last_completed = ss.completed_at
+                        if ss.sheet.is_initial:
+                            row.append(ss.completed_at.strftime(DATETIME_FMT))
+
+                        info = sheet_info[ss.sheet.original_id]
+
+                        for fid, finfo in info['fields'].items():
+                            if ss and (ss.id, fid) in fieldsub_lookup:
+                                fs = fieldsub_lookup[(ss.id, fid)]
+                                handler = FIELD_TYPE_MODELS[fs.field.fieldtype](fs.field.config)
+                                row.append(handler.to_text(fs))
+                                found_anything = True
+                            else:
+                                row.append(None)
+
+                    if found_anything:
+                        yield row
+
+        return headers, rows()
 
     def email_confirm(self, recipient):
         msg = EmailMultiAlternatives(subject=self.emailsubject(), body=self.emailbody(),
@@ -1,4 +1,5 @@
 from django.test import TestCase
+import datetime
 import django.db.transaction
 from django.db.utils import IntegrityError
 from django.urls import reverse
@@ -369,6 +370,40 @@ class ViewTestCase(TestCase):
         sheetsub.save()
         self.run_basic_page_tests(views, args)
 
+    def test_summary_csv(self):
+        import onlineforms.models
+        form = Form.objects.get(slug=self.slug_data["form_slug"])
+        statuses = ['DONE', 'PEND', 'WAIT']
+        FormSubmission.objects.filter(form=form).update(status='DONE')
+        SheetSubmission.objects.filter(form_submission__form=form).update(status='DONE', completed_at=datetime.datetime.now())
+        headers, data = form.all_submission_summary(statuses=statuses)
+        self.assertTrue(data)
+        special_headers, special_data = form.all_submission_summary_special(statuses=statuses,
+                recurring_sheet_slug=self.slug_data["non_initial_sheet_slug"])
+        self.assertTrue(special_data)
+
+        # the results shouldn't depend on how the submissions are chunked
+        chunk_size = onlineforms.models.SUMMARY_CHUNK_SIZE
+        onlineforms.models.SUMMARY_CHUNK_SIZE = 1
+        try:
+            self.assertEqual(form.all_submission_summary(statuses=statuses), (headers, data))
+            self.assertEqual(form.all_submission_summary_special(statuses=statuses,
+                    recurring_sheet_slug=self.slug_data["non_initial_sheet_slug"]), (special_headers, special_data))
+        finally:
+            onlineforms.models.SUMMARY_CHUNK_SIZE = chunk_size
+
+        url = reverse('onlineforms:summary_csv', kwargs={'form_slug': form.slug})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertEqual(len(content.splitlines()), len(data) + 1)
+        self.assertIn(data[0][-1], content)
+
+        url = reverse('onlineforms:download_result_csv', kwargs={'form_slug': form.slug})
+        response = self.client.get(url, {'fromdate': '2000-01-01', 'todate': ''})
+        self.assertEqual(response.status_code, 200)
+
     def run_basic_page_tests(self, views, arguments):
         for view in views:
             try:
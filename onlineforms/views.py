@@ -4,7 +4,7 @@ from django.contrib.auth.views import redirect_to_login
 from django.db.models import Max
 from django.forms.fields import FileField
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponseRedirect, HttpResponse, Http404
+from django.http import HttpResponseRedirect, HttpResponse, StreamingHttpResponse, Http404
 from django.urls import reverse
 import django.db.transaction
 from django.db.models import Q, Count
@@ -30,6 +30,7 @@ from coredata.queries import ensure_person_from_userid, SIMSProblem
 from log.models import LogEntry
 import datetime
 import csv
+import itertools
 import json
 import os
 
@@ -544,131 +545,77 @@ def admin_rejected_form(request, form_slug):
 
 
 
+# A special case for a few particular forms, for now: form slug -> the slug of the sheet whose submissions are *all*
+# output, with all_submission_summary_special.
+#
+# All the SEE hiring forms are duplicates of one another with a different title.  They all also need
+# this special handling.  Their recurring sheet is all titled the same.  apsc-see-professor-of-professional-practice
+# is just slightly different (the sheet we want to be recurring is named differently.)
+#
+# If we're going to use this code path any more than this, then a better suggestion would be to store the recurring
+# sheet in the config of the form, look for said config variable, and just call the alternate method if it exists.
+SUMMARY_RECURRING_SHEETS = {
+    'mse-mse-ta-application-mse-graduate-students': 'instructor-approval-7',
+    'apsc-see-lecturer-electrical-and-electronics': 'initial-scoring',
+    'apsc-see-lecturer-engineering-and-design-2': 'initial-scoring',
+    'apsc-see-lecturer-writing-ethics-and-economics': 'initial-scoring',
+    'apsc-see-researcher-materials-for-energy-systems': 'initial-scoring',
+    'apsc-see-researcher-thermo-fluids': 'initial-scoring',
+    'apsc-see-professor-of-professional-practice': 'support-for-interview',
+}
+
+
+class _Echo(object):
+    """
+    File-like object for csv.writer that just returns what's written, so rows can be streamed.
+    """
+    def write(self, value):
+        return value
+
+
+def _summary_csv_response(form, filename, statuses=['DONE'], fromdate=None, todate=None):
+    """
+    A StreamingHttpResponse of the form's submission summary CSV: rows are produced as the submissions are read (in
+    chunks), so large forms aren't held in memory.
+    """
+    recurring_sheet_slug = SUMMARY_RECURRING_SHEETS.get(form.slug)
+    if recurring_sheet_slug:
+        headers, rows = form.submission_summary_special(statuses=statuses, recurring_sheet_slug=recurring_sheet_slug,
+                                                        fromdate=fromdate, todate=todate)
+    else:
+        headers, rows = form.submission_summary(statuses=statuses, fromdate=fromdate, todate=todate)
+
+    writer = csv.writer(_Echo())
+    content = itertools.chain([writer.writerow(headers)], (writer.writerow(row) for row in rows))
+    response = StreamingHttpResponse(content, content_type='text/csv;charset=utf-8')
+    response['Content-Disposition'] = 'inline; filename="%s"' % (filename)
+    return response
+
+
 @requires_formgroup()
 def summary_csv(request, form_slug):
     form = get_object_or_404(Form, slug=form_slug, owner__in=request.formgroups)
-    response = HttpResponse(content_type='text/csv;charset=utf-8')
-    response['Content-Disposition'] = 'inline; filename="%s-summary.csv"' % (form_slug)
-    writer = csv.writer(response)
-    # A special case for one particular form, for now.
-    if form_slug == 'mse-mse-ta-application-mse-graduate-students':
-        headers, data = form.all_submission_summary_special(recurring_sheet_slug='instructor-approval-7')
-    # All the SEE hiring forms are duplicates of one another with a different title.  They all also need
-    # this special handling.  Their recurring sheet is all titled the same.
-    #
-    # If we're going to use this code path any more than this, then a better suggestion would be to store the recurring
-    # sheet in the config of the form, look for said config variable, and just call the alternate method if it exists.
-    elif form_slug in ['apsc-see-lecturer-electrical-and-electronics', 'apsc-see-lecturer-engineering-and-design-2',
-                       'apsc-see-lecturer-writing-ethics-and-economics',
-                       'apsc-see-researcher-materials-for-energy-systems', 'apsc-see-researcher-thermo-fluids']:
-        headers, data = form.all_submission_summary_special(recurring_sheet_slug='initial-scoring')
-    #  This one is just slightly different (the sheet we want to be recurring is named differently.)
-    elif form_slug == 'apsc-see-professor-of-professional-practice':
-        headers, data = form.all_submission_summary_special(recurring_sheet_slug='support-for-interview')
-    else:
-        headers, data = form.all_submission_summary()
-    writer.writerow(headers)
-    for row in data:
-        writer.writerow(row)
-    return response
+    return _summary_csv_response(form, '%s-summary.csv' % (form_slug))
 
 
 @requires_formgroup()
 def pending_summary_csv(request, form_slug):
     form = get_object_or_404(Form, slug=form_slug, owner__in=request.formgroups)
-    response = HttpResponse(content_type='text/csv;charset=utf-8')
-    response['Content-Disposition'] = 'inline; filename="%s-pending_summary.csv"' % form_slug
-    writer = csv.writer(response)
-    # A special case for one particular form, for now.
-    if form_slug == 'mse-mse-ta-application-mse-graduate-students':
-        headers, data = form.all_submission_summary_special(statuses=['PEND'],
-                                                            recurring_sheet_slug='instructor-approval-7')
-
-    # All the SEE hiring forms are duplicates of one another with a different title.  They all also need
-    # this special handling.  Their recurring sheet is all titled the same.
-    #
-    # If we're going to use this code path any more than this, then a better suggestion would be to store the recurring
-    # sheet in the config of the form, look for said config variable, and just call the alternate method if it exists.
-    elif form_slug in ['apsc-see-lecturer-electrical-and-electronics', 'apsc-see-lecturer-engineering-and-design-2',
-                       'apsc-see-lecturer-writing-ethics-and-economics',
-                       'apsc-see-researcher-materials-for-energy-systems', 'apsc-see-researcher-thermo-fluids']:
-        headers, data = form.all_submission_summary_special(statuses=['PEND'],
-                                                            recurring_sheet_slug='initial-scoring')
-    #  This one is just slightly different (the sheet we want to be recurring is named differently.)
-    elif form_slug == 'apsc-see-professor-of-professional-practice':
-        headers, data = form.all_submission_summary_special(statuses=['PEND'],
-                                                            recurring_sheet_slug='support-for-interview')
-    else:
-        headers, data = form.all_submission_summary(statuses=['PEND'])
-    writer.writerow(headers)
-    for row in data:
-        writer.writerow(row)
-    return response
+    return _summary_csv_response(form, '%s-pending_summary.csv' % (form_slug), statuses=['PEND'])
 
 
 @requires_formgroup()
 def waiting_summary_csv(request, form_slug):
     form = get_object_or_404(Form, slug=form_slug, owner__in=request.formgroups)
-    response = HttpResponse(content_type='text/csv;charset=utf-8')
-    response['Content-Disposition'] = 'inline; filename="%s-waiting_summary.csv"' % form_slug
-    writer = csv.writer(response)
-    # A special case for one particular form, for now.
-    if form_slug == 'mse-mse-ta-application-mse-graduate-students':
-        headers, data = form.all_submission_summary_special(statuses=['WAIT'],
-                                                            recurring_sheet_slug='instructor-approval-7')
-
-    # All the SEE hiring forms are duplicates of one another with a different title.  They all also need
-    # this special handling.  Their recurring sheet is all titled the same.
-    #
-    # If we're going to use this code path any more than this, then a better suggestion would be to store the recurring
-    # sheet in the config of the form, look for said config variable, and just call the alternate method if it exists.
-    elif form_slug in ['apsc-see-lecturer-electrical-and-electronics', 'apsc-see-lecturer-engineering-and-design-2',
-                       'apsc-see-lecturer-writing-ethics-and-economics',
-                       'apsc-see-researcher-materials-for-energy-systems', 'apsc-see-researcher-thermo-fluids']:
-        headers, data = form.all_submission_summary_special(statuses=['WAIT'],
-                                                            recurring_sheet_slug='initial-scoring')
-    #  This one is just slightly different (the sheet we want to be recurring is named differently.)
-    elif form_slug == 'apsc-see-professor-of-professional-practice':
-        headers, data = form.all_submission_summary_special(statuses=['WAIT'],
-                                                            recurring_sheet_slug='support-for-interview')
+    return _summary_csv_response(form, '%s-waiting_summary.csv' % (form_slug), statuses=['WAIT'])
 
-    else:
-        headers, data = form.all_submission_summary(statuses=['WAIT'])
-    writer.writerow(headers)
-    for row in data:
-        writer.writerow(row)
-    return response
 
 @requires_formgroup()
 def download_result_csv(request, form_slug):
     form = get_object_or_404(Form, slug=form_slug, owner__in=request.formgroups)
-    response = HttpResponse(content_type='text/csv;charset=utf-8')
-    response['Content-Disposition'] = 'inline; filename="%s-summary.csv"' % (form_slug)
-    writer = csv.writer(response)
     fromdate = request.GET['fromdate']
     todate = request.GET['todate']
-
-    # A special case for one particular form, for now.
-    if form_slug == 'mse-mse-ta-application-mse-graduate-students':
-        headers, data = form.all_submission_summary_special(recurring_sheet_slug='instructor-approval-7', fromdate=fromdate, todate=todate)
-    # All the SEE hiring forms are duplicates of one another with a different title.  They all also need
-    # this special handling.  Their recurring sheet is all titled the same.
-    #
-    # If we're going to use this code path any more than this, then a better suggestion would be to store the recurring
-    # sheet in the config of the form, look for said config variable, and just call the alternate method if it exists.
-    elif form_slug in ['apsc-see-lecturer-electrical-and-electronics', 'apsc-see-lecturer-engineering-and-design-2',
-                       'apsc-see-lecturer-writing-ethics-and-economics',
-                       'apsc-see-researcher-materials-for-energy-systems', 'apsc-see-researcher-thermo-fluids']:
-        headers, data = form.all_submission_summary_special(recurring_sheet_slug='initial-scoring', fromdate=fromdate, todate=todate)
-    #  This one is just slightly different (the sheet we want to be recurring is named differently.)
-    elif form_slug == 'apsc-see-professor-of-professional-practice':
-        headers, data = form.all_submission_summary_special(recurring_sheet_slug='support-for-interview', fromdate=fromdate, todate=todate)
-    else:
-        headers, data = form.all_submission_summary(fromdate=fromdate, todate=todate)
-    writer.writerow(headers)
-    for row in data:
-        writer.writerow(row)
-    return response
+    return _summary_csv_response(form, '%s-summary.csv' % (form_slug), fromdate=fromdate, todate=todate)
 
 #######################################################################
 # Creating/editing forms
@@ -0,0 +1,71 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from courselib.markup import ParserFor, build_creole_parser
+from pages.models import Page
+
+SAMPLE_PAGE = """= Assignment 1
+
+This assignment is due <<duedate A1>>: see <<activitylink A1>> to submit.
+
+== Part 1
+
+Write a function that **returns** the //sum// of a list. A few notes:
+* Use a ^^loop^^, not {{{sum()}}}.
+* Test it with --one-- some values.
+** Including the empty list.
+
+{{{
+[python]
+def total(lst):
+    return 0
+}}}
+
+|=Case|=Expected|
+|{{{[]}}}|0|
+|{{{[1, 2]}}}|3|
+
+See also [[resources|the resources page]] &amp; <<pagelist>>.
+"""
+
+
+class Command(BaseCommand):
+    help = """Compare Creole rendering throughput with the shared per-process parser against building a parser for each
+    render (as markup_to_html used to)."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--offering', type=str,
+                            help='render the current wiki pages in the offering with this slug (default a sample page)')
+        parser.add_argument('--repeat', type=int, default=20, help='number of times to render each page')
+
+    def handle(self, *args, **options):
+        if options['offering']:
+            pages = []
+            for page in Page.objects.filter(offering__slug=options['offering']).select_related('offering'):
+                version = page.current_version()
+                pages.append((page.offering, version, version.get_wikitext()))
+            if not pages:
+                raise CommandError('No pages in that offering.')
+        else:
+            pages = [(None, None, SAMPLE_PAGE)]
+
+        n = options['repeat'] * len(pages)
+        self.stdout.write('rendering %i pages, %i times each' % (len(pages), options['repeat']))
+
+        def timed(render):
+            start = time.perf_counter()
+            for _ in range(options['repeat']):
+                for offering, pageversion, wikitext in pages:
+                    render(offering, pageversion, wikitext)
+            return time.perf_counter() - start
+
+        def build_each_time(offering, pageversion, wikitext):
+            parser = build_creole_parser(with_macros=bool(offering))
+            parser.render(wikitext, environ={'offering': offering, 'pageversion': pageversion})
+
+        def shared(offering, pageversion, wikitext):
+            ParserFor(offering, pageversion).text2html(wikitext)
+
+        for label, render in [('parser per render', build_each_time), ('shared parser', shared)]:
+            elapsed = timed(render)
+            self.stdout.write('%-18s %8.2f ms/page %8.1f pages/s' % (label, 1000 * elapsed / n, n / elapsed))
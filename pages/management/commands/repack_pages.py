@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from pages.models import Page, repack_page_versions
+
+
+class Command(BaseCommand):
+    help = """Re-store page histories with the current layout: diffs from the next version, with periodic full-text
+    checkpoints."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--offering', type=str, help='only repack pages in the offering with this slug')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        pages = Page.objects.order_by('id')
+        if options['offering']:
+            pages = pages.filter(offering__slug=options['offering'])
+
+        n_pages = 0
+        n_versions = 0
+        for page in pages.iterator():
+            changed = repack_page_versions(page, dry_run=options['dry_run'])
+            if changed:
+                n_pages += 1
+                n_versions += changed
+                if options['verbosity'] > 1:
+                    self.stdout.write('%s: %i versions' % (page, changed))
+
+        self.stdout.write('%i versions in %i pages %s.' % (n_versions, n_pages,
+                                                          'would be repacked' if options['dry_run'] else 'repacked'))
@@ -4,7 +4,7 @@ from django.utils.safestring import mark_safe
 from django.core.cache import cache
 from django.urls import reverse
 from coredata.models import CourseOffering, Member, Person
-from grades.models import Activity
+from grades.models import Activity, NumericActivity, LetterActivity, CalNumericActivity, CalLetterActivity
 
 from courselib.json_fields import JSONField
 from courselib.json_fields import getter_setter
@@ -12,7 +12,8 @@ from courselib.text import normalize_newlines
 from courselib.storage import UploadedFileStorage, upload_path
 from courselib.markup import markup_to_html, ensure_sanitary_markup
 import pytz
-import os, datetime, re, difflib, json, uuid
+import os, datetime, re, difflib, json, uuid, threading
+from collections import OrderedDict
 
 WRITE_ACL_CHOICES = [
     ('NONE', 'nobody'),
@@ -51,6 +52,108 @@ def attachment_upload_to(instance, filename):
     return upload_path(instance.page.offering.slug, '_pagefiles', filename)
 
 
+# at most CHECKPOINT_INTERVAL-1 diffs are applied to reconstruct a PageVersion: older versions are a full-text checkpoint
+CHECKPOINT_INTERVAL = 10
+# number of newer PageVersions fetched at once when reconstructing from diffs (so usually the whole chain)
+CHAIN_BATCH_SIZE = 2*CHECKPOINT_INTERVAL
+
+# process-wide LRU cache of reconstructed PageVersion wikitext, keyed by (PageVersion.id, PageVersion.created_at).
+WIKITEXT_LRU_SIZE = 200
+_wikitext_lru = OrderedDict()
+_wikitext_lru_lock = threading.Lock()
+
+def _wikitext_lru_get(key):
+    with _wikitext_lru_lock:
+        wikitext = _wikitext_lru.get(key)
+        if wikitext is not None:
+            _wikitext_lru.move_to_end(key)
+    return wikitext
+
+def _wikitext_lru_put(key, wikitext):
+    with _wikitext_lru_lock:
+        _wikitext_lru[key] = wikitext
+        while len(_wikitext_lru) > WIKITEXT_LRU_SIZE:
+            _wikitext_lru.popitem(last=False)
+
+
+def text_changes(text1, text2):
+    """
+    Changes to get from text1 to text2.
+
+    List of changes that can be insertions, deletions, or replacements. Each
+    is a tuple containing:
+      (type flag, position of change, [other info need to reconstrut original])
+    """
+    lines1 = text1.split("\n")
+    lines2 = text2.split("\n")
+    
+    matcher = difflib.SequenceMatcher()
+    matcher.set_seqs(lines1, lines2)
+    
+    changes = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            # ignore no-change blocks
+            pass
+        elif tag == 'insert':
+            changes.append(("I", i1, lines2[j1:j2]))
+        elif tag == 'delete':
+            changes.append(("D", i1, i2))
+        elif tag == 'replace':
+            changes.append(("R", i1, i2, lines2[j1:j2]))
+        else:
+            raise ValueError
+    
+    return changes
+
+
+def apply_text_changes(text, changes):
+    """
+    Apply changes (from text_changes) to the text.
+    """
+    lines = text.split("\n")
+    # sort by reverse linenumber: make sure we make changes in the right place
+    changes.sort(key=lambda x: -x[1])
+    
+    for change in changes:
+        c = change[0]
+        if c=="I":
+            _, pos, ls = change
+            lines[pos:pos] = ls
+        elif c=="D":
+            _, pos1, pos2 = change
+            del lines[pos1:pos2]
+        elif c=="R":
+            _, pos1, pos2, ls = change
+            lines[pos1:pos2] = ls
+        else:
+            raise ValueError
+
+    return "\n".join(lines)
+
+
+PAGE_GENERATION_KEY = 'page-generation-%s'
+
+def offering_cache_generation(offering_id):
+    """
+    The current generation of the offering's cached page HTML and macros, which is part of their cache keys: a new
+    random value is set by each expire_offering_cache.
+    """
+    key = PAGE_GENERATION_KEY % (offering_id,)
+    generation = cache.get(key)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        cache.set(key, generation, None)
+    return generation
+
+def expire_offering_cache(offering_id):
+    """
+    Invalidate the cached HTML and macros for all pages in the offering, by starting a new generation. The old entries
+    are never used again, and age out of the cache.
+    """
+    cache.set(PAGE_GENERATION_KEY % (offering_id,), uuid.uuid4().hex, None)
+
+
 class Page(models.Model):
     """
     A page in this courses "web site". Actual data is versioned in PageVersion objects.
@@ -115,16 +218,13 @@ class Page(models.Model):
         return "page-curver-" + str(self.id)
 
     def macro_cache_key(self):
-        return "MACROS-" + str(self.offering_id)
+        return "MACROS-%s-%s" % (offering_cache_generation(self.offering_id), self.offering_id)
 
     def expire_offering_cache(self):
         # invalidate cache for all pages in this offering: makes sure current page, and all <<filelist>> are up to date
-        for pv in PageVersion.objects.filter(page__offering=self.offering):
-            cache.delete(pv.html_cache_key())
-            cache.delete(pv.wikitext_cache_key())
+        expire_offering_cache(self.offering_id)
         # other cache cleanup
         cache.delete(self.version_cache_key())
-        cache.delete(self.macro_cache_key())
 
     def label_okay(self, label):
         """
@@ -225,30 +325,69 @@ class PageVersion(models.Model):
     redirect_reason, set_redirect_reason = getter_setter('redirect_reason')
 
     def html_cache_key(self):
-        return "page-html-" + str(self.id)
+        generation = offering_cache_generation(self.page.offering_id) if self.page_id else None
+        return "page-html-%s-%s" % (generation, self.id)
     def wikitext_cache_key(self):
-        return "page-wikitext-" + str(self.id)
+        # the text of a version never changes, but include created_at in case ids are reused (e.g. in tests)
+        return "page-wikitext-%s-%s" % (self.id, self.created_at.strftime('%Y%m%d%H%M%S%f'))
 
     def get_wikitext(self):
         """
         Return this version's markup (reconstructing from diffs if necessary).
         
-        Caches when reconstructing from diffs
+        Caches when reconstructing from diffs (in-process and in the cache)
         """
-        if self.diff_from:
+        if self.diff_from_id:
+            lru_key = (self.id, self.created_at)
+            wikitext = _wikitext_lru_get(lru_key)
+            if wikitext is not None:
+                return wikitext
+
             key = self.wikitext_cache_key()
             wikitext = cache.get(key)
             if wikitext:
-                return str(wikitext)
+                wikitext = str(wikitext)
+                _wikitext_lru_put(lru_key, wikitext)
+                return wikitext
             else:
-                src = self.diff_from
-                diff = json.loads(self.diff)
-                wikitext = src.apply_changes(diff)
+                wikitext = self._reconstruct_wikitext()
                 cache.set(key, wikitext, 24*3600) # no need to expire: shouldn't change for a version
-                return str(wikitext)
+                return wikitext
 
         return str(self.wikitext)
 
+    def _reconstruct_wikitext(self):
+        """
+        Rebuild this version's text by applying the diffs along the diff_from chain. The versions in the chain are the
+        next-newer versions of the page, so they are fetched together; intermediate results go in the in-process LRU.
+        """
+        newer = PageVersion.objects.filter(page_id=self.page_id, created_at__gte=self.created_at).exclude(id=self.id) \
+            .order_by('created_at')[:CHAIN_BATCH_SIZE]
+        newer = {v.id: v for v in newer}
+
+        # walk the chain until we find a version whose text we know
+        chain = [self]
+        v = self
+        while True:
+            nxt = newer.get(v.diff_from_id)
+            if nxt is None:
+                # longer chain than we fetched (or out-of-order creation times): fall back to following the link.
+                nxt = PageVersion.objects.get(id=v.diff_from_id)
+            if not nxt.diff_from_id:
+                wikitext = str(nxt.wikitext)
+                break
+            wikitext = _wikitext_lru_get((nxt.id, nxt.created_at))
+            if wikitext is not None:
+                break
+            chain.append(nxt)
+            v = nxt
+
+        # ... then apply the diffs back to this version
+        for v in reversed(chain):
+            wikitext = apply_text_changes(wikitext, json.loads(v.diff))
+            _wikitext_lru_put((v.id, v.created_at), wikitext)
+        return wikitext
+
     def __init__(self, *args, **kwargs):
         super(PageVersion, self).__init__(*args, **kwargs)
 
@@ -265,57 +404,15 @@ class PageVersion(models.Model):
 
     def changes(self, other):
         """
-        Changes to get from the get_wikitext() of self to other.
-        
-        List of changes that can be insertions, deletions, or replacements. Each
-        is a tuple containing:
-          (type flag, position of change, [other info need to reconstrut original])
+        Changes to get from the get_wikitext() of self to other: see text_changes.
         """
-        lines1 = self.get_wikitext().split("\n")
-        lines2 = other.get_wikitext().split("\n")
-        
-        matcher = difflib.SequenceMatcher()
-        matcher.set_seqs(lines1, lines2)
-        
-        changes = []
-        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
-            if tag == 'equal':
-                # ignore no-change blocks
-                pass
-            elif tag == 'insert':
-                changes.append(("I", i1, lines2[j1:j2]))
-            elif tag == 'delete':
-                changes.append(("D", i1, i2))
-            elif tag == 'replace':
-                changes.append(("R", i1, i2, lines2[j1:j2]))
-            else:
-                raise ValueError
-        
-        return changes
+        return text_changes(self.get_wikitext(), other.get_wikitext())
 
     def apply_changes(self, changes):
         """
         Apply changes to this wikitext
         """
-        lines = self.get_wikitext().split("\n")
-        # sort by reverse linenumber: make sure we make changes in the right place
-        changes.sort(key=lambda x: -x[1])
-        
-        for change in changes:
-            c = change[0]
-            if c=="I":
-                _, pos, ls = change
-                lines[pos:pos] = ls
-            elif c=="D":
-                _, pos1, pos2 = change
-                del lines[pos1:pos2]
-            elif c=="R":
-                _, pos1, pos2, ls = change
-                lines[pos1:pos2] = ls
-            else:
-                raise ValueError
-
-        return "\n".join(lines)
+        return apply_text_changes(self.get_wikitext(), changes)
 
     def diff_to(self, other):
         """
@@ -324,8 +421,8 @@ class PageVersion(models.Model):
         if not self.wikitext or self.diff_from:
             # must already be a diff: don't repeat ourselves
             return
-        if self.depth() > 10:
-            # don't let the chain of diffs get too long
+        if self.depth() >= CHECKPOINT_INTERVAL - 1:
+            # don't let the chain of diffs get too long: this version stays as a full-text checkpoint
             return
                 
         oldw = self.wikitext
@@ -445,23 +542,116 @@ class PageVersion(models.Model):
             return mark_safe(html)
 
 
+def _reconstruct_texts(versions):
+    """
+    The wikitext of each of these PageVersions (of one page), reconstructed in memory from the diffs (without the
+    cache). Returns a dict of PageVersion.id -> wikitext, omitting file and redirect versions.
+    """
+    texts = {}
+    remaining = [v for v in versions if not v.file_attachment and not v.redirect]
+    while remaining:
+        # the versions whose diff_from is already done (starting with the full-text versions)
+        ready = [v for v in remaining if not v.diff_from_id or v.diff_from_id in texts]
+        if not ready:
+            # diff_from outside these versions: reconstruct those the usual way
+            ready = remaining
+        for v in ready:
+            if v.diff_from_id and v.diff_from_id in texts:
+                texts[v.id] = apply_text_changes(texts[v.diff_from_id], json.loads(v.diff))
+            else:
+                texts[v.id] = v.get_wikitext()
+        remaining = [v for v in remaining if v.id not in texts]
+    return texts
+
+
+def repack_page_versions(page, dry_run=False):
+    """
+    Re-lay the PageVersions of this page in the current storage layout: the newest version as full text, older
+    versions as diffs from the next-newer version, with a full-text checkpoint every CHECKPOINT_INTERVAL versions (or
+    where a diff wouldn't be smaller). File and redirect versions are left as they are.
+
+    Returns the number of PageVersions changed.
+    """
+    versions = list(PageVersion.objects.filter(page=page).order_by('-created_at', '-id'))
+    if not versions:
+        return 0
+
+    texts = _reconstruct_texts(versions)
+
+    # decide the new layout, newest first
+    layout = {} # PageVersion.id -> (wikitext, diff, diff_from_id)
+    newer = None
+    chain_length = 0
+    for v in versions:
+        if v.id not in texts:
+            # file or redirect
+            newer = None
+            continue
+        text = texts[v.id]
+        diff = None
+        if newer is not None and text and chain_length < CHECKPOINT_INTERVAL - 1:
+            diff = json.dumps(text_changes(texts[newer.id], text), separators=(',',':'))
+            if len(diff) > len(text):
+                diff = None
+
+        if diff is None:
+            layout[v.id] = (text, None, None)
+            chain_length = 0
+        else:
+            layout[v.id] = ('', diff, newer.id)
+            chain_length += 1
+        newer = v
+
+    # depth: the length of the chain of diffs below each version
+    depths = {}
+    for v in reversed(versions):
+        if v.id not in layout:
+            continue
+        depths.setdefault(v.id, 0)
+        _, _, diff_from_id = layout[v.id]
+        if diff_from_id:
+            depths[diff_from_id] = depths[v.id] + 1
+
+    changed = 0
+    with transaction.atomic():
+        for v in versions:
+            if v.id not in layout:
+                continue
+            wikitext, diff, diff_from_id = layout[v.id]
+            if (v.wikitext or '', v.diff or None, v.diff_from_id) == (wikitext, diff, diff_from_id) \
+                    and v.depth() == depths[v.id]:
+                continue
+            changed += 1
+            v.set_depth(depths[v.id])
+            if not dry_run:
+                # .update so the usual .save() logic (diffing, sanitizing, cache expiry) isn't triggered: the text of
+                # every version is unchanged.
+                PageVersion.objects.filter(id=v.id).update(wikitext=wikitext, diff=diff, diff_from_id=diff_from_id,
+                                                           config=v.config)
+
+        if not dry_run:
+            # make sure nothing was lost
+            if _reconstruct_texts(PageVersion.objects.filter(page=page)) != texts:
+                raise ValueError('Repacking changed the text of %s.' % (page,))
+
+    return changed
+
+
 # signal for cache invalidation
 def clear_offering_cache(instance, **kwargs):
     """
     Saving an activity might change HTML contents of any PageVersion, since they might
     contain <<duedate>> macros: invalidate all cached copies to be safe.
     """
-    if not isinstance(instance, Activity):
-        return
-    if not hasattr(instance, 'offering'):
+    if not instance.offering_id:
         # doesn't have an offering set yet: can't be a problem. Right?
         return
 
-    for pv in PageVersion.objects.filter(page__offering=instance.offering):
-        key = pv.html_cache_key()
-        cache.delete(key)
+    expire_offering_cache(instance.offering_id)
 
-models.signals.post_save.connect(clear_offering_cache)
+# post_save is sent with the concrete class as sender, so connect each kind of Activity
+for activity_class in [Activity, NumericActivity, LetterActivity, CalNumericActivity, CalLetterActivity]:
+    models.signals.post_save.connect(clear_offering_cache, sender=activity_class)
 
 
 class PagePermission(models.Model):
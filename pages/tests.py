@@ -4,10 +4,13 @@ from django.urls import reverse
 from django.utils.safestring import mark_safe, SafeText
 from pages.models import Page, PageVersion, MACRO_LABEL, PagePermission
 from coredata.models import CourseOffering, Member, Person
-from grades.models import Activity
+from grades.models import Activity, NumericActivity
 from courselib.testing import TEST_COURSE_SLUG, Client, test_views
-from courselib.markup import ParserFor, markup_to_html
-import re
+from courselib.markup import ParserFor, markup_to_html, markup_to_html_many, prefetch_markup_html, \
+    _markup_cache_key
+from django.core.cache import cache
+from django.core.management import call_command
+import re, datetime, io
 
 wikitext = """Some Python code:
 {{{ [python]
@@ -151,6 +154,56 @@ class PagesTest(TestCase):
         self.assertEqual(v3.wikitext, contents3)
         self.assertEqual(v3.diff_from, None)
 
+    def test_version_checkpoints(self):
+        "Test the diff chains, checkpoints, and repacking."
+        import pages.models
+        crs = CourseOffering.objects.get(slug=TEST_COURSE_SLUG)
+        memb = Member.objects.get(offering=crs, person__userid="ggbaker")
+
+        p = Page(offering=crs, label="Long")
+        p.save()
+        lines = ['line %i of the page' % (i,) for i in range(30)]
+        texts = []
+        for i in range(25):
+            lines[i] = 'changed line %i' % (i,)
+            texts.append('\n'.join(lines))
+            PageVersion(page=p, title="T", wikitext=texts[-1], editor=memb, comment="edit %i" % (i,)).save()
+
+        versions = list(PageVersion.objects.filter(page=p).order_by('created_at', 'id'))
+        self.assertTrue(any(v.diff_from_id for v in versions))
+        # no chain longer than CHECKPOINT_INTERVAL-1 diffs
+        for v in versions:
+            self.assertLess(v.depth(), pages.models.CHECKPOINT_INTERVAL)
+
+        # reconstructing doesn't need the cache or the LRU
+        cache.clear()
+        pages.models._wikitext_lru.clear()
+        self.assertEqual([v.get_wikitext() for v in versions], texts)
+        self.assertEqual([v.get_wikitext() for v in reversed(versions)], list(reversed(texts)))
+
+        # lay the history out as if every version were stored full-text, then repack
+        for v, t in zip(versions, texts):
+            PageVersion.objects.filter(id=v.id).update(wikitext=t, diff=None, diff_from=None, config={})
+        self.assertEqual(pages.models.repack_page_versions(p, dry_run=True), len(versions))
+        self.assertEqual(pages.models.repack_page_versions(p), len(versions))
+        self.assertEqual(pages.models.repack_page_versions(p), 0)
+
+        cache.clear()
+        pages.models._wikitext_lru.clear()
+        versions = list(PageVersion.objects.filter(page=p).order_by('created_at', 'id'))
+        self.assertEqual([v.get_wikitext() for v in versions], texts)
+        self.assertEqual(versions[-1].wikitext, texts[-1])
+        self.assertEqual(sum(1 for v in versions if not v.diff_from_id), 3)
+
+        # ... and new versions continue the same layout
+        PageVersion(page=p, title="T", wikitext=texts[0], editor=memb, comment="revert").save()
+        self.assertEqual(PageVersion.objects.get(id=versions[-1].id).get_wikitext(), texts[-1])
+
+        out = io.StringIO()
+        call_command('repack_pages', offering=crs.slug, stdout=out)
+        self.assertIn('repacked', out.getvalue())
+        self.assertEqual(PageVersion.objects.get(id=versions[-1].id).get_wikitext(), texts[-1])
+
     def test_api(self):
         crs = CourseOffering.objects.get(slug=TEST_COURSE_SLUG)
         memb = Member.objects.get(offering=crs, person__userid="ggbaker")
@@ -502,6 +555,47 @@ class PagesTest(TestCase):
         link = '<a href="%s">%s' % (a1.get_absolute_url(), a1.name)
         self.assertIn(link.encode('utf-8'), html)
 
+        # the parser is shared by offerings, but the macros look in the right one
+        other = CourseOffering.objects.exclude(id=crs.id).exclude(activity__name=a1.name).first()
+        p2 = ParserFor(other)
+        self.assertIs(p2.parser, p.parser)
+        self.assertIn(b'[No activity "A1"]', p2.text2html('one <<activitylink A1>> two'))
+        self.assertIn(link.encode('utf-8'), p.text2html('one <<activitylink A1>> two'))
+        self.assertIsNot(ParserFor(None).parser, p.parser)
+
+        out = io.StringIO()
+        call_command('benchmark_markup', '--repeat', '2', stdout=out)
+        self.assertIn('shared parser', out.getvalue())
+
+    def test_activity_cache_invalidation(self):
+        """
+        Changing an activity should refresh cached HTML for pages in the offering
+        """
+        crs = CourseOffering.objects.get(slug=TEST_COURSE_SLUG)
+        memb = Member.objects.get(offering=crs, person__userid="ggbaker")
+        a1 = NumericActivity.objects.get(offering=crs, slug='a1')
+
+        p = Page(offering=crs, label="DueDates")
+        p.save()
+        v = PageVersion(page=p, title="Due", wikitext='Due <<duedate A1>>.', editor=memb, comment="original page")
+        v.save()
+        v.html_contents()
+        key = v.html_cache_key()
+        self.assertIsNotNone(cache.get(key))
+
+        # one new generation for the offering: old entries are no longer used
+        a1.due_date = a1.due_date + datetime.timedelta(days=10)
+        a1.save()
+        new_key = v.html_cache_key()
+        self.assertNotEqual(new_key, key)
+        self.assertIsNone(cache.get(new_key))
+        v.html_contents()
+        self.assertIsNotNone(cache.get(new_key))
+
+        # ... and saving a page does the same
+        p.save()
+        self.assertNotEqual(v.html_cache_key(), new_key)
+
     def test_markup_choice(self):
         """
         Check the distinction between Creole and Markdown pages
@@ -552,6 +646,36 @@ class PagesTest(TestCase):
         self.assertIsInstance(result, SafeText)
         self.assertEqual(result.strip(), '<p>Paragraph &lt;#1&gt; \u2605\U0001F600</p>')
 
+    def test_markup_many(self):
+        """
+        Check markup_to_html_many against markup_to_html, and prefetching HTML for a list of objects
+        """
+        items = [
+            {'markup': 'one **two**', 'markuplang': 'creole'},
+            {'markup': 'one *two*', 'markuplang': 'markdown', 'math': True},
+            {'markup': 'Foo<script>x</script>', 'markuplang': 'html', 'restricted': True},
+            {'markup': 'one **two**', 'markuplang': 'creole'},
+            {'markup': 'one **two**', 'markuplang': 'creole', 'forum_links': True},
+        ]
+        cache.clear()
+        results = markup_to_html_many(items)
+        self.assertEqual(results, [markup_to_html(**item) for item in items])
+        self.assertEqual(results[0], '<p>one <strong>two</strong></p>')
+        self.assertEqual(results[1], '<div class="tex2jax_process wikicontents"><p>one <em>two</em></p></div>')
+        self.assertIsInstance(results[2], SafeText)
+
+        # the results were cached (and are used by markup_to_html_many too)
+        self.assertEqual(len(cache.get_many([_markup_cache_key(**item) for item in items])), 4)
+        cache.set(_markup_cache_key(**items[0]), 'cached')
+        self.assertEqual(markup_to_html_many(items[:1]), ['cached'])
+
+        from dashboard.models import NewsItem
+        news = [NewsItem(content='**A**', markup='creole'), NewsItem(content='*B*', markup='markdown')]
+        prefetch_markup_html(news, 'content_xhtml')
+        cache.clear()
+        self.assertEqual([n.content_xhtml() for n in news], ['<p><strong>A</strong></p>', '<p><em>B</em></p>'])
+        self.assertEqual(news[0].__dict__['_prefetched_markup_html']['content_xhtml'], news[0].content_xhtml())
+
     def test_html_safety(self):
         """
         Check that we're handling HTML in a safe way
@@ -0,0 +1,27 @@
+import courselib.json_fields
+import datetime
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coredata', '0028_searchindexchange'),
+        ('quizzes', '0002_trivial_migration_updates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuizAutosave',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(default=datetime.datetime.now)),
+                ('ip_address', models.GenericIPAddressField()),
+                ('applied', models.BooleanField(db_index=True, default=False)),
+                ('config', courselib.json_fields.JSONField(default=dict)),
+                ('quiz', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='quizzes.quiz')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='coredata.member')),
+            ],
+        ),
+    ]
@@ -9,7 +9,7 @@ import itertools
 import json
 from collections import namedtuple, defaultdict
 from importlib import import_module
-from typing import Optional, Tuple, List, Iterable, Any, Dict
+from typing import Optional, Tuple, List, Iterable, Any, Dict, Callable
 
 from django.conf import settings
 from django.contrib.auth.models import User
@@ -24,12 +24,13 @@ from django.utils.functional import cached_property
 from django.utils.safestring import SafeText
 from ipware import get_client_ip
 
-from coredata.models import Member, CourseOffering
+from coredata.models import Member, CourseOffering, Person
 from courselib.conditional_save import ConditionalSaveMixin
 from courselib.json_fields import JSONField, config_property
-from courselib.markup import markup_to_html
+from courselib.markup import markup_to_html, markup_html_for
 from courselib.storage import UploadedFileStorage, upload_path
-from grades.models import Activity, NumericActivity, NumericGrade
+from grades.models import Activity, NumericActivity, NumericGrade, GradeHistory, get_entry_person
+from grades.utils import recalculate_dependents_many
 from marking.models import ActivityComponent, ActivityComponentMark, StudentActivityMark
 from quizzes import DEFAULT_QUIZ_MARKUP
 from quizzes.types.file import FileAnswer
@@ -70,6 +71,9 @@ REVIEW_CHOICES = [
     ('all', 'may review questions, their answers, marks, comments, and review notes'),
 ]
 
+AUTOMARK_CHUNK_SIZE = 100  # students whose automarking results are written together
+AUTOSAVE_APPLY_BATCH = 500  # QuizAutosave records applied to QuestionAnswers together
+
 
 class MarkingNotConfiguredError(ValueError):
     pass
@@ -343,11 +347,15 @@ class Quiz(models.Model):
 
         return component_lookup
 
-    @transaction.atomic()
-    def automark_all(self, user: User) -> int:
+    def automark_all(self, user: User, progress: Optional[Callable[[int, int], None]] = None) -> int:
         """
         Fill in marking for any QuestionVersions that support it. Return number marked.
+
+        The results are computed in memory and written in bulk, AUTOMARK_CHUNK_SIZE students at a time, each chunk in
+        its own transaction (so this must not be called inside a transaction for the chunks to actually commit). If
+        given, progress(students_done, students_total) is called after each chunk is committed.
         """
+        QuizAutosave.apply_pending(quiz=self)
         versions = QuestionVersion.objects.filter(question__quiz=self, question__status='V').select_related('question')
         activity_components = self.activitycomponents_by_question()
         member_component_results = []  # : List[Tuple[Member, ActivityComponentMark]]
@@ -358,52 +366,75 @@ class Quiz(models.Model):
 
         # Now the ugly work: combine the just-automarked components with any existing manual marking, and save...
 
-        old_sam_lookup = {  # dict to find old StudentActivityMarks
-            sam.numeric_grade.member: sam
-            for sam
-            in StudentActivityMark.objects.filter(activity=self.activity)
-                .order_by('created_at')
-                .select_related('numeric_grade__member')
-                .prefetch_related('activitycomponentmark_set')
-        }
-
-        # dict to find old ActivityComponentMarks
-        old_acm_by_component_id = defaultdict(dict)  # : Dict[int, Dict[Member, ActivityComponentMark]]
-        old_sam = StudentActivityMark.objects.filter(activity=self.activity).order_by('created_at') \
-            .select_related('numeric_grade__member').prefetch_related('activitycomponentmark_set')
-        for sam in old_sam:
+        # dicts to find the old StudentActivityMarks and ActivityComponentMarks (most recent wins)
+        old_sam_lookup = {}  # : Dict[int, StudentActivityMark], keyed by Member.id
+        old_acm_by_component_id = defaultdict(dict)  # : Dict[int, Dict[int, ActivityComponentMark]]
+        old_sams = StudentActivityMark.objects.filter(activity=self.activity).order_by('created_at') \
+            .select_related('numeric_grade').prefetch_related('activitycomponentmark_set')
+        for sam in old_sams:
+            member_id = sam.numeric_grade.member_id
+            old_sam_lookup[member_id] = sam
             for acm in sam.activitycomponentmark_set.all():
-                old_acm_by_component_id[acm.activity_component_id][sam.numeric_grade.member] = acm
+                old_acm_by_component_id[acm.activity_component_id][member_id] = acm
 
-        numeric_grade_lookup = {  # dict to find existing NumericGrades
-            ng.member: ng
-            for ng
-            in NumericGrade.objects.filter(activity=self.activity).select_related('member')
-        }
-        all_components = set(ActivityComponent.objects.filter(numeric_activity_id=self.activity_id, deleted=False))
+        all_components = list(ActivityComponent.objects.filter(numeric_activity_id=self.activity_id, deleted=False))
+        entered_by = get_entry_person(user.username)
 
         member_component_results.sort(key=lambda pair: pair[0].id)  # ... get Members grouped together
+        results_by_member = [
+            (member, {acm.activity_component: acm for _, acm in member_acms})
+            for member, member_acms in itertools.groupby(member_component_results, lambda pair: pair[0])
+        ]
+
+        n_marked = 0
+        for start in range(0, len(results_by_member), AUTOMARK_CHUNK_SIZE):
+            chunk = results_by_member[start:start + AUTOMARK_CHUNK_SIZE]
+            with transaction.atomic():
+                n_marked += self._automark_save(chunk, all_components, old_sam_lookup, old_acm_by_component_id,
+                                                user, entered_by)
+            if progress:
+                progress(start + len(chunk), len(results_by_member))
+
+        return n_marked
+
+    def _automark_save(self, chunk: List[Tuple[Member, Dict[ActivityComponent, ActivityComponentMark]]],
+                       all_components: List[ActivityComponent],
+                       old_sam_lookup: Dict[int, StudentActivityMark],
+                       old_acm_by_component_id: Dict[int, Dict[int, ActivityComponentMark]],
+                       user: User, entered_by: Person) -> int:
+        """
+        Save the automarking results for these students, as part of automark_all. Return the number of components
+        marked.
+        """
+        members = [member for member, _ in chunk]
+
+        # Get NumericGrades to work with: create any that are missing, with one query
+        numeric_grade_lookup = {ng.member_id: ng for ng in NumericGrade.objects.filter(activity_id=self.activity_id,
+                                                                                        member__in=members)}
+        missing = [NumericGrade(activity_id=self.activity_id, member=member, flag='NOGR', value=0)
+                   for member in members if member.id not in numeric_grade_lookup]
+        if missing:
+            NumericGrade.objects.bulk_create(missing)
+            # (bulk_create doesn't fill in the ids on every database backend)
+            numeric_grade_lookup = {ng.member_id: ng for ng in NumericGrade.objects.filter(
+                activity_id=self.activity_id, member__in=members)}
+
         n_marked = 0
-        for member, member_acms in itertools.groupby(member_component_results, lambda pair: pair[0]):
-            # Get a NumericGrade to work with
-            try:
-                ngrade = numeric_grade_lookup[member]
-            except KeyError:
-                ngrade = NumericGrade(activity_id=self.activity_id, member=member, flag='NOGR')
-                ngrade.save(newsitem=False, entered_by=None, is_temporary=True)
-
-            # Create ActivityMark to save under
+        new_acms = []
+        grades = []
+        for member, auto_acm_lookup in chunk:
+            ngrade = numeric_grade_lookup[member.id]
+
+            # ActivityMark to save under
             am = StudentActivityMark(numeric_grade=ngrade, activity_id=self.activity_id, created_by=user.username)
-            old_am = old_sam_lookup.get(member)
+            old_am = old_sam_lookup.get(member.id)
             if old_am:
                 am.overall_comment = old_am.overall_comment
                 am.late_penalty = old_am.late_penalty
                 am.mark_adjustment = old_am.mark_adjustment
                 am.mark_adjustment_reason = old_am.mark_adjustment_reason
-            am.save()
 
             # Find/create ActivityComponentMarks for each component
-            auto_acm_lookup = {acm.activity_component: acm for _, acm in member_acms}
             any_missing = False
             acms = []
             for c in all_components:
@@ -413,16 +444,13 @@ class Quiz(models.Model):
                 # (3) nothing.
                 if c in auto_acm_lookup:  # (1)
                     acm = auto_acm_lookup[c]
-                    acm.activity_mark = am
                     n_marked += 1
-                elif c.id in old_acm_by_component_id and member in old_acm_by_component_id[c.id]:  # (2)
-                    old_acm = old_acm_by_component_id[c.id][member]
-                    acm = ActivityComponentMark(activity_mark=am, activity_component=c, value=old_acm.value, comment=old_acm.comment)
+                elif member.id in old_acm_by_component_id.get(c.id, {}):  # (2)
+                    old_acm = old_acm_by_component_id[c.id][member.id]
+                    acm = ActivityComponentMark(activity_component=c, value=old_acm.value, comment=old_acm.comment)
                 else:  # (3)
-                    acm = ActivityComponentMark(activity_mark=am, activity_component=c, value=None, comment=None)
+                    acm = ActivityComponentMark(activity_component=c, value=None, comment=None)
                     any_missing = True
-
-                acm.save()
                 acms.append(acm)
 
             if not any_missing:
@@ -435,8 +463,24 @@ class Quiz(models.Model):
                 ngrade.flag = 'NOGR'
                 am.mark = None
 
-            ngrade.save(newsitem=False, entered_by=user.username)
+            # StudentActivityMark is a multi-table-inheritance model, so can't be bulk_created.
             am.save()
+            for acm in acms:
+                acm.activity_mark = am
+            new_acms.extend(acms)
+            grades.append((ngrade, am))
+
+        ActivityComponentMark.objects.bulk_create(new_acms, batch_size=500)
+
+        # the equivalent of NumericGrade.save(newsitem=False, entered_by=user.username) for each grade
+        NumericGrade.objects.bulk_update([ngrade for ngrade, _ in grades], ['value', 'flag'], batch_size=500)
+        GradeHistory.objects.bulk_create([
+            GradeHistory(activity_id=self.activity_id, member_id=ngrade.member_id, entered_by=entered_by,
+                         activity_status=self.activity.status, numeric_grade=ngrade.value, grade_flag=ngrade.flag,
+                         comment=ngrade.comment, mark=am, group=None)
+            for ngrade, am in grades
+        ], batch_size=500)
+        recalculate_dependents_many(self.activity, members)
 
         return n_marked
 
@@ -618,13 +662,19 @@ class QuestionVersion(models.Model):
         helper = self.helper()
         return helper.entry_head_html()
 
-    def marking_html(self) -> SafeText:
+    def marking_html_args(self) -> Dict[str, Any]:
         text, markup, math = self.marking
-        return markup_to_html(text, markup, math=math, hidden_llm=True)
+        return {'markup': text, 'markuplang': markup, 'math': math, 'hidden_llm': True}
 
-    def review_html(self) -> SafeText:
+    def marking_html(self) -> SafeText:
+        return markup_html_for(self, 'marking_html')
+
+    def review_html_args(self) -> Dict[str, Any]:
         text, markup, math = self.review
-        return markup_to_html(text, markup, math=math, hidden_llm=True)
+        return {'markup': text, 'markuplang': markup, 'math': math, 'hidden_llm': True}
+
+    def review_html(self) -> SafeText:
+        return markup_html_for(self, 'review_html')
 
     def automark_all(self, activity_components: Dict['Question', ActivityComponent]) -> Iterable[Tuple[Member, ActivityComponentMark]]:
         """
@@ -741,6 +791,8 @@ class QuizSubmission(models.Model):
     # .config['honour_code']: did student agree to the honour code?
     # .config['autosave']: was this an auto-save?
 
+    autosave = config_property('autosave', default=False)
+
     @classmethod
     def create(cls, request: HttpRequest, quiz: Quiz, student: Member, answers: List[QuestionAnswer],
                commit: bool = True, autosave: bool = False) -> 'QuizSubmission':
@@ -839,10 +891,153 @@ class QuizSubmission(models.Model):
         if 'fingerprint' in self.config and 'visitorId' in self.config['fingerprint']:
             return self.config['fingerprint']['visitorId'][:8]
         else:
-            ident = self.config['user_agent'] + '--' + json.dumps(self.config['fingerprint'])
+            ident = (self.config['user_agent'] or '') + '--' + json.dumps(self.config['fingerprint'])
             return '%08x' % (string_hash(ident, 4),)
 
 
+class QuizAutosave(models.Model):
+    """
+    A compact record of an auto-save: only the answers that changed, and enough about the client to check for
+    strange history. The answers are applied to the QuestionAnswers later (coalesced with the student's other
+    pending auto-saves) by .apply_pending(), so auto-saving is a single INSERT. Explicit submissions are still
+    recorded as a full QuizSubmission.
+    """
+    quiz = models.ForeignKey(Quiz, null=False, blank=False, on_delete=models.PROTECT)
+    student = models.ForeignKey(Member, null=False, blank=False, on_delete=models.PROTECT)
+    created_at = models.DateTimeField(default=datetime.datetime.now, null=False, blank=False)
+    ip_address = models.GenericIPAddressField(null=False, blank=False)
+    applied = models.BooleanField(default=False, db_index=True)  # have the answers been written to QuestionAnswers?
+    config = JSONField(null=False, blank=False, default=dict)  # additional data about the auto-save:
+
+    # .config['answers']: list of changed answers, in the same format as QuizSubmission.config['answers'],
+    #     as [(QuestionVersion.id, Answer.id|None, Answer.answer)]
+    # .config['session']: QuizSubmission.session_fingerprint for the request
+    # .config['browser']: QuizSubmission.browser_fingerprint for the request
+
+    # for display alongside QuizSubmissions
+    autosave = True
+    capture = None
+
+    @classmethod
+    def create(cls, request: HttpRequest, quiz: Quiz, student: Member,
+               answers: List[Tuple[QuestionVersion, Optional[QuestionAnswer], Dict[str, Any]]]) -> 'QuizAutosave':
+        """
+        Record the (changed) answers: answers is a list of (QuestionVersion, existing QuestionAnswer or None, answer).
+        """
+        ip_addr, _ = get_client_ip(request)
+        autosave = cls(quiz=quiz, student=student, ip_address=ip_addr, applied=not answers)
+        autosave.config['answers'] = [(v.id, qa.id if qa else None, answer) for v, qa, answer in answers]
+        autosave.config['session'] = '%08x' % (string_hash(request.session.session_key or '', 4),)
+        try:
+            fingerprint = json.loads(request.POST['fingerprint'])
+        except KeyError:
+            fingerprint = 'missing'
+        except json.JSONDecodeError:
+            fingerprint = 'json-error'
+        if isinstance(fingerprint, dict) and 'visitorId' in fingerprint:
+            autosave.config['browser'] = fingerprint['visitorId'][:8]
+        else:
+            ident = (request.META.get('HTTP_USER_AGENT') or '') + '--' + json.dumps(fingerprint)
+            autosave.config['browser'] = '%08x' % (string_hash(ident, 4),)
+        autosave.save()
+        return autosave
+
+    @classmethod
+    def pending_answers(cls, quiz: Quiz, student: Member) -> Dict[int, Dict[str, Any]]:
+        """
+        The student's auto-saved answers that haven't been applied yet, as a dict of QuestionVersion.id to answer.
+        """
+        pending = {}
+        for autosave in cls.objects.filter(quiz=quiz, student=student, applied=False).order_by('id'):
+            for version_id, _, answer in autosave.config['answers']:
+                pending[version_id] = answer
+        return pending
+
+    @classmethod
+    def apply_pending(cls, quiz: Optional[Quiz] = None, student: Optional[Member] = None,
+                      batch_size: int = AUTOSAVE_APPLY_BATCH) -> int:
+        """
+        Write pending auto-saved answers (for this quiz/student, or all of them) to QuestionAnswers, batch_size
+        records at a time. Returns the number of QuizAutosave records applied.
+        """
+        n_applied = 0
+        while True:
+            with transaction.atomic():
+                pending = cls.objects.filter(applied=False)
+                if quiz is not None:
+                    pending = pending.filter(quiz=quiz)
+                if student is not None:
+                    pending = pending.filter(student=student)
+                # locked, so a concurrent apply_pending can't overwrite these answers with older ones
+                pending = list(pending.select_for_update().order_by('id')[:batch_size])
+                if not pending:
+                    break
+                cls._apply(pending)
+            n_applied += len(pending)
+            if len(pending) < batch_size:
+                break
+        return n_applied
+
+    @classmethod
+    def _apply(cls, autosaves: List['QuizAutosave']) -> None:
+        # coalesce: the most recent answer for each student/version wins
+        latest = {}  # : Dict[Tuple[int, int], Tuple[Dict[str, Any], datetime.datetime]]
+        for autosave in autosaves:
+            for version_id, _, answer in autosave.config['answers']:
+                latest[(autosave.student_id, version_id)] = (answer, autosave.created_at)
+
+        version_ids = {version_id for _, version_id in latest}
+        student_ids = {student_id for student_id, _ in latest}
+        versions = {v.id: v for v in QuestionVersion.all_objects.filter(id__in=version_ids)}
+        existing = {
+            (qa.student_id, qa.question_version_id): qa
+            for qa in QuestionAnswer._base_manager.filter(question_version_id__in=version_ids,
+                                                          student_id__in=student_ids)
+        }
+
+        updated = []
+        created = []
+        for (student_id, version_id), (answer, modified_at) in latest.items():
+            qa = existing.get((student_id, version_id))
+            if qa is None:
+                created.append(QuestionAnswer(question_id=versions[version_id].question_id,
+                                              question_version_id=version_id, student_id=student_id,
+                                              modified_at=modified_at, answer=answer))
+            elif qa.modified_at < modified_at:
+                # (if not, an explicit submission has replaced the auto-saved answer)
+                qa.answer = answer
+                qa.modified_at = modified_at
+                updated.append(qa)
+
+        QuestionAnswer.objects.bulk_create(created, ignore_conflicts=True)
+        QuestionAnswer.objects.bulk_update(updated, ['answer', 'modified_at'])
+        cls.objects.filter(id__in=[a.id for a in autosaves]).update(applied=True)
+
+    annotate_questions = QuizSubmission.annotate_questions
+
+    @property
+    def session_fingerprint(self) -> str:
+        return self.config['session']
+
+    @property
+    def browser_fingerprint(self) -> str:
+        return self.config['browser']
+
+
+def submission_history(quiz: Quiz, student: Optional[Member] = None) -> List[Any]:
+    """
+    The QuizSubmissions and QuizAutosaves for this quiz (and student), sorted by student and time.
+    """
+    submissions = QuizSubmission.objects.filter(quiz=quiz).select_related('student__person')
+    autosaves = QuizAutosave.objects.filter(quiz=quiz).select_related('student__person')
+    if student is not None:
+        submissions = submissions.filter(student=student)
+        autosaves = autosaves.filter(student=student)
+    history = list(submissions) + list(autosaves)
+    history.sort(key=lambda s: (s.student_id, s.created_at))
+    return history
+
+
 class TimeSpecialCase(models.Model):
     """
     Model to represent quiz start/end times that are unique to one student, to allow makeup quizzes, accessibility
@@ -0,0 +1,61 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+
+from courselib.celerytasks import task
+from log.models import LogEntry
+from quizzes.models import Quiz, QuizAutosave
+
+AUTOMARK_PROGRESS_KEY = 'quiz-automark-%i'
+AUTOMARK_PROGRESS_TIMEOUT = 3600
+
+
+def automark_progress(quiz_id: int):
+    """
+    The progress of the quiz's automarking task, as a dict of 'done', 'total', 'marked', 'finished', 'error'; or None if
+    there isn't one (recently).
+    """
+    return cache.get(AUTOMARK_PROGRESS_KEY % (quiz_id,))
+
+
+def start_automark(quiz_id: int):
+    """
+    Record that automarking has been requested (before automark_quiz starts), so the marking page can say so.
+    """
+    cache.set(AUTOMARK_PROGRESS_KEY % (quiz_id,),
+              {'done': 0, 'total': None, 'marked': 0, 'finished': False, 'error': False}, AUTOMARK_PROGRESS_TIMEOUT)
+
+
+@task(queue='batch')
+def automark_quiz(quiz_id: int, userid: str):
+    quiz = Quiz.objects.select_related('activity').get(id=quiz_id)
+    user = User.objects.get(username=userid)
+    key = AUTOMARK_PROGRESS_KEY % (quiz_id,)
+
+    status = {'done': 0, 'total': None, 'marked': 0, 'finished': False, 'error': False}
+
+    def progress(done, total):
+        status.update(done=done, total=total)
+        cache.set(key, status, AUTOMARK_PROGRESS_TIMEOUT)
+
+    try:
+        n = quiz.automark_all(user=user, progress=progress)
+    except Exception:
+        # record the failure, so the marking page doesn't say "in progress" until the status expires
+        status.update(finished=True, error=True)
+        cache.set(key, status, AUTOMARK_PROGRESS_TIMEOUT)
+        raise
+
+    status.update(done=status['total'], marked=n, finished=True)
+    cache.set(key, status, AUTOMARK_PROGRESS_TIMEOUT)
+    LogEntry(userid=userid,
+             description='automarked quiz %s' % (quiz.id),
+             related_object=quiz).save()
+    return n
+
+
+@task(queue='fast')
+def apply_quiz_autosaves():
+    """
+    Write pending auto-saved answers to the QuestionAnswers.
+    """
+    return QuizAutosave.apply_pending()
@@ -1,15 +1,19 @@
 import datetime
+from unittest import mock
 
+from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import reverse
 
 from coredata.models import CourseOffering, Member
 from courselib.testing import Client, TEST_COURSE_SLUG, test_views
-from grades.models import Activity
+from grades.models import Activity, NumericGrade, GradeHistory
+from marking.models import ActivityComponentMark, StudentActivityMark
 from quizzes.forms import QuizImportForm
-from quizzes.models import Quiz, Question, QuestionAnswer, TimeSpecialCase, QuestionVersion
+from quizzes.models import Quiz, Question, QuestionAnswer, TimeSpecialCase, QuestionVersion, QuizAutosave
+from quizzes.tasks import automark_progress, automark_quiz, start_automark
 
 now = datetime.datetime.now()
 hour = datetime.timedelta(hours=1)
@@ -151,6 +155,101 @@ class QuizzesTest(TestCase):
         self.assertTemplateUsed(response, 'quizzes/index_student.html')
         self.assertEqual(response.status_code, 200)
 
+    def test_automark(self):
+        """
+        Automark the multiple choice question, and check the bulk-saved results.
+        """
+        user = User.objects.create(username='ggbaker')
+        progress = []
+        n = self.quiz.automark_all(user=user, progress=lambda done, total: progress.append((done, total)))
+        self.assertEqual(n, 2)
+        self.assertEqual(progress, [(2, 2)])
+
+        components = self.quiz.activitycomponents_by_question()
+        mc_component = components[self.q2]
+        for member, expected in [(self.s0, 0), (self.s1, 1)]:
+            ng = NumericGrade.objects.get(activity=self.activity, member=member)
+            self.assertEqual(ng.flag, 'NOGR')  # other questions still need manual marking
+            sam = StudentActivityMark.objects.filter(numeric_grade=ng).latest('created_at')
+            acm = ActivityComponentMark.objects.get(activity_mark=sam, activity_component=mc_component)
+            self.assertEqual(acm.value, expected)
+            self.assertIsNone(sam.mark)
+            self.assertEqual(GradeHistory.objects.filter(activity=self.activity, member=member).count(), 1)
+
+        # doing it again creates a new mark for each student, but doesn't lose anything
+        n = self.quiz.automark_all(user=user)
+        self.assertEqual(n, 2)
+        ng = NumericGrade.objects.get(activity=self.activity, member=self.s1)
+        self.assertEqual(StudentActivityMark.objects.filter(numeric_grade=ng).count(), 2)
+        self.assertEqual(GradeHistory.objects.filter(activity=self.activity, member=self.s1).count(), 2)
+        sam = StudentActivityMark.objects.filter(numeric_grade=ng).latest('created_at')
+        self.assertEqual(ActivityComponentMark.objects.get(activity_mark=sam, activity_component=mc_component).value, 1)
+
+    def test_automark_task(self):
+        """
+        The automarking task records its progress, and its failure.
+        """
+        user = User.objects.create(username='ggbaker')
+        start_automark(self.quiz.id)
+        self.assertEqual(automark_progress(self.quiz.id)['finished'], False)
+
+        n = automark_quiz(self.quiz.id, user.username)
+        self.assertEqual(n, 2)
+        self.assertEqual(automark_progress(self.quiz.id),
+                         {'done': 2, 'total': 2, 'marked': 2, 'finished': True, 'error': False})
+
+        start_automark(self.quiz.id)
+        with mock.patch.object(Quiz, '_automark_save', side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                automark_quiz(self.quiz.id, user.username)
+        progress = automark_progress(self.quiz.id)
+        self.assertTrue(progress['finished'])
+        self.assertTrue(progress['error'])
+
+    def test_autosave(self):
+        """
+        Auto-saves record only the changed answers, and are applied to the QuestionAnswers.
+        """
+        c = Client()
+        c.login_user(self.s0.person.userid)
+        url = reverse('offering:quiz:autosave', kwargs={'course_slug': self.offering.slug, 'activity_slug': self.activity.slug})
+        field = self.q1.ident()
+
+        with override_settings(USE_CELERY=True):
+            # with celery, the answers are left for the periodic task
+            resp = c.post(url, {field: 'I like it a lot.'})
+            self.assertEqual(resp.json()['status'], 'ok')
+            autosave = QuizAutosave.objects.get(student=self.s0)
+            self.assertFalse(autosave.applied)
+            self.assertIn(self.v11.id, [vid for vid, _, _ in autosave.config['answers']])
+            self.assertEqual(QuestionAnswer.objects.get(student=self.s0, question=self.q1).answer['data'], 'I like it.')
+            self.assertEqual(QuizAutosave.pending_answers(self.quiz, self.s0)[self.v11.id]['data'], 'I like it a lot.')
+
+            # unchanged from the pending answer: not recorded again
+            c.post(url, {field: 'I like it a lot.'})
+            autosave = QuizAutosave.objects.filter(student=self.s0).latest('id')
+            self.assertNotIn(self.v11.id, [vid for vid, _, _ in autosave.config['answers']])
+
+        self.assertEqual(QuizAutosave.apply_pending(quiz=self.quiz), 1)
+        self.assertEqual(QuestionAnswer.objects.get(student=self.s0, question=self.q1).answer['data'], 'I like it a lot.')
+        self.assertFalse(QuizAutosave.objects.filter(applied=False).exists())
+
+        # without celery, applied immediately
+        c.post(url, {field: 'Not any more.'})
+        self.assertEqual(QuestionAnswer.objects.get(student=self.s0, question=self.q1).answer['data'], 'Not any more.')
+
+        # an explicit submission is still a full QuizSubmission, and auto-saves are part of the history
+        c.post(reverse('offering:quiz:index', kwargs={'course_slug': self.offering.slug, 'activity_slug': self.activity.slug}),
+               {field: 'Final answer.'})
+        self.assertEqual(QuestionAnswer.objects.get(student=self.s0, question=self.q1).answer['data'], 'Final answer.')
+        c.login_user('ggbaker')
+        resp = c.get(reverse('offering:quiz:submission_history', kwargs={'course_slug': self.offering.slug,
+                              'activity_slug': self.activity.slug, 'userid': self.s0.person.userid}))
+        self.assertEqual(len(resp.context['quiz_submissions']), 4)
+        resp = c.get(reverse('offering:quiz:strange_history', kwargs={'course_slug': self.offering.slug,
+                              'activity_slug': self.activity.slug}))
+        self.assertEqual(resp.status_code, 200)
+
 
 class QuizImportTest(TestCase):
     fixtures = ['basedata', 'coredata']
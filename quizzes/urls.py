@@ -14,6 +14,7 @@ quiz_patterns = [
     url(r'^delete/(?P<question_id>\d+)-(?P<version_id>\d+)$', views.version_delete, name='version_delete'),
     url(r'^add$', views.question_add, name='question_add'),
     url(r'^preview$', views.preview_student, name='preview_student'),
+    url(r'^autosave$', views.autosave, name='autosave'),
     url(r'^export$', views.export, name='export'),
     url(r'^import$', views.import_, name='import'),
     url(r'^notable-history$', views.strange_history, name='strange_history'),
@@ -6,6 +6,7 @@ import random
 from collections import OrderedDict, defaultdict
 from typing import Optional, List, Tuple
 
+from django.conf import settings
 from django.contrib import messages
 from django.db import transaction
 from django.db.models import Q, Max, Min
@@ -19,6 +20,7 @@ from django.views.generic.edit import ModelFormMixin, UpdateView
 
 from coredata.models import CourseOffering, Member
 from courselib.auth import requires_course_by_slug, requires_course_staff_by_slug, ForbiddenResponse, HttpError
+from courselib.markup import prefetch_markup_html
 from courselib.search import find_member
 from grades.models import Activity, NumericGrade
 from grades.views import has_photo_agreement
@@ -27,7 +29,9 @@ from marking.models import ActivityComponent, ActivityComponentMark, StudentActi
 from quizzes.forms import QuizForm, StudentForm, TimeSpecialCaseForm, MarkingForm, ComponentForm, MarkingSetupForm, \
     QuizImportForm
 from quizzes.models import Quiz, QUESTION_TYPE_CHOICES, QUESTION_HELPER_CLASSES, Question, QuestionAnswer, \
-    TimeSpecialCase, QuizSubmission, QuestionVersion, MarkingNotConfiguredError, HONOUR_CODE_DEFAULT
+    TimeSpecialCase, QuizSubmission, QuizAutosave, QuestionVersion, MarkingNotConfiguredError, HONOUR_CODE_DEFAULT, \
+    submission_history as quiz_submission_history
+from quizzes.tasks import automark_quiz, automark_progress, start_automark
 
 
 @requires_course_by_slug
@@ -68,6 +72,7 @@ def _index_instructor(request: HttpRequest, offering: CourseOffering, activity:
 def _index_student(request: HttpRequest, offering: CourseOffering, activity: Activity, quiz: Quiz) -> HttpResponse:
     member = request.member
     assert member.role == 'STUD'
+    QuizAutosave.apply_pending(quiz=quiz, student=member)
 
     # Overtime logic: cannot display the quiz (i.e. page with form), period. Submitting form will be accepted up to
     # 5 minutes late, with timestamp to allow instructor to interpret as they see fit.
@@ -116,7 +121,6 @@ def _index_student(request: HttpRequest, offering: CourseOffering, activity: Act
     previous_honour_code = request.session.get(honour_code_key, False)  # did student agree to honour code recently?
 
     questions = Question.objects.filter(quiz=quiz)
-    question_number = {q.id: i + 1 for i, q in enumerate(questions)}
 
     answers = list(QuestionAnswer.objects.filter(question__in=questions, student=member))
     answer_lookup = {a.question.ident(): a for a in answers}
@@ -134,50 +138,8 @@ def _index_student(request: HttpRequest, offering: CourseOffering, activity: Act
         autosave = 'autosave' in request.GET
 
         if form.is_valid():
-            # Iterate through each answer we received, and create/update corresponding QuestionAnswer objects.
-            answers = []
-            for name, data in form.cleaned_data.items():
-                if name == 'photo-capture':
-                    continue
-
-                try:
-                    vers = version_lookup[name]
-                except KeyError:
-                    continue # Submitted a question that doesn't exist? Ignore
-
-                n = question_number[vers.question.id]
-                helper = vers.helper()
-                answer = helper.to_jsonable(data)
-
-                if name in answer_lookup:
-                    # Have an existing QuestionAnswer: update only if answer has changed.
-                    ans = answer_lookup[name]
-                    if helper.unchanged_answer(ans.answer, answer):
-                        pass  # autosave breaks the "unchanged answer" logic by saving outside the students' view
-                        #if not autosave:
-                        #   messages.add_message(request, messages.INFO, 'Question #%i answer unchanged from previous submission.' % (n,))
-                    else:
-                        ans.modified_at = datetime.datetime.now()
-                        ans.answer = answer
-                        ans.save()
-                        answers.append(ans)
-                        #if not autosave:
-                        #    messages.add_message(request, messages.INFO, 'Question #%i answer saved.' % (n,))
-                        LogEntry(userid=request.user.username, description='submitted quiz question %i' % (vers.question.id),
-                                 related_object=ans).save()
-
-                else:
-                    # No existing QuestionAnswer: create one.
-                    ans = QuestionAnswer(question=vers.question, question_version=vers, student=member)
-                    ans.modified_at = datetime.datetime.now()
-                    ans.answer = answer
-                    ans.save()
-                    answers.append(ans)
-                    #if not autosave:
-                    #    messages.add_message(request, messages.INFO, 'Question #%i answer saved.' % (n,))
-                    LogEntry(userid=request.user.username, description='submitted quiz question %i' % (vers.question.id),
-                             related_object=ans).save()
-
+            changed = _changed_answers(form.cleaned_data, version_lookup, answer_lookup)
+            answers = _save_answers(request, member, changed)
             QuizSubmission.create(request=request, quiz=quiz, student=member, answers=answers, autosave=autosave)
             if request.POST.get('honour-code', None):
                 request.session[honour_code_key] = True
@@ -226,6 +188,110 @@ def _index_student(request: HttpRequest, offering: CourseOffering, activity: Act
     return render(request, 'quizzes/index_student.html', context=context)
 
 
+def _changed_answers(cleaned_data: dict, version_lookup: dict, answer_lookup: dict,
+                     pending: Optional[dict] = None) -> List[Tuple[QuestionVersion, Optional[QuestionAnswer], dict]]:
+    """
+    Find the submitted answers that differ from the student's current answers (including any pending auto-saved
+    answers, keyed by QuestionVersion.id). Returns (QuestionVersion, existing QuestionAnswer or None, answer) triples.
+    """
+    changed = []
+    for name, data in cleaned_data.items():
+        if name == 'photo-capture':
+            continue
+
+        try:
+            vers = version_lookup[name]
+        except KeyError:
+            continue # Submitted a question that doesn't exist? Ignore
+
+        helper = vers.helper()
+        answer = helper.to_jsonable(data)
+        ans = answer_lookup.get(name, None)
+        if pending and vers.id in pending:
+            prev_answer = pending[vers.id]
+        elif ans is not None:
+            prev_answer = ans.answer
+        else:
+            prev_answer = None
+
+        # autosave breaks the "unchanged answer" logic by saving outside the students' view, so no messages about it
+        if prev_answer is not None and helper.unchanged_answer(prev_answer, answer):
+            continue
+        changed.append((vers, ans, answer))
+
+    return changed
+
+
+def _save_answers(request: HttpRequest, member: Member,
+                  changed: List[Tuple[QuestionVersion, Optional[QuestionAnswer], dict]]) -> List[QuestionAnswer]:
+    """
+    Create/update the QuestionAnswers for these answers, as found by _changed_answers.
+    """
+    answers = []
+    for vers, ans, answer in changed:
+        if ans is None:
+            ans = QuestionAnswer(question=vers.question, question_version=vers, student=member)
+        ans.modified_at = datetime.datetime.now()
+        ans.answer = answer
+        ans.save()
+        answers.append(ans)
+        LogEntry(userid=request.user.username, description='submitted quiz question %i' % (vers.question.id),
+                 related_object=ans).save()
+    return answers
+
+
+@requires_course_by_slug
+def autosave(request: HttpRequest, course_slug: str, activity_slug: str) -> HttpResponse:
+    """
+    Auto-save of the student's quiz form. With settings.QUIZ_AUTOSAVE_MODE == 'delta', the changed answers are recorded
+    as a QuizAutosave and written to the QuestionAnswers later.
+    """
+    if request.method != 'POST' or request.member.role != 'STUD':
+        raise Http404()
+    activity = get_object_or_404(Activity, slug=activity_slug, offering__slug=course_slug, group=False)
+    quiz = get_object_or_404(Quiz, activity=activity)
+    member = request.member
+
+    start, end = quiz.get_start_end(member)
+    now = datetime.datetime.now()
+    if start > now or end + datetime.timedelta(seconds=quiz.grace) < now:
+        return JsonResponse({'status': 'closed'})
+
+    questions = Question.objects.filter(quiz=quiz)
+    answers = list(QuestionAnswer.objects.filter(question__in=questions, student=member))
+    answer_lookup = {a.question.ident(): a for a in answers}
+    versions = QuestionVersion.select(quiz=quiz, questions=questions, student=member, answers=answers)
+    version_lookup = {v.question.ident(): v for v in versions}
+
+    form = StudentForm(data=request.POST, files=request.FILES)
+    form.fields = OrderedDict(
+        (v.question.ident(), v.entry_field(student=member, questionanswer=answer_lookup.get(v.question.ident(), None)))
+        for v in versions
+    )
+    if not form.is_valid():
+        error_data = {k: str(v) for k, v in form.errors.items()}  # pre-render the errors
+        return JsonResponse({'status': 'error', 'errors': error_data})
+
+    if settings.QUIZ_AUTOSAVE_MODE == 'full':
+        changed = _changed_answers(form.cleaned_data, version_lookup, answer_lookup)
+        answers = _save_answers(request, member, changed)
+        QuizSubmission.create(request=request, quiz=quiz, student=member, answers=answers, autosave=True)
+        return JsonResponse({'status': 'ok'})
+
+    pending = QuizAutosave.pending_answers(quiz, member)
+    changed = _changed_answers(form.cleaned_data, version_lookup, answer_lookup, pending)
+    # uploaded files have to be stored now: those answers are saved as usual
+    file_answers = _save_answers(request, member, [(v, ans, answer) for v, ans, answer in changed if '_file' in answer])
+    deltas = [(v, ans, answer) for v, ans, answer in changed if '_file' not in answer]
+    QuizAutosave.create(request=request, quiz=quiz, student=member,
+                        answers=deltas + [(a.question_version, a, a.answer) for a in file_answers])
+    if not settings.USE_CELERY:
+        # no periodic task to apply the answers, so do it now
+        QuizAutosave.apply_pending(quiz=quiz, student=member)
+
+    return JsonResponse({'status': 'ok'})
+
+
 def _student_review(request: HttpRequest, offering: CourseOffering, activity: Activity, quiz: Quiz) -> HttpResponse:
     member = request.member
     assert member.role == 'STUD'
@@ -258,6 +324,9 @@ def _student_review(request: HttpRequest, offering: CourseOffering, activity: Ac
     if today > review_cutoff and quiz.review in ['answers', 'all']:
         quiz.review = 'marks'
 
+    if quiz.review in ['all', 'answers', 'marks']:
+        prefetch_markup_html([v for v in versions if v.review[0]], 'review_html')
+
     context = {
         'offering': offering,
         'activity': activity,
@@ -637,6 +706,7 @@ def submissions(request: HttpRequest, course_slug: str, activity_slug: str) -> H
     offering = get_object_or_404(CourseOffering, slug=course_slug)
     activity = get_object_or_404(Activity, slug=activity_slug, offering=offering, group=False)
     quiz = get_object_or_404(Quiz, activity=activity)
+    QuizAutosave.apply_pending(quiz=quiz)
     questions = Question.objects.filter(quiz=quiz)
 
     answers = QuestionAnswer.objects.filter(question__in=questions) \
@@ -662,6 +732,7 @@ def _setup_download(request: HttpRequest, course_slug: str, activity_slug: str):
     offering = get_object_or_404(CourseOffering, slug=course_slug)
     activity = get_object_or_404(Activity, slug=activity_slug, offering=offering, group=False)
     quiz = get_object_or_404(Quiz, activity=activity)
+    QuizAutosave.apply_pending(quiz=quiz)
     questions = Question.objects.filter(quiz=quiz)
     versions = QuestionVersion.objects.filter(question__in=questions)
     version_number_lookup = {  # version_number_lookup[question_id][version_id] == version_number
@@ -758,6 +829,7 @@ def view_submission(request: HttpRequest, course_slug: str, activity_slug: str,
     quiz = get_object_or_404(Quiz, activity=activity)
     questions = Question.objects.filter(quiz=quiz)
     member = get_object_or_404(Member, ~Q(role='DROP'), find_member(userid), offering__slug=course_slug)
+    QuizAutosave.apply_pending(quiz=quiz, student=member)
     answers = QuestionAnswer.objects.filter(student=member, question__in=questions).select_related('question')
     versions = QuestionVersion.select(quiz=quiz, questions=questions, student=member, answers=answers)
 
@@ -821,8 +893,7 @@ def strange_history(request: HttpRequest, course_slug: str, activity_slug: str)
     questions = Question.all_objects.filter(quiz=quiz)
     versions = QuestionVersion.all_objects.filter(question__in=questions)
 
-    quiz_submissions = QuizSubmission.objects.filter(quiz=quiz).select_related('student__person').order_by('student')
-    quiz_submissions = list(quiz_submissions)
+    quiz_submissions = quiz_submission_history(quiz)
     [qs.annotate_questions(questions, versions) for qs in quiz_submissions]
 
     # one student, multiple IP addresses
@@ -889,7 +960,7 @@ def submission_history(request: HttpRequest, course_slug: str, activity_slug: st
     questions = Question.all_objects.filter(quiz=quiz).select_related('quiz').prefetch_related('versions')
     versions = QuestionVersion.all_objects.filter(question__in=questions)
     member = get_object_or_404(Member, ~Q(role='DROP'), find_member(userid), offering__slug=course_slug)
-    quiz_submissions = QuizSubmission.objects.filter(quiz=quiz, student=member)
+    quiz_submissions = quiz_submission_history(quiz, student=member)
     [qs.annotate_questions(questions, versions) for qs in quiz_submissions]
 
     context = {
@@ -1028,6 +1099,7 @@ def marking(request: HttpRequest, course_slug: str, activity_slug: str) -> HttpR
     offering = get_object_or_404(CourseOffering, slug=course_slug)
     activity = get_object_or_404(Activity, slug=activity_slug, offering=offering, group=False)
     quiz = get_object_or_404(Quiz, activity=activity)
+    QuizAutosave.apply_pending(quiz=quiz)
     questions = Question.objects.filter(quiz=quiz)
     versions = QuestionVersion.objects.filter(question__quiz=quiz)
     components = ActivityComponent.objects.filter(numeric_activity_id=quiz.activity_id, deleted=False)
@@ -1039,11 +1111,17 @@ def marking(request: HttpRequest, course_slug: str, activity_slug: str) -> HttpR
 
     if request.method == 'POST' and 'automark' in request.POST:
         # clicked the 'auto-mark' button
-        n = quiz.automark_all(user=request.user)
-        messages.add_message(request, messages.SUCCESS, 'Automarked %i answers.' % (n,))
-        LogEntry(userid=request.user.username,
-                 description='automarked quiz %s' % (quiz.id),
-                 related_object=quiz).save()
+        if settings.USE_CELERY:
+            # large classes take a while: let the task work in the background and report progress
+            start_automark(quiz.id)
+            automark_quiz.delay(quiz.id, request.user.username)
+            messages.add_message(request, messages.SUCCESS, 'Automarking started: refresh this page to see progress.')
+        else:
+            n = quiz.automark_all(user=request.user)
+            messages.add_message(request, messages.SUCCESS, 'Automarked %i answers.' % (n,))
+            LogEntry(userid=request.user.username,
+                     description='automarked quiz %s' % (quiz.id),
+                     related_object=quiz).save()
         return redirect('offering:quiz:marking', course_slug=offering.slug, activity_slug=activity.slug)
 
     # collect existing marks for tally
@@ -1100,6 +1178,7 @@ def marking(request: HttpRequest, course_slug: str, activity_slug: str) -> HttpR
         'question_marks': question_marks,
         'student_mark_data': student_mark_data,
         'automark': automark,
+        'automark_progress': automark_progress(quiz.id),
     }
     return render(request, 'quizzes/marking.html', context=context)
 
@@ -1133,6 +1212,7 @@ def mark_next(request: HttpRequest, course_slug: str, activity_slug: str,
     offering = get_object_or_404(CourseOffering, slug=course_slug)
     activity = get_object_or_404(Activity, slug=activity_slug, offering=offering, group=False)
     quiz = get_object_or_404(Quiz, activity=activity)
+    QuizAutosave.apply_pending(quiz=quiz)
     component_lookup = quiz.activitycomponents_by_question()
     if not activity.quiz_marking():
         raise MarkingNotConfiguredError
@@ -1198,6 +1278,7 @@ def mark_student(request: HttpRequest, course_slug: str, activity_slug: str, mem
     offering = get_object_or_404(CourseOffering, slug=course_slug)
     activity = get_object_or_404(Activity, slug=activity_slug, offering=offering, group=False)
     quiz = get_object_or_404(Quiz, activity=activity)
+    QuizAutosave.apply_pending(quiz=quiz)
     member = get_object_or_404(Member, id=member_id, offering=offering)
     answers = QuestionAnswer.objects.filter(question__quiz=quiz, student=member)
     questions = Question.objects.filter(quiz=quiz)
@@ -1314,6 +1395,8 @@ def mark_student(request: HttpRequest, course_slug: str, activity_slug: str, mem
     # enumerate versions of each question, so we know if the "next version n" button is relevant
     num_versions_lookup = {q_id: len(list(versions)) for q_id, versions in itertools.groupby(all_versions, key=lambda v: v.question_id)}
 
+    prefetch_markup_html([v for v in versions if v.marking[0]], 'marking_html')
+
     # data struct with all the per-question stuff needed
     version_form_answers = [
         (v,
@@ -9,6 +9,7 @@ from courselib.slugs import make_slug
 from grad.models import Scholarship
 from courselib.text import normalize_newlines
 from courselib.storage import UploadedFileStorage, upload_path
+from dashboard.pdfcache import remove_cached_pdfs
 from django.template.loader import get_template
 from django.core.mail import EmailMultiAlternatives
 from django.conf import settings
@@ -1503,3 +1504,7 @@ class SemesterConfig(models.Model):
     def set_end_date(self, date):
         self.config['end_date'] = date.strftime('%Y-%m-%d')
 
+
+# cached PDFs (see dashboard/pdfcache.py) are out of date when the request changes
+models.signals.post_save.connect(remove_cached_pdfs, sender=RARequest)
+models.signals.post_delete.connect(remove_cached_pdfs, sender=RARequest)
@@ -22,6 +22,8 @@ from tacontracts.models import TAContract
 from ta.models import TAContract as OldTAContract
 from log.models import LogEntry
 from dashboard.letters import ra_form, ra_paf, FASOfficialLetter, OfficialLetter, LetterContents
+from dashboard.models import Signature
+from dashboard.pdfcache import cached_pdf, pdf_response
 from django import forms
 from django.db import transaction
 from django.http import HttpResponse, HttpRequest
@@ -960,13 +962,12 @@ def edit_request_notes(request: HttpRequest, ra_slug: str) -> HttpResponse:
         noteform = RARequestNoteForm(instance=req)
     return render(request, 'ra/admin/edit_request_notes.html', {'noteform': noteform, 'req':req, 'status': req.status()})
 
-@requires_role(["FUND", "FDMA"])
-def request_offer_letter(request: HttpRequest, ra_slug: str) -> HttpResponse:
-    queryset = RARequest.objects.filter(Q(backdated=False) | Q(hiring_category__in=['GRAS']))
-    req = _manage_req(request, ra_slug, queryset) 
-    response = HttpResponse(content_type="application/pdf")
-    response['Content-Disposition'] = 'inline; filename="%s-letter.pdf"' % (req.slug)
-    letter = FASOfficialLetter(response)
+def _offer_letter_inputs(req):
+    return [req, req.supervisor, req.unit, list(Signature.objects.filter(user=req.supervisor))]
+
+@cached_pdf('ra_offer_letter', _offer_letter_inputs)
+def _offer_letter_pdf(req, outfile):
+    letter = FASOfficialLetter(outfile)
     from_name_lines = [req.supervisor.letter_name(), req.unit.name]
     to_addr_lines = [req.get_legal_name(), req.unit.name]
     extra_signature_prompt = None
@@ -988,14 +989,19 @@ def request_offer_letter(request: HttpRequest, ra_slug: str) -> HttpResponse:
         signer=req.supervisor,
         cosigner_lines=[req.get_cosigner_line(), req.get_legal_name()])
     contents.add_paragraphs(["Dear " + req.get_legal_name()])
+    contents.add_paragraphs(req.letter_paragraphs())
+    letter.add_letter(contents)
+    letter.write()
+
+@requires_role(["FUND", "FDMA"])
+def request_offer_letter(request: HttpRequest, ra_slug: str) -> HttpResponse:
+    queryset = RARequest.objects.filter(Q(backdated=False) | Q(hiring_category__in=['GRAS']))
+    req = _manage_req(request, ra_slug, queryset) 
     try:
-        contents.add_paragraphs(req.letter_paragraphs())
+        return pdf_response(request, _offer_letter_pdf, (req,), '%s-letter.pdf' % (req.slug))
     except ValueError as e:
         messages.error(request, f'Could not render letter. Error was: {e}')
         return HttpResponseRedirect(reverse('ra:request_offer_letter_update', kwargs={'ra_slug': req.slug}))
-    letter.add_letter(contents)
-    letter.write()
-    return response
 
 # for offer letters
 @requires_role(["FUND", "FDMA"])
@@ -1,21 +1,20 @@
-import threading
-import zipfile
-import tempfile
 import os
 import errno
+import glob
 import io
 import csv
 from shlex import quote
 from datetime import datetime
-from typing import List
-
 from wsgiref.util import FileWrapper
+
+from django.conf import settings
 from django.http import StreamingHttpResponse
 
 from .base import SubmissionComponent, Submission, StudentSubmission, GroupSubmission, SubmittedComponent
 from coredata.models import Person
 from groups.models import GroupMember
 from courselib.branding import help_email
+from courselib.zipstream import ZipStream
 
 from .url import URL
 from .archive import Archive
@@ -330,46 +329,83 @@ class SubmissionInfo(object):
             self.get_most_recent_components()
             compsub = self.components_and_submitted()
 
-        handle, filename = tempfile.mkstemp('.zip')
-        os.close(handle)
-        z = zipfile.ZipFile(filename, 'w')
-
+        z = ZipStream()
         self._add_to_zip(z, self.activity, compsub, self.submissions[0].created_at,
                 slug=self.submissions[0].file_slug(), multi=multi)
 
-        z.close()
-
-        file = open(filename, 'rb')
-        response = StreamingHttpResponse(FileWrapper(file), content_type='application/zip')
+        response = StreamingHttpResponse(z, content_type='application/zip')
         response['Content-Disposition'] = 'attachment; filename="%s_%s.zip"' % (
                 self.submissions[0].file_slug(), self.activity.slug)
-        try:
-            os.remove(filename)
-        except OSError:
-            pass
-
         return response
 
     def generate_activity_zip(self):
         """
-        Create ZIP file for this activity
+        Create ZIP file for this activity: served from the archive cache if nothing has changed since it was last
+        built, or streamed to the client as it's built (and cached) otherwise.
+        """
+        content, size = self.activity_zip_content()
+
+        response = StreamingHttpResponse(content, content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename="%s.zip"' % (self.activity.slug)
+        if size is not None:
+            response['Content-Length'] = size
+        return response
+
+    def _cached_archives(self):
+        """
+        Paths of the cached archives for this activity, most recent first.
         """
-        handle, filename = tempfile.mkstemp('.zip')
-        os.close(handle)
+        pattern = os.path.join(settings.SUBMISSION_ARCHIVE_CACHE_PATH, '%i-*.zip' % (self.activity.id,))
+        archives = []
+        for p in glob.glob(pattern):
+            try:
+                archives.append((os.stat(p).st_mtime, p))
+            except FileNotFoundError:
+                # removed by a concurrent download that just replaced it
+                pass
+        archives.sort(reverse=True)
+        return [p for _, p in archives]
+
+    def activity_zip_content(self):
+        """
+        Content of the ZIP file for this activity, as a pair of (iterable of bytes, size or None).
 
-        z = zipfile.ZipFile(filename, 'w')
+        The archive cache is keyed by the fingerprint of the archive's entries (i.e. the most-recent SubmittedComponents
+        and their files). If there's no archive with this fingerprint, it's built as it's streamed, copying any
+        unchanged entries from the last archive built for this activity.
+        """
+        self.get_all_components()
+        z = ZipStream()
         self.generate_submission_contents(z, prefix='')
-        z.close()
 
-        file = open(filename, 'rb')
-        response = StreamingHttpResponse(FileWrapper(file), content_type='application/zip')
-        response['Content-Disposition'] = 'attachment; filename="%s.zip"' % (self.activity.slug)
+        cache_dir = settings.SUBMISSION_ARCHIVE_CACHE_PATH
+        path = os.path.join(cache_dir, '%i-%s.zip' % (self.activity.id, z.fingerprint()))
         try:
-            os.remove(filename)
-        except OSError:
+            fh = open(path, 'rb')
+        except FileNotFoundError:
             pass
+        else:
+            os.utime(path) # recently used: see submission.tasks.warm_submission_archives
+            return FileWrapper(fh), os.fstat(fh.fileno()).st_size
+
+        os.makedirs(cache_dir, exist_ok=True)
+        previous = self._cached_archives()
+        if previous:
+            z.reuse(previous[0])
+
+        def content():
+            yield from z.save_as(path)
+            # the new archive replaces any older ones for this activity (but a concurrent download may have built the
+            # same one first, so leave that)
+            for p in previous:
+                if p == path:
+                    continue
+                try:
+                    os.remove(p)
+                except FileNotFoundError:
+                    pass
 
-        return response
+        return content(), None
 
     @staticmethod
     def _add_to_zip(zipf, activity, components_and_submitted, created_at, prefix='', slug=None, multi=False):
@@ -430,18 +466,9 @@ class SubmissionInfo(object):
 
         return found, individual_subcomps, last_submission
 
-    @staticmethod
-    def hash_all(subcomps: List[SubmittedComponent]):
-        """
-        Calculate the hash of all files, discarding the results. Calling this should pre-fetch files from disk, in an
-        effort to speed up building the .zip.
-        """
-        for sc in subcomps:
-            sc.file_hash()
-
     def generate_submission_contents(self, z, prefix='', always_summary=True):
         """
-        Assemble submissions and put in ZIP file.
+        Assemble submissions and put in ZIP file (a zipfile.ZipFile or courselib.zipstream.ZipStream).
         """
         self.ensure_components()
         assert self.submissions is not None
@@ -456,14 +483,8 @@ class SubmissionInfo(object):
         # get SubmittedComponents and metadata
         found, individual_subcomps, last_submission = self.most_recent_submissions()
 
-        # start a thread to pre-fetch the second half of the files
-        subcomps_items = list(individual_subcomps.items())
-        all_subcomps = [sc for _, subcomps in subcomps_items for _, sc in subcomps]
-        t = threading.Thread(target=self.hash_all, args=(all_subcomps[len(all_subcomps)//2:],))
-        t.start()
-
-        # Now add them to the ZIP
-        for slug, subcomps in subcomps_items:
+        # Now add them to the ZIP (a ZipStream reads ahead the files as it's streamed)
+        for slug, subcomps in individual_subcomps.items():
             lastsub = last_submission[slug]
             p = os.path.join(prefix, slug)
             self._add_to_zip(z, self.activity, subcomps, lastsub.created_at,
@@ -1,6 +1,13 @@
+import datetime
+import os
+import time
 from typing import List
+
+from django.conf import settings
+
 from courselib.celerytasks import task
 from grades.models import Activity
+from submission.models import SubmissionInfo, select_all_components
 from submission.models.base import SimilarityResult
 from submission.moss import run_moss, MOSSError
 
@@ -16,3 +23,32 @@ def run_moss_task(activity_id: int, activity_ids: List[int], language: str, resu
         result.config['error'] = str(e)
         result.config['extra'] = getattr(e, 'extra', None)
         result.save()
+
+
+@task(queue='batch')
+def warm_submission_archives():
+    """
+    Build the "all submissions" archives for activities whose due date has just passed, so they're in the archive
+    cache when the instructor/TAs download them. Also remove archives that haven't been used in a while.
+    """
+    now = datetime.datetime.now()
+    activities = Activity.objects.filter(due_date__lte=now, due_date__gt=now - datetime.timedelta(hours=1),
+                                         deleted=False)
+    for activity in activities:
+        if select_all_components(activity):
+            warm_submission_archive.delay(activity.id)
+
+    cache_dir = settings.SUBMISSION_ARCHIVE_CACHE_PATH
+    if os.path.isdir(cache_dir):
+        cutoff = time.time() - settings.SUBMISSION_ARCHIVE_CACHE_AGE * 86400
+        for entry in os.scandir(cache_dir):
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+
+
+@task(queue='batch')
+def warm_submission_archive(activity_id: int):
+    activity = Activity.objects.get(id=activity_id)
+    content, _ = SubmissionInfo.for_activity(activity).activity_zip_content()
+    for _ in content:
+        pass
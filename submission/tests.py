@@ -1,7 +1,8 @@
 #from django.test import TestCase
 from django.test import TestCase
 
-from submission.models import URL, Archive, Code, StudentSubmission, select_all_components, ALL_TYPE_CLASSES
+from submission.models import URL, Archive, Code, StudentSubmission, SubmissionInfo, select_all_components, \
+    ALL_TYPE_CLASSES
 from submission.models.code import SubmittedCode
 from submission.forms import filetype
 from grades.models import NumericActivity, Activity
@@ -9,10 +10,12 @@ from groups.models import Group, GroupMember
 from coredata.tests import create_offering, validate_content
 from coredata.models import Member, Person, CourseOffering
 from django.urls import reverse
+from django.core.files.base import ContentFile
 from courselib.testing import Client, test_views, basic_page_tests, TEST_COURSE_SLUG
-import datetime, tempfile, os
+import datetime, tempfile, os, zipfile
 
 import base64, io
+from unittest import mock
 TGZ_FILE = base64.b64decode('H4sIAI7Wr0sAA+3OuxHCMBAE0CtFJUjoVw8BODfQP3bgGSKIcPResjO3G9w9/i9vRmt7ltnzZx6ilNrr7PVS9vscbUTKJ/wWr8fzuqYUy3pbvu1+9QAAAAAAAAAAAHCiNyHUDpAAKAAA')
 GZ_FILE = base64.b64decode('H4sICIjWr0sAA2YAAwAAAAAAAAAAAA==')
 ZIP_FILE = base64.b64decode('UEsDBAoAAAAAAMB6fDwAAAAAAAAAAAAAAAABABwAZlVUCQADiNavSzTYr0t1eAsAAQToAwAABOgDAABQSwECHgMKAAAAAADAenw8AAAAAAAAAAAAAAAAAQAYAAAAAAAAAAAApIEAAAAAZlVUBQADiNavS3V4CwABBOgDAAAE6AMAAFBLBQYAAAAAAQABAEcAAAA7AAAAAAA=')
@@ -290,6 +293,49 @@ class SubmissionTest(TestCase):
         code.code.open()
         self.assertEqual(code.code.read(), codecontents)
         code.code.close()
+
+        with tempfile.TemporaryDirectory() as cache_dir, self.settings(SUBMISSION_ARCHIVE_CACHE_PATH=cache_dir):
+            # download all submissions: streamed ZIP with the file and summary
+            client.login_user("ggbaker")
+            url = reverse('offering:submission:download_activity_files', kwargs={'course_slug': course.slug, 'activity_slug': a1.slug})
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            zipdata = b''.join(response.streaming_content)
+            z = zipfile.ZipFile(io.BytesIO(zipdata))
+            names = z.namelist()
+            self.assertIn('summary.csv', names)
+            codefile = [n for n in names if n.startswith('0aaa0/')]
+            self.assertEqual(len(codefile), 1)
+            self.assertEqual(z.read(codefile[0]), codecontents)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+            # nothing has changed: served from the archive cache
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(int(response['Content-Length']), len(zipdata))
+            self.assertEqual(b''.join(response.streaming_content), zipdata)
+
+            # another submission: rebuilt, replacing the old archive
+            sub2 = StudentSubmission(activity=a1, member=Member.objects.get(offering=course, person__userid=userid2))
+            sub2.save()
+            code2 = SubmittedCode(submission=sub2, component=c)
+            code2.code.save('code2.py', ContentFile(b'print(2)\n'), save=False)
+            code2.save()
+            response = client.get(url)
+            zipdata2 = b''.join(response.streaming_content)
+            z = zipfile.ZipFile(io.BytesIO(zipdata2))
+            self.assertEqual(z.read(codefile[0]), codecontents)
+            self.assertEqual(len([n for n in z.namelist() if n.startswith('0aaa1/')]), 1)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+            # a concurrent first download built this archive between our cache check and the build: it isn't removed
+            # as one of the old archives
+            archive = os.listdir(cache_dir)[0]
+            with mock.patch('submission.models.open', side_effect=FileNotFoundError, create=True):
+                content, _ = SubmissionInfo.for_activity(a1).activity_zip_content()
+            self.assertEqual(b''.join(content), zipdata2)
+            self.assertEqual(os.listdir(cache_dir), [archive])
             
     def test_pages(self):
         "Test a bunch of page views"
@@ -9,6 +9,7 @@ from courselib.json_fields import getter_setter
 from courselib.slugs import make_slug
 from autoslug import AutoSlugField
 import decimal, datetime, uuid
+from collections import namedtuple
 from numbers import Number
 from dashboard.models import NewsItem
 from django.urls import reverse
@@ -25,6 +26,7 @@ from . import bu_rules
 from django.utils import timezone
 from tacontracts.models import HiringSemester
 from dashboard.letters import ta_evaluation_form
+from dashboard.pdfcache import remove_cached_pdfs
 
 LAB_BONUS_DECIMAL = decimal.Decimal('0.17')
 LAB_BONUS = float(LAB_BONUS_DECIMAL)
@@ -617,6 +619,8 @@ class TAPosting(models.Model):
         super(TAPosting, self).save(*args, **kwargs)
         key = self.html_cache_key()
         cache.delete(key)
+        cache.delete(posting_totals_cache_key(self.id))
+        self._totals = None
 
     def short_str(self):
         return "%s %s" % (self.unit.label, self.semester)
@@ -675,6 +679,19 @@ class TAPosting(models.Model):
         strategy = bu_rules.get_bu_strategy( self.semester, self.unit )
         return strategy( self, offering, count )
 
+    def totals(self):
+        """
+        The PostingTotals for this posting: cached, and invalidated when contracts/assignments/applications change.
+        """
+        if getattr(self, '_totals', None) is None:
+            key = posting_totals_cache_key(self.id)
+            totals = cache.get(key)
+            if totals is None:
+                totals = PostingTotals(self)
+                cache.set(key, totals, 24*3600)
+            self._totals = totals
+        return self._totals
+
     def required_bu(self, offering, count=None):
         if self.unit.label in ["CMPT", "COMP"] and self.semester.name >= "1231":
             """
@@ -688,11 +705,11 @@ class TAPosting(models.Model):
             """
             default = self.default_bu(offering, count=count)
             extra = offering.extra_bu()        
-            tacourses = TACourse.objects.filter(contract__posting=self, course=offering).exclude(contract__status__in=['REJ', 'CAN'])
+            ta_count = self.ta_count(offering)
             if offering.flags.write:
-                return default + extra + CMPT_WCOURSE_BU + decimal.Decimal((CMPT_COURSE_BU + LAB_BONUS_DECIMAL) * len(tacourses)) 
+                return default + extra + CMPT_WCOURSE_BU + decimal.Decimal((CMPT_COURSE_BU + LAB_BONUS_DECIMAL) * ta_count) 
             else:                
-                return default + extra + decimal.Decimal((CMPT_COURSE_BU + LAB_BONUS_DECIMAL)* len(tacourses)) 
+                return default + extra + decimal.Decimal((CMPT_COURSE_BU + LAB_BONUS_DECIMAL)* ta_count) 
         else:
             """
                 Actual BUs to assign to this course: default + extra + 0.17*number of TA's
@@ -701,8 +718,7 @@ class TAPosting(models.Model):
             extra = offering.extra_bu()
 
             if offering.labtas():
-                tacourses = TACourse.objects.filter(contract__posting=self, course=offering).exclude(contract__status__in=['REJ', 'CAN'])
-                return default + extra + decimal.Decimal(LAB_BONUS_DECIMAL * len(tacourses)) 
+                return default + extra + decimal.Decimal(LAB_BONUS_DECIMAL * self.ta_count(offering)) 
             else:
                 return default + extra
 
@@ -724,48 +740,32 @@ class TAPosting(models.Model):
         """
         BUs already assigned to this course
         """
-        total = decimal.Decimal(0)
-        tacourses = TACourse.objects.filter(contract__posting=self, course=offering).exclude(contract__status__in=['REJ', 'CAN']).select_related('course__semester', 'contract__posting__unit')
-        if(tacourses.count() > 0):
-            total = sum([t.total_bu for t in tacourses])
-        return decimal.Decimal(total)
+        return self.totals().offering(offering.id).bu
 
     def applicant_count(self, offering):
         """
         Number of people who have applied to TA this offering
         """
-        prefs = CoursePreference.objects.filter(app__posting=self, app__late=False, course=offering.course).exclude(rank=0)
-        return prefs.count()
+        return self.totals().applicants.get(offering.course_id, 0)
     
     def ta_count(self, offering):
         """
         Number of people who have assigned to be TA for this offering
         """
-        tacourses = TACourse.objects.filter(contract__posting=self, course=offering).exclude(contract__status__in=['REJ', 'CAN'])
-        return tacourses.count()
+        return self.totals().offering(offering.id).ta_count
     
     def total_pay(self, offering):
         """
         Payments for all tacourses associated with this offering 
         """
-        total = 0
-        tacourses = TACourse.objects.filter(course=offering, contract__posting=self).exclude(contract__status__in=['REJ', 'CAN'])
-        for course in tacourses:
-            total += course.pay()
-        return total
+        return self.totals().offering(offering.id).pay
     
     def all_total(self):
         """
         BU's and Payments for all tacourses associated with all offerings 
         """
-        pay = 0
-        bus = 0
-        tac = TAContract.objects.filter(posting=self).exclude(status__in=['REJ', 'CAN']).count()
-        tacourses = TACourse.objects.filter(contract__posting=self).exclude(contract__status__in=['REJ', 'CAN'])
-        for course in tacourses:
-            pay += course.pay()
-            bus += course.total_bu
-        return (bus, pay, tac)
+        totals = self.totals()
+        return (totals.bu, totals.pay, totals.contract_count)
     
     def html_cache_key(self):
         return "taposting-offertext-html-" + str(self.id)
@@ -1332,3 +1332,86 @@ class TAContractEmailText(models.Model):
 
     def __str__(self):
         return "TA contract acceptance text for %s" % self.unit.label.upper()
+
+
+def posting_totals_cache_key(posting_id):
+    return "taposting-totals-" + str(posting_id)
+
+
+OfferingTotals = namedtuple('OfferingTotals', ['ta_count', 'bu', 'pay'])
+NO_OFFERING_TOTALS = OfferingTotals(0, decimal.Decimal(0), decimal.Decimal(0))
+
+
+class PostingTotals(object):
+    """
+    BUs, pay, and TA/applicant counts for every offering in a TAPosting, built from a few queries (instead of several
+    for each offering). Get it with TAPosting.totals().
+
+    .offerings: offering_id -> OfferingTotals, for assignments on contracts that aren't rejected/cancelled.
+    .applicants: course_id -> number of (non-late) applicants ranking the course.
+    .applications: application_id -> ([offering names], total BU) for assignments on active contracts.
+    .contract_courses: contract_id -> [(offering label, total BU)] for all contracts.
+    .bu, .pay, .contract_count: totals for the posting.
+    """
+    def __init__(self, posting):
+        self.offerings = {}
+        self.applications = {}
+        self.contract_courses = {}
+        self.bu = decimal.Decimal(0)
+        self.pay = decimal.Decimal(0)
+
+        tacourses = TACourse.objects.filter(contract__posting=posting).order_by('id') \
+            .select_related('course__semester', 'contract__posting__unit', 'description')
+        for tc in tacourses:
+            offering = tc.course
+            total_bu = tc.total_bu
+            label = offering.subject + " " + offering.number + " " + offering.section
+            self.contract_courses.setdefault(tc.contract_id, []).append((label, total_bu))
+            if tc.contract.status in ['REJ', 'CAN']:
+                continue
+
+            pay = tc.pay()
+            ta_count, bu, offering_pay = self.offerings.get(tc.course_id, NO_OFFERING_TOTALS)
+            self.offerings[tc.course_id] = OfferingTotals(ta_count + 1, bu + total_bu, offering_pay + pay)
+
+            names, app_bu = self.applications.get(tc.contract.application_id, ([], decimal.Decimal(0)))
+            self.applications[tc.contract.application_id] = (names + [offering.name()], app_bu + total_bu)
+
+            self.bu += total_bu
+            self.pay += pay
+
+        self.contract_count = TAContract.objects.filter(posting=posting).exclude(status__in=['REJ', 'CAN']).count()
+
+        prefs = CoursePreference.objects.filter(app__posting=posting, app__late=False).exclude(rank=0) \
+            .values('course_id').annotate(count=models.Count('id')).order_by()
+        self.applicants = {p['course_id']: p['count'] for p in prefs}
+
+    def offering(self, offering_id):
+        return self.offerings.get(offering_id, NO_OFFERING_TOTALS)
+
+
+def clear_posting_totals(sender, instance, **kwargs):
+    """
+    Signal handler: changes to these objects invalidate the cached PostingTotals.
+    """
+    if isinstance(instance, TACourse):
+        posting_ids = [instance.contract.posting_id]
+    elif isinstance(instance, (TAContract, TAApplication)):
+        posting_ids = [instance.posting_id]
+    elif isinstance(instance, CoursePreference):
+        posting_ids = [instance.app.posting_id]
+    elif isinstance(instance, CourseDescription):
+        posting_ids = TAPosting.objects.filter(unit_id=instance.unit_id).values_list('id', flat=True)
+    else:
+        return
+    cache.delete_many([posting_totals_cache_key(pid) for pid in posting_ids])
+
+for model in [TACourse, TAContract, TAApplication, CoursePreference, CourseDescription]:
+    models.signals.post_save.connect(clear_posting_totals, sender=model)
+    models.signals.post_delete.connect(clear_posting_totals, sender=model)
+
+
+# cached PDFs of these (see dashboard/pdfcache.py) are out of date when they change
+for model in [TAContract, TUG, TAEvaluation]:
+    models.signals.post_save.connect(remove_cached_pdfs, sender=model)
+    models.signals.post_delete.connect(remove_cached_pdfs, sender=model)
@@ -1,6 +1,6 @@
 from django.test import TestCase
 from courselib.testing import basic_page_tests, Client, test_views, TEST_COURSE_SLUG, freshen_roles
-from ta.models import CourseDescription, TAPosting, TAApplication, TAContract, CampusPreference, CoursePreference, TUG
+from ta.models import CourseDescription, TAPosting, TAApplication, TAContract, TACourse, CampusPreference, CoursePreference, TUG
 from coredata.models import Person, Semester, Unit, CourseOffering, Course, Role, Member
 from ra.models import Account
 from django.urls import reverse
@@ -140,3 +140,40 @@ class ApplicationTest(TestCase):
 
 
 
+
+    def test_posting_totals(self):
+        post = TAPosting.objects.filter(unit__label='CMPT')[0]
+        tacourses = TACourse.objects.filter(contract__posting=post).exclude(contract__status__in=['REJ', 'CAN'])
+        self.assertTrue(tacourses.exists())
+
+        # totals agree with per-offering calculations
+        for tc in tacourses:
+            o = tc.course
+            assigned = TACourse.objects.filter(contract__posting=post, course=o).exclude(contract__status__in=['REJ', 'CAN'])
+            self.assertEqual(post.ta_count(o), assigned.count())
+            self.assertEqual(post.assigned_bu(o), sum(t.total_bu for t in assigned))
+            self.assertEqual(post.total_pay(o), sum(t.pay() for t in assigned))
+        bu, pay, count = post.all_total()
+        self.assertEqual(bu, sum(t.total_bu for t in tacourses))
+        self.assertEqual(count, TAContract.objects.filter(posting=post).exclude(status__in=['REJ', 'CAN']).count())
+
+        # changing an assignment invalidates the cached totals
+        tc = tacourses[0]
+        before = TAPosting.objects.get(id=post.id).assigned_bu(tc.course)
+        tc.bu += 1
+        tc.save()
+        self.assertEqual(TAPosting.objects.get(id=post.id).assigned_bu(tc.course), before + 1)
+
+        # cancelling the contract removes it from the totals
+        contract = tc.contract
+        contract.status = 'CAN'
+        contract.save()
+        self.assertEqual(TAPosting.objects.get(id=post.id).all_total()[2], count - 1)
+
+        c = Client()
+        c.login_user('dzhao')
+        test_views(self, c, 'ta:', ['view_financial', 'all_contracts'], {'post_slug': post.slug})
+        for view in ['download_financial', 'download_assign', 'generate_csv', 'generate_csv_detail',
+                     'contracts_table_csv']:
+            response = c.get(reverse('ta:' + view, kwargs={'post_slug': post.slug}))
+            self.assertEqual(response.status_code, 200)
@@ -26,7 +26,9 @@ from ta.forms import TUGForm, TAApplicationForm, TAContractForm, TAAcceptanceFor
     TAEvaluationForm, TAEvaluationFormbyTA, TAAcceptTermsForm
 from advisornotes.forms import StudentSearchForm
 from log.models import LogEntry
-from dashboard.letters import ta_form, ta_forms, tug_form, taworkload_form, ta_evaluation_form
+from dashboard.letters import ta_form, tug_form, taworkload_form, ta_evaluation_form
+from dashboard.bulkpdf import bulk_pdf_response
+from dashboard.pdfcache import pdf_response
 from django.forms.models import inlineformset_factory
 from django.forms.formsets import formset_factory
 from django.core.paginator import Paginator, EmptyPage, InvalidPage
@@ -37,7 +39,7 @@ import json
 from . import bu_rules
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import never_cache
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 from formtools.wizard.views import SessionWizardView
 from django.core.mail import EmailMultiAlternatives
 from django.conf import settings
@@ -671,11 +673,8 @@ def download_tug(request, course_slug, userid):
         else:
             new_format = False
 
-        response = HttpResponse(content_type="application/pdf")        
         filename = "%s_%s_%s_TUG_%s.pdf" % (tug.member.person.last_name, tug.member.person.first_name , tug.member.person.emplid, course_slug)
-        response['Content-Disposition'] = 'inline; filename="%s"' % (filename)
-        tug_form(tug, contract_info, new_format, response)
-        return response
+        return pdf_response(request, tug_form, (tug, contract_info, new_format), filename)
 
 def _email_tug(tug, contract_info):         
     # Email TA and Admin when instructor submit the TUG     
@@ -997,11 +996,8 @@ def download_ta_evaluation(request, course_slug, userid):
     if curr_user_role=="TA" and (not userid==request.user.username or not taevaluation.is_past_nextsemstart() or taevaluation.draft):
         return ForbiddenResponse(request)
        
-    response = HttpResponse(content_type="application/pdf")    
     filename = "%s_%s_%s_TAEval_%s.pdf" % (member.person.last_name, member.person.first_name , member.person.emplid, course_slug)
-    response['Content-Disposition'] = 'inline; filename="%s"' % (filename)
-    ta_evaluation_form(taevaluation, member, course, response)
-    return response
+    return pdf_response(request, ta_evaluation_form, (taevaluation, member, course), filename)
 
 @_requires_course_staff_or_admin_by_slug
 def edit_ta_evaluation_by_ta(request, course_slug, userid):
@@ -1624,6 +1620,24 @@ def view_postings(request):
             }
     return render(request, 'ta/view_postings.html', context) 
 
+def _assignments_by_offering(tacourses):
+    """
+    Group TACourses by offering id, omitting those whose contract has no BUs (in one pass, instead of calling
+    contract.bu() for each).
+    """
+    tacourses = list(tacourses)
+    contract_bu = defaultdict(decimal.Decimal)
+    for crs in tacourses:
+        if crs.contract.status not in ('CAN', 'REJ'):
+            contract_bu[crs.contract_id] += crs.bu
+
+    assignments = defaultdict(list)
+    for crs in tacourses:
+        if contract_bu[crs.contract_id] > 0:
+            assignments[crs.course_id].append(crs)
+    return assignments
+
+
 @requires_role("TAAD")
 def assign_tas(request, post_slug):
     posting = get_object_or_404(TAPosting, slug=post_slug, unit__in=request.units)
@@ -1634,8 +1648,9 @@ def assign_tas(request, post_slug):
 
     # decorate offerings with currently-assigned TAs
     all_assignments = TACourse.objects.filter(contract__posting=posting).select_related('course', 'contract__application__person', 'course__semester')
+    assignments = _assignments_by_offering(all_assignments)
     for o in all_offerings:
-        o.assigned = [crs for crs in all_assignments if crs.course_id == o.id and crs.contract.bu() > 0]
+        o.assigned = assignments.get(o.id, [])
     
     # ignore excluded courses
     excl = set(posting.excluded())
@@ -1655,10 +1670,13 @@ def download_assign_csv(request, post_slug):
     all_offerings = CourseOffering.objects.filter(semester=posting.semester, owner=posting.unit).exclude(component='CAN')
 
     # decorate offerings with currently-assigned TAs
-    all_assignments = TACourse.objects.filter(contract__posting=posting).select_related('course',
-                                                                                        'contract__application__person')
+    all_assignments = TACourse.objects.filter(contract__posting=posting).select_related('course__semester',
+                                                                                        'contract__application__person',
+                                                                                        'contract__posting__unit',
+                                                                                        'description')
+    assignments = _assignments_by_offering(all_assignments)
     for o in all_offerings:
-        o.assigned = [crs for crs in all_assignments if crs.course == o and crs.contract.bu() > 0]        
+        o.assigned = assignments.get(o.id, [])
 
     # ignore excluded courses
     excl = set(posting.excluded())
@@ -1913,6 +1931,17 @@ def assign_bus(request, post_slug, course_slug):
                'applications': applicants, 'LAB_BONUS': LAB_BONUS}
     return render(request, 'ta/assign_bu.html', context) 
 
+def _decorate_contract_courses(posting, contracts):
+    """
+    Set .crs_list (the courses, with BUs) and .bu_total (same as .total_bu()) on each contract, from the posting's totals.
+    """
+    contract_courses = posting.totals().contract_courses
+    for contract in contracts:
+        courses = contract_courses.get(contract.id, [])
+        contract.crs_list = ''.join(label + " (" + str(bu) + ")\n" for label, bu in courses)
+        contract.bu_total = sum((bu for _, bu in courses), decimal.Decimal(0)) if contract.status not in ('CAN', 'REJ') else 0
+
+
 @requires_role("TAAD")
 def all_contracts(request, post_slug):
     #name, appointment category, rank, deadline, status. Total BU, Courses TA-ing , view/edit
@@ -1982,12 +2011,9 @@ def all_contracts(request, post_slug):
 
     
     # Create a list of courses that this TA is assigned to. 
+    contracts = contracts.select_related('application__person', 'posting')
+    _decorate_contract_courses(posting, contracts)
     for contract in contracts:
-        crs_list = ''
-        courses = TACourse.objects.filter(contract=contract)
-        for course in courses:
-            crs_list += course.course.subject+" "+course.course.number+" "+course.course.section+" ("+str(course.total_bu)+")\n"
-        contract.crs_list = crs_list
         if contract.status == 'ACC' and contract.config.get('accepted_date') is not None:            
             contract.accrej_date = datetime.datetime.fromisoformat(contract.config.get('accepted_date'))
         if contract.status == 'REJ' and contract.config.get('rejected_date') is not None:
@@ -2004,13 +2030,8 @@ def contracts_table_csv(request, post_slug):
     # The contracts_csv view is actually a payroll upload file, with way more fields.  This one is basically
     # the exact same as all_contracts, but in CSV format.
     posting = get_object_or_404(TAPosting, slug=post_slug, unit__in=request.units)
-    contracts = TAContract.objects.filter(posting=posting)
-    for contract in contracts:
-        crs_list = ''
-        courses = TACourse.objects.filter(contract=contract)
-        for course in courses:
-            crs_list += course.course.subject+" "+course.course.number+" "+course.course.section+" ("+str(course.total_bu)+")\n"
-        contract.crs_list = crs_list
+    contracts = TAContract.objects.filter(posting=posting).select_related('application__person')
+    _decorate_contract_courses(posting, contracts)
     response = HttpResponse(content_type='text/csv')
     response['Content-Disposition'] = 'inline; filename="%s-table.csv"' % (posting.slug)
     writer = csv.writer(response)
@@ -2033,7 +2054,7 @@ def contracts_table_csv(request, post_slug):
             statusdate = datetime.datetime.fromisoformat(c.config.get('rejected_date')).strftime("%Y/%m/%d")
 
         writer.writerow([c.application.person, c.application.person.email(), citizen, c.get_appt_category_display() + '(' + c.appt_category + ')',
-                         c.application.rank, c.get_status_display(), statusdate, c.total_bu(), c.crs_list, c.deadline])
+                         c.application.rank, c.get_status_display(), statusdate, c.bu_total, c.crs_list, c.deadline])
     return response
 
 
@@ -2229,21 +2250,15 @@ def view_contract(request, post_slug, userid):
 def view_form(request, post_slug, userid):
     posting = get_object_or_404(TAPosting, slug=post_slug, unit__in=request.units)
     contract = get_object_or_404(TAContract, posting=posting, application__person__userid=userid)
-    response = HttpResponse(content_type="application/pdf")
     filename =  "%s_%s_%s_%s.pdf" % (contract.application.person.last_name, contract.application.person.first_name , 
                                                                               contract.application.person.emplid, posting.slug)
-    response['Content-Disposition'] = 'inline; filename="%s"' % (filename)
-    ta_form(contract, response)
-    return response
+    return pdf_response(request, ta_form, (contract,), filename)
 
 @requires_role("TAAD")
 def contracts_forms(request, post_slug):
     posting = get_object_or_404(TAPosting, slug=post_slug, unit__in=request.units)
     contracts = TAContract.objects.filter(posting=posting, status__in=['ACC', 'SGN']).order_by('application__person__last_name', 'application__person__first_name')
-    response = HttpResponse(content_type="application/pdf")
-    response['Content-Disposition'] = 'inline; filename="%s.pdf"' % (posting.slug)
-    ta_forms(contracts, response)
-    return response
+    return bulk_pdf_response(request, 'ta', contracts, '%s.pdf' % (posting.slug))
 
 @requires_role("TAAD")
 def new_contract(request, post_slug):
@@ -2642,7 +2657,8 @@ def generate_csv(request, post_slug):
     off = ['']*16 + [str(CAMPUSES_SHORTENED[o.campus]) for o in offerings]
     csvWriter.writerow(off)
     
-    apps = TAApplication.objects.filter(posting=posting).order_by('person')
+    assigned = posting.totals().applications
+    apps = TAApplication.objects.filter(posting=posting).order_by('person').select_related('person')
     for app in apps:
         rank = 'R%d' % app.rank
         system_program = ''
@@ -2673,17 +2689,13 @@ def generate_csv(request, post_slug):
             elif cp.pref == 'WIL':
                 campuspref += cp.campus[0].lower()
 
-        # Get all TAContracts that match this posting and application, then the matching TACourses
-        # so we can find out if a course/courses have been assigned to this TA
+        # The courses (and BUs) that have been assigned to this TA on non-cancelled contracts
 
         assigned_courses = ''
         assigned_bus = ''
-        ta_contracts = TAContract.objects.filter(posting=posting, application=app).exclude(status__in=['CAN', 'REJ'])
-        if len(ta_contracts) > 0:
-            ta_courses = TACourse.objects.filter(contract__in=ta_contracts)
-            if len(ta_courses) > 0:
-                assigned_courses = ', '.join([tacourse.course.name() for tacourse in ta_courses])
-                assigned_bus = sum([t.total_bu for t in ta_courses])
+        if app.id in assigned:
+            names, assigned_bus = assigned[app.id]
+            assigned_courses = ', '.join(names)
 
         supervisorlist = app.coursys_supervisor_display()
         row = [rank, app.person.sortname(), app.person.emplid, app.person.email(), app.category, app.get_current_program_display(), system_program, status, app.supervisor, supervisorlist, unit, startsem,
@@ -2752,7 +2764,8 @@ def generate_csv_detail(request, post_slug):
     # collect all campus preferences in a sensible way
     allcp = CampusPreference.objects.filter(app__posting=posting)
     
-    apps = TAApplication.objects.filter(posting=posting).order_by('person')
+    assigned = posting.totals().applications
+    apps = TAApplication.objects.filter(posting=posting).order_by('person').select_related('person')
     for app in apps:
         rank = 'R%d' % app.rank
         
@@ -2796,17 +2809,13 @@ def generate_csv_detail(request, post_slug):
                 elif cp.pref == 'WIL':
                     campuspref += cp.campus[0].lower()
 
-        # Get all TAContracts that match this posting and application, then the matching TACourses
-        # so we can find out if a course/courses have been assigned to this TA
+        # The courses (and BUs) that have been assigned to this TA on non-cancelled contracts
 
         assigned_courses = ''
         assigned_bus = ''
-        ta_contracts = TAContract.objects.filter(posting=posting, application=app).exclude(status__in=['CAN', 'REJ'])
-        if len(ta_contracts) > 0:
-            ta_courses = TACourse.objects.filter(contract__in=ta_contracts).select_related('course')
-            if len(ta_courses) > 0:
-                assigned_courses = ', '.join([tacourse.course.name() for tacourse in ta_courses])
-                assigned_bus = sum([t.total_bu for t in ta_courses])
+        if app.id in assigned:
+            names, assigned_bus = assigned[app.id]
+            assigned_courses = ', '.join(names)
 
         supervisorlist = app.coursys_supervisor_display()
                 
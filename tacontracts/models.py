@@ -15,6 +15,7 @@ from courselib.storage import UploadedFileStorage, upload_path
 from grad.models import GradStudent
 from ra.models import Account
 from dashboard.models import NewsItem
+from dashboard.pdfcache import remove_cached_pdfs
 
 
 CONTRACT_STATUS_CHOICES = (
@@ -752,3 +753,8 @@ class TAContractAttachment(models.Model):
     def hide(self):
         self.hidden = True
         self.save()
+
+
+# cached PDFs of the contract (see dashboard/pdfcache.py) are out of date when it changes
+models.signals.post_save.connect(remove_cached_pdfs, sender=TAContract)
+models.signals.post_delete.connect(remove_cached_pdfs, sender=TAContract)
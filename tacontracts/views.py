@@ -23,7 +23,9 @@ from .models import HiringSemester, TACategory, TAContract, TACourse, \
                     EmailReceipt, NoPreviousSemesterException, CourseDescription, TAContractAttachment
 from .forms import HiringSemesterForm, TACategoryForm, TAContractForm, \
                     TACourseForm, EmailForm, CourseDescriptionForm, TAContracttAttachmentForm
-from dashboard.letters import tacontract_form, tacontract_forms
+from dashboard.letters import tacontract_form
+from dashboard.bulkpdf import bulk_pdf_response
+from dashboard.pdfcache import pdf_response
 
 locale.setlocale(locale.LC_ALL, 'en_CA.UTF-8')
 
@@ -565,11 +567,7 @@ def print_contract(request, unit_slug, semester, contract_slug):
                                             kwargs={'unit_slug': unit_slug,
                                                     'semester': semester,
                                                     'contract_slug': contract_slug}))
-    response = HttpResponse(content_type="application/pdf")
-    response['Content-Disposition'] = 'inline; filename="%s-%s.pdf"' % \
-                                        (contract.slug, contract.person.userid)
-    tacontract_form(contract, response)
-    return response
+    return pdf_response(request, tacontract_form, (contract,), '%s-%s.pdf' % (contract.slug, contract.person.userid))
 
 
 @requires_role(["TAAD", "GRAD"])
@@ -593,10 +591,8 @@ def print_all_contracts(request, unit_slug, semester):
         return HttpResponseRedirect(reverse('tacontracts:list_all_contracts',
                                             kwargs={'unit_slug': unit_slug,
                                                     'semester': semester,}))
-    response = HttpResponse(content_type="application/pdf")
-    response['Content-Disposition'] = 'inline; filename="tacontracts-%s-%s.pdf"' % (hiring_semester, unit_slug)
-    tacontract_forms(contracts, response)
-    return response
+    return bulk_pdf_response(request, 'tacontract', contracts,
+                             'tacontracts-%s-%s.pdf' % (hiring_semester, unit_slug))
 
 
 
@@ -828,11 +824,7 @@ def ta_print_contract(request, semester, contract_slug):
                                  person__userid=request.user.username,
                                  slug=contract_slug)
 
-    response = HttpResponse(content_type="application/pdf")
-    response['Content-Disposition'] = 'inline; filename="%s-%s.pdf"' % \
-                                        (contract.slug, request.user.username)
-    tacontract_form(contract, response)
-    return response
+    return pdf_response(request, tacontract_form, (contract,), '%s-%s.pdf' % (contract.slug, request.user.username))
 
 
 @requires_role(["TAAD", "GRAD"])